@@ -23,7 +23,6 @@
 
 import numpy as np
 from scipy.sparse import coo_matrix
-import scipy.linalg as spl
 #import numexpr as ne # the dependency on this modul can be avoided by replacing
 #                       # logsumexp_ne and exp_ne with logsumexp and np.exp
 
@@ -32,7 +31,7 @@ def VB_diarization(X, m, iE, w, V, sp=None, q=None,
                    maxSpeakers = 10, maxIters = 10,
                    epsilon = 1e-4, loopProb = 0.99, statScale = 1.0,
                    alphaQInit = 1.0, downsample = None, VtiEV = None, ref=None,
-                   plot=False, sparsityThr=0.001, llScale=1.0, minDur=1):
+                   plot=False, sparsityThr=0.001, llScale=1.0, minDur=1, beam=None):
 
   """
   This a generalized version of speaker diarization described in:
@@ -71,10 +70,15 @@ def VB_diarization(X, m, iE, w, V, sp=None, q=None,
   downsample  - perform diarization on input downsampled by this factor
   VtiEV       - C x (R**2+R)/2 matrix normally calculated by VB_diarization when
                 VtiEV is None. However, it can be pre-calculated using function
-                precalculate_VtiEV(V) and used across calls of VB_diarization.
+                precalculate_VtiEV(V, iE) and used across calls of VB_diarization.
   minDur      - minimum number of frames between speaker turns imposed by linear
                 chains of HMM states corresponding to each speaker. All the states
                 in a chain share the same output distribution
+  beam        - if not None, after each iteration the speakers whose posterior
+                is below exp(-beam) in every frame are left out of the
+                forward-backward of the following iterations. This only
+                changes the result in the iteration where a speaker is first
+                left out, as its prior is then re-estimated as 0.
   ref         - T dim. integer vector with reference speaker ID (0:maxSpeakers)
                 per frame
   plot        - if set to True, plot per-frame speaker posteriors.
@@ -125,15 +129,14 @@ def VB_diarization(X, m, iE, w, V, sp=None, q=None,
   print('Sparsity: ', len(NN.row), float(len(NN.row))/np.prod(NN.shape))
   LL = np.sum(G) # total log-likelihod as calculated using UBM
 
-  mixture_sum = coo_matrix((np.ones(C*D), (np.repeat(range(C),D), range(C*D))), shape=(C, C*D))
-
   #G = np.sum((NN.multiply(ll - np.log(w))).toarray(), 1) + Kx  # eq. (15) # Aleready calculated above
 
   # Calculate per-frame first order statistics projected into the R-dim. subspace
-  # V^T \Sigma^{-1} F_m
-  F_s = coo_matrix((((X[NN.row]-m[NN.col])*NN.data[:,np.newaxis]).flat,
+  # V^T \Sigma^{-1} F_m. The sparse statistics are scaled by \Sigma^{-1}, which
+  # is cheaper than scaling the R x C*D matrix V.
+  F_s = coo_matrix((((X[NN.row]-m[NN.col])*(NN.data[:,np.newaxis]*iE[NN.col])).flat,
                    (NN.row.repeat(D), NN.col.repeat(D)*D+np.tile(range(D), len(NN.col)))), shape=(nframes, D*C))
-  VtiEF = F_s.tocsr().dot((iE.flat * V).T) ; del F_s
+  VtiEF = F_s.tocsr().dot(V.T) ; del F_s
   ## The code above is only efficient implementation of the following comented code
   #VtiEF = 0;
   #for ii in range(C):
@@ -154,35 +157,34 @@ def VB_diarization(X, m, iE, w, V, sp=None, q=None,
   if ref is not None:
     Li[-1] += [DER(downsampler.T.dot(q), ref), DER(downsampler.T.dot(q), ref, xentropy=True)]
 
-  lls = np.zeros_like(q)
-  tr = np.eye(minDur*maxSpeakers, k=1)
-  ip = np.zeros(minDur*maxSpeakers)
+  active = None # speakers included in forward-backward; see 'beam'
   for ii in range(maxIters):
     L = 0 # objective function (37) (i.e. VB lower-bound on the evidence)
     Ns =   NN.T.dot(q).T                             # bracket in eq. (34) for all 's'
     VtNsiEV_flat = Ns.astype(VtiEV.dtype).dot(VtiEV) # eq. (34) except for 'I' for all 's'
     VtiEFs = q.T.dot(VtiEF)                          # eq. (35) except for \Lambda_s^{-1} for all 's'
-    for sid in range(maxSpeakers):
-        invL = np.linalg.inv(np.eye(R) + tril_to_sym(VtNsiEV_flat[sid])) # eq. (34) inverse
-        a = invL.dot(VtiEFs[sid])                                        # eq. (35)
-        # eq. (29) except for the prior term \ln \pi_s. Our prior is given by HMM
-        # trasition probability matrix. Instead of eq. (30), we need to use
-        # forward-backwar algorithm to calculate per-frame speaker posteriors,
-        # where 'lls' plays role of HMM output log-probabilities
-        lls[:,sid] = G + VtiEF.dot(a) - 0.5 * NN.dot(mixture_sum.dot(((invL+np.outer(a,a)).astype(V.dtype).dot(V) * (iE.flat * V)).sum(0)))
-        L += 0.5 * (logdet(invL) - np.sum(np.diag(invL) + a**2, 0) + R)
-
-    # Construct transition probability matrix with linear chain of 'minDur'
-    # states for each of 'maxSpeaker' speaker. The last state in each chain has
-    # self-loop probability 'loopProb' and the transition probabilities to the
-    # initial chain states given by vector '(1-loopProb) * sp'. From all other,
-    #states, one must move to the next state in the chain with probability one.
-    tr[minDur-1::minDur,0::minDur]=(1-loopProb)*sp
-    tr[(np.arange(1,maxSpeakers+1)*minDur-1,)*2] += loopProb
-    ip[::minDur]=sp
+    invL = np.linalg.inv(np.eye(R) + tril_to_sym(VtNsiEV_flat)) # eq. (34) inverse for all 's'
+    a = np.einsum('srt,st->sr', invL, VtiEFs)                    # eq. (35) for all 's'
+    # eq. (29) except for the prior term \ln \pi_s. Our prior is given by HMM
+    # trasition probability matrix. Instead of eq. (30), we need to use
+    # forward-backwar algorithm to calculate per-frame speaker posteriors,
+    # where 'lls' plays role of HMM output log-probabilities.
+    # The per-component traces tr((invL + a a^T) V_c^T iE_c V_c) are obtained
+    # from the lower triangles stored in VtiEV, so we never form the
+    # R x C*D products with V.
+    traces = VtiEV.dot(sym_to_tril(invL + a[:,:,np.newaxis]*a[:,np.newaxis,:]).astype(VtiEV.dtype).T)
+    lls = G[:,np.newaxis] + VtiEF.dot(a.T) - 0.5 * NN.dot(traces)
+    L += 0.5 * np.sum(logdet(invL) - np.diagonal(invL, axis1=1, axis2=2).sum(1) - (a**2).sum(1) + R)
+
+    # The HMM has a linear chain of 'minDur' states for each of 'maxSpeaker'
+    # speaker. The last state in each chain has self-loop probability 'loopProb'
+    # and the transition probabilities to the initial chain states given by
+    # vector '(1-loopProb) * sp'. From all other, states, one must move to the
+    # next state in the chain with probability one (see forward_backward_chains
+    # for the equivalent transition matrix).
     # per-frame HMM state posteriors. Note that we can have linear chain of minDur states
     # for each speaker.
-    q, tll, lf, lb = forward_backward(lls.repeat(minDur,axis=1), tr, ip) #, np.arange(1,maxSpeakers+1)*minDur-1)
+    q, tll, lf, lb = forward_backward_chains(lls, sp, loopProb, minDur, active)
 
     # Right after updating q(Z), tll is E{log p(X|,Y,Z)} - KL{q(Z)||p(Z)}.
     # L now contains -KL{q(Y)||p(Y)}. Therefore, L+ttl is correct value for ELBO.
@@ -197,6 +199,8 @@ def VB_diarization(X, m, iE, w, V, sp=None, q=None,
     # per-frame speaker posteriors (analogue to eq. (30)), obtained by summing
     # HMM state posteriors corresponding to each speaker
     q = q.reshape(len(q),maxSpeakers,minDur).sum(axis=2)
+    if beam is not None:
+      active = q.max(0) >= min(np.exp(-beam), q.max())
 
 
     # if reference is provided, report DER, cross-entropy and plot the figures
@@ -308,18 +312,29 @@ def exp_ne(x, out=None):
     return ne.evaluate("exp(x)", out=None)
 
 
-# Convert vector with lower-triangular coefficients into symetric matrix
+# Convert vector with lower-triangular coefficients into symetric matrix.
+# A stack of such vectors (... x (R**2+R)/2) gives a stack of matrices.
 def tril_to_sym(tril):
-    R = np.sqrt(len(tril)*2).astype(int)
+    R = np.sqrt(tril.shape[-1]*2).astype(int)
     tril_ind = np.tril_indices(R)
-    S = np.empty((R,R))
-    S[tril_ind]       = tril
-    S[tril_ind[::-1]] = tril
+    S = np.empty(tril.shape[:-1] + (R,R))
+    S[..., tril_ind[0], tril_ind[1]] = tril
+    S[..., tril_ind[1], tril_ind[0]] = tril
     return S
 
 
+# Inverse of tril_to_sym for the purpose of computing traces: returns the
+# lower-triangular coefficients of (a stack of) symetric matrices, with the
+# off-diagonal ones doubled, so that sym_to_tril(A).dot(B_tril) equals
+# np.sum(A * tril_to_sym(B_tril)).
+def sym_to_tril(S):
+    tril_ind = np.tril_indices(S.shape[-1])
+    return S[..., tril_ind[0], tril_ind[1]] * np.where(tril_ind[0] == tril_ind[1], 1.0, 2.0)
+
+
+# Log-determinant of (a stack of) symetric positive definite matrices.
 def logdet(A):
-    return 2*np.sum(np.log(np.diag(spl.cholesky(A))))
+    return 2*np.sum(np.log(np.diagonal(np.linalg.cholesky(A), axis1=-2, axis2=-1)), -1)
 
 
 def forward_backward(lls, tr, ip):
@@ -351,3 +366,112 @@ def forward_backward(lls, tr, ip):
     tll = logsumexp(lfw[-1])
     sp = np.exp(lfw + lbw - tll)
     return sp, tll, lfw, lbw
+
+
+def forward_backward_chains(lls, sp, loopProb, minDur, active=None):
+    """
+    Structured version of forward_backward for the HMM used in VB_diarization,
+    i.e. it returns the same as
+        tr = np.eye(minDur*S, k=1)
+        tr[minDur-1::minDur,0::minDur] = (1-loopProb)*sp
+        tr[(np.arange(1,S+1)*minDur-1,)*2] += loopProb
+        ip = np.zeros(minDur*S); ip[::minDur] = sp
+        forward_backward(lls.repeat(minDur,axis=1), tr, ip)
+    but only visits the non-zero transitions: the next state in the chain,
+    the self-loop of the last state and the transitions from the last states
+    to the first states. This makes each frame O(S*minDur) instead of
+    O((S*minDur)**2).
+    Inputs:
+        lls      - T x S matrix of per-frame log speaker output probabilities
+                   (shared by all the states in the speaker's chain)
+        sp       - S dimensional vector of speaker priors
+        loopProb - self-loop probability of the last state in each chain
+        minDur   - number of states in each chain
+        active   - if not None, S dimensional boolean vector; the chains of the
+                   other speakers are left out of the HMM (as if their prior
+                   were 0), and their posteriors are 0.
+    Outputs:
+        as forward_backward, with S*minDur states. The chains of speakers with
+        zero prior can't be reached, so they are always left out; their
+        backward log probabilities are -inf rather than the (unused) values
+        forward_backward would give.
+    """
+    nframes, S = lls.shape
+    active = sp > 0 if active is None else np.logical_and(active, sp > 0)
+    if not np.all(active):
+      q, tll, lf, lb = forward_backward_chains(lls[:,active], sp[active], loopProb, minDur)
+      sp_full = np.zeros((nframes, S, minDur))
+      lfw = np.full((nframes, S, minDur), -np.inf)
+      lbw = np.full((nframes, S, minDur), -np.inf)
+      sp_full[:,active] = q.reshape(nframes, -1, minDur)
+      lfw[:,active] = lf.reshape(nframes, -1, minDur)
+      lbw[:,active] = lb.reshape(nframes, -1, minDur)
+      return (sp_full.reshape(nframes, S*minDur), tll,
+              lfw.reshape(nframes, S*minDur), lbw.reshape(nframes, S*minDur))
+
+    lentry = np.log((1-loopProb)*sp) # last state of any chain -> first states
+    lloop = np.log(loopProb)         # self-loop of the last states
+    lip = np.log(sp)
+    lls = lls[:,:,np.newaxis]
+    lfw = np.empty((nframes, S, minDur))
+    lbw = np.empty((nframes, S, minDur))
+    lfw[:] = -np.inf
+    lbw[:] = -np.inf
+    lfw[0,:,0] = lls[0,:,0] + lip
+    lbw[-1] = 0.0
+
+    for ii in range(1,nframes):
+        prev, cur = lfw[ii-1], lfw[ii]
+        cur[:,0] = np.logaddexp.reduce(prev[:,-1]) + lentry
+        cur[:,1:] = prev[:,:-1]
+        cur[:,-1] = np.logaddexp(cur[:,-1], prev[:,-1] + lloop)
+        cur += lls[ii]
+
+    for ii in reversed(range(nframes-1)):
+        nxt, cur = lbw[ii+1] + lls[ii+1], lbw[ii]
+        cur[:,:-1] = nxt[:,1:]
+        cur[:,-1] = np.logaddexp(np.logaddexp.reduce(nxt[:,0] + lentry), nxt[:,-1] + lloop)
+
+    lfw = lfw.reshape(nframes, S*minDur)
+    lbw = lbw.reshape(nframes, S*minDur)
+    tll = logsumexp(lfw[-1])
+    sp = np.exp(lfw + lbw - tll)
+    return sp, tll, lfw, lbw
+
+
+# Compares forward_backward_chains with forward_backward on random
+# log-likelihoods, and times both. Returns the largest differences of the
+# posteriors and of the total log-likelihoods, and the two run times.
+def compare_forward_backward(nframes, maxSpeakers, minDur, loopProb=0.9, numZeroPriors=0, seed=0):
+    import time
+    rng = np.random.RandomState(seed)
+    lls = rng.randn(nframes, maxSpeakers) * 5
+    sp = rng.dirichlet(np.ones(maxSpeakers))
+    sp[maxSpeakers-numZeroPriors:] = 0.0
+    sp = sp / sp.sum()
+    tr = np.eye(minDur*maxSpeakers, k=1)
+    tr[minDur-1::minDur,0::minDur] = (1-loopProb)*sp
+    tr[(np.arange(1,maxSpeakers+1)*minDur-1,)*2] += loopProb
+    ip = np.zeros(minDur*maxSpeakers)
+    ip[::minDur] = sp
+    with np.errstate(divide='ignore', invalid='ignore'):
+      start_time = time.time()
+      q_dense, tll_dense, _, _ = forward_backward(lls.repeat(minDur,axis=1), tr, ip)
+      dense_time = time.time() - start_time
+      start_time = time.time()
+      q, tll, _, _ = forward_backward_chains(lls, sp, loopProb, minDur)
+      chains_time = time.time() - start_time
+    return np.abs(q - q_dense).max(), abs(tll - tll_dense), dense_time, chains_time
+
+
+if __name__ == "__main__":
+    # Checks that the structured forward-backward gives the same result as
+    # the dense one, and reports their speed.
+    for nframes, maxSpeakers, minDur, numZeroPriors in [(1, 3, 2, 0), (7, 3, 1, 1), (10000, 10, 1, 0),
+                                                        (10000, 10, 1, 6), (10000, 10, 5, 0), (10000, 15, 10, 0)]:
+      q_diff, tll_diff, dense_time, chains_time = compare_forward_backward(
+          nframes, maxSpeakers, minDur, numZeroPriors=numZeroPriors)
+      assert q_diff < 1e-6 and tll_diff < 1e-6 * nframes, (q_diff, tll_diff)
+      print('frames={} speakers={} minDur={} zero-priors={}: max posterior diff {:.2g}, '
+            'tll diff {:.2g}, dense {:.3f}s, chains {:.3f}s'.format(
+                nframes, maxSpeakers, minDur, numZeroPriors, q_diff, tll_diff, dense_time, chains_time))
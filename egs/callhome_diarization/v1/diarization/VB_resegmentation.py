@@ -12,6 +12,7 @@ import numpy as np
 import VB_diarization
 import kaldi_io
 import argparse
+import multiprocessing
 from convert_VB_model import load_dubm, load_ivector_extractor 
 
 def get_utt_list(utt2spk_filename):
@@ -43,7 +44,21 @@ def get_utt2feats(utt2feats_filename):
         utt2feats[line_split[0]] = line_split[1]
     return utt2feats
 
-def create_ref(uttname, utt2num_frames, full_rttm_filename):
+# prepare utt2segments dictionary from the rttm file, so that the file is read
+# once rather than once per utterance. The segments of each utterance are kept
+# as [start_time, duration, spkname] lists in file order.
+def get_utt2segments(full_rttm_filename):
+    utt2segments = {}
+    with open(full_rttm_filename, 'r') as fh:
+        content = fh.readlines()
+    for line in content:
+        line = line.strip('\n')
+        line_split = line.split()
+        utt2segments.setdefault(line_split[1], []).append(
+            [line_split[3], line_split[4], line_split[7]])
+    return utt2segments
+
+def create_ref(uttname, utt2num_frames, utt2segments):
     num_frames = utt2num_frames[uttname]
 
     # We use 0 to denote silence frames and 1 to denote overlapping frames.
@@ -51,17 +66,9 @@ def create_ref(uttname, utt2num_frames, full_rttm_filename):
     speaker_dict = {}
     num_spk = 0
 
-    with open(full_rttm_filename, 'r') as fh:
-        content = fh.readlines()
-    for line in content:
-        line = line.strip('\n')
-        line_split = line.split()
-        uttname_line = line_split[1]
-        if uttname != uttname_line:
-            continue
-        start_time, duration = int(float(line_split[3]) * 100), int(float(line_split[4]) * 100)
+    for start, dur, spkname in utt2segments.get(uttname, []):
+        start_time, duration = int(float(start) * 100), int(float(dur) * 100)
         end_time = start_time + duration
-        spkname = line_split[7]
         if spkname not in speaker_dict.keys():
             spk_idx = num_spk + 2
             speaker_dict[spkname] = spk_idx
@@ -108,6 +115,83 @@ def create_rttm_output(uttname, predicted_label, output_dir, channel):
             fh.write("SPEAKER {} {} {:.2f} {:.2f} <NA> <NA> {} <NA> <NA>\n".format(uttname, channel, start_frame / 100.0, duration / 100.0, label))
     return 0
 
+# Runs VB resegmentation on one utterance and writes its rttm file. 'model' is
+# the dictionary created in main() with the UBM parameters (m, iE, w), the
+# eigenvoices (V) and the cached VtiEV. Returns False if the utterance was
+# skipped.
+def diarize_utterance(utt, model, args, utt2num_frames, utt2segments, feats_dict):
+    # Get the alignments from the clustering result.
+    # In init_ref, 0 denotes the silence silence frames
+    # 1 denotes the overlapping speech frames, the speaker
+    # label starts from 2.
+    init_ref = create_ref(utt, utt2num_frames, utt2segments)
+
+    # load MFCC features
+    X = kaldi_io.read_mat(feats_dict[utt]).astype(np.float64)
+    assert len(init_ref) == len(X)
+
+    # Keep only the voiced frames (0 denotes the silence 
+    # frames, 1 denotes the overlapping speech frames).
+    mask = (init_ref >= 2)
+    X_voiced = X[mask]
+    init_ref_voiced = init_ref[mask] - 2
+
+    if X_voiced.shape[0] == 0:
+        print("Warning: {} has no voiced frames in the initialization file".format(utt))
+        return False
+
+    # Initialize the posterior of each speaker based on the clustering result.
+    if args.initialize:
+        q = VB_diarization.frame_labels2posterior_mx(init_ref_voiced, args.max_speakers)
+    else:
+        q = None
+    
+    # VB resegmentation
+
+    # q  - S x T matrix of posteriors attribution each frame to one of S possible
+    #      speakers, where S is given by opts.maxSpeakers
+    # sp - S dimensional column vector of ML learned speaker priors. Ideally, these
+    #      should allow to estimate # of speaker in the utterance as the
+    #      probabilities of the redundant speaker should converge to zero.
+    # Li - values of auxiliary function (and DER and frame cross-entropy between q
+    #      and reference if 'ref' is provided) over iterations.
+    q_out, sp_out, L_out = VB_diarization.VB_diarization(X_voiced, model['m'], model['iE'], model['w'], model['V'], sp=None, q=q, maxSpeakers=args.max_speakers, maxIters=args.max_iters, VtiEV=model['VtiEV'],
+                              downsample=args.downsample, alphaQInit=args.alphaQInit, sparsityThr=args.sparsityThr, epsilon=args.epsilon, minDur=args.minDur,
+                              loopProb=args.loopProb, statScale=args.statScale, llScale=args.llScale, ref=None, plot=False, beam=args.beam)
+    predicted_label_voiced = np.argmax(q_out, 1) + 2
+    predicted_label = (np.zeros(len(mask))).astype(int)
+    predicted_label[mask] = predicted_label_voiced
+
+    # Create the output rttm file
+    create_rttm_output(utt, predicted_label, args.output_dir, args.channel)
+    return True
+
+# Copies the model arrays into shared memory, so that the worker processes
+# wrap the same memory instead of each holding a copy. Returns a dictionary
+# of (buffer, shape) pairs to be passed to init_worker().
+def share_model(model):
+    shared_model = {}
+    for name, array in model.items():
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        buf = multiprocessing.RawArray('d', array.size)
+        np.frombuffer(buf, dtype=np.float64)[:] = array.ravel()
+        shared_model[name] = (buf, array.shape)
+    return shared_model
+
+_worker_state = None
+
+def init_worker(shared_model, args, utt2num_frames, utt2segments, feats_dict):
+    global _worker_state
+    model = dict((name, np.frombuffer(buf, dtype=np.float64).reshape(shape))
+                 for name, (buf, shape) in shared_model.items())
+    # Forked workers would otherwise share the parent's random state, and so
+    # draw the same random initializations when --initialize is 0.
+    np.random.seed()
+    _worker_state = (model, args, utt2num_frames, utt2segments, feats_dict)
+
+def diarize_utterance_in_worker(utt):
+    return utt, diarize_utterance(utt, *_worker_state)
+
 def main():
     parser = argparse.ArgumentParser(description='VB Resegmentation Wrapper')
     parser.add_argument('data_dir', type=str, help='Subset data directory')
@@ -145,12 +229,19 @@ def main():
                         help='Channel information in the rttm file')
     parser.add_argument('--initialize', type=int, default=1,
                         help='Whether to initalize the speaker posterior')
+    parser.add_argument('--beam', type=float, default=None,
+                        help='If set, speakers whose posterior is below exp(-beam) in every frame \
+                        are left out of the forward-backward of the following iterations')
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help='Number of processes used to diarize the utterances in parallel. \
+                        The models are loaded once and shared between the processes (default: 1)')
 
     args = parser.parse_args()
     print(args)
 
     utt_list = get_utt_list("{}/utt2spk".format(args.data_dir))
     utt2num_frames = get_utt2num_frames("{}/utt2num_frames".format(args.data_dir))
+    utt2segments = get_utt2segments(args.init_rttm_filename)
     
     # Load the diagonal UBM and i-vector extractor
     dubm_para = load_dubm(args.dubm_model)
@@ -167,54 +258,32 @@ def main():
     w = DUBM_WEIGHTS
     V = IE_M
 
+    # VtiEV only depends on the models, so it is computed once here rather
+    # than in every call of VB_diarization.
+    model = {'m': m, 'iE': iE, 'w': w, 'V': V,
+             'VtiEV': VB_diarization.precalculate_VtiEV(V, iE)}
+
     # Load the MFCC features
     feats_dict = get_utt2feats("{}/feats.scp".format(args.data_dir))
 
-    for utt in utt_list:
-        # Get the alignments from the clustering result.
-        # In init_ref, 0 denotes the silence silence frames
-        # 1 denotes the overlapping speech frames, the speaker
-        # label starts from 2.
-        init_ref = create_ref(utt, utt2num_frames, args.init_rttm_filename)
-
-        # load MFCC features
-        X = kaldi_io.read_mat(feats_dict[utt]).astype(np.float64)
-        assert len(init_ref) == len(X)
-
-        # Keep only the voiced frames (0 denotes the silence 
-        # frames, 1 denotes the overlapping speech frames).
-        mask = (init_ref >= 2)
-        X_voiced = X[mask]
-        init_ref_voiced = init_ref[mask] - 2
-
-        if X_voiced.shape[0] == 0:
-            print("Warning: {} has no voiced frames in the initialization file".format(utt))
-            continue
-
-        # Initialize the posterior of each speaker based on the clustering result.
-        if args.initialize:
-            q = VB_diarization.frame_labels2posterior_mx(init_ref_voiced, args.max_speakers)
-        else:
-            q = None
-        
-        # VB resegmentation
-
-        # q  - S x T matrix of posteriors attribution each frame to one of S possible
-        #      speakers, where S is given by opts.maxSpeakers
-        # sp - S dimensional column vector of ML learned speaker priors. Ideally, these
-        #      should allow to estimate # of speaker in the utterance as the
-        #      probabilities of the redundant speaker should converge to zero.
-        # Li - values of auxiliary function (and DER and frame cross-entropy between q
-        #      and reference if 'ref' is provided) over iterations.
-        q_out, sp_out, L_out = VB_diarization.VB_diarization(X_voiced, m, iE, w, V, sp=None, q=q, maxSpeakers=args.max_speakers, maxIters=args.max_iters, VtiEV=None,
-                                  downsample=args.downsample, alphaQInit=args.alphaQInit, sparsityThr=args.sparsityThr, epsilon=args.epsilon, minDur=args.minDur,
-                                  loopProb=args.loopProb, statScale=args.statScale, llScale=args.llScale, ref=None, plot=False)
-        predicted_label_voiced = np.argmax(q_out, 1) + 2
-        predicted_label = (np.zeros(len(mask))).astype(int)
-        predicted_label[mask] = predicted_label_voiced
-
-        # Create the output rttm file
-        create_rttm_output(utt, predicted_label, args.output_dir, args.channel)
+    num_done = 0
+    if args.num_workers > 1:
+        pool = multiprocessing.Pool(args.num_workers, initializer=init_worker,
+                                    initargs=(share_model(model), args, utt2num_frames,
+                                              utt2segments, feats_dict))
+        try:
+            for utt, done in pool.imap_unordered(diarize_utterance_in_worker, utt_list):
+                num_done += done
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for utt in utt_list:
+            num_done += diarize_utterance(utt, model, args, utt2num_frames, utt2segments, feats_dict)
+    print("Diarized {} of {} utterances".format(num_done, len(utt_list)))
     return 0
 
 if __name__ == "__main__":
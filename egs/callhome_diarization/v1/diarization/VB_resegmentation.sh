@@ -22,6 +22,7 @@ statScale=0.2
 llScale=1.0
 channel=0
 initialize=1
+num_workers=1
 # End configuration section.
 
 echo "$0 $@"  # Print the command line for logging
@@ -72,6 +73,10 @@ if [ $# != 5 ]; then
   echo "                                                   # speaker posterior (if not)"
   echo "                                                   # the speaker posterior will be"
   echo "                                                   # randomly initilized"
+  echo "  --num-workers <n|1>                              # Number of processes used by"
+  echo "                                                   # each job; the models are"
+  echo "                                                   # loaded once per job and"
+  echo "                                                   # shared between them"
 
   exit 1;
 fi
@@ -103,12 +108,12 @@ fi
 
 if [ $stage -le 1 ]; then
     # VB resegmentation
-    $cmd JOB=1:$nj $output_dir/log/VB_resegmentation.JOB.log \
+    $cmd --num-threads $num_workers JOB=1:$nj $output_dir/log/VB_resegmentation.JOB.log \
       python3 diarization/VB_resegmentation.py --max-speakers $max_speakers \
         --max-iters $max_iters --downsample $downsample --alphaQInit $alphaQInit \
 	--sparsityThr $sparsityThr --epsilon $epsilon --minDur $minDur \
 	--loopProb $loopProb --statScale $statScale --llScale $llScale \
-	--channel $channel --initialize $initialize \
+	--channel $channel --initialize $initialize --num-workers $num_workers \
         $sdata/JOB $init_rttm_filename $output_dir/tmp $output_dir/tmp/dubm.tmp $output_dir/tmp/ie.tmp || exit 1;
 
     cat $output_dir/tmp/*.rttm > $output_dir/rttm/VB_rttm
@@ -0,0 +1,141 @@
+# Copyright 2020  Johns Hopkins University
+# Apache 2.0
+
+""" This module contains what the scripts that convert images to Kaldi
+feature matrices (local/process_data.py in cifar/v1 and svhn/v1,
+image/ocr/make_features.py, ...) have in common: the conversion of an
+image to a feature matrix, and the writing of the matrices to a binary
+archive (and optionally an scp file), compressed or not, like
+"copy-feats --compress=true ark:- ark,scp:foo.ark,foo.scp" would, with
+the images converted by a pool of processes if requested.  The output is in
+the order of the input whatever the number of processes.
+
+Like the scripts, it must be used from the recipe directory (which has the
+'image' and 'steps' links).
+
+e.g.:
+    sys.path.insert(0, 'image')
+    import image_features_lib
+    ...
+    image_features_lib.add_writer_args(parser)
+    parser.add_argument('--num-jobs', type=int, default=1)
+    args = parser.parse_args()
+    with image_features_lib.open_writer(args) as writer:
+        num_ok, num_fail = image_features_lib.write_features(
+            open('data/train/images.scp'), process_line, writer,
+            num_jobs=args.num_jobs)
+where process_line() is a module-level function returning a pair
+(key, feature-matrix), with None as the matrix for images to skip.  If it
+uses random numbers (e.g. for augmentation), it should call
+seed_random_generators() with the key of the image first, so that the output
+doesn't depend on the number of processes.
+"""
+
+from __future__ import division
+import multiprocessing
+import random
+import sys
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, 'steps')
+import libs.kaldi_io as kaldi_io
+
+
+def image_to_feat_matrix(im, scale=1.0 / 255.0):
+    """ Converts an image, as an array of shape (height, width) or (height,
+    width, num_channels), to a float32 feature matrix with a row for each
+    column of the image (left to right), in which the pixels are ordered
+    from top to bottom with their channels interleaved, i.e. of shape
+    (width, height * num_channels).  The values are multiplied by 'scale'.
+    """
+    im = np.asarray(im)
+    if im.ndim == 2:
+        data = im.T
+    else:
+        data = np.transpose(im, (1, 0, 2)).reshape(im.shape[1], -1)
+    return (data * scale).astype(np.float32)
+
+
+def seed_random_generators(key):
+    """ Seeds the generators of the 'random' and 'numpy.random' modules from
+    the string 'key' (e.g. an image id).  With write_features(), the images
+    are processed by processes which all start with the same random state, in
+    an order that depends on the number of processes, so the scripts that use
+    random numbers call this for each image to get the same output whatever
+    the number of processes.
+    """
+    seed = zlib.crc32(key.encode('utf-8')) & 0xffffffff
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def add_writer_args(parser):
+    """ Adds the options of open_writer() to the argparse parser 'parser'.
+    """
+    parser.add_argument('--out-ark', type=str, default='-',
+                        help='Where to write the features, as a binary '
+                        'archive ("-" for standard output)')
+    parser.add_argument('--out-scp', type=str, default=None,
+                        help='If supplied, an scp file for the archive '
+                        'written to --out-ark is written there.')
+    parser.add_argument('--compress', type=lambda x: (str(x).lower()=='true'),
+                        default=False,
+                        help='If true, write the features as compressed '
+                        'matrices (see --compression-method).')
+    parser.add_argument('--compression-method', type=int,
+                        default=kaldi_io.kOneByteZeroOne,
+                        help='Compression method (as in copy-feats); the '
+                        'default, 7, is for values between 0 and 1.')
+
+
+def open_writer(args):
+    """ Returns a kaldi_io.ArkScpWriter for the options added by
+    add_writer_args(). """
+    return kaldi_io.ArkScpWriter(
+        args.out_ark, args.out_scp,
+        compression_method=args.compression_method if args.compress else None)
+
+
+def write_features(items, convert, writer, num_jobs=1, chunksize=8):
+    """ Converts each element of the iterable 'items' with the function
+    'convert', which returns a pair (key, feature-matrix), or (key, None) if
+    the element should be skipped, and writes the matrices with 'writer'
+    (e.g. from open_writer()) in the order of 'items'.  If num_jobs > 1,
+    the conversions are done by a pool of 'num_jobs' processes, in which case
+    'convert' must be a module-level function.  Returns the pair
+    (num_written, num_skipped).
+    """
+    num_written = 0
+    num_skipped = 0
+    pool = None
+    if num_jobs > 1:
+        # The workers are forked even where the default start method is
+        # 'spawn' or 'forkserver' (e.g. on macOS): the scripts that call this
+        # have no "if __name__ == '__main__'" guard, so with those methods
+        # each worker would run the whole script again.
+        if hasattr(multiprocessing, 'get_context'):
+            pool = multiprocessing.get_context('fork').Pool(num_jobs)
+        else:
+            pool = multiprocessing.Pool(num_jobs)  # python 2 always forks.
+        results = pool.imap(convert, items, chunksize)
+    else:
+        results = map(convert, items)
+    try:
+        for key, mat in results:
+            if mat is None:
+                num_skipped += 1
+                continue
+            writer.write_mat(key, mat)
+            num_written += 1
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+    return num_written, num_skipped
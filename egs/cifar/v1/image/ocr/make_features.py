@@ -9,7 +9,8 @@
 """ This script converts images to Kaldi-format feature matrices. The input to
     this script is the path to a data directory, e.g. "data/train". This script
     reads the images listed in images.scp and writes them to standard output
-    (by default) as Kaldi-formatted matrices (in text form). It also scales the
+    (by default) as Kaldi-formatted matrices (in binary form, or compressed
+    with --compress true; see --out-ark and --out-scp). It also scales the
     images so they have the same height (via --feat-dim). It can optionally pad
     the images (on left/right sides) with white pixels. It by default performs 
     augmentation, (directly scaling down and scaling up). It will double the 
@@ -18,6 +19,9 @@
     to enforce the images to have the specified length in that file by padding
     white pixels (the --padding option will be ignored in this case). This relates
     to end2end chain training.
+    The images can be processed by several processes (--num-jobs); the output
+    is in the order of images.scp and, as the random augmentation is seeded
+    from the image id, the same whatever the number of processes.
     eg. local/make_features.py data/train --feat-dim 40
 """
 import random
@@ -30,15 +34,19 @@ import math
 from signal import signal, SIGPIPE, SIG_DFL
 signal(SIGPIPE, SIG_DFL)
 
+sys.path.insert(0, 'image')
+import image_features_lib
+
 parser = argparse.ArgumentParser(description="""Converts images (in 'dir'/images.scp) to features and
-                                                writes them to standard output in text format.""")
+                                                writes them to standard output in binary format.""")
 parser.add_argument('images_scp_path', type=str,
                     help='Path of images.scp file')
 parser.add_argument('--allowed_len_file_path', type=str, default=None,
                     help='If supplied, each images will be padded to reach the '
                     'target length (this overrides --padding).')
-parser.add_argument('--out-ark', type=str, default='-',
-                    help='Where to write the output feature file')
+image_features_lib.add_writer_args(parser)
+parser.add_argument('--num-jobs', type=int, default=1,
+                    help='Number of processes to convert the images with')
 parser.add_argument('--feat-dim', type=int, default=40,
                     help='Size to scale the height of all images')
 parser.add_argument('--padding', type=int, default=5,
@@ -56,22 +64,6 @@ parser.add_argument('--augment_type', type=str, default='no_aug',
 args = parser.parse_args()
 
 
-def write_kaldi_matrix(file_handle, matrix, key):
-    file_handle.write(key + " [ ")
-    num_rows = len(matrix)
-    if num_rows == 0:
-        raise Exception("Matrix is empty")
-    num_cols = len(matrix[0])
-
-    for row_index in range(len(matrix)):
-        if num_cols != len(matrix[row_index]):
-            raise Exception("All the rows of a matrix are expected to "
-                            "have the same length")
-        file_handle.write(" ".join(map(lambda x: str(x), matrix[row_index])))
-        if row_index != num_rows - 1:
-            file_handle.write("\n")
-    file_handle.write(" ]\n")
-
 def horizontal_pad(im, allowed_lengths = None):
     if allowed_lengths is None:
         left_padding = right_padding = args.padding
@@ -149,13 +141,35 @@ def vertical_shift(im, mode='normal'):
          np.random.normal(2, 1, (bottom, width)).astype(int)), axis=0)
     return im_pad
 
+def process_line(line):
+    """ Returns (image-id, feature-matrix) for a line of images.scp, with None
+    as the matrix if the image is too long. """
+    line = line.strip()
+    line_vect = line.split(' ')
+    image_id = line_vect[0]
+    image_path = line_vect[1]
+    image_features_lib.seed_random_generators(image_id)
+    if args.num_channels == 4:
+        im = misc.imread(image_path, mode='L')
+    else:
+        im = misc.imread(image_path)
+    if args.fliplr:
+        im = np.fliplr(im)
+    if args.augment_type == 'no_aug' or 'random_shift':
+        im = get_scaled_image_aug(im, 'normal')
+    elif args.augment_type == 'random_scale':
+        im = get_scaled_image_aug(im, 'scaled')
+    im = horizontal_pad(im, allowed_lengths)
+    if im is None:
+        return image_id, None
+    if args.augment_type == 'no_aug' or 'random_scale':
+        im = vertical_shift(im, 'normal')
+    elif args.augment_type == 'random_shift':
+        im = vertical_shift(im, 'notmid')
+    return image_id, image_features_lib.image_to_feat_matrix(im)
+
 ### main ###
-random.seed(1)
 data_list_path = args.images_scp_path
-if args.out_ark == '-':
-    out_fh = sys.stdout
-else:
-    out_fh = open(args.out_ark,'w')
 
 allowed_lengths = None
 allowed_len_handle = args.allowed_len_file_path
@@ -168,42 +182,9 @@ if os.path.isfile(allowed_len_handle):
     print("Read {} allowed lengths and will apply them to the "
           "features.".format(len(allowed_lengths)), file=sys.stderr)
 
-num_fail = 0
-num_ok = 0
-with open(data_list_path) as f:
-    for line in f:
-        line = line.strip()
-        line_vect = line.split(' ')
-        image_id = line_vect[0]
-        image_path = line_vect[1]
-        if args.num_channels == 4:
-            im = misc.imread(image_path, mode='L')
-        else:
-            im = misc.imread(image_path)
-        if args.fliplr:
-            im = np.fliplr(im)
-        if args.augment_type == 'no_aug' or 'random_shift':
-            im = get_scaled_image_aug(im, 'normal')
-        elif args.augment_type == 'random_scale':
-            im = get_scaled_image_aug(im, 'scaled')
-        im = horizontal_pad(im, allowed_lengths)
-        if im is None:
-            num_fail += 1
-            continue
-        if args.augment_type == 'no_aug' or 'random_scale':
-            im = vertical_shift(im, 'normal')
-        elif args.augment_type == 'random_shift':
-            im = vertical_shift(im, 'notmid')
-        if args.num_channels in [1,4]:
-            data = np.transpose(im, (1, 0))
-        elif args.num_channels == 3:
-            H = im.shape[0]
-            W = im.shape[1]
-            C = im.shape[2]
-            data = np.reshape(np.transpose(im, (1, 0, 2)), (W, H * C))
-        data = np.divide(data, 255.0)
-        num_ok += 1
-        write_kaldi_matrix(out_fh, data, image_id)
+with open(data_list_path) as f, image_features_lib.open_writer(args) as writer:
+    num_ok, num_fail = image_features_lib.write_features(
+        f, process_line, writer, num_jobs=args.num_jobs)
 
 print('Generated features for {} images. Failed for {} (image too '
       'long).'.format(num_ok, num_fail), file=sys.stderr)
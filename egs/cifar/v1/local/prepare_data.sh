@@ -31,13 +31,13 @@ cp data/cifar10_{train,test}/classes.txt
 echo 3 > data/cifar10_train/num_channels
 echo 3 > data/cifar10_test/num_channels
 
-local/process_data.py --dataset train $cifar10 data/cifar10_train/ | \
-  copy-feats --compress=true --compression-method=7 \
-   ark:- ark,scp:data/cifar10_train/data/images.ark,data/cifar10_train/images.scp || exit 1
+local/process_data.py --dataset train --compress true \
+  --out-ark data/cifar10_train/data/images.ark --out-scp data/cifar10_train/images.scp \
+  $cifar10 data/cifar10_train/ || exit 1
 
-local/process_data.py --dataset test $cifar10 data/cifar10_test/ | \
-  copy-feats --compress=true --compression-method=7 \
-    ark:- ark,scp:data/cifar10_test/data/images.ark,data/cifar10_test/images.scp || exit 1
+local/process_data.py --dataset test --compress true \
+  --out-ark data/cifar10_test/data/images.ark --out-scp data/cifar10_test/images.scp \
+  $cifar10 data/cifar10_test/ || exit 1
 
 
 
@@ -66,10 +66,10 @@ cp data/cifar100_{train,test}/classes.txt
 echo 3 > data/cifar100_train/num_channels
 echo 3 > data/cifar100_test/num_channels
 
-local/process_data.py --cifar-version CIFAR-100 --dataset train $cifar100 data/cifar100_train/ | \
-  copy-feats --compress=true --compression-method=7 \
-    ark:- ark,scp:data/cifar100_train/data/images.ark,data/cifar100_train/images.scp || exit 1
+local/process_data.py --cifar-version CIFAR-100 --dataset train --compress true \
+  --out-ark data/cifar100_train/data/images.ark --out-scp data/cifar100_train/images.scp \
+  $cifar100 data/cifar100_train/ || exit 1
 
-local/process_data.py --cifar-version CIFAR-100 --dataset test $cifar100 data/cifar100_test/ | \
-  copy-feats --compress=true --compression-method=7 \
-    ark:- ark,scp:data/cifar100_test/data/images.ark,data/cifar100_test/images.scp || exit 1
+local/process_data.py --cifar-version CIFAR-100 --dataset test --compress true \
+  --out-ark data/cifar100_test/data/images.ark --out-scp data/cifar100_test/images.scp \
+  $cifar100 data/cifar100_test/ || exit 1
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # Copyright 2017 Johns Hopkins University (author: Hossein Hadian)
 # Apache 2.0
@@ -12,6 +12,11 @@ import argparse
 import os
 import sys
 
+import numpy as np
+
+sys.path.insert(0, 'image')
+import image_features_lib
+
 parser = argparse.ArgumentParser(description="""Converts train/test data of
                                                 CIFAR-10 or CIFAR-100 to
                                                 Kaldi feature format""")
@@ -21,7 +26,7 @@ parser.add_argument('database',
 parser.add_argument('dir', help='output dir')
 parser.add_argument('--cifar-version', default='CIFAR-10', choices=['CIFAR-10', 'CIFAR-100'])
 parser.add_argument('--dataset', default='train', choices=['train', 'test'])
-parser.add_argument('--out-ark', default='-', help='where to write output feature data')
+image_features_lib.add_writer_args(parser)
 
 args = parser.parse_args()
 
@@ -30,131 +35,45 @@ C = 3  # num_channels
 H = 32  # num_rows
 W = 32  # num_cols
 
-def load_cifar10_data_batch(datafile):
-    num_images_in_batch = 10000
-    data = []
-    labels = []
-    with open(datafile, 'rb') as fh:
-        for i in range(num_images_in_batch):
-            label = ord(fh.read(1))
-            bin_img = fh.read(C * H * W)
-            img = [[[ord(byte)/255.0 for byte in bin_img[channel*H*W+row*W:channel*H*W+(row+1)*W]]
-                  for row in range(H)] for channel in range(C)]
-            labels += [label]
-            data += [img]
-    return data, labels
-
-def load_cifar100_data_batch(datafile, num_images_in_batch):
-    data = []
-    fine_labels = []
-    coarse_labels = []
-    with open(datafile, 'rb') as fh:
-        for i in range(num_images_in_batch):
-            coarse_label = ord(fh.read(1))
-            fine_label = ord(fh.read(1))
-            bin_img = fh.read(C * H * W)
-            img = [[[ord(byte)/255.0 for byte in bin_img[channel*H*W+row*W:channel*H*W+(row+1)*W]]
-                  for row in range(H)] for channel in range(C)]
-            fine_labels += [fine_label]
-            coarse_labels += [coarse_label]
-            data += [img]
-    return data, fine_labels, coarse_labels
+def load_cifar_data_batch(datafile, num_label_bytes):
+    """Returns (images, labels) for a CIFAR binary data file, where images
+       is an array of shape (num_images, C, H, W) of bytes and labels
+       contains the last label of each image (i.e. the fine label for
+       CIFAR-100, which has the coarse label before it)."""
+    record_size = num_label_bytes + C * H * W
+    data = np.fromfile(datafile, dtype=np.uint8)
+    if data.size % record_size != 0:
+        raise Exception("Unexpected size of {0}".format(datafile))
+    data = data.reshape(-1, record_size)
+    labels = data[:, num_label_bytes - 1]
+    images = data[:, num_label_bytes:].reshape(-1, C, H, W)
+    return images, labels
 
 def image_to_feat_matrix(img):
-  mat = [0]*H  # 32 * 96
-  for i in range(W):
-    mat[i] = [0]*C*H
-    for ch in range(C):
-      for j in range(H):
-        mat[i][j*C+ch] = img[ch][j][i]
-  return mat
-
-def write_kaldi_matrix(file_handle, matrix, key):
-    # matrix is a list of lists
-    file_handle.write(key + "  [ ")
-    num_rows = len(matrix)
-    if num_rows == 0:
-        raise Exception("Matrix is empty")
-    num_cols = len(matrix[0])
-
-    for row_index in range(len(matrix)):
-        if num_cols != len(matrix[row_index]):
-            raise Exception("All the rows of a matrix are expected to "
-                            "have the same length")
-        file_handle.write(" ".join([str(x) for x in matrix[row_index]]))
-        if row_index != num_rows - 1:
-            file_handle.write("\n")
-    file_handle.write(" ]\n")
-
-def zeropad(x, length):
-  s = str(x)
-  while len(s) < length:
-    s = '0' + s
-  return s
+    # img is C x H x W; the matrix has a row per column of the image.
+    return image_features_lib.image_to_feat_matrix(np.transpose(img, (1, 2, 0)))
 
 ### main ###
 cifar10 = (args.cifar_version.lower() == 'cifar-10')
-if args.out_ark == '-':
-  out_fh = sys.stdout  # output file handle to write the feats to
-else:
-  out_fh = open(args.out_ark, 'wb')
-
 if cifar10:
-    img_id = 1  # similar to utt_id
-    labels_file = os.path.join(args.dir, 'labels.txt')
-    labels_fh = open(labels_file, 'wb')
-
-
     if args.dataset == 'train':
-        for i in range(1, 6):
-            fpath = os.path.join(args.database, 'data_batch_' + str(i) + '.bin')
-            data, labels = load_cifar10_data_batch(fpath)
-            for i in range(len(data)):
-                key = zeropad(img_id, 5)
-                labels_fh.write(key + ' ' + str(labels[i]) + '\n')
-                feat_mat = image_to_feat_matrix(data[i])
-                write_kaldi_matrix(out_fh, feat_mat, key)
-                img_id += 1
+        files = ['data_batch_' + str(i) + '.bin' for i in range(1, 6)]
     else:
-        fpath = os.path.join(args.database, 'test_batch.bin')
-        data, labels = load_cifar10_data_batch(fpath)
-        for i in range(len(data)):
-            key = zeropad(img_id, 5)
-            labels_fh.write(key + ' ' + str(labels[i]) + '\n')
-            feat_mat = image_to_feat_matrix(data[i])
-            write_kaldi_matrix(out_fh, feat_mat, key)
-            img_id += 1
-
-    labels_fh.close()
+        files = ['test_batch.bin']
+    num_label_bytes = 1
 else:
-    img_id = 1  # similar to utt_id
-    fine_labels_file = os.path.join(args.dir, 'labels.txt')
-    # coarse_labels_file = os.path.join(args.dir, 'coarse_labels.txt')
-    fine_labels_fh = open(fine_labels_file, 'wb')
-    # coarse_labels_fh = open(coarse_labels_file, 'wb')
-
-    if args.dataset == 'train':
-        fpath = os.path.join(args.database, 'train.bin')
-        data, fine_labels, coarse_labels = load_cifar100_data_batch(fpath, 50000)
-        for i in range(len(data)):
-            key = zeropad(img_id, 5)
-            fine_labels_fh.write(key + ' ' + str(fine_labels[i]) + '\n')
-            # coarse_labels_fh.write(key + ' ' + str(coarse_labels[i]) + '\n')
-            feat_mat = image_to_feat_matrix(data[i])
-            write_kaldi_matrix(out_fh, feat_mat, key)
-            img_id += 1
-    else:
-        fpath = os.path.join(args.database, 'test.bin')
-        data, fine_labels, coarse_labels = load_cifar100_data_batch(fpath, 10000)
-        for i in range(len(data)):
-            key = zeropad(img_id, 5)
-            fine_labels_fh.write(key + ' ' + str(fine_labels[i]) + '\n')
-            # coarse_labels_fh.write(key + ' ' + str(coarse_labels[i]) + '\n')
-            feat_mat = image_to_feat_matrix(data[i])
-            write_kaldi_matrix(out_fh, feat_mat, key)
+    files = ['train.bin' if args.dataset == 'train' else 'test.bin']
+    num_label_bytes = 2  # the coarse label, then the fine label.
+
+img_id = 1  # similar to utt_id
+labels_file = os.path.join(args.dir, 'labels.txt')
+with open(labels_file, 'w') as labels_fh, \
+        image_features_lib.open_writer(args) as writer:
+    for f in files:
+        images, labels = load_cifar_data_batch(os.path.join(args.database, f),
+                                               num_label_bytes)
+        for i in range(len(images)):
+            key = '{0:05d}'.format(img_id)
+            labels_fh.write(key + ' ' + str(labels[i]) + '\n')
+            writer.write_mat(key, image_to_feat_matrix(images[i]))
             img_id += 1
-
-    fine_labels_fh.close()
-    # coarse_labels_fh.close()
-
-out_fh.close()
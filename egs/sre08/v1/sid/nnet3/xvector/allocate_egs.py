@@ -61,12 +61,18 @@
 # 2   120
 # the format is:  <archive-index> <num-frames>.  The <num-frames> will always
 # be in the range [min-frames-per-chunk, max-frames-per-chunk].
+#
+# The random choices for each archive (chunk length, speakers, utterances and
+# offsets) are made with numpy, with a random generator seeded from --seed and
+# the archive index, so the output only depends on --seed and not on how many
+# processes (--num-workers) are used to write the ranges.* files.
 
 
 # We're using python 3.x style print but want it to work in python 2.x.
 from __future__ import print_function
 from __future__ import division
-import re, os, argparse, sys, math, warnings, random
+import re, os, argparse, sys, math, warnings, multiprocessing
+import numpy as np
 
 def get_args():
     parser = argparse.ArgumentParser(description="Writes ranges.*, outputs.* and archive_chunk_lengths files "
@@ -96,6 +102,9 @@ def get_args():
                     help="Seed for random number generator")
     parser.add_argument("--num-pdfs", type=int, default=-1,
                     help="Num pdfs")
+    parser.add_argument("--num-workers", type=int, default=1,
+                    help="Number of processes used to allocate the egs of the jobs and write "
+                    "their ranges.* files; the output doesn't depend on it.")
 
     # now the positional arguments
     parser.add_argument("--utt2len-filename", type=str, required=True,
@@ -130,6 +139,8 @@ def process_args(args):
         raise Exception("--num-archives is invalid")
     if args.num_jobs > args.num_archives:
         raise Exception("--num-jobs is invalid (must not exceed num-archives)")
+    if args.num_workers < 1:
+        raise Exception("--num-workers is invalid")
     return args
 
 # Create utt2len
@@ -173,19 +184,6 @@ def get_labels(utt2int_filename):
     # Done utt2int
 
 
-# this function returns a random integer utterance index, limited to utterances
-# above a minimum length in frames, with probability proportional to its length.
-def get_random_utt(spkr, spk2utt, min_length):
-    this_utts = spk2utt[spkr]
-    this_num_utts = len(this_utts)
-    i = random.randint(0, this_num_utts-1)
-    utt = this_utts[i]
-    return utt
-
-def random_chunk_length(min_frames_per_chunk, max_frames_per_chunk):
-    ans = random.randint(min_frames_per_chunk, max_frames_per_chunk)
-    return ans
-
 # This function returns an integer in the range
 # [min-frames-per-chunk, max-frames-per-chunk] according to a geometric
 # sequence. For example, suppose min-frames-per-chunk is 50,
@@ -203,119 +201,171 @@ def deterministic_chunk_length(archive_id, num_archives, min_frames_per_chunk, m
 
 
 
-# given an utterance length utt_length (in frames) and two desired chunk lengths
-# (length1 and length2) whose sum is <= utt_length,
-# this function randomly picks the starting points of the chunks for you.
-# the chunks may appear randomly in either order.
-def get_random_offset(utt_length, length):
-    if length > utt_length:
+# The tables used by allocate_archive() and write_job().  This is a global
+# so that the worker processes get it once, from init_worker().
+allocation = None
+
+def make_allocation(args, prefix, utt2len, spk2utt, utt2spk, archive_chunk_lengths):
+    # The utterances are numbered in sorted order, so that sorting the
+    # egs by utterance index sorts them by utterance-id.  The utterances of
+    # speaker s are spk_utts[spk_first[s]:spk_first[s] + spk_num_utts[s]].
+    utts = sorted(utt2spk.keys())
+    utt2index = dict((utt, i) for i, utt in enumerate(utts))
+    spks = sorted(spk2utt.keys())
+    spk_utts = np.array([utt2index[utt] for spk in spks for utt in spk2utt[spk]],
+                        dtype=np.int64)
+    spk_num_utts = np.array([len(spk2utt[spk]) for spk in spks], dtype=np.int64)
+    spk_first = np.cumsum(spk_num_utts) - spk_num_utts
+
+    # work out how many archives we assign to each job in an equitable way;
+    # each job gets a contiguous range of archives.
+    num_archives_per_job = [ 0 ] * args.num_jobs
+    for i in range(0, args.num_archives):
+        num_archives_per_job[i % args.num_jobs]  = num_archives_per_job[i % args.num_jobs] + 1
+    job_first_archive = np.cumsum(num_archives_per_job) - num_archives_per_job
+
+    return { 'args': args,
+             'prefix': prefix,
+             'utts': utts,
+             'utt_lens': np.array([utt2len[utt] for utt in utts], dtype=np.int64),
+             'utt_spks': np.array([utt2spk[utt] for utt in utts], dtype=np.int64),
+             'spk_utts': spk_utts,
+             'spk_num_utts': spk_num_utts,
+             'spk_first': spk_first,
+             'archive_chunk_lengths': archive_chunk_lengths,
+             'job_archives': [list(range(job_first_archive[job],
+                                         job_first_archive[job] + num_archives_per_job[job]))
+                              for job in range(args.num_jobs)] }
+
+def init_worker(this_allocation):
+    global allocation
+    allocation = this_allocation
+
+# This function chooses the egs of archive 'archive_index' (zero-based) and
+# returns them as arrays (utterance-indexes, offsets).  Each eg comes from a
+# different one of the num-repeats copies of the speakers, taken in random
+# order, and from a random utterance of its speaker, at a random offset.
+def allocate_archive(archive_index):
+    args = allocation['args']
+    length = allocation['archive_chunk_lengths'][archive_index]
+    spk_num_utts = allocation['spk_num_utts']
+    rng = np.random.RandomState([args.seed, archive_index, 1])
+
+    this_num_egs = int(float(args.frames_per_iter) / length + 1)
+    num_spks = len(spk_num_utts)
+    if this_num_egs > args.num_repeats * num_spks:
+        print("Ran out of speakers for archive {0}".format(archive_index + 1))
+        this_num_egs = args.num_repeats * num_spks
+    spks = rng.permutation(args.num_repeats * num_spks)[0:this_num_egs] % num_spks
+    utts = allocation['spk_utts'][allocation['spk_first'][spks] +
+        (rng.random_sample(this_num_egs) * spk_num_utts[spks]).astype(np.int64)]
+    free_lengths = allocation['utt_lens'][utts] - length
+    if np.any(free_lengths < 0):
         sys.exit("code error: length > utt-length")
-    free_length = utt_length - length
+    offsets = (rng.random_sample(this_num_egs) * (free_lengths + 1)).astype(np.int64)
+    return utts, offsets
+
+# This function allocates the egs of the archives of job 'job' (zero-based),
+# writes its ranges.* and outputs.* files, and returns the number of egs of
+# each pdf.
+def write_job(job):
+    args = allocation['args']
+    prefix = allocation['prefix']
+    utts = allocation['utts']
+    utt_spks = allocation['utt_spks']
+    archive_chunk_lengths = allocation['archive_chunk_lengths']
+    this_archives_for_job = allocation['job_archives'][job]
+
+    this_utts = []
+    this_offsets = []
+    this_indexes = []
+    for i, archive_index in enumerate(this_archives_for_job):
+        print("Processing archive {0}".format(archive_index + 1))
+        utt_indexes, offsets = allocate_archive(archive_index)
+        this_utts.append(utt_indexes)
+        this_offsets.append(offsets)
+        this_indexes.append(np.full(len(utt_indexes), i, dtype=np.int64))
+    this_utts = np.concatenate(this_utts)
+    this_offsets = np.concatenate(this_offsets)
+    this_indexes = np.concatenate(this_indexes)
+
+    # sort by utterance-id, then relative archive index, then offset.
+    order = np.lexsort((this_offsets, this_indexes, this_utts))
+    f = open(args.egs_dir + "/temp/" + prefix + "ranges." + str(job + 1), "w")
+    if f is None:
+        sys.exit("Error opening file " + args.egs_dir + "/temp/" + prefix + "ranges." + str(job + 1))
+    for utterance_index, i, offset in zip(this_utts[order].tolist(),
+                                          this_indexes[order].tolist(),
+                                          this_offsets[order].tolist()):
+        archive_index = this_archives_for_job[i]
+        f.write("{0} {1} {2} {3} {4} {5}\n".format(utts[utterance_index],
+                                                  i,
+                                                  archive_index + 1,
+                                                  offset,
+                                                  archive_chunk_lengths[archive_index],
+                                                  utt_spks[utterance_index]))
+    f.close()
 
-    offset = random.randint(0, free_length)
-    return offset
+    f = open(args.egs_dir + "/temp/" + prefix + "outputs." + str(job + 1), "w")
+    if f is None:
+        sys.exit("Error opening file " + args.egs_dir + "/temp/" + prefix + "outputs." + str(job + 1))
+    print( " ".join([ str("{0}/" + prefix + "egs_temp.{1}.ark").format(args.egs_dir, n + 1) for n in this_archives_for_job ]),
+       file=f)
+    f.close()
+
+    return np.bincount(utt_spks[this_utts], minlength=args.num_pdfs)[0:args.num_pdfs]
 
 
 def main():
     args = get_args()
     if not os.path.exists(args.egs_dir + "/temp"):
         os.makedirs(args.egs_dir + "/temp")
-    random.seed(args.seed)
     utt2len = get_utt2len(args.utt2len_filename)
     spks, spk2utt, utt2spk = get_labels(args.utt2int_filename)
     if args.num_pdfs == -1:
         args.num_pdfs = max(spks) + 1
 
-    # archive_chunk_lengths is an mapping from archive id to the number of
-    # frames in examples of that archive.
-    archive_chunk_lengths = []
-    # all_egs contains 2-tuples of the form (utt-id, offset)
-    all_egs= []
-
     prefix = ""
     if args.prefix != "":
         prefix = args.prefix + "_"
 
+    # archive_chunk_lengths is an mapping from archive id to the number of
+    # frames in examples of that archive.
+    archive_chunk_lengths = []
     info_f = open(args.egs_dir + "/temp/" + prefix + "archive_chunk_lengths", "w")
     if info_f is None:
         sys.exit(str("Error opening file {0}/temp/" + prefix + "archive_chunk_lengths").format(args.egs_dir));
     for archive_index in range(args.num_archives):
-        print("Processing archive {0}".format(archive_index + 1))
         if args.randomize_chunk_length == "true":
             # don't constrain the lengths to be the same
-            length = random_chunk_length(args.min_frames_per_chunk, args.max_frames_per_chunk)
+            rng = np.random.RandomState([args.seed, archive_index, 0])
+            length = rng.randint(args.min_frames_per_chunk, args.max_frames_per_chunk + 1)
         else:
             length = deterministic_chunk_length(archive_index, args.num_archives, args.min_frames_per_chunk, args.max_frames_per_chunk);
         print("{0} {1}".format(archive_index + 1, length), file=info_f)
-        archive_chunk_lengths.append(length)
-        this_num_egs = int(float(args.frames_per_iter) / length + 1)
-        this_egs = [ ] # A 2-tuple of the form (utt-id, start-frame)
-        spkrs = args.num_repeats * list(spk2utt.keys())
-        random.shuffle(spkrs)
-        for n in range(this_num_egs):
-            if len(spkrs) == 0:
-                print("Ran out of speakers for archive {0}".format(archive_index + 1))
-                break
-            spkr = spkrs.pop()
-            utt = get_random_utt(spkr, spk2utt, length)
-            utt_len = utt2len[utt]
-            offset = get_random_offset(utt_len, length)
-            this_egs.append( (utt, offset) )
-        all_egs.append(this_egs)
+        archive_chunk_lengths.append(int(length))
     info_f.close()
 
-    # work out how many archives we assign to each job in an equitable way.
-    num_archives_per_job = [ 0 ] * args.num_jobs
-    for i in range(0, args.num_archives):
-        num_archives_per_job[i % args.num_jobs]  = num_archives_per_job[i % args.num_jobs] + 1
-
-    pdf2num = {}
-    cur_archive = 0
-    for job in range(args.num_jobs):
-        this_ranges = []
-        this_archives_for_job = []
-        this_num_archives = num_archives_per_job[job]
-
-        for i in range(0, this_num_archives):
-            this_archives_for_job.append(cur_archive)
-            for (utterance_index, offset) in all_egs[cur_archive]:
-                this_ranges.append( (utterance_index, i, offset) )
-            cur_archive = cur_archive + 1
-
-        f = open(args.egs_dir + "/temp/" + prefix + "ranges." + str(job + 1), "w")
-        if f is None:
-            sys.exit("Error opening file " + args.egs_dir + "/temp/" + prefix + "ranges." + str(job + 1))
-        for (utterance_index, i, offset) in sorted(this_ranges):
-            archive_index = this_archives_for_job[i]
-            print("{0} {1} {2} {3} {4} {5}".format(utterance_index,
-                                           i,
-                                           archive_index + 1,
-                                           offset,
-                                           archive_chunk_lengths[archive_index],
-                                           utt2spk[utterance_index]),
-              file=f)
-            if utt2spk[utterance_index] in pdf2num:
-                 pdf2num[utt2spk[utterance_index]] += 1
-            else:
-                pdf2num[utt2spk[utterance_index]] = 1
-        f.close()
-
-
-        f = open(args.egs_dir + "/temp/" + prefix + "outputs." + str(job + 1), "w")
-        if f is None:
-            sys.exit("Error opening file " + args.egs_dir + "/temp/" + prefix + "outputs." + str(job + 1))
-        print( " ".join([ str("{0}/" + prefix + "egs_temp.{1}.ark").format(args.egs_dir, n + 1) for n in this_archives_for_job ]),
-           file=f)
-        f.close()
+    this_allocation = make_allocation(args, prefix, utt2len, spk2utt, utt2spk,
+                                      archive_chunk_lengths)
+    if args.num_workers > 1 and args.num_jobs > 1:
+        pool = multiprocessing.Pool(min(args.num_workers, args.num_jobs),
+                                    initializer=init_worker,
+                                    initargs=(this_allocation,))
+        try:
+            pdf_counts = pool.map(write_job, range(args.num_jobs), chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        init_worker(this_allocation)
+        pdf_counts = [write_job(job) for job in range(args.num_jobs)]
+    nums = np.sum(pdf_counts, axis=0)
 
     f = open(args.egs_dir + "/" + prefix + "pdf2num", "w")
-    nums = []
-    for k in range(0, args.num_pdfs):
-        if k in pdf2num:
-          nums.append(pdf2num[k])
-        else:
-          nums.append(0)
-
     print(" ".join(map(str, nums)), file=f)
     f.close()
 
@@ -323,4 +373,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
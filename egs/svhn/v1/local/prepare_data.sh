@@ -27,9 +27,9 @@ for datafile in test_32x32.mat train_32x32.mat extra_32x32.mat; do
     wget -P $dl_dir $url || exit 1;
   fi
   out_data_dir=$(echo $datafile | cut -d'_' -f 1)
-  local/process_data.py $dl_dir/$datafile data/$out_data_dir/ | \
-    copy-feats --compress=true --compression-method=7 \
-     ark:- ark,scp:data/$out_data_dir/data/images.ark,data/$out_data_dir/images.scp || exit 1
+  local/process_data.py --compress true \
+    --out-ark data/$out_data_dir/data/images.ark --out-scp data/$out_data_dir/images.scp \
+    $dl_dir/$datafile data/$out_data_dir/ || exit 1
 done
 
 seq 0 9 | awk '{print $1 " " $1}' > data/train/classes.txt
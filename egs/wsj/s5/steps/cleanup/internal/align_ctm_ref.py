@@ -14,11 +14,19 @@ e.g.: align_ctm_ref.py --hyp-format=CTM --ref=data/train/text --hyp=foo/ctm
 from __future__ import print_function
 import argparse
 import logging
+import random
 import sys
+import time
 
 sys.path.insert(0, 'steps')
 import libs.common as common_lib
 
+try:
+    import numpy as np
+    g_have_numpy = True
+except ImportError:
+    g_have_numpy = False
+
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler()
 formatter = logging.Formatter("%(asctime)s [%(pathname)s:%(lineno)s - "
@@ -75,10 +83,22 @@ def get_args():
                         the end to get the alignment. This is different
                         from the normal Smith-Waterman alignment, where the
                         traceback will be from the maximum score.""")
+    parser.add_argument("--band-width", type=int, default=0,
+                        help="""If > 0, limit the alignment to the cells
+                        within this many hypothesis words of the diagonal
+                        going from the start of both sequences to the end
+                        of both sequences. This reduces the time and memory
+                        from O(ref_len * hyp_len) to
+                        O((ref_len + hyp_len) * band_width), but the
+                        alignment is only guaranteed to be the same as the
+                        unbanded one if the best path stays inside the band.
+                        If 0, the full score matrix is searched.
+                        Requires numpy.""")
 
     parser.add_argument("--debug-only", type=str, default="false",
                         choices=["true", "false"],
-                        help="Run test functions only")
+                        help="Run test functions and the benchmark of "
+                        "smith_waterman_alignment_vectorized() only")
     parser.add_argument("--verbose", type=int, default=0,
                         choices=[0, 1, 2, 3],
                         help="Use larger value for more verbose logging.")
@@ -100,6 +120,12 @@ def get_args():
 
     args.debug_only = bool(args.debug_only == "true")
 
+    if args.band_width < 0:
+        raise ValueError("Invalid --band-width value {0}".format(
+            args.band_width))
+    if args.band_width > 0 and not g_have_numpy:
+        raise ValueError("--band-width > 0 requires numpy")
+
     global verbose_level
     verbose_level = args.verbose
     if args.verbose > 2:
@@ -344,6 +370,229 @@ def smith_waterman_alignment(ref, hyp, similarity_score_function,
     return (output, max_score)
 
 
+# Back-pointer codes used by smith_waterman_alignment_vectorized().
+# _BP_NONE means the cell was not reached from any other cell; it
+# corresponds to the back-pointer (0, 0) in smith_waterman_alignment().
+_BP_NONE = 0
+_BP_DIAG = 1
+_BP_UP = 2
+_BP_LEFT = 3
+
+
+def smith_waterman_alignment_vectorized(ref, hyp, correct_score,
+                                        substitution_score,
+                                        del_score, ins_score,
+                                        eps_symbol="<eps>",
+                                        align_full_hyp=True, band_width=0):
+    """Vectorized version of smith_waterman_alignment() for the case where
+    the similarity score is 'correct_score' if the words are the same and
+    'substitution_score' otherwise.  It returns exactly the same
+    alignment and score as smith_waterman_alignment().
+
+    The words are mapped to integer ids and the score matrix is computed
+    one anti-diagonal (i.e. the cells with ref_index + hyp_index = d) at a
+    time: every cell on an anti-diagonal only depends on cells on the
+    previous two anti-diagonals, so a whole anti-diagonal is computed with
+    a few numpy operations.  Only the back-pointers (one byte per cell) are
+    stored, not the score matrix.
+
+    If band_width > 0, only the cells (ref_index, hyp_index) with
+    |hyp_index - ref_index * hyp_len / ref_len| <= band_width are
+    searched, which makes the time and memory linear in the length of the
+    sequences.  The result is the same as for the full search as long as
+    the best alignment stays inside the band.
+
+    With --verbose 3, the score matrix is printed to the standard error like
+    smith_waterman_alignment() does, with '-' for the cells outside the band.
+    """
+    ref_len = len(ref)
+    hyp_len = len(hyp)
+    if ref_len == 0 or hyp_len == 0:
+        # Nothing to vectorize; this also reproduces the behavior of
+        # smith_waterman_alignment() in these corner cases.
+        return smith_waterman_alignment(
+            ref, hyp, lambda x, y: (correct_score if x == y
+                                    else substitution_score),
+            del_score, ins_score, eps_symbol=eps_symbol,
+            align_full_hyp=align_full_hyp)
+
+    word2id = {}
+    ref_ids = np.array([word2id.setdefault(w, len(word2id)) for w in ref],
+                       dtype=np.int64)
+    hyp_ids = np.array([word2id.setdefault(w, len(word2id)) for w in hyp],
+                       dtype=np.int64)
+    # hyp_ids_rev[hyp_len - d + r] == hyp_ids[d - r - 1], so the
+    # hypothesis words along an anti-diagonal are a contiguous slice.
+    hyp_ids_rev = hyp_ids[::-1]
+
+    # Score of cells that are outside the band or not yet computed;
+    # low enough that it never wins a comparison.
+    unreachable = -(2 ** 60)
+    init_score = -(hyp_len + 2) if align_full_hyp else 0
+
+    # Score buffers indexed by ref_index for anti-diagonals d-2, d-1 and d,
+    # and the cells that were set in each of them.
+    buffers = [np.full(ref_len + 2, unreachable, dtype=np.int64)
+               for i in range(3)]
+    buffer_cells = [[] for i in range(3)]
+    # bp_diags[d] is an int8 array with the back-pointers of the interior
+    # cells (r, d - r) for r in bp_first_r[d] ... bp_first_r[d] + len - 1.
+    # The back-pointers of the cells in row 0 and column 0 are fixed and
+    # are not stored.
+    bp_diags = []
+    bp_first_r = []
+    # copies of the score buffers of all anti-diagonals, only kept to print
+    # the score matrix.
+    score_diags = [] if verbose_level > 2 else None
+
+    max_key = None
+
+    for d in range(ref_len + hyp_len + 1):
+        cur = buffers[d % 3]
+        prev = buffers[(d - 1) % 3]
+        prev2 = buffers[(d - 2) % 3]
+        for cells in buffer_cells[d % 3]:
+            cur[cells] = unreachable
+        buffer_cells[d % 3] = []
+
+        # Boundary cells (0, d) and (d, 0).
+        if d <= hyp_len:
+            cur[0] = d * ins_score if align_full_hyp else 0
+            buffer_cells[d % 3].append(slice(0, 1))
+        if 0 < d <= ref_len:
+            cur[d] = 0
+            buffer_cells[d % 3].append(slice(d, d + 1))
+
+        # The interior cells (r, d - r) with r >= 1 and d - r >= 1.
+        lo = max(1, d - hyp_len)
+        hi = min(ref_len, d - 1)
+        if band_width > 0:
+            lo = max(lo, -((-(d - band_width) * ref_len)
+                           // (ref_len + hyp_len)))
+            hi = min(hi, ((d + band_width) * ref_len)
+                     // (ref_len + hyp_len))
+        bp_first_r.append(lo)
+        if lo > hi:
+            bp_diags.append(np.zeros(0, dtype=np.int8))
+            if score_diags is not None:
+                score_diags.append(cur.copy())
+            continue
+
+        r = slice(lo, hi + 1)
+        r_minus_1 = slice(lo - 1, hi)
+        same = (ref_ids[lo - 1:hi]
+                == hyp_ids_rev[hyp_len - d + lo:hyp_len - d + hi + 1])
+        sub_or_ok = prev2[r_minus_1] + np.where(same, correct_score,
+                                                substitution_score)
+        if align_full_hyp:
+            use_diag = sub_or_ok >= init_score
+        else:
+            use_diag = sub_or_ok > 0
+        scores = np.where(use_diag, sub_or_ok, init_score)
+        bp = np.where(use_diag, _BP_DIAG, _BP_NONE).astype(np.int8)
+
+        deletion = prev[r_minus_1] + del_score
+        use_up = deletion > scores
+        scores = np.where(use_up, deletion, scores)
+        bp[use_up] = _BP_UP
+
+        insertion = prev[r] + ins_score
+        use_left = insertion > scores
+        scores = np.where(use_left, insertion, scores)
+        bp[use_left] = _BP_LEFT
+
+        cur[r] = scores
+        buffer_cells[d % 3].append(r)
+        bp_diags.append(bp)
+        if score_diags is not None:
+            score_diags.append(cur.copy())
+
+        # Track the maximum score like smith_waterman_alignment() does:
+        # ties are broken in favour of the cell that comes last in
+        # row-major order, i.e. we take the largest (score, r, h).
+        if not align_full_hyp:
+            best = int(scores.max())
+            # The last occurrence of the maximum has the largest r.
+            best_r = hi - int(np.argmax(scores[::-1] == best))
+            key = (best, best_r, d - best_r)
+        elif lo <= d - hyp_len:
+            # The cell (d - hyp_len, hyp_len) in the last column.
+            key = (int(scores[d - hyp_len - lo]), d - hyp_len, hyp_len)
+        else:
+            key = None
+        if key is not None and (max_key is None or key > max_key):
+            max_key = key
+
+    if max_key is None:
+        max_score = -float("inf")
+        ref_index, hyp_index = 0, 0
+    else:
+        max_score, ref_index, hyp_index = max_key
+    logger.debug("Alignment score: %s for (%d, %d)",
+                 max_score, ref_index, hyp_index)
+
+    output = []
+    while not align_full_hyp or hyp_index > 0:
+        if ref_index == 0:
+            code = _BP_LEFT if align_full_hyp and hyp_index > 0 else _BP_NONE
+        elif hyp_index == 0:
+            code = _BP_NONE
+        else:
+            d = ref_index + hyp_index
+            i = ref_index - bp_first_r[d]
+            if i < 0 or i >= len(bp_diags[d]):
+                raise RuntimeError(
+                    "Unexpected result: traceback reached cell ({0},{1}) "
+                    "outside the band".format(ref_index, hyp_index))
+            code = bp_diags[d][i]
+        if code == _BP_DIAG:
+            prev_ref_index, prev_hyp_index = ref_index - 1, hyp_index - 1
+        elif code == _BP_UP:
+            prev_ref_index, prev_hyp_index = ref_index - 1, hyp_index
+        elif code == _BP_LEFT:
+            prev_ref_index, prev_hyp_index = ref_index, hyp_index - 1
+        else:
+            prev_ref_index, prev_hyp_index = 0, 0
+
+        if ((prev_ref_index, prev_hyp_index) == (ref_index, hyp_index)
+                or (prev_ref_index, prev_hyp_index) == (0, 0)):
+            break
+
+        if code == _BP_DIAG:
+            output.append((ref[ref_index-1], hyp[hyp_index-1],
+                           prev_ref_index, prev_hyp_index,
+                           ref_index, hyp_index))
+        elif code == _BP_UP:
+            output.append((ref[ref_index-1], eps_symbol,
+                           prev_ref_index, prev_hyp_index,
+                           ref_index, hyp_index))
+        else:
+            output.append((eps_symbol, hyp[hyp_index-1],
+                           prev_ref_index, prev_hyp_index,
+                           ref_index, hyp_index))
+        ref_index, hyp_index = prev_ref_index, prev_hyp_index
+
+    output.reverse()
+
+    if score_diags is not None:
+        for ref_index in range(ref_len+1):
+            for hyp_index in range(hyp_len+1):
+                score = score_diags[ref_index + hyp_index][ref_index]
+                print ("{0} ".format(score if score != unreachable else "-"),
+                       end='', file=sys.stderr)
+            print ("", file=sys.stderr)
+
+    logger.debug("Aligned output:")
+    logger.debug("  -  ".join(["({0},{1})".format(x[4], x[5])
+                               for x in output]))
+    logger.debug("REF: ")
+    logger.debug("    ".join(str(x[0]) for x in output))
+    logger.debug("HYP:")
+    logger.debug("    ".join(str(x[1]) for x in output))
+
+    return (output, max_score)
+
+
 def print_alignment(recording, alignment, out_file_handle):
     out_text = [recording]
     for line in alignment:
@@ -503,9 +752,90 @@ def test_alignment(align_full_hyp):
     print_alignment("Alignment", output, out_file_handle=sys.stderr)
 
 
+def test_vectorized_alignment(align_full_hyp, num_tests=200):
+    """Checks that smith_waterman_alignment_vectorized() gives the same
+    output as smith_waterman_alignment() on random sequences."""
+    random.seed(0)
+    for i in range(num_tests):
+        vocab = ["w{0}".format(x) for x in range(random.randint(1, 10))]
+        ref = [random.choice(vocab) for x in range(random.randint(0, 30))]
+        hyp = [random.choice(vocab) for x in range(random.randint(0, 30))]
+        correct_score = random.randint(1, 3)
+        sub_score = -random.randint(0, 3)
+        del_score = -random.randint(0, 3)
+        ins_score = -random.randint(0, 3)
+        try:
+            expected = smith_waterman_alignment(
+                ref, hyp, similarity_score_function=(
+                    lambda x, y: correct_score if x == y else sub_score),
+                del_score=del_score, ins_score=ins_score,
+                eps_symbol="-", align_full_hyp=align_full_hyp)
+        except AssertionError:
+            # smith_waterman_alignment() fails with empty hypothesis when
+            # align_full_hyp is false.
+            continue
+        output = smith_waterman_alignment_vectorized(
+            ref, hyp, correct_score, sub_score, del_score, ins_score,
+            eps_symbol="-", align_full_hyp=align_full_hyp)
+        if output != expected:
+            raise RuntimeError(
+                "smith_waterman_alignment_vectorized() differs from "
+                "smith_waterman_alignment() for ref = {0}, hyp = {1}: "
+                "{2} != {3}".format(ref, hyp, output, expected))
+    logger.info("smith_waterman_alignment_vectorized() gave the same output "
+                "as smith_waterman_alignment() on %d random tests",
+                num_tests)
+
+
+def benchmark_alignment(align_full_hyp, band_width=0):
+    """Compares the speed of smith_waterman_alignment() and
+    smith_waterman_alignment_vectorized() on synthetic long recordings,
+    where the hypothesis is the reference with about 10% of words
+    substituted, deleted or inserted."""
+    random.seed(1)
+    vocab = ["w{0}".format(x) for x in range(5000)]
+    for ref_len in [300, 1000]:
+        ref = [random.choice(vocab) for x in range(ref_len)]
+        hyp = []
+        for word in ref:
+            x = random.random()
+            if x < 0.03:
+                continue
+            elif x < 0.06:
+                hyp.extend([word, random.choice(vocab)])
+            elif x < 0.1:
+                hyp.append(random.choice(vocab))
+            else:
+                hyp.append(word)
+
+        start_time = time.time()
+        expected = smith_waterman_alignment(
+            ref, hyp, similarity_score_function=(
+                lambda x, y: 1 if x == y else -1),
+            del_score=-1, ins_score=-1, align_full_hyp=align_full_hyp)
+        python_time = time.time() - start_time
+
+        start_time = time.time()
+        output = smith_waterman_alignment_vectorized(
+            ref, hyp, 1, -1, -1, -1, align_full_hyp=align_full_hyp,
+            band_width=band_width)
+        numpy_time = time.time() - start_time
+
+        logger.info("ref_len = %d, hyp_len = %d: smith_waterman_alignment() "
+                    "took %.2f s, smith_waterman_alignment_vectorized() took "
+                    "%.2f s (band-width = %d); outputs are %s", ref_len,
+                    len(hyp), python_time, numpy_time, band_width,
+                    "identical" if output == expected else "different")
+
+
 def run(args):
     if args.debug_only:
         test_alignment(args.align_full_hyp)
+        if g_have_numpy:
+            test_vectorized_alignment(args.align_full_hyp)
+            benchmark_alignment(args.align_full_hyp)
+            benchmark_alignment(args.align_full_hyp,
+                                band_width=max(args.band_width, 100))
         raise SystemExit("Exiting since --debug-only was true")
 
     def similarity_score_function(x, y):
@@ -565,11 +895,20 @@ def run(args):
 
             logger.debug("Running Smith-Waterman alignment for %s", reco)
 
-            output, score = smith_waterman_alignment(
-                ref_text, hyp_array, eps_symbol=args.eps_symbol,
-                similarity_score_function=similarity_score_function,
-                del_score=del_score, ins_score=ins_score,
-                align_full_hyp=args.align_full_hyp)
+            if g_have_numpy:
+                output, score = smith_waterman_alignment_vectorized(
+                    ref_text, hyp_array, eps_symbol=args.eps_symbol,
+                    correct_score=args.correct_score,
+                    substitution_score=-args.substitution_penalty,
+                    del_score=del_score, ins_score=ins_score,
+                    align_full_hyp=args.align_full_hyp,
+                    band_width=args.band_width)
+            else:
+                output, score = smith_waterman_alignment(
+                    ref_text, hyp_array, eps_symbol=args.eps_symbol,
+                    similarity_score_function=similarity_score_function,
+                    del_score=del_score, ins_score=ins_score,
+                    align_full_hyp=args.align_full_hyp)
 
             if args.hyp_format == "CTM":
                 ctm_edits = get_ctm_edits(output, hyp_lines[reco],
@@ -61,6 +61,12 @@ def _get_args():
                         choices=["true", "false"],
                         help="If true, the stats are accumulated over all the "
                         "documents and a single tf-idf-file is written out.")
+    parser.add_argument("--output-format", type=str, default="text",
+                        choices=["text", "binary"],
+                        help="""Format of the output tf-idf-file. If binary,
+                        a compact TF-IDF index is written that can be loaded
+                        much faster by retrieve_similar_docs.py; this is
+                        only supported with --accumulate-over-docs=true.""")
     parser.add_argument("docs", type=argparse.FileType('r'),
                         help="Input documents in kaldi text format i.e. "
                         "<document-id> <text>")
@@ -81,6 +87,11 @@ def _get_args():
             "If --accumulate-over-docs=false is provided, "
             "then --input-idf-stats must be provided.")
 
+    if not args.accumulate_over_docs and args.output_format == "binary":
+        raise TypeError(
+            "--output-format=binary is only supported with "
+            "--accumulate-over-docs=true.")
+
     return args
 
 
@@ -118,11 +129,20 @@ def _run(args):
             idf_stats.write(args.output_idf_stats)
             args.output_idf_stats.close()
 
-        tf_idf.write_tfidf_from_stats(
-            tf_stats, idf_stats, args.tf_idf_file,
-            tf_weighting_scheme=args.tf_weighting_scheme,
-            idf_weighting_scheme=args.idf_weighting_scheme,
-            tf_normalization_factor=args.tf_normalization_factor)
+        if args.output_format == "binary":
+            index = tf_idf.TFIDFIndex()
+            index.add_stats(
+                tf_stats, idf_stats,
+                tf_weighting_scheme=args.tf_weighting_scheme,
+                idf_weighting_scheme=args.idf_weighting_scheme,
+                tf_normalization_factor=args.tf_normalization_factor)
+            index.write(args.tf_idf_file.buffer)
+        else:
+            tf_idf.write_tfidf_from_stats(
+                tf_stats, idf_stats, args.tf_idf_file,
+                tf_weighting_scheme=args.tf_weighting_scheme,
+                idf_weighting_scheme=args.idf_weighting_scheme,
+                tf_normalization_factor=args.tf_normalization_factor)
 
     if num_done == 0:
         raise RuntimeError("Could not compute TF-IDF for any query documents")
@@ -7,11 +7,14 @@ for Term-frequency and Inverse-document-frequency values.
 
 from __future__ import print_function
 from __future__ import division
+import heapq
 import logging
 import math
 import re
 import sys
 
+import numpy as np
+
 sys.path.insert(0, 'steps')
 
 logger = logging.getLogger('__name__')
@@ -389,6 +392,269 @@ def write_tfidf_from_stats(
     print ("</TFIDF>", file=tf_idf_file)
 
 
+class TFIDFIndex(object):
+    """A compact index of TF-IDF values, which is an alternative to the
+    TFIDF class for large sets of source documents.
+
+    The terms and documents are interned to integer ids and the values are
+    stored as a sparse term x document matrix in CSR format, i.e. for each
+    term the documents containing it (its 'postings') are stored
+    contiguously.  The similarity scores of a batch of query documents with
+    all the source documents are then computed with a few numpy operations
+    on the postings of the query terms, instead of looping over
+    (term, document) pairs in python.
+
+    Parameters:
+        terms - List of terms (tuples of words) indexed by term-id
+        term2id - Dictionary from term to term-id
+        doc_ids - List of document-ids indexed by the document index
+        doc2index - Dictionary from document-id to document index
+        indptr - Array of size num_terms + 1; the postings of term-id i
+                 are at positions indptr[i] ... indptr[i+1] - 1 of
+                 doc_indices and values
+        doc_indices - Array of document indexes of the postings
+        values - Array of TF-IDF values of the postings
+        norms - Array with the L2-norm of the TF-IDF vector of each document
+    """
+
+    def __init__(self):
+        self.terms = []
+        self.term2id = {}
+        self.doc_ids = []
+        self.doc2index = {}
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.doc_indices = np.zeros(0, dtype=np.int32)
+        self.values = np.zeros(0, dtype=np.float64)
+        self.norms = np.zeros(0, dtype=np.float64)
+
+    def num_docs(self):
+        return len(self.doc_ids)
+
+    def _intern_term(self, term):
+        term_id = self.term2id.get(term)
+        if term_id is None:
+            term_id = len(self.terms)
+            self.term2id[term] = term_id
+            self.terms.append(term)
+        return term_id
+
+    def _intern_doc(self, doc):
+        index = self.doc2index.get(doc)
+        if index is None:
+            index = len(self.doc_ids)
+            self.doc2index[doc] = index
+            self.doc_ids.append(doc)
+        return index
+
+    def _build(self, term_ids, doc_indices, values):
+        """Builds the CSR arrays from the unsorted postings."""
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind='stable')
+        self.doc_indices = np.asarray(doc_indices, dtype=np.int32)[order]
+        self.values = np.asarray(values, dtype=np.float64)[order]
+        counts = np.bincount(term_ids, minlength=len(self.terms))
+        self.indptr = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+        self._compute_norms()
+
+    def _compute_norms(self):
+        self.norms = np.sqrt(np.bincount(
+            self.doc_indices, weights=self.values ** 2,
+            minlength=len(self.doc_ids)))
+
+    def add_entries(self, entries):
+        """Builds the index from an iterable of (term, doc, tf-idf value)
+        tuples.  Can only be called on an empty index."""
+        if len(self.terms) != 0:
+            raise RuntimeError("TFIDFIndex object is not empty.")
+        term_ids = []
+        doc_indices = []
+        values = []
+        for term, doc, value in entries:
+            term_ids.append(self._intern_term(term))
+            doc_indices.append(self._intern_doc(doc))
+            values.append(value)
+        if len(values) == 0:
+            raise RuntimeError("No TF-IDF values to index.")
+        self._build(term_ids, doc_indices, values)
+
+    def add_tfidf(self, tf_idf):
+        """Builds the index from a TFIDF object."""
+        self.add_entries((term, doc, value)
+                         for (term, doc), value in tf_idf.tf_idf.items())
+
+    def add_stats(self, tf_stats, idf_stats, tf_weighting_scheme="raw",
+                  idf_weighting_scheme="log", tf_normalization_factor=0.5):
+        """Builds the index from TF and IDF stats, with the same values that
+        write_tfidf_from_stats() would write."""
+        if len(tf_stats.raw_counts) == 0:
+            raise RuntimeError("Supplied tf-stats object is empty.")
+        if idf_stats.num_docs == 0:
+            raise RuntimeError("Supplied idf-stats object is empty.")
+        idf_cache = {}
+
+        def entries():
+            for term, doc in tf_stats.raw_counts:
+                tf_value = tf_stats.get_term_frequency(
+                    term, doc,
+                    weighting_scheme=tf_weighting_scheme,
+                    normalization_factor=tf_normalization_factor)
+                idf_value = idf_cache.get(term)
+                if idf_value is None:
+                    idf_value = idf_stats.get_inverse_document_frequency(
+                        term, weighting_scheme=idf_weighting_scheme)
+                    idf_cache[term] = idf_value
+                yield term, doc, tf_value * idf_value
+
+        self.add_entries(entries())
+
+    def query_vector(self, tf_idf, query_id=None):
+        """Converts a TFIDF object with the values of a single query
+        document into a tuple (term_ids, values, num_terms), where
+        term_ids and values are arrays for the terms that are in the index
+        (the other terms do not contribute to the similarity scores) and
+        num_terms is the number of terms in the query document."""
+        term_ids = []
+        values = []
+        num_terms = 0
+        for (term, doc), value in tf_idf.tf_idf.items():
+            if query_id is not None and doc != query_id:
+                raise RuntimeError("TF-IDF contains document {0}, which is "
+                                   "not the required query {1}.".format(
+                                       doc, query_id))
+            num_terms += 1
+            term_id = self.term2id.get(term)
+            if term_id is not None:
+                term_ids.append(term_id)
+                values.append(value)
+        return (np.array(term_ids, dtype=np.int64),
+                np.array(values, dtype=np.float64), num_terms)
+
+    def compute_similarity_scores(self, queries, source_docs=None,
+                                  do_length_normalization=False,
+                                  use_cosine=False):
+        """Computes the TF-IDF similarity scores between a batch of query
+        documents and the source documents in this index.
+
+        Arguments:
+            queries - A list of tuples (term_ids, values, num_terms) as
+                      returned by query_vector()
+            source_docs - If provided, the scores are computed only for
+                          these document-ids, in this order.
+            do_length_normalization - If True, the scores are divided by
+                                      the number of terms in the query, like
+                                      in TFIDF.compute_similarity_scores().
+            use_cosine - If True, the scores are divided by the norms of the
+                         query and source TF-IDF vectors.
+
+        Returns a matrix of shape (len(queries), num-source-docs), whose
+        element (i, j) is the score of query i with source document j.
+        """
+        num_docs = len(self.doc_ids)
+        num_queries = len(queries)
+        if num_queries == 0:
+            return np.zeros((0, num_docs if source_docs is None
+                             else len(source_docs)))
+        term_ids = np.concatenate([q[0] for q in queries])
+        query_values = np.concatenate([q[1] for q in queries])
+        query_of_term = np.repeat(np.arange(num_queries),
+                                  [len(q[0]) for q in queries])
+
+        # Gather the postings of all the query terms.
+        starts = self.indptr[term_ids]
+        lengths = self.indptr[term_ids + 1] - starts
+        total = int(lengths.sum())
+        offsets = np.cumsum(lengths) - lengths
+        positions = (np.repeat(starts - offsets, lengths)
+                     + np.arange(total, dtype=np.int64))
+        weights = self.values[positions] * np.repeat(query_values, lengths)
+        cells = (np.repeat(query_of_term, lengths) * num_docs
+                 + self.doc_indices[positions])
+        scores = np.bincount(cells, weights=weights,
+                             minlength=num_queries * num_docs).reshape(
+                                 num_queries, num_docs)
+
+        if source_docs is not None:
+            # Documents that are not in the index (e.g. empty documents)
+            # get a score of 0, like in TFIDF.compute_similarity_scores().
+            columns = np.array([self.doc2index.get(doc, num_docs)
+                                for doc in source_docs], dtype=np.int64)
+            scores = np.concatenate(
+                [scores, np.zeros((num_queries, 1))], axis=1)[:, columns]
+            norms = np.append(self.norms, 0.0)[columns]
+        else:
+            norms = self.norms
+
+        if do_length_normalization:
+            scores /= np.array([float(q[2]) for q in queries])[:, np.newaxis]
+        if use_cosine:
+            query_norms = np.array([np.sqrt(np.sum(q[1] ** 2))
+                                    for q in queries])
+            denominator = np.outer(query_norms, norms)
+            scores = np.where(denominator > 0,
+                              scores / np.maximum(denominator, 1e-30), 0.0)
+        return scores
+
+    @staticmethod
+    def top_k(scores, k):
+        """Returns the indexes of the k largest elements of the vector
+        'scores' in decreasing order of score (and increasing index for
+        equal scores), using heap selection."""
+        return [i for score, i in heapq.nsmallest(
+            k, ((-score, i) for i, score in enumerate(scores.tolist())))]
+
+    def write(self, file_handle):
+        """Writes the index in binary format (a numpy .npz archive) to an
+        opened binary file handle or file name."""
+        np.savez(file_handle,
+                 terms=np.array([" ".join(x) for x in self.terms],
+                                dtype=np.str_),
+                 doc_ids=np.array(self.doc_ids, dtype=np.str_),
+                 indptr=self.indptr, doc_indices=self.doc_indices,
+                 values=self.values)
+
+    def read(self, file_handle):
+        """Loads the index from an opened binary file handle or a file name
+        written by write()."""
+        if len(self.terms) != 0:
+            raise RuntimeError("TFIDFIndex object is not empty.")
+        with np.load(file_handle, allow_pickle=False) as arrays:
+            self.terms = [tuple(x.split(" ")) for x in arrays['terms']]
+            self.doc_ids = [str(x) for x in arrays['doc_ids']]
+            self.indptr = arrays['indptr']
+            self.doc_indices = arrays['doc_indices']
+            self.values = arrays['values']
+        self.term2id = {term: i for i, term in enumerate(self.terms)}
+        self.doc2index = {doc: i for i, doc in enumerate(self.doc_ids)}
+        if len(self.indptr) != len(self.terms) + 1:
+            raise TypeError("Invalid TF-IDF index: inconsistent number of "
+                            "terms")
+        self._compute_norms()
+
+
+def is_binary_tfidf_index(file_name):
+    """Returns True if file_name contains a TFIDFIndex written in binary
+    format by TFIDFIndex.write(), and False if it is a text TFIDF object."""
+    with open(file_name, 'rb') as f:
+        # .npz files are zip archives.
+        return f.read(2) == b'PK'
+
+
+def load_tfidf_index(file_name):
+    """Loads a TFIDFIndex from a file in either the binary format written
+    by TFIDFIndex.write() or the text format written by TFIDF.write() and
+    write_tfidf_from_stats()."""
+    index = TFIDFIndex()
+    if is_binary_tfidf_index(file_name):
+        index.read(file_name)
+    else:
+        tf_idf = TFIDF()
+        with open(file_name) as f:
+            tf_idf.read(f)
+        index.add_tfidf(tf_idf)
+    return index
+
+
 def read_key(fd):
   """ [str] = read_key(fd)
    Read the utterance-key from the opened ark/stream descriptor 'fd'.
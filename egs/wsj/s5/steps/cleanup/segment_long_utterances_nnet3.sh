@@ -385,14 +385,15 @@ if [ $stage -le 8 ]; then
       --tf-weighting-scheme="raw" \
       --idf-weighting-scheme="log" \
       --input-idf-stats=$dir/docs/idf_stats.txt \
-      $sdir/docs.JOB.txt $sdir/src_tf_idf.JOB.txt
+      --output-format=binary \
+      $sdir/docs.JOB.txt $sdir/src_tf_idf.JOB.npz
 
   sdir=$dir/docs/split$nj
   # Make $sdir an absolute pathname.
   sdir=`perl -e '($dir,$pwd)= @ARGV; if($dir!~m:^/:) { $dir = "$pwd/$dir"; } print $dir; ' $sdir ${PWD}`
 
   for n in `seq $nj`; do
-    awk -v f="$sdir/src_tf_idf.$n.txt" '{print $1" "f}' \
+    awk -v f="$sdir/src_tf_idf.$n.npz" '{print $1" "f}' \
       $sdir/text2doc.$n
   done | perl -ane 'BEGIN { %tfidfs = (); }
   {
@@ -1,10 +1,13 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # Copyright 2015  Brno University of Technology (author: Karel Vesely)
 # Apache 2.0
 
 from __future__ import print_function
-import sys, gzip, re
+import sys
+
+sys.path.insert(0, 'steps')
+import libs.arpa_lm as arpa_lm
 
 # Parse options,
 if len(sys.argv) != 4:
@@ -12,22 +15,22 @@ if len(sys.argv) != 4:
   sys.exit(0)
 words_txt, arpa_gz, unigrams_out = sys.argv[1:]
 
-if arpa_gz == '-': arpa_gz = '/dev/stdin'
 if unigrams_out == '-': unigrams_out = '/dev/stdout'
 
 # Load the words.txt,
 words = [ l.split() for l in open(words_txt) ]
 
-# Load the unigram probabilities in 10log from ARPA,
+# Load the unigram probabilities in 10log from ARPA (only the unigram section
+# is read),
 wrd_log10 = dict()
-with gzip.open(arpa_gz,'r') as f:
-  read = False
-  for l in f:
-    if l.strip() == '\\1-grams:': read = True
-    if l.strip() == '\\2-grams:': break
-    if read and len(l.split())>=2:
-      log10_p_unigram, wrd = re.split('[\t ]+',l.strip(),2)[:2]
-      wrd_log10[wrd] = float(log10_p_unigram)
+with arpa_lm.ArpaReader(arpa_gz) as reader:
+  for n, lines in reader.sections():
+    for l in lines:
+      parts = arpa_lm.split_line(l)
+      if len(parts) >= 2:
+        log10_p_unigram, wrd = parts[:2]
+        wrd_log10[wrd] = float(log10_p_unigram)
+    break
 
 # Create list, 'wrd id log_p_unigram',
 words_unigram = [[wrd, id, (wrd_log10[wrd] if wrd in wrd_log10 else -99)] for wrd,id in words ]
@@ -0,0 +1,232 @@
+# Copyright 2020  Johns Hopkins University
+# Apache 2.0
+
+""" This module maintains a persistent index of the audio in a noise or RIR
+corpus, so that the augmentation scripts (steps/data/make_musan.py,
+steps/data/augment_data_dir.py and steps/data/reverberate_data_dir.py) don't
+have to run wav-to-duration, or re-parse their RIR and noise lists, every
+time they are called.
+
+For each rxfilename (a wave file, an offset into an archive or a command
+ending in '|'), the index stores a signature of the files it reads (their
+sizes and modification times) and a hash of its content; the metadata
+(sampling rate, number of channels, number of samples and RMS) is stored by
+content hash, so renamed or copied files are not analysed again.  An entry is
+recomputed when its signature changes.  The index also caches the parsed
+lines of the RIR and noise list files given to reverberate_data_dir.py, keyed
+by the signature of the list file.
+
+The index is a JSON file:
+    {"version": 1,
+     "audio": {<rxfilename>: [<signature>, <content-hash>], ...},
+     "metadata": {<content-hash>: [<samp-freq>, <num-channels>,
+                                   <num-samples>, <rms>], ...},
+     "lists": {<filename>: [<signature>, [<parsed line>, ...]], ...}}
+It is rewritten (atomically) whenever it changes; if several scripts update
+the same index at once, some of the new entries may be lost, and they will
+be recomputed the next time they are needed.
+
+e.g.:
+    index = AudioIndex('data/musan/audio_index.json')
+    index.update(rxfilenames, num_workers=8)
+    duration = index[rxfilenames[0]].duration
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import shlex
+
+import numpy as np
+
+import libs.kaldi_io as kaldi_io
+
+
+class AudioInfo(collections.namedtuple(
+        'AudioInfo', ['samp_freq', 'num_channels', 'num_samples', 'rms'])):
+    """ Metadata of a recording; rms is over all channels, in the 16-bit
+    integer scale of the samples. """
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        """ The duration in seconds, computed in single precision like
+        WaveData::Duration(), as used by wav-to-duration. """
+        return float(np.float32(self.num_samples) / np.float32(self.samp_freq))
+
+
+def format_duration(duration):
+    """ Formats a duration the way wav-to-duration writes it (6 significant
+    digits), so that reco2dur and utt2dur files made from the index are the
+    same as those made by utils/data/get_reco2dur.sh. """
+    return '{0:g}'.format(duration)
+
+
+def _file_signature(filename):
+    stat = os.stat(filename)
+    return '{0}:{1}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def get_signature(rxfilename):
+    """ Returns a string that changes when the files read by 'rxfilename'
+    change.  For a command ending in '|', these are the words of the
+    command that are names of existing files, so e.g. a command that
+    downloads its input is never considered changed. """
+    rxfilename = rxfilename.strip()
+    if rxfilename.endswith('|'):
+        try:
+            words = shlex.split(rxfilename[:-1])
+        except ValueError:
+            words = rxfilename[:-1].split()
+        filenames = [word for word in words if os.path.isfile(word)]
+    else:
+        filenames = [kaldi_io.parse_rxfilename(rxfilename)[0]]
+    return ','.join(_file_signature(filename) for filename in filenames)
+
+
+class _HashingReader(object):
+    """ Wraps a binary file object and hashes the bytes read from it. """
+    def __init__(self, fd):
+        self.fd = fd
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        self.sha1.update(data)
+        return data
+
+
+def compute_audio_info(rxfilename):
+    """ Reads the wave data of 'rxfilename' and returns (content_hash, info),
+    where info is an AudioInfo object. """
+    fd = kaldi_io.open_or_fd(rxfilename)
+    try:
+        reader = _HashingReader(fd)
+        samp_freq, data = kaldi_io.read_wav(reader)
+        if rxfilename.strip().endswith('|'):
+            reader.read()  # the rest of the output is part of the content.
+    finally:
+        fd.close()
+    num_channels, num_samples = data.shape
+    rms = float(np.sqrt(np.mean(np.square(data, dtype=np.float64)))) \
+        if data.size > 0 else 0.0
+    return reader.sha1.hexdigest(), AudioInfo(samp_freq, num_channels,
+                                              num_samples, rms)
+
+
+def _compute_entry(args):
+    rxfilename, signature = args
+    content_hash, info = compute_audio_info(rxfilename)
+    return rxfilename, signature, content_hash, info
+
+
+class AudioIndex(object):
+    """ The persistent index described in the module docstring.  'filename'
+    is the JSON file; it is created by the first call to update() or
+    parse_list() that adds something to it. """
+    def __init__(self, filename):
+        self.filename = filename
+        self.audio = {}
+        self.metadata = {}
+        self.lists = {}
+        if os.path.exists(filename):
+            with open(filename, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == 1:
+                self.audio = index['audio']
+                self.metadata = index['metadata']
+                self.lists = index['lists']
+            else:
+                print("{0}: ignoring the index {1}, which has an unknown "
+                      "version".format(__name__, filename))
+
+    def __contains__(self, rxfilename):
+        return rxfilename in self.audio
+
+    def __getitem__(self, rxfilename):
+        """ Returns the AudioInfo of 'rxfilename', which must have been
+        indexed; it is not checked for changes (see update()). """
+        return AudioInfo(*self.metadata[self.audio[rxfilename][1]])
+
+    def update(self, rxfilenames, num_workers=1):
+        """ Makes sure the index has up-to-date entries for 'rxfilenames',
+        reading the new or changed ones with 'num_workers' processes, and
+        writes the index if anything changed. """
+        rxfilenames = sorted(set(rxfilenames))
+        stale = []
+        for rxfilename in rxfilenames:
+            signature = get_signature(rxfilename)
+            entry = self.audio.get(rxfilename)
+            if entry is None or entry[0] != signature \
+                    or entry[1] not in self.metadata:
+                stale.append((rxfilename, signature))
+        if not stale:
+            return
+        print("{0}: indexing {1} of {2} recordings ({3} were up to "
+              "date)".format(os.path.basename(self.filename), len(stale),
+                             len(rxfilenames), len(rxfilenames) - len(stale)))
+        if num_workers > 1 and len(stale) > 1:
+            pool = multiprocessing.Pool(min(num_workers, len(stale)))
+            try:
+                entries = pool.imap_unordered(_compute_entry, stale,
+                                              chunksize=16)
+                self._add_entries(entries)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            self._add_entries(map(_compute_entry, stale))
+        self.write()
+
+    def _add_entries(self, entries):
+        for rxfilename, signature, content_hash, info in entries:
+            self.audio[rxfilename] = [signature, content_hash]
+            self.metadata[content_hash] = list(info)
+
+    def get_durations(self, wav_scp, num_workers=1):
+        """ Returns a dict from recording-id to duration for the wav.scp
+        file 'wav_scp', updating the index first; the durations are
+        rounded as in reco2dur files (see format_duration()). """
+        reco2wav = {}
+        for line in open(wav_scp, 'r', encoding='utf-8'):
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                reco2wav[parts[0]] = parts[1].strip()
+        self.update(reco2wav.values(), num_workers)
+        return {reco: float(format_duration(self[wav].duration))
+                for reco, wav in reco2wav.items()}
+
+    def parse_list(self, filename, parser):
+        """ Returns the lines of 'filename' parsed by the
+        argparse.ArgumentParser 'parser' (as argparse.Namespace objects),
+        re-using the parsed lines stored in the index if the file has not
+        changed since they were stored.  The caller must always use the
+        same parser for the same file. """
+        signature = _file_signature(filename)
+        entry = self.lists.get(filename)
+        if entry is None or entry[0] != signature:
+            records = [vars(parser.parse_args(shlex.split(line.strip())))
+                       for line in open(filename)]
+            self.lists[filename] = [signature, records]
+            self.write()
+        return [argparse.Namespace(**record)
+                for record in self.lists[filename][1]]
+
+    def write(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname != '' and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_filename = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump({'version': 1, 'audio': self.audio,
+                       'metadata': self.metadata, 'lists': self.lists}, f)
+        os.rename(tmp_filename, self.filename)
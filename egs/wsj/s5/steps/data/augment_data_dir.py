@@ -60,6 +60,19 @@ def get_args():
                         help="Background noise data directory")
     parser.add_argument("--fg-noise-dir", type=str, dest="fg_noise_dir",
                         help="Foreground noise data directory")
+    parser.add_argument("--output-audio-dir", type=str, dest="output_audio_dir", default=None,
+                        help="If specified, the augmented audio is computed by this script and written "
+                        "to wave archives in this directory, and wav.scp points to them instead of "
+                        "containing wav-reverberate pipelines.  The random choices are the same as "
+                        "without this option.")
+    parser.add_argument("--num-workers", type=int, dest="num_workers", default=1,
+                        help="Number of processes used to compute the audio if --output-audio-dir "
+                        "is specified (this is also the number of archives written), and to "
+                        "update --audio-index.")
+    parser.add_argument("--audio-index", type=str, dest="audio_index", default=None,
+                        help="If specified, an index file (see steps/data/audio_index_lib.py) from which "
+                        "the durations of the noises are taken, instead of the reco2dur files of the "
+                        "noise directories; it is updated if the noises changed.")
     parser.add_argument("input_dir", help="Input data directory")
     parser.add_argument("output_dir", help="Output data directory")
 
@@ -88,6 +101,8 @@ def check_args(args):
         raise Exception("--fg-interval must be 0 or greater")
     if args.bg_noise_dir is None and args.fg_noise_dir is None:
         raise Exception("Either --fg-noise-dir or --bg-noise-dir must be specified")
+    if args.num_workers <= 0:
+        raise Exception("--num-workers must be positive")
     return args
 
 def get_noise_list(noise_wav_scp_filename):
@@ -101,8 +116,18 @@ def get_noise_list(noise_wav_scp_filename):
         noise_wavs[toks[0]] = wav.rstrip()
     return noise_utts, noise_wavs
 
+def get_noise_reco2dur(noise_dir, audio_index, num_workers):
+    # The durations come from the reco2dur file of the noise directory, or
+    # from audio_index (an audio_index_lib.AudioIndex object) if it is not None.
+    if audio_index is None:
+        return parse_file_to_dict(noise_dir + "/reco2dur",
+            value_processor = lambda x: float(x[0]))
+    return audio_index.get_durations(noise_dir + "/wav.scp", num_workers)
+
 def augment_wav(utt, wav, dur, fg_snr_opts, bg_snr_opts, fg_noise_utts, \
-    bg_noise_utts, noise_wavs, noise2dur, interval, num_opts):
+    bg_noise_utts, noise_wavs, noise2dur, interval, num_opts, augmentation=None):
+    # If 'augmentation' is a dict, it also receives the chosen noises, in the
+    # form used by steps/data/augmentation_lib.py.
     # This section is common to both foreground and background noises
     new_wav = ""
     dur_str = str(dur)
@@ -110,6 +135,7 @@ def augment_wav(utt, wav, dur, fg_snr_opts, bg_snr_opts, fg_noise_utts, \
     tot_noise_dur = 0
     snrs=[]
     noises=[]
+    signals=[]
     start_times=[]
 
     # Now handle the background noises
@@ -123,6 +149,7 @@ def augment_wav(utt, wav, dur, fg_snr_opts, bg_snr_opts, fg_noise_utts, \
             snrs.append(snr)
             start_times.append(0)
             noises.append(noise)
+            signals.append({'input': noise_wavs[noise_utt], 'duration': dur})
 
     # Now handle the foreground noises
     if len(fg_noise_utts) > 0:
@@ -135,11 +162,19 @@ def augment_wav(utt, wav, dur, fg_snr_opts, bg_snr_opts, fg_noise_utts, \
             start_times.append(tot_noise_dur)
             tot_noise_dur += noise_dur + interval
             noises.append(noise)
+            signals.append(noise)
 
     start_times_str = "--start-times='" + ",".join([str(i) for i in start_times]) + "'"
     snrs_str = "--snrs='" + ",".join([str(i) for i in snrs]) + "'"
     noises_str = "--additive-signals='" + ",".join(noises).strip() + "'"
 
+    if augmentation is not None:
+        augmentation.update({'input': wav,
+                             'additive_signals': signals,
+                             'start_times': start_times,
+                             'snrs': snrs,
+                             'shift_output': True})
+
     # If the wav is just a file
     if wav.strip()[-1] != "|":
         new_wav = "wav-reverberate --shift-output=true " + noises_str + " " \
@@ -211,12 +246,17 @@ def main():
     bg_noise_utts = []
     fg_noise_utts = []
 
+    audio_index = None
+    if args.audio_index is not None:
+        import audio_index_lib
+        audio_index = audio_index_lib.AudioIndex(args.audio_index)
+
     # Load background noises
     if args.bg_noise_dir:
         bg_noise_wav_filename = args.bg_noise_dir + "/wav.scp"
         bg_noise_utts, bg_noise_wavs = get_noise_list(bg_noise_wav_filename)
-        bg_noise_reco2dur = parse_file_to_dict(args.bg_noise_dir + "/reco2dur",
-            value_processor = lambda x: float(x[0]))
+        bg_noise_reco2dur = get_noise_reco2dur(args.bg_noise_dir, audio_index,
+            args.num_workers)
         noise_wavs.update(bg_noise_wavs)
         noise_reco2dur.update(bg_noise_reco2dur)
 
@@ -225,14 +265,15 @@ def main():
         fg_noise_wav_filename = args.fg_noise_dir + "/wav.scp"
         fg_noise_reco2dur_filename = args.fg_noise_dir + "/reco2dur"
         fg_noise_utts, fg_noise_wavs = get_noise_list(fg_noise_wav_filename)
-        fg_noise_reco2dur = parse_file_to_dict(args.fg_noise_dir + "/reco2dur",
-            value_processor = lambda x: float(x[0]))
+        fg_noise_reco2dur = get_noise_reco2dur(args.fg_noise_dir, audio_index,
+            args.num_workers)
         noise_wavs.update(fg_noise_wavs)
         noise_reco2dur.update(fg_noise_reco2dur)
 
     random.seed(args.random_seed)
     new_utt2wav = {}
     new_utt2spk = {}
+    augmentations = {}
 
     # Augment each line in the wav file
     for line in wav_scp_file:
@@ -240,17 +281,26 @@ def main():
         utt = toks[0]
         wav = " ".join(toks[1:])
         dur = reco2dur[utt]
+        augmentation = {}
         new_wav = augment_wav(utt, wav, dur, fg_snrs, bg_snrs, fg_noise_utts,
             bg_noise_utts, noise_wavs, noise_reco2dur, args.fg_interval,
-            num_bg_noises)
+            num_bg_noises, augmentation)
 
         new_utt = get_new_id(utt, args.utt_modifier_type, args.utt_modifier)
 
         new_utt2wav[new_utt] = new_wav
+        augmentations[new_utt] = augmentation
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    if args.output_audio_dir is not None:
+        import augmentation_lib
+        print("Writing the audio of {0} augmented recordings to {1}".format(
+            len(augmentations), args.output_audio_dir))
+        new_utt2wav.update(augmentation_lib.materialize(
+            augmentations, args.output_audio_dir, args.num_workers))
+
     write_dict_to_file(new_utt2wav, output_dir + "/wav.scp")
     copy_file_if_exists(input_dir + "/reco2dur", output_dir + "/reco2dur",
                                 args.utt_modifier_type, args.utt_modifier)
@@ -0,0 +1,350 @@
+# Copyright 2020  Johns Hopkins University
+# Apache 2.0
+
+""" This module computes the augmented audio that steps/data/reverberate_data_dir.py
+and steps/data/augment_data_dir.py otherwise describe as 'wav-reverberate ... |'
+pipelines in wav.scp.  Those pipelines are re-run, and their impulse responses
+and noises re-read, every time the data is read (e.g. by each feature
+extraction run); when the scripts are called with --output-audio-dir, the
+audio is computed once here and written to wave archives instead.
+
+An augmentation is described by a dict with the options of one call of
+wav-reverberate (see src/featbin/wav-reverberate.cc):
+    {'input': <rxfilename or description>,
+     'impulse_response': <rxfilename>,                  # optional
+     'additive_signals': [<rxfilename or description>, ...],  # optional
+     'start_times': [<seconds>, ...],                   # one per additive signal
+     'snrs': [<dB>, ...],                               # one per additive signal
+     'duration': <seconds>,           # optional; 0 means the input's duration
+     'shift_output': <bool>}          # optional; True by default
+where additive signals may themselves be descriptions, e.g. a noise that is
+reverberated and extended to the duration of the speech.
+
+The impulse responses and additive signals are read once, by
+SharedSignals, into shared memory that the worker processes of
+materialize() use directly; only the top-level inputs (the speech) are
+read per recording.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import os
+
+import numpy as np
+
+import libs.kaldi_io as kaldi_io
+
+
+def fft_convolve(signal, filter):
+    """ Returns the full linear convolution of 'signal' and 'filter' (of
+    length len(signal) + len(filter) - 1), computed with FFTs by overlap-add
+    like FFTbasedBlockConvolveSignals() in src/feat/signal.cc.  The blocks are
+    processed a few at a time to bound the memory used for long signals. """
+    signal_length = len(signal)
+    filter_length = len(filter)
+    output_length = signal_length + filter_length - 1
+    fft_length = 1
+    while fft_length < 4 * filter_length:
+        fft_length *= 2
+    block_length = fft_length - filter_length + 1
+    num_blocks = (signal_length + block_length - 1) // block_length
+
+    filter_fft = np.fft.rfft(filter, fft_length)
+    # one extra block at the end for the tail of the last block.
+    output = np.zeros((num_blocks + 1) * block_length)
+    padded_signal = np.zeros(num_blocks * block_length)
+    padded_signal[0:signal_length] = signal
+    blocks = padded_signal.reshape(num_blocks, block_length)
+    blocks_per_chunk = max(1, (1 << 22) // fft_length)
+    for first in range(0, num_blocks, blocks_per_chunk):
+        last = min(first + blocks_per_chunk, num_blocks)
+        convolved = np.fft.irfft(np.fft.rfft(blocks[first:last], fft_length, axis=1)
+                                 * filter_fft, fft_length, axis=1)
+        # the first block_length samples of each convolved block go to its
+        # own block, the next filter_length - 1 to the start of the next one.
+        output[first * block_length:last * block_length] += \
+            convolved[:, 0:block_length].ravel()
+        if filter_length > 1:
+            output[(first + 1) * block_length:(last + 1) * block_length].reshape(
+                last - first, block_length)[:, 0:filter_length - 1] += \
+                convolved[:, block_length:block_length + filter_length - 1]
+    return output[0:output_length]
+
+
+def compute_early_reverb_energy(rir, signal, samp_freq):
+    """ Returns the power of 'signal' convolved with the early part of 'rir'
+    (from 1 ms before its peak to 50 ms after it), as
+    ComputeEarlyReverbEnergy() in wav-reverberate.cc does; this is what the
+    SNRs of the added noises are relative to. """
+    peak_index = int(np.argmax(rir))
+    early_rir_start_index = max(0, int(peak_index - 0.001 * samp_freq))
+    early_rir_end_index = min(len(rir), int(peak_index + 0.05 * samp_freq))
+    early_reverb = fft_convolve(signal, rir[early_rir_start_index:early_rir_end_index])
+    return np.dot(early_reverb, early_reverb) / len(early_reverb)
+
+
+def wav_reverberate(input, samp_freq, impulse_response=None,
+                    additive_signals=(), start_times=(), snrs=(),
+                    duration=0, shift_output=True, normalize_output=True):
+    """ Does what wav-reverberate does to a single channel: 'input',
+    'impulse_response' and the elements of 'additive_signals' are 1-d arrays
+    of samples in the 16-bit integer scale, all at 'samp_freq'.  The input is
+    convolved with the impulse response (scaled by 1/32768), the additive
+    signals are scaled to the given SNRs relative to the early reverberation
+    energy and added at the given start times, and the result is scaled back
+    to the power of the input (if normalize_output), then shifted by the peak
+    of the impulse response (if shift_output) and trimmed or cyclically
+    extended to 'duration' seconds (if nonzero).  Returns a float64 array.
+    """
+    if not len(additive_signals) == len(start_times) == len(snrs):
+        raise ValueError("The numbers of additive signals ({0}), start times "
+                         "({1}) and snrs ({2}) differ".format(
+                             len(additive_signals), len(start_times), len(snrs)))
+    signal = np.asarray(input, dtype=np.float64)
+    num_samp_input = len(signal)
+    num_samp_rir = 1 if impulse_response is None else len(impulse_response)
+    if duration > 0:
+        # in single precision, as in the binary.
+        num_samp_output = int(np.float32(samp_freq) * np.float32(duration))
+    elif shift_output:
+        num_samp_output = num_samp_input
+    else:
+        num_samp_output = num_samp_input + num_samp_rir - 1
+
+    power_before_reverb = np.dot(signal, signal) / num_samp_input
+    early_energy = power_before_reverb
+    shift_index = 0
+    if impulse_response is not None:
+        rir = np.asarray(impulse_response, dtype=np.float64) / (1 << 15)
+        early_energy = compute_early_reverb_energy(rir, signal, samp_freq)
+        signal = fft_convolve(signal, rir)
+        if shift_output:
+            shift_index = int(np.argmax(rir))
+    else:
+        signal = signal.copy()
+
+    for noise, start_time, snr in zip(additive_signals, start_times, snrs):
+        noise = np.asarray(noise, dtype=np.float64)
+        noise_power = np.dot(noise, noise) / len(noise)
+        scale = np.sqrt(10 ** (-float(snr) / 10) * early_energy / noise_power)
+        offset = int(float(start_time) * samp_freq)
+        add_length = min(len(signal) - offset, len(noise))
+        if add_length > 0:
+            signal[offset:offset + add_length] += scale * noise[0:add_length]
+
+    power_after_reverb = np.dot(signal, signal) / len(signal)
+    if normalize_output and power_after_reverb > 0:
+        signal *= np.sqrt(power_before_reverb / power_after_reverb)
+
+    if num_samp_output <= num_samp_input:
+        return signal[shift_index:shift_index + num_samp_output]
+    # repeat the signal to fill up the duration.
+    num_repeats = (num_samp_output + len(signal) - 1) // len(signal)
+    return np.tile(signal, num_repeats)[0:num_samp_output]
+
+
+def _is_description(source):
+    return isinstance(source, dict)
+
+
+def get_shared_rxfilenames(descriptions):
+    """ Returns the sorted list of the rxfilenames of the impulse responses
+    and additive signals used in 'descriptions' (an iterable of
+    descriptions), including those inside nested descriptions. """
+    rxfilenames = set()
+
+    def add_signals(description, is_top_level):
+        if not is_top_level:
+            if _is_description(description['input']):
+                add_signals(description['input'], False)
+            else:
+                rxfilenames.add(description['input'])
+        if description.get('impulse_response') is not None:
+            rxfilenames.add(description['impulse_response'])
+        for signal in description.get('additive_signals', []):
+            if _is_description(signal):
+                add_signals(signal, False)
+            else:
+                rxfilenames.add(signal)
+
+    for description in descriptions:
+        add_signals(description, True)
+    return sorted(rxfilenames)
+
+
+class SharedSignals(object):
+    """ Holds the first channel of a set of wave files, keyed by rxfilename,
+    in shared memory (multiprocessing.RawArray), so that processes started
+    after it was created (e.g. the workers of a multiprocessing.Pool that
+    get it as an initializer argument) can use the same memory.  Signals
+    whose samples are all 16-bit integers, as is the case for 16-bit wave
+    files, are stored as int16 to halve the memory.
+
+    e.g.:
+        signals = SharedSignals(['rir1.wav', 'sox noise1.wav -t wav - |'])
+        samp_freq, samples = signals['rir1.wav']
+    """
+    def __init__(self, rxfilenames):
+        # index[rxfilename] = (buffer, offset, length, samp_freq), where
+        # buffer is 0 for int16 and 1 for float32 samples.
+        self.index = {}
+        signals = []
+        sizes = [0, 0]
+        for rxfilename in rxfilenames:
+            samp_freq, data = kaldi_io.read_wav(rxfilename)
+            samples = data[0]
+            as_int16 = samples.astype(np.int16)
+            if np.array_equal(as_int16, samples):
+                buffer, samples = 0, as_int16
+            else:
+                buffer = 1
+            self.index[rxfilename] = (buffer, sizes[buffer], len(samples), samp_freq)
+            sizes[buffer] += len(samples)
+            signals.append(samples)
+        self.buffers = [multiprocessing.RawArray('h', sizes[0]),
+                        multiprocessing.RawArray('f', sizes[1])]
+        for rxfilename, samples in zip(rxfilenames, signals):
+            buffer, offset, length, _ = self.index[rxfilename]
+            self._array(buffer)[offset:offset + length] = samples
+        self._arrays = None
+
+    def _array(self, buffer):
+        return np.frombuffer(self.buffers[buffer],
+                             dtype=(np.int16 if buffer == 0 else np.float32))
+
+    def __getstate__(self):
+        # the numpy views can't be pickled; they are recreated on demand.
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __contains__(self, rxfilename):
+        return rxfilename in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def total_duration(self):
+        """ Returns the total duration of the signals, in seconds. """
+        return sum(length / samp_freq
+                   for _, _, length, samp_freq in self.index.values())
+
+    def __getitem__(self, rxfilename):
+        """ Returns (samp_freq, samples); samples is a read-only view. """
+        if self._arrays is None:
+            self._arrays = [self._array(0), self._array(1)]
+        buffer, offset, length, samp_freq = self.index[rxfilename]
+        samples = self._arrays[buffer][offset:offset + length]
+        samples.flags.writeable = False
+        return samp_freq, samples
+
+
+def _read_signal(source, signals):
+    """ Returns (samp_freq, samples) for 'source', which is a description
+    or an rxfilename; rxfilenames in 'signals' are not read again. """
+    if _is_description(source):
+        return render(source, signals)
+    if source in signals:
+        return signals[source]
+    samp_freq, data = kaldi_io.read_wav(source)
+    return samp_freq, data[0]
+
+
+def render(description, signals):
+    """ Computes the audio for 'description' (see the module docstring) and
+    returns (samp_freq, samples).  'signals' is a SharedSignals object (or a
+    dict) with the impulse responses and noises; other rxfilenames are
+    read as needed. """
+    samp_freq, input = _read_signal(description['input'], signals)
+    impulse_response = None
+    if description.get('impulse_response') is not None:
+        rir_samp_freq, impulse_response = _read_signal(
+            description['impulse_response'], signals)
+        if rir_samp_freq != samp_freq:
+            raise ValueError("Sampling rate of impulse response {0} ({1}) "
+                             "differs from that of the input ({2})".format(
+                                 description['impulse_response'],
+                                 rir_samp_freq, samp_freq))
+    additive_signals = []
+    for source in description.get('additive_signals', []):
+        noise_samp_freq, noise = _read_signal(source, signals)
+        if noise_samp_freq != samp_freq:
+            raise ValueError("Sampling rate of additive signal {0} ({1}) "
+                             "differs from that of the input ({2})".format(
+                                 source, noise_samp_freq, samp_freq))
+        additive_signals.append(noise)
+    output = wav_reverberate(
+        input, samp_freq, impulse_response=impulse_response,
+        additive_signals=additive_signals,
+        start_times=description.get('start_times', []),
+        snrs=description.get('snrs', []),
+        duration=description.get('duration', 0),
+        shift_output=description.get('shift_output', True))
+    return samp_freq, output
+
+
+_worker_signals = None
+
+
+def _init_worker(signals):
+    global _worker_signals
+    _worker_signals = signals
+
+
+def _write_shard(args):
+    """ Renders the (key, description) pairs in 'items' and writes them to
+    the archive 'ark' and the scp file 'scp'. """
+    ark, scp, items = args
+    with kaldi_io.ArkScpWriter(ark, scp) as writer:
+        for key, description in items:
+            samp_freq, samples = render(description, _worker_signals)
+            writer.write_wav(key, samples, samp_freq)
+    return scp
+
+
+def materialize(descriptions, output_dir, num_workers=1):
+    """ Computes the audio for each description in the dict 'descriptions'
+    (recording-id -> description), with 'num_workers' processes, and writes
+    it to the wave archives output_dir/wav.{1..num_workers}.ark.  Returns a
+    dict from recording-id to the rxfilename of its audio (e.g.
+    'output_dir/wav.1.ark:1234'), for use in wav.scp.  The impulse responses
+    and noises are read once, before the workers start, into shared memory.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    signals = SharedSignals(get_shared_rxfilenames(descriptions.values()))
+    print("Loaded {0} impulse responses and noises ({1:.2f} hours) into "
+          "shared memory".format(len(signals),
+                                 signals.total_duration() / 3600))
+
+    # the recordings are assigned to the archives in turn, so that each
+    # worker gets a similar mix of short and long ones.
+    keys = sorted(descriptions.keys())
+    num_shards = max(1, min(num_workers, len(keys)))
+    shards = [('{0}/wav.{1}.ark'.format(output_dir, n + 1),
+               '{0}/wav.{1}.scp'.format(output_dir, n + 1),
+               [(key, descriptions[key]) for key in keys[n::num_shards]])
+              for n in range(num_shards)]
+    if num_shards == 1:
+        _init_worker(signals)
+        scps = [_write_shard(shards[0])]
+    else:
+        pool = multiprocessing.Pool(num_shards, initializer=_init_worker,
+                                    initargs=(signals,))
+        try:
+            scps = pool.map(_write_shard, shards, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    locations = {}
+    for scp in scps:
+        for line in open(scp):
+            key, rxfilename = line.split()
+            locations[key] = rxfilename
+    return locations
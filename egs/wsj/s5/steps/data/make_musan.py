@@ -22,6 +22,12 @@ def get_args():
                         help="Sampling rate of the source data. If a positive integer is specified with this option, "
                         "the MUSAN corpus will be resampled to the rate of the source data."
                         "Original MUSAN corpus is sampled at 16KHz. Defaults to 16000 Hz")
+    parser.add_argument('--audio-index', type=str, default=None,
+                        help="If specified, an index file (see steps/data/audio_index_lib.py) that is "
+                        "updated with the MUSAN recordings and used to write reco2dur and utt2dur, "
+                        "so they don't have to be computed with wav-to-duration.")
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help="Number of processes used to update --audio-index")
     parser.add_argument("in_dir", help="Input data directory")
     parser.add_argument("out_dir", help="Output data directory")
 
@@ -37,6 +43,8 @@ def check_args(args):
     if not os.path.exists(args.out_dir):
         print("Preparing {0}/musan...".format(args.out_dir))
         os.makedirs(args.out_dir)
+    if args.num_workers <= 0:
+        raise Exception('--num-workers must be positive')
 
     return args
 
@@ -173,6 +181,19 @@ def main():
     utt2spk_fi = open(os.path.join(out_dir, "utt2spk"), 'w')
     utt2spk_fi.write(utt2spk)
 
+    if args.audio_index is not None:
+        import audio_index_lib
+        wav_fi.close()
+        audio_index = audio_index_lib.AudioIndex(args.audio_index)
+        reco2dur = audio_index.get_durations(os.path.join(out_dir, "wav.scp"),
+                                             args.num_workers)
+        # The recording-ids are the utterance-ids.
+        for name in ["reco2dur", "utt2dur"]:
+            with open(os.path.join(out_dir, name), 'w') as f:
+                for reco in sorted(reco2dur):
+                    f.write("{0} {1}\n".format(
+                        reco, audio_index_lib.format_duration(reco2dur[reco])))
+
 
 if __name__=="__main__":
     main()
@@ -20,6 +20,10 @@
 set -e
 use_vocals=true
 sampling_rate=16000
+audio_index=   # if set, a file in which the metadata of the recordings is
+               # cached (see steps/data/audio_index_lib.py); it's used to get
+               # their durations instead of wav-to-duration.
+num_workers=1  # number of processes used to update $audio_index
 stage=0
 
 echo "$0 $@"  # Print the command line for logging
@@ -34,6 +38,8 @@ if [ $# -ne 2 ]; then
     echo "main options (for others, see top of script file)"
     echo "  --sampling-rate <sampling frequency>        # Sampling frequency of source dir"
     echo "  --use-vocals <true/false>        # Use vocals from music portion of MUSAN corpus"
+    echo "  --audio-index <index-file>       # Cache of the durations etc. of the recordings"
+    echo "  --num-workers <n>                # Number of processes used to update the audio index"
     exit 1;
 fi
 
@@ -45,6 +51,7 @@ mkdir -p local/musan.tmp
 # The below script will create the musan corpus
 steps/data/make_musan.py --use-vocals ${use_vocals} \
                         --sampling-rate ${sampling_rate} \
+                        ${audio_index:+--audio-index $audio_index --num-workers $num_workers} \
                         ${in_dir} ${data_dir}/musan || exit 1;
 
 utils/fix_data_dir.sh ${data_dir}/musan
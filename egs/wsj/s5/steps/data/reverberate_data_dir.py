@@ -8,6 +8,7 @@
 import argparse, shlex, glob, math, os, random, sys, warnings, copy, imp, ast
 
 data_lib = imp.load_source('dml', 'steps/data/data_dir_manipulation_lib.py')
+sys.path.insert(0, 'steps')
 
 def get_args():
     # we add required arguments as named arguments for readability
@@ -71,6 +72,16 @@ def get_args():
                         "the RIRs/noises will be resampled to the rate of the source data.")
     parser.add_argument("--include-original-data", type=str, help="If true, the output data includes one copy of the original data",
                          choices=['true', 'false'], default = "false")
+    parser.add_argument("--output-audio-dir", type=str, default = None,
+                        help="If specified, the reverberated audio is computed by this script and written to wave archives "
+                        "in this directory, and wav.scp points to them instead of containing wav-reverberate pipelines. "
+                        "The random choices are the same as without this option.")
+    parser.add_argument("--num-workers", type=int, default = 1,
+                        help="Number of processes used to compute the audio if --output-audio-dir is specified; "
+                        "this is also the number of archives written.")
+    parser.add_argument("--audio-index", type=str, default = None,
+                        help="If specified, an index file (see steps/data/audio_index_lib.py) in which the parsed "
+                        "RIR and noise lists are cached, so they are only parsed again when they change.")
     parser.add_argument("input_dir",
                         help="Input data directory")
     parser.add_argument("output_dir",
@@ -113,6 +124,9 @@ def check_args(args):
     if args.source_sampling_rate is not None and args.source_sampling_rate <= 0:
         raise Exception("--source-sampling-rate cannot be non-positive")
 
+    if args.num_workers <= 0:
+        raise Exception("--num-workers must be positive")
+
     return args
 
 
@@ -218,10 +232,15 @@ def add_point_source_noise(noise_addition_descriptor,  # descriptor to store the
             # if it is a foreground noise, the noise will not extended and be added at a random time of the speech
             if noise.bg_fg_type == "background":
                 noise_rvb_command = """wav-reverberate --impulse-response="{0}" --duration={1}""".format(noise_rir.rir_rspecifier, speech_dur)
+                noise_addition_descriptor['signals'].append({'input': noise.noise_rspecifier,
+                                                             'impulse_response': noise_rir.rir_rspecifier,
+                                                             'duration': speech_dur})
                 noise_addition_descriptor['start_times'].append(0)
                 noise_addition_descriptor['snrs'].append(next(background_snrs))
             else:
                 noise_rvb_command = """wav-reverberate --impulse-response="{0}" """.format(noise_rir.rir_rspecifier)
+                noise_addition_descriptor['signals'].append({'input': noise.noise_rspecifier,
+                                                             'impulse_response': noise_rir.rir_rspecifier})
                 noise_addition_descriptor['start_times'].append(round(random.random() * speech_dur, 2))
                 noise_addition_descriptor['snrs'].append(next(foreground_snrs))
 
@@ -243,7 +262,8 @@ def generate_reverberation_opts(room_dict,  # the room dictionary, please refer
                               isotropic_noise_addition_probability, # Probability of adding isotropic noises
                               pointsource_noise_addition_probability, # Probability of adding point-source noises
                               speech_dur,  # duration of the recording
-                              max_noises_recording  # Maximum number of point-source noises that can be added
+                              max_noises_recording,  # Maximum number of point-source noises that can be added
+                              reverberation = None  # if not None, a dict that receives the same options in the form used by augmentation_lib.py
                               ):
     """ This function randomly decides whether to reverberate, and sample a RIR if it does
         It also decides whether to add the appropriate noises
@@ -251,8 +271,11 @@ def generate_reverberation_opts(room_dict,  # the room dictionary, please refer
     """
     reverberate_opts = ""
     noise_addition_descriptor = {'noise_io': [],
+                                 'signals': [],
                                  'start_times': [],
                                  'snrs': []}
+    if reverberation is None:
+        reverberation = {}
     # Randomly select the room
     # Here the room probability is a sum of the probabilities of the RIRs recorded in the room.
     room = pick_item_with_probability(room_dict)
@@ -261,6 +284,7 @@ def generate_reverberation_opts(room_dict,  # the room dictionary, please refer
     if random.random() < speech_rvb_probability:
         # pick the RIR to reverberate the speech
         reverberate_opts += """--impulse-response="{0}" """.format(speech_rir.rir_rspecifier)
+        reverberation['impulse_response'] = speech_rir.rir_rspecifier
 
     rir_iso_noise_list = []
     if speech_rir.room_id in iso_noise_dict:
@@ -274,6 +298,8 @@ def generate_reverberation_opts(room_dict,  # the room dictionary, please refer
             noise_addition_descriptor['noise_io'].append("wav-reverberate --duration={1} {0} - |".format(isotropic_noise.noise_rspecifier, speech_dur))
         else:
             noise_addition_descriptor['noise_io'].append("{0} wav-reverberate --duration={1} - - |".format(isotropic_noise.noise_rspecifier, speech_dur))
+        noise_addition_descriptor['signals'].append({'input': isotropic_noise.noise_rspecifier,
+                                                     'duration': speech_dur})
         noise_addition_descriptor['start_times'].append(0)
         noise_addition_descriptor['snrs'].append(next(background_snrs))
 
@@ -293,6 +319,9 @@ def generate_reverberation_opts(room_dict,  # the room dictionary, please refer
         reverberate_opts += "--additive-signals='{0}' ".format(','.join(noise_addition_descriptor['noise_io']))
         reverberate_opts += "--start-times='{0}' ".format(','.join([str(x) for x in noise_addition_descriptor['start_times']]))
         reverberate_opts += "--snrs='{0}' ".format(','.join([str(x) for x in noise_addition_descriptor['snrs']]))
+        reverberation['additive_signals'] = noise_addition_descriptor['signals']
+        reverberation['start_times'] = noise_addition_descriptor['start_times']
+        reverberation['snrs'] = noise_addition_descriptor['snrs']
 
     return reverberate_opts
 
@@ -324,16 +353,21 @@ def generate_reverberated_wav_scp(wav_scp,  # a dictionary whose values are the
                                shift_output, # option whether to shift the output waveform
                                isotropic_noise_addition_probability, # Probability of adding isotropic noises
                                pointsource_noise_addition_probability, # Probability of adding point-source noises
-                               max_noises_per_minute # maximum number of point-source noises that can be added to a recording according to its duration
+                               max_noises_per_minute, # maximum number of point-source noises that can be added to a recording according to its duration
+                               output_audio_dir = None, # if not None, directory to write the corrupted audio to
+                               num_workers = 1 # number of processes used to compute the corrupted audio
                                ):
     """ This is the main function to generate pipeline command for the corruption
         The generic command of wav-reverberate will be like:
         wav-reverberate --duration=t --impulse-response=rir.wav
         --additive-signals='noise1.wav,noise2.wav' --snrs='snr1,snr2' --start-times='s1,s2' input.wav output.wav
+        If output_audio_dir is given, the corrupted audio is instead computed by
+        augmentation_lib.py with the same options, and written to archives in that directory.
     """
     foreground_snrs = list_cyclic_iterator(foreground_snr_array)
     background_snrs = list_cyclic_iterator(background_snr_array)
     corrupted_wav_scp = {}
+    reverberations = {}
     keys = sorted(wav_scp.keys())
     if include_original:
         start_index = 0
@@ -349,6 +383,8 @@ def generate_reverberated_wav_scp(wav_scp,  # a dictionary whose values are the
             speech_dur = durations[recording_id]
             max_noises_recording = math.floor(max_noises_per_minute * speech_dur / 60)
 
+            reverberation = {'input': wav_scp[recording_id],
+                             'shift_output': shift_output == "true"}
             reverberate_opts = generate_reverberation_opts(room_dict,  # the room dictionary, please refer to make_room_dict() for the format
                                                          pointsource_noise_list, # the point source noise list
                                                          iso_noise_dict, # the isotropic noise dictionary
@@ -358,7 +394,8 @@ def generate_reverberated_wav_scp(wav_scp,  # a dictionary whose values are the
                                                          isotropic_noise_addition_probability, # Probability of adding isotropic noises
                                                          pointsource_noise_addition_probability, # Probability of adding point-source noises
                                                          speech_dur,  # duration of the recording
-                                                         max_noises_recording  # Maximum number of point-source noises that can be added
+                                                         max_noises_recording,  # Maximum number of point-source noises that can be added
+                                                         reverberation
                                                          )
 
             # prefix using index 0 is reserved for original data e.g. rvb0_swb0035 corresponds to the swb0035 recording in original data
@@ -369,6 +406,13 @@ def generate_reverberated_wav_scp(wav_scp,  # a dictionary whose values are the
 
             new_recording_id = get_new_id(recording_id, prefix, i)
             corrupted_wav_scp[new_recording_id] = wav_corrupted_pipe
+            if not (reverberate_opts == "" or i == 0):
+                reverberations[new_recording_id] = reverberation
+
+    if output_audio_dir is not None:
+        import augmentation_lib
+        print("Writing the audio of {0} reverberated recordings to {1}".format(len(reverberations), output_audio_dir))
+        corrupted_wav_scp.update(augmentation_lib.materialize(reverberations, output_audio_dir, num_workers))
 
     write_dict_to_file(corrupted_wav_scp, output_dir + "/wav.scp")
 
@@ -409,7 +453,9 @@ def create_reverberated_copy(input_dir,
                            shift_output, # option whether to shift the output waveform
                            isotropic_noise_addition_probability, # Probability of adding isotropic noises
                            pointsource_noise_addition_probability, # Probability of adding point-source noises
-                           max_noises_per_minute  # maximum number of point-source noises that can be added to a recording according to its duration
+                           max_noises_per_minute,  # maximum number of point-source noises that can be added to a recording according to its duration
+                           output_audio_dir = None, # if not None, directory to write the corrupted audio to
+                           num_workers = 1 # number of processes used to compute the corrupted audio
                            ):
     """ This function creates multiple copies of the necessary files,
         e.g. utt2spk, wav.scp ...
@@ -427,7 +473,8 @@ def create_reverberated_copy(input_dir,
     generate_reverberated_wav_scp(wav_scp, durations, output_dir, room_dict, pointsource_noise_list, iso_noise_dict,
                foreground_snr_array, background_snr_array, num_replicas, include_original, prefix,
                speech_rvb_probability, shift_output, isotropic_noise_addition_probability,
-               pointsource_noise_addition_probability, max_noises_per_minute)
+               pointsource_noise_addition_probability, max_noises_per_minute,
+               output_audio_dir, num_workers)
 
     add_prefix_to_fields(input_dir + "/utt2spk", output_dir + "/utt2spk", num_replicas, include_original, prefix, field = [0,1])
     data_lib.RunKaldiCommand("utils/utt2spk_to_spk2utt.pl <{output_dir}/utt2spk >{output_dir}/spk2utt"
@@ -510,11 +557,13 @@ def parse_set_parameter_strings(set_para_array):
     return smooth_probability_distribution(set_list)
 
 
-def parse_rir_list(rir_set_para_array, smoothing_weight, sampling_rate = None):
+def parse_rir_list(rir_set_para_array, smoothing_weight, sampling_rate = None, audio_index = None):
     """ This function creates the RIR list
         Each rir object in the list contains the following attributes:
         rir_id, room_id, receiver_position_id, source_position_id, rt60, drr, probability
         Please refer to the help messages in the parser for the meaning of these attributes
+        If audio_index (an audio_index_lib.AudioIndex object) is given, the parsed
+        lines of the RIR list files are cached in it.
     """
     rir_parser = argparse.ArgumentParser()
     rir_parser.add_argument('--rir-id', type=str, required=True, help='This id is unique for each RIR and the noise may associate with a particular RIR by refering to this id')
@@ -532,7 +581,10 @@ def parse_rir_list(rir_set_para_array, smoothing_weight, sampling_rate = None):
 
     rir_list = []
     for rir_set in set_list:
-        current_rir_list = [rir_parser.parse_args(shlex.split(x.strip())) for x in open(rir_set.filename)]
+        if audio_index is None:
+            current_rir_list = [rir_parser.parse_args(shlex.split(x.strip())) for x in open(rir_set.filename)]
+        else:
+            current_rir_list = audio_index.parse_list(rir_set.filename, rir_parser)
         for rir in current_rir_list:
             if sampling_rate is not None:
                 # check if the rspecifier is a pipe or not
@@ -575,7 +627,7 @@ def make_room_dict(rir_list):
 
     return room_dict
 
-def parse_noise_list(noise_set_para_array, smoothing_weight, sampling_rate = None):
+def parse_noise_list(noise_set_para_array, smoothing_weight, sampling_rate = None, audio_index = None):
     """ This function creates the point-source noise list
          and the isotropic noise dictionary from the noise information file
          The isotropic noise dictionary is indexed by the room
@@ -583,6 +635,8 @@ def parse_noise_list(noise_set_para_array, smoothing_weight, sampling_rate = Non
          Each noise object in the list contains the following attributes:
          noise_id, noise_type, bg_fg_type, room_linkage, probability, noise_rspecifier
          Please refer to the help messages in the parser for the meaning of these attributes
+         If audio_index (an audio_index_lib.AudioIndex object) is given, the parsed
+         lines of the noise list files are cached in it.
     """
     noise_parser = argparse.ArgumentParser()
     noise_parser.add_argument('--noise-id', type=str, required=True, help='noise id')
@@ -600,7 +654,10 @@ def parse_noise_list(noise_set_para_array, smoothing_weight, sampling_rate = Non
     pointsource_noise_list = []
     iso_noise_dict = {}
     for noise_set in set_list:
-        current_noise_list = [noise_parser.parse_args(shlex.split(x.strip())) for x in open(noise_set.filename)]
+        if audio_index is None:
+            current_noise_list = [noise_parser.parse_args(shlex.split(x.strip())) for x in open(noise_set.filename)]
+        else:
+            current_noise_list = audio_index.parse_list(noise_set.filename, noise_parser)
         current_pointsource_noise_list = []
         for noise in current_noise_list:
             if sampling_rate is not None:
@@ -638,15 +695,22 @@ def parse_noise_list(noise_set_para_array, smoothing_weight, sampling_rate = Non
 def main():
     args = get_args()
 
+    audio_index = None
+    if args.audio_index is not None:
+        import audio_index_lib
+        audio_index = audio_index_lib.AudioIndex(args.audio_index)
+
     random.seed(args.random_seed)
-    rir_list = parse_rir_list(args.rir_set_para_array, args.rir_smoothing_weight, args.source_sampling_rate)
+    rir_list = parse_rir_list(args.rir_set_para_array, args.rir_smoothing_weight, args.source_sampling_rate,
+                              audio_index)
     print("Number of RIRs is {0}".format(len(rir_list)))
     pointsource_noise_list = []
     iso_noise_dict = {}
     if args.noise_set_para_array is not None:
         pointsource_noise_list, iso_noise_dict = parse_noise_list(args.noise_set_para_array,
                                                                 args.noise_smoothing_weight,
-                                                                args.source_sampling_rate)
+                                                                args.source_sampling_rate,
+                                                                audio_index)
         print("Number of point-source noises is {0}".format(len(pointsource_noise_list)))
         print("Number of isotropic noises is {0}".format(sum(len(iso_noise_dict[key]) for key in iso_noise_dict.keys())))
     room_dict = make_room_dict(rir_list)
@@ -669,7 +733,9 @@ def main():
                            shift_output = args.shift_output,
                            isotropic_noise_addition_probability = args.isotropic_noise_addition_probability,
                            pointsource_noise_addition_probability = args.pointsource_noise_addition_probability,
-                           max_noises_per_minute = args.max_noises_per_minute)
+                           max_noises_per_minute = args.max_noises_per_minute,
+                           output_audio_dir = args.output_audio_dir,
+                           num_workers = args.num_workers)
 
 
     data_lib.RunKaldiCommand("utils/validate_data_dir.sh --no-feats --no-text {output_dir}"
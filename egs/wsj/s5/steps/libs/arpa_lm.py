@@ -0,0 +1,548 @@
+# Copyright 2020  Johns Hopkins University
+# Apache 2.0
+
+""" This module contains tools for ARPA language models: ArpaReader and
+ArpaWriter, which read and write ARPA files one n-gram at a time (so that
+scripts that transform ARPA files don't need to hold them in memory), and
+ArpaModel, a compact in-memory form of an ARPA language model for scoring
+sentences (e.g. for perplexities or n-best rescoring) from python.
+
+As in Kaldi's C++ code, the fields of the lines of ARPA files are separated
+by ASCII whitespace only (see split_line()), so words may contain e.g.
+non-breaking spaces, and files can be read with any ASCII-compatible
+encoding, e.g. latin-1 to pass the bytes of the words through unchanged.
+
+The vocabulary is interned to integer ids (in the order of the unigram
+section), and the n-grams of each order are stored as sorted arrays: a
+64-bit hash of the word-ids of each n-gram (see hash_word_ids()), its log10
+probability and its log10 backoff weight (float32).  That is 16 bytes per
+n-gram, and n-grams are found by binary search.  As in KenLM's "probing"
+data structure only the hashes of the n-grams are stored, so an n-gram that
+is not in the model could in principle be mistaken for one that is, but
+with 64-bit hashes the chance of that is negligible (collisions between the
+n-grams of the model are detected when it is built).
+
+Reading a large ARPA file is slow (it is parsed in python), so the model can
+be written to a binary snapshot with write_snapshot(); load_model() reads
+either form, and a snapshot is memory-mapped, so it loads in seconds and its
+pages are shared between processes.
+
+e.g.:
+    # copy the unigrams and bigrams of a model.
+    with arpa_lm.ArpaReader('data/local/lm/lm.arpa.gz') as reader:
+        with open('lm.2g.arpa', 'w') as f:
+            writer = arpa_lm.ArpaWriter(f)
+            for n, logprob, words, backoff in reader.ngrams():
+                if n <= 2:
+                    writer.write_ngram(n, logprob, words, backoff)
+            writer.close()
+
+    model = arpa_lm.load_model('data/local/lm/lm.arpa.gz')
+    model.write_snapshot('data/local/lm/lm.arpa.snapshot')
+    logprobs = model.score_sentences([['<s>', 'a', 'b', '</s>']])
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import array
+import gzip
+import io
+import json
+import mmap
+import re
+import shutil
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+g_snapshot_magic = b'KALDIARPASNAPSHOT\n'
+g_snapshot_version = 1
+
+# multipliers for hash_word_ids(); the next one is tried if the first gives
+# a collision between two n-grams of the model.
+g_hash_multipliers = [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F,
+                      0x165667B19E3779F9, 0xD6E8FEB86659FD93]
+
+
+def hash_word_ids(word_ids, multiplier):
+    """ Returns the 64-bit hash of the n-grams whose word-ids are the
+    columns of the int array 'word_ids' (of shape (num-ngrams, n)), as an
+    array of uint64: h = ((id1 + 1) * M + (id2 + 1)) * M + ... modulo 2^64.
+    This lets the hashes of the n-grams ending at each position of a
+    sentence be computed from those of order n-1 (see score_sentences()). """
+    multiplier = np.uint64(multiplier)
+    hashes = np.zeros(word_ids.shape[0], dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for i in range(word_ids.shape[1]):
+            hashes = hashes * multiplier + (word_ids[:, i].astype(np.uint64)
+                                            + np.uint64(1))
+    return hashes
+
+
+g_ascii_whitespace = ' \t\n\r\f\v'
+g_ascii_whitespace_regex = re.compile('[ \t\n\r\f\v]+')
+
+
+def split_line(line):
+    """ Splits 'line' at ASCII whitespace, like str.split() (which, for
+    non-ASCII strings, also splits at other unicode whitespace). """
+    if line.isascii():
+        return line.split()
+    line = line.strip(g_ascii_whitespace)
+    return g_ascii_whitespace_regex.split(line) if line != '' else []
+
+
+def parse_ngram_line(line, n):
+    """ Parses the line 'line' of the section of the n-grams of order 'n'
+    and returns (logprob, words, backoff), where words is a list and backoff
+    is None if the line has no backoff weight.  Raises ValueError if the line
+    is not valid. """
+    parts = split_line(line)
+    if len(parts) == n + 1:
+        return float(parts[0]), parts[1:], None
+    if len(parts) == n + 2:
+        return float(parts[0]), parts[1:n + 1], float(parts[n + 1])
+    raise ValueError("Bad {0}-gram line: {1}".format(n, line.strip()))
+
+
+def open_arpa(filename, encoding='utf-8'):
+    """ Opens the ARPA file 'filename' ('-' for stdin) for reading as text;
+    it is decompressed if it is gzipped (whatever its name). """
+    if filename == '-':
+        f = sys.stdin.buffer
+    else:
+        f = open(filename, 'rb')
+    if not isinstance(f, io.BufferedReader):
+        f = io.BufferedReader(f)
+    if f.peek(2)[:2] == b'\x1f\x8b':
+        f = gzip.GzipFile(fileobj=f, mode='rb')
+    return io.TextIOWrapper(f, encoding=encoding)
+
+
+class ArpaReader(object):
+    """ Reads an ARPA file lazily, one section at a time.  The header is read
+    when the object is created; 'counts' is the list of the numbers of
+    n-grams of each order in the header, and 'order' the order of the model.
+    'filename' may also be '-' for stdin; gzipped files are decompressed.
+
+    Use sections() to get the lines of each section, or ngrams() to get the
+    parsed n-grams; the sections must be read in order, and only once.
+    Raises ValueError if the file is not a valid ARPA file; it doesn't check
+    that the numbers of n-grams are those in the header (the callers can,
+    e.g. the files written by some tools have wrong counts). """
+
+    def __init__(self, filename, encoding='utf-8'):
+        self.filename = filename
+        self.f = open_arpa(filename, encoding)
+        self.counts = []
+        line = self._next_nonempty_line()
+        if line != '\\data\\':
+            raise ValueError("Please make sure that {0} is a language model "
+                             "in ARPA format".format(filename))
+        line = self._next_nonempty_line()
+        while line is not None and line.startswith('ngram'):
+            # e.g. "ngram 2=1000" (or "ngram 2 = 1000").
+            n, equals, count = line[5:].partition('=')
+            if equals == '' or int(n) != len(self.counts) + 1:
+                raise ValueError("Unexpected line in the header of {0}: "
+                                 "{1}".format(filename, line))
+            self.counts.append(int(count))
+            line = self._next_nonempty_line()
+        if len(self.counts) == 0:
+            raise ValueError("No n-gram counts in the header of "
+                             "{0}".format(filename))
+        # the first line after the current section, e.g. "\2-grams:"
+        self.next_section_line = line
+
+    @property
+    def order(self):
+        return len(self.counts)
+
+    def _next_nonempty_line(self):
+        for line in self.f:
+            line = line.strip(g_ascii_whitespace)
+            if line != '':
+                return line
+        return None
+
+    def sections(self):
+        """ Yields (n, lines) for n = 1 ... order, where 'lines' is an
+        iterator over the non-empty lines of the section of the n-grams of
+        order n, without the newline.  If the caller stops reading 'lines'
+        early, the rest of the section is skipped. """
+        for n in range(1, self.order + 1):
+            if self.next_section_line != '\\{0}-grams:'.format(n):
+                raise ValueError("Expected the \\{0}-grams: section in {1}, "
+                                 "got: {2}".format(n, self.filename,
+                                                   self.next_section_line))
+            self.next_section_line = None
+            lines = self._section_lines()
+            yield n, lines
+            for line in lines:
+                pass
+        if self.next_section_line != '\\end\\':
+            raise ValueError("Expected \\end\\ in {0}, got: {1}".format(
+                self.filename, self.next_section_line))
+
+    def _section_lines(self):
+        for line in self.f:
+            line = line.rstrip('\n')
+            if line.startswith('\\'):
+                self.next_section_line = line.strip(g_ascii_whitespace)
+                return
+            if line.strip(g_ascii_whitespace) != '':
+                yield line
+
+    def ngrams(self):
+        """ Yields (n, logprob, words, backoff) for all the n-grams, as
+        parse_ngram_line(). """
+        for n, lines in self.sections():
+            for line in lines:
+                try:
+                    logprob, words, backoff = parse_ngram_line(line, n)
+                except ValueError as e:
+                    raise ValueError("{0}: {1}".format(self.filename, e))
+                yield n, logprob, words, backoff
+
+    def close(self):
+        if self.filename != '-':
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ArpaWriter(object):
+    """ Writes an ARPA file, one n-gram at a time, to the text file object
+    'f' (which it does not close).  The n-grams must be written in order of
+    increasing n.  If the numbers of n-grams of each order ('counts') are
+    known in advance, the file is written directly, and close() checks them.
+    Otherwise the n-grams are first written to a temporary file (in $TMPDIR)
+    and copied to 'f' after the header, with the numbers of n-grams that were
+    written, by close(). """
+
+    def __init__(self, f, counts=None):
+        self.f = f
+        self.counts = counts
+        self.num_ngrams = []
+        if counts is None:
+            self.out = tempfile.TemporaryFile(
+                mode='w+', encoding=getattr(f, 'encoding', None) or 'utf-8')
+        else:
+            self.out = f
+            self._write_header(counts)
+
+    def _write_header(self, counts):
+        self.f.write('\\data\\\n')
+        for n, count in enumerate(counts, 1):
+            self.f.write('ngram {0}={1}\n'.format(n, count))
+
+    def write_ngram_line(self, n, line):
+        """ Writes the line 'line' (without the newline) to the section of
+        the n-grams of order 'n'. """
+        while len(self.num_ngrams) < n:
+            self.num_ngrams.append(0)
+            self.out.write('\n\\{0}-grams:\n'.format(len(self.num_ngrams)))
+        if len(self.num_ngrams) != n:
+            raise ValueError("ARPA n-grams must be written in order of "
+                             "increasing n")
+        self.out.write(line)
+        self.out.write('\n')
+        self.num_ngrams[n - 1] += 1
+
+    def write_ngram(self, n, logprob, words, backoff=None):
+        """ Writes an n-gram of order n=len(words), with the floats 'logprob'
+        and 'backoff' (if not None) formatted with '{0:g}'. """
+        if backoff is None:
+            line = '{0:g}\t{1}'.format(logprob, ' '.join(words))
+        else:
+            line = '{0:g}\t{1}\t{2:g}'.format(logprob, ' '.join(words),
+                                                backoff)
+        self.write_ngram_line(n, line)
+
+    def close(self, order=None):
+        """ Finishes writing the file.  'order' is the order of the model
+        (by default, the highest order of the n-grams written); the sections
+        of the orders that have no n-grams are written empty. """
+        if order is None:
+            order = len(self.counts) if self.counts is not None \
+                else len(self.num_ngrams)
+        while len(self.num_ngrams) < order:
+            self.num_ngrams.append(0)
+            self.out.write('\n\\{0}-grams:\n'.format(len(self.num_ngrams)))
+        if self.counts is None:
+            self._write_header(self.num_ngrams)
+            self.out.seek(0)
+            shutil.copyfileobj(self.out, self.f, 1 << 20)
+            self.out.close()
+        elif list(self.counts) != self.num_ngrams:
+            raise ValueError("The numbers of n-grams written, {0}, are not "
+                             "those in the header, {1}".format(
+                                 self.num_ngrams, list(self.counts)))
+        self.f.write('\n\\end\\\n')
+
+
+class ArpaModel(object):
+    """ The language model described in the module docstring.  'words' is the
+    list of words (the word-id is the index), and keys[n-1], logprobs[n-1] and
+    backoffs[n-1] are the sorted hashes, log10 probabilities and log10
+    backoff weights of the n-grams of order n.  Use load_model() (or
+    read_arpa() / read_snapshot()) to create one. """
+
+    def __init__(self, words, multiplier, keys, logprobs, backoffs):
+        self.words = words
+        self.word_to_id = dict((word, i) for i, word in enumerate(words))
+        self.multiplier = multiplier
+        self.keys = keys
+        self.logprobs = logprobs
+        self.backoffs = backoffs
+
+    @property
+    def order(self):
+        return len(self.keys)
+
+    def num_ngrams(self, n):
+        return len(self.keys[n - 1])
+
+    def word_ids(self, words, unk_word='<unk>'):
+        """ Returns the word-ids of the list 'words' as an int32 array;
+        words that are not in the vocabulary are mapped to 'unk_word'. """
+        word_to_id = self.word_to_id
+        unk_id = word_to_id.get(unk_word)
+        ids = [word_to_id.get(word, unk_id) for word in words]
+        if unk_id is None and None in ids:
+            raise ValueError("The word '{0}' is not in the language model, "
+                             "which has no {1}".format(
+                                 words[ids.index(None)], unk_word))
+        return np.array(ids, dtype=np.int32)
+
+    def _find(self, n, hashes):
+        """ Returns (found, index) for the array of hashes of n-grams of
+        order n, where found is a bool array and index the positions of the
+        found n-grams in the arrays of order n. """
+        keys = self.keys[n - 1]
+        if len(keys) == 0:
+            return (np.zeros(len(hashes), dtype=bool),
+                    np.zeros(len(hashes), dtype=np.int64))
+        index = np.searchsorted(keys, hashes)
+        np.minimum(index, len(keys) - 1, out=index)
+        found = keys[index] == hashes
+        return found, index
+
+    def score_sentences(self, sentences, ngram_order=None,
+                        unk_word='<unk>'):
+        """ Returns the log10 probabilities of 'sentences', a list of lists
+        of words (including <s> and </s>, if wanted), as a float64 array.
+        The first word of each sentence is not scored (it is the history of
+        the second), and each other word is scored with a history of up to
+        ngram_order - 1 words (by default, the order of the model), using
+        the usual backoff: if the n-gram is not in the model, the backoff
+        weight of its history is added to the probability of the word with
+        a history one word shorter.  Raises ValueError if a word is not in
+        the model (after mapping to 'unk_word').  All the sentences are
+        scored at once, so the time is spent in numpy. """
+        order = self.order if ngram_order is None else ngram_order
+        if order < 1 or order > self.order:
+            raise ValueError("Invalid n-gram order {0}; the model has order "
+                             "{1}".format(order, self.order))
+        lengths = np.array([len(sentence) for sentence in sentences],
+                           dtype=np.int64)
+        num_words = int(lengths.sum())
+        if num_words == 0:
+            return np.zeros(len(sentences))
+        word_ids = self.word_ids([word for sentence in sentences
+                                  for word in sentence], unk_word)
+        sentence_index = np.repeat(np.arange(len(sentences)), lengths)
+        starts = np.cumsum(lengths) - lengths
+        # position of each word in its sentence.
+        position = np.arange(num_words) - np.repeat(starts, lengths)
+        # order of the n-gram used to score each word (0 for the first word
+        # of each sentence, which is not scored).
+        word_order = np.minimum(position + 1, order)
+        word_order[position == 0] = 0
+
+        multiplier = np.uint64(self.multiplier)
+        ids_plus_one = word_ids.astype(np.uint64) + np.uint64(1)
+        # hashes[j] is the hash of the n-gram of the current order ending
+        # at word j; it is only meaningful if position[j] >= n - 1.
+        hashes = ids_plus_one
+        best_logprob = np.zeros(num_words)
+        best_order = np.zeros(num_words, dtype=np.int64)
+        # context_backoff[n-1][j] is the backoff weight of the n-gram ending
+        # at word j (the history of length n of word j + 1), or 0.
+        context_backoff = []
+        for n in range(1, order + 1):
+            if n > 1:
+                with np.errstate(over='ignore'):
+                    hashes = np.concatenate(
+                        [np.zeros(1, dtype=np.uint64),
+                         hashes[:-1] * multiplier]) + ids_plus_one
+            valid = position >= n - 1
+            found, index = self._find(n, hashes)
+            found &= valid
+            use = found & (word_order >= n)
+            best_logprob[use] = self.logprobs[n - 1][index[use]]
+            best_order[use] = n
+            if n < order:
+                context_backoff.append(
+                    np.where(found, self.backoffs[n - 1][index], 0.0))
+
+        if np.any(best_order < np.minimum(word_order, 1)):
+            j = int(np.nonzero(best_order < np.minimum(word_order, 1))[0][0])
+            raise ValueError("The word '{0}' has no unigram in the language "
+                             "model".format(self.words[word_ids[j]]))
+        # add the backoff weights of the histories longer than the n-gram
+        # that was found, i.e. of lengths best_order ... word_order - 1.
+        logprob = best_logprob
+        for n in range(1, order):
+            use = (best_order <= n) & (word_order > n)
+            use[0] = False
+            previous = np.nonzero(use)[0] - 1
+            logprob[use] += context_backoff[n - 1][previous]
+        logprob[word_order == 0] = 0.0
+        return np.bincount(sentence_index, weights=logprob,
+                           minlength=len(sentences))
+
+    def write_snapshot(self, filename):
+        """ Writes the model to the binary snapshot 'filename', which can be
+        read by read_snapshot() (or load_model()).  The format is: the magic
+        string g_snapshot_magic, the length of the header as a little-endian
+        uint64, the JSON header (with the vocabulary and the offsets of the
+        arrays) and the arrays, aligned to 64 bytes. """
+        arrays = []
+        for n in range(1, self.order + 1):
+            arrays.append(('keys', n, self.keys[n - 1]))
+            arrays.append(('logprobs', n, self.logprobs[n - 1]))
+            arrays.append(('backoffs', n, self.backoffs[n - 1]))
+        header = {'version': g_snapshot_version, 'order': self.order,
+                  'multiplier': self.multiplier, 'words': self.words,
+                  'arrays': []}
+        # the offsets are relative to the end of the header.
+        offset = 0
+        for name, n, a in arrays:
+            header['arrays'].append([name, n, a.dtype.str, len(a), offset])
+            offset += (a.nbytes + 63) // 64 * 64
+        header_bytes = json.dumps(header, separators=(',', ':')).encode(
+            'utf-8')
+        data_start = len(g_snapshot_magic) + 8 + len(header_bytes)
+        padding = (64 - data_start % 64) % 64
+        header_bytes += b' ' * padding
+        with open(filename, 'wb') as f:
+            f.write(g_snapshot_magic)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for name, n, a in arrays:
+                f.write(np.ascontiguousarray(a).tobytes())
+                f.write(b'\0' * ((64 - a.nbytes % 64) % 64))
+
+
+def is_snapshot(filename):
+    """ Returns True if 'filename' is a snapshot written by
+    ArpaModel.write_snapshot(). """
+    if filename == '-':
+        return False
+    with open(filename, 'rb') as f:
+        return f.read(len(g_snapshot_magic)) == g_snapshot_magic
+
+
+def read_snapshot(filename):
+    """ Reads a snapshot written by ArpaModel.write_snapshot(); the arrays
+    are memory-mapped from the file. """
+    with open(filename, 'rb') as f:
+        if f.read(len(g_snapshot_magic)) != g_snapshot_magic:
+            raise ValueError("{0} is not an ARPA snapshot".format(filename))
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+        if header.get('version') != g_snapshot_version:
+            raise ValueError("{0} has an unknown snapshot version; write it "
+                             "again from the ARPA file".format(filename))
+        data_start = len(g_snapshot_magic) + 8 + header_length
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    order = header['order']
+    arrays = {'keys': [None] * order, 'logprobs': [None] * order,
+              'backoffs': [None] * order}
+    for name, n, dtype, length, offset in header['arrays']:
+        arrays[name][n - 1] = np.frombuffer(buf, dtype=dtype, count=length,
+                                            offset=data_start + offset)
+    return ArpaModel(header['words'], header['multiplier'], arrays['keys'],
+                     arrays['logprobs'], arrays['backoffs'])
+
+
+def read_arpa(filename):
+    """ Reads the ARPA language model 'filename' ('-' for stdin; it may be
+    gzipped), and returns an ArpaModel.  Raises ValueError if it is not a
+    valid ARPA file, if the numbers of n-grams are not those in its header,
+    or if an n-gram is duplicated. """
+    with ArpaReader(filename) as reader:
+        order = reader.order
+        words = []
+        word_to_id = {}
+        ngram_word_ids, logprobs, backoffs = [], [], []
+        for n, lines in reader.sections():
+            ids = array.array('i')
+            probs = array.array('f')
+            bows = array.array('f')
+            for line in lines:
+                parts = split_line(line)
+                if len(parts) != n + 1 and len(parts) != n + 2:
+                    raise ValueError("Bad {0}-gram line in {1}: {2}".format(
+                        n, filename, line.strip()))
+                for word in parts[1:n + 1]:
+                    i = word_to_id.get(word)
+                    if i is None:
+                        i = len(words)
+                        word_to_id[word] = i
+                        words.append(word)
+                    ids.append(i)
+                probs.append(float(parts[0]))
+                bows.append(float(parts[n + 1]) if len(parts) == n + 2
+                            else 0.0)
+            num_ngrams = len(probs)
+            if num_ngrams != reader.counts[n - 1]:
+                raise ValueError("{0} has {1} {2}-grams, but its header says "
+                                 "{3}".format(filename, num_ngrams, n,
+                                              reader.counts[n - 1]))
+            ngram_word_ids.append(np.frombuffer(ids, dtype=np.int32).reshape(
+                num_ngrams, n))
+            logprobs.append(np.frombuffer(probs, dtype=np.float32))
+            backoffs.append(np.frombuffer(bows, dtype=np.float32))
+
+    for multiplier in g_hash_multipliers:
+        keys = []
+        for n in range(1, order + 1):
+            hashes = hash_word_ids(ngram_word_ids[n - 1], multiplier)
+            sorted_order = np.argsort(hashes, kind='stable')
+            hashes = hashes[sorted_order]
+            duplicates = np.nonzero(hashes[1:] == hashes[:-1])[0]
+            if len(duplicates) > 0:
+                a, b = sorted_order[duplicates[0]], sorted_order[duplicates[0] + 1]
+                if np.array_equal(ngram_word_ids[n - 1][a],
+                                  ngram_word_ids[n - 1][b]):
+                    raise ValueError(
+                        "Duplicated n-gram in {0}: {1}".format(filename, " ".join(
+                            words[i] for i in ngram_word_ids[n - 1][a])))
+                break  # a hash collision: try the next multiplier.
+            keys.append((hashes, sorted_order))
+        if len(keys) == order:
+            break
+    else:
+        raise ValueError("Could not find a hash function without collisions "
+                         "for the n-grams of {0}".format(filename))
+    return ArpaModel(words, multiplier,
+                     [hashes for hashes, sorted_order in keys],
+                     [logprobs[n][keys[n][1]] for n in range(order)],
+                     [backoffs[n][keys[n][1]] for n in range(order)])
+
+
+def load_model(filename):
+    """ Returns the ArpaModel of 'filename', which may be an ARPA file or a
+    snapshot written by ArpaModel.write_snapshot(). """
+    if is_snapshot(filename):
+        return read_snapshot(filename)
+    return read_arpa(filename)
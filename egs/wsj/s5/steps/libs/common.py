@@ -12,18 +12,27 @@ commonly used in many kaldi python scripts.
 from __future__ import print_function
 from __future__ import division
 import argparse
+import atexit
+import errno
 import logging
 import math
 import os
+import signal
 import subprocess
 import sys
 import threading
+import time
 
 try:
     import thread as thread_module
 except:
     import _thread as thread_module
 
+try:
+    import Queue as queue_module
+except ImportError:
+    import queue as queue_module
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
@@ -185,27 +194,496 @@ def get_command_stdout(command, require_zero_status = True):
 
 
 
+class BackgroundJobError(Exception):
+    """ Raised by BackgroundJob.result() and wait_for_jobs() when a job exited
+        with nonzero status or was cancelled.  The JobResult is in
+        'self.result'."""
+
+    def __init__(self, result):
+        Exception.__init__(self, str(result))
+        self.result = result
+
+
+class JobResult(object):
+    """ What we know about a finished (or cancelled) background job.
+
+        status is the exit status of the command as returned by the shell,
+        or minus the signal number if it was killed by a signal, or None if
+        the job was cancelled before it started.  wall_time is in seconds,
+        and cpu_time is the user+system time, in seconds, of the command and
+        of those of its descendants that it waited for.  start_time is as
+        returned by time.time().
+    """
+
+    def __init__(self, command, status, start_time=None, wall_time=0.0,
+                 cpu_time=0.0, cancelled=False):
+        self.command = command
+        self.status = status
+        self.start_time = (time.time() if start_time is None else start_time)
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.cancelled = cancelled
+
+    def succeeded(self):
+        return self.status == 0 and not self.cancelled
+
+    def __str__(self):
+        if self.cancelled:
+            return "Command was cancelled: {0}".format(self.command)
+        return "Command exited with status {0}: {1}".format(
+            self.status, self.command)
+
+
+class BackgroundJob(object):
+    """ A command submitted to a JobExecutor; this works like a 'future'.
+        It also has a join() method, so code that used to wait on the
+        Thread objects returned by background_command() keeps working.
+    """
+
+    def __init__(self, command, require_zero_status=False, group=None,
+                 on_failure=None):
+        self.command = command
+        self.require_zero_status = require_zero_status
+        self.group = group
+        self.on_failure = on_failure
+        self._result = None
+        self._popen = None
+        self._cancel_requested = False
+        self._lock = threading.Lock()
+        self._done_event = threading.Event()
+
+    def done(self):
+        return self._done_event.is_set()
+
+    def cancelled(self):
+        return self.done() and self._result.cancelled
+
+    def cancel(self):
+        """ Cancels the job: if it has not started it never will, and if it is
+            running, its process group is sent SIGTERM.  Returns False if the
+            job had already finished."""
+        with self._lock:
+            if self.done():
+                return False
+            self._cancel_requested = True
+            popen = self._popen
+        if popen is not None:
+            _kill_process_group(popen)
+        return True
+
+    def wait(self, timeout=None):
+        """ Waits for the job to finish; returns True if it has finished."""
+        # Event.wait() without a timeout can't be interrupted by Ctrl-C in
+        # python 2, so we wait in short slices.
+        start_time = time.time()
+        while not self._done_event.wait(1.0):
+            if timeout is not None and time.time() - start_time >= timeout:
+                return False
+        return True
+
+    join = wait
+
+    def result(self, timeout=None):
+        """ Waits for the job and returns its JobResult.  Raises
+            BackgroundJobError if it was cancelled, or if it exited with
+            nonzero status and require_zero_status was set."""
+        if not self.wait(timeout):
+            raise RuntimeError("Timed out waiting for command: {0}".format(
+                self.command))
+        if self._result.cancelled or (self.require_zero_status
+                                      and not self._result.succeeded()):
+            raise BackgroundJobError(self._result)
+        return self._result
+
+    def _start(self):
+        """ Called by the worker thread.  Returns the Popen object, or None if
+            the job was cancelled before it started."""
+        with self._lock:
+            if self._cancel_requested:
+                return None
+            # The job gets its own session (and so its own process group) so
+            # that cancel() can kill the whole pipeline, not just the shell.
+            # This means that the signals from the terminal (e.g. Ctrl-C) and
+            # those that queueing systems send to our process group don't
+            # reach it, so get_background_executor() forwards them (see
+            # _forward_signals_to_jobs()), and _JobWatchdog kills the job if
+            # we die without being able to do that.  start_new_session is
+            # safe to use with threads, unlike preexec_fn, but it does not
+            # exist in python 2.
+            if sys.version_info[0] >= 3:
+                new_group_args = {'start_new_session': True}
+            else:
+                new_group_args = {'preexec_fn': os.setpgrp}
+            self._popen = subprocess.Popen(self.command, shell=True,
+                                           close_fds=True, **new_group_args)
+            _job_watchdog.add(self._popen.pid)
+            return self._popen
+
+    def _finish(self, result):
+        with self._lock:
+            self._result = result
+            self._popen = None
+            self._done_event.set()
+
+
+def _kill_process_group(popen, sig=signal.SIGTERM):
+    try:
+        os.killpg(popen.pid, sig)
+    except OSError:
+        pass  # it already exited.
+
+
+class _JobWatchdog(object):
+    """ A small child process that sends SIGTERM to the process groups of the
+        running background jobs when this program dies, even if it was killed
+        with SIGKILL and so couldn't do it itself.  It learns of the groups
+        through a pipe ('+pid' when a job starts, '-pid' when it has been
+        reaped) and acts when it reads end-of-file, i.e. when the pipe is
+        closed because we exited.  It ignores the usual termination signals
+        and is in its own session, so it outlives us when our process group
+        is killed. """
+
+    _SCRIPT = """
+import os, signal, sys
+for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+    signal.signal(sig, signal.SIG_IGN)
+groups = set()
+for line in iter(sys.stdin.readline, ''):
+    if line[:1] == '+':
+        groups.add(int(line[1:]))
+    elif line[:1] == '-':
+        groups.discard(int(line[1:]))
+for pgid in groups:
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except OSError:
+        pass
+"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._popen = None
+        self._failed = False
+
+    def add(self, pid):
+        self._write('+{0}\n'.format(pid))
+
+    def remove(self, pid):
+        self._write('-{0}\n'.format(pid))
+
+    def _write(self, line):
+        with self._lock:
+            if self._failed:
+                return
+            try:
+                if self._popen is None:
+                    self._start()
+                self._popen.stdin.write(line.encode())
+                self._popen.stdin.flush()
+            except (IOError, OSError) as e:
+                self._failed = True
+                logger.warning("Background jobs will not be killed if this "
+                               "program is killed: could not run the job "
+                               "watchdog: {0}".format(e))
+
+    def _start(self):
+        if sys.version_info[0] >= 3:
+            new_group_args = {'start_new_session': True}
+        else:
+            new_group_args = {'preexec_fn': os.setsid}
+        self._popen = subprocess.Popen(
+            [sys.executable, '-c', self._SCRIPT], stdin=subprocess.PIPE,
+            close_fds=True, **new_group_args)
+        if sys.version_info[0] < 3:
+            # python 2 makes pipes inheritable, and the pipe must be closed
+            # when we exit even if e.g. a foreground command is still running.
+            import fcntl
+            fd = self._popen.stdin.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+_job_watchdog = _JobWatchdog()
+
+
+def _run_job(job):
+    """ Runs a BackgroundJob in the calling thread and returns its JobResult.
+        We reap the process with os.wait4() rather than Popen.wait() so we get
+        its resource usage."""
+    start_time = time.time()
+    try:
+        popen = job._start()
+    except OSError as e:
+        logger.error("Error starting command {0}: {1}".format(job.command, e))
+        return JobResult(job.command, 127, start_time=start_time)
+    if popen is None:
+        return JobResult(job.command, None, cancelled=True)
+    while True:
+        try:
+            _, wait_status, rusage = os.wait4(popen.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(wait_status):
+        status = -os.WTERMSIG(wait_status)
+    else:
+        status = os.WEXITSTATUS(wait_status)
+    popen.returncode = status  # so Popen won't try to reap it again.
+    _job_watchdog.remove(popen.pid)
+    return JobResult(job.command, status, start_time=start_time,
+                     wall_time=time.time() - start_time,
+                     cpu_time=rusage.ru_utime + rusage.ru_stime,
+                     cancelled=job._cancel_requested)
+
+
+class JobGroup(object):
+    """ A set of related jobs, e.g. the parallel training jobs of one
+        iteration: when one of them fails (and had require_zero_status set),
+        the others are cancelled, since their output won't be used. """
+
+    def __init__(self):
+        self.jobs = []
+        self.failed_job = None
+        self._lock = threading.Lock()
+
+    def _add(self, job):
+        with self._lock:
+            self.jobs.append(job)
+            cancel = self.failed_job is not None
+        if cancel:
+            job.cancel()
+
+    def _job_failed(self, job):
+        with self._lock:
+            if self.failed_job is not None:
+                return
+            self.failed_job = job
+            siblings = [j for j in self.jobs if j is not job]
+        for sibling in siblings:
+            sibling.cancel()
+
+
+class JobExecutor(object):
+    """ Runs shell commands in the background on a set of persistent worker
+        threads, each of which waits for one command at a time; at most
+        'max_workers' commands run at once (if None, there is no limit, and a
+        worker is added whenever all the existing ones are busy).  Idle
+        workers are reused, so training scripts that launch many jobs on
+        every iteration don't create a new thread per job.
+
+        e.g.:
+            executor = JobExecutor(max_workers=4)
+            jobs = [executor.submit(cmd, require_zero_status=True)
+                    for cmd in commands]
+            results = wait_for_jobs(jobs)
+    """
+
+    def __init__(self, max_workers=None):
+        if max_workers is not None and max_workers < 1:
+            raise ValueError("max_workers must be positive")
+        self.max_workers = max_workers
+        self._queue = queue_module.Queue()
+        # reentrant, because the signal handlers of _forward_signals_to_jobs()
+        # take it and may run in the main thread while it holds it.
+        self._lock = threading.RLock()
+        self._num_workers = 0
+        self._num_running = 0
+        # the jobs that are queued or running; each of them has, or will
+        # have, a worker of its own, so the other workers are idle.
+        self._pending_jobs = set()
+        # notified whenever a job finishes.
+        self._all_done = threading.Condition(self._lock)
+        self._shutdown = False
+
+    def submit(self, command, require_zero_status=False, group=None,
+               on_failure=None):
+        """ Queues 'command' (executed in 'shell' mode) and returns a
+            BackgroundJob.  If the job fails and require_zero_status is True,
+            the rest of 'group' (a JobGroup), if given, is cancelled, and
+            on_failure(job) is called, if given, from the worker thread.
+            At most max_workers of the submitted jobs run at once."""
+        job = BackgroundJob(command, require_zero_status, group, on_failure)
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("submit() called after shutdown()")
+            if (len(self._pending_jobs) >= self._num_workers and
+                    (self.max_workers is None or
+                     self._num_workers < self.max_workers)):
+                self._add_worker()
+            self._pending_jobs.add(job)
+        if group is not None:
+            group._add(job)
+        self._queue.put(job)
+        return job
+
+    def wait_for_all(self):
+        """ Waits until all submitted jobs have finished. """
+        with self._lock:
+            while self._pending_jobs:
+                self._all_done.wait(1.0)
+
+    def cancel_all(self):
+        """ Cancels all jobs that have not finished. """
+        with self._lock:
+            jobs = list(self._pending_jobs)
+        for job in jobs:
+            job.cancel()
+
+    def shutdown(self, cancel_pending=False):
+        """ Stops the workers once the queued jobs are done (or cancelled, if
+            cancel_pending is True)."""
+        with self._lock:
+            self._shutdown = True
+            num_workers = self._num_workers
+        if cancel_pending:
+            self.cancel_all()
+        for _ in range(num_workers):
+            self._queue.put(None)
+
+    def signal_running_jobs(self, sig):
+        """ Sends the signal 'sig' to the process groups of the jobs that are
+            running. """
+        with self._lock:
+            jobs = list(self._pending_jobs)
+        for job in jobs:
+            popen = job._popen
+            if popen is not None:
+                _kill_process_group(popen, sig)
+
+    def _add_worker(self):
+        # called with self._lock held.
+        self._num_workers += 1
+        thread = threading.Thread(target=self._worker_loop)
+        thread.daemon = True  # make sure it exits if main thread is terminated
+                              # abnormally.
+        thread.start()
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            # max_workers may have been lowered since this worker was added.
+            with self._lock:
+                while (self.max_workers is not None and
+                       self._num_running >= self.max_workers):
+                    self._all_done.wait(1.0)
+                self._num_running += 1
+            result = _run_job(job)
+            job._finish(result)
+            if job.require_zero_status and not result.succeeded():
+                if not result.cancelled:
+                    logger.error(str(result))
+                if job.group is not None:
+                    job.group._job_failed(job)
+                if job.on_failure is not None and not result.cancelled:
+                    job.on_failure(job)
+            elif not result.succeeded() and not result.cancelled:
+                logger.warning(str(result))
+            with self._lock:
+                self._pending_jobs.discard(job)
+                self._num_running -= 1
+                self._all_done.notify_all()
+
+
+_background_executor = None
+_background_executor_lock = threading.Lock()
+
+
+def get_background_executor():
+    """ Returns the JobExecutor used by background_command(), creating it if
+        necessary. """
+    global _background_executor
+    with _background_executor_lock:
+        if _background_executor is None:
+            _background_executor = JobExecutor()
+            atexit.register(_background_executor.cancel_all)
+            _forward_signals_to_jobs(_background_executor)
+        return _background_executor
+
+
+def _forward_signals_to_jobs(executor):
+    """ Makes SIGINT, SIGTERM and SIGHUP received by this program also go to
+        the running jobs of 'executor', which are in their own process groups,
+        so that e.g. Ctrl-C, killing the training script or closing its
+        terminal stops them as it did when they were in our process group;
+        the signal is then handled as it was before.  Signals that we ignore
+        (e.g. SIGHUP under nohup) are left alone, as the jobs used to inherit
+        that.  This only works when called from the main thread; otherwise
+        the jobs are only cancelled by the atexit handler (or by _JobWatchdog
+        if we are killed). """
+    def make_handler(previous_handler):
+        def handler(signum, frame):
+            executor.signal_running_jobs(signum)
+            if callable(previous_handler):
+                previous_handler(signum, frame)
+            else:
+                # the default action, e.g. termination for SIGTERM.
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+        return handler
+
+    for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+        try:
+            previous_handler = signal.getsignal(sig)
+            if previous_handler != signal.SIG_IGN:
+                signal.signal(sig, make_handler(previous_handler))
+        except ValueError:
+            return  # we are not in the main thread.
+
+
+def set_max_background_jobs(max_jobs):
+    """ Limits the number of commands from background_command() that run at
+        once (None means no limit); the others wait in a queue.  The training
+        scripts call this with the value of --max-background-jobs. """
+    get_background_executor().max_workers = max_jobs
+
+
+def wait_for_jobs(jobs):
+    """ Waits for all the BackgroundJobs in 'jobs' and returns their
+        JobResults, in the same order.  If any of them failed and had
+        require_zero_status set, or was cancelled, it raises
+        BackgroundJobError after all of them have finished, for the first
+        job that failed or, if they were all cancelled, the first job. """
+    for job in jobs:
+        job.wait()
+    for job in jobs:
+        if not job.cancelled():
+            job.result()
+    return [job.result() for job in jobs]
+
+
 def wait_for_background_commands():
-    """ This waits for all threads to exit.  You will often want to
-        run this at the end of programs that have launched background
-        threads, so that the program will wait for its child processes
-        to terminate before it dies."""
-    for t in threading.enumerate():
-        if not t == threading.current_thread():
-            t.join()
-
-def background_command(command, require_zero_status = False):
-    """Executes a command in a separate thread, like running with '&' in the shell.
+    """ This waits for all the commands started by background_command() to
+        finish.  You will often want to run this at the end of programs that
+        have launched background commands, so that the program will wait for
+        its child processes to terminate before it dies."""
+    get_background_executor().wait_for_all()
+
+
+def _interrupt_main_on_failure(job):
+    # thread.interrupt_main() sends a KeyboardInterrupt to the main
+    # thread, which will generally terminate the program.
+    thread_module.interrupt_main()
+
+
+def background_command(command, require_zero_status = False, group = None):
+    """Executes a command in the background, like running with '&' in the shell.
        If you want the program to die if the command eventually returns with
        nonzero status, then set require_zero_status to True.  'command' will be
        executed in 'shell' mode, so it's OK for it to contain pipes and other
        shell constructs.
 
-       This function returns the Thread object created, just in case you want
-       to wait for that specific command to finish.  For example, you could do:
-             thread = background_command('foo | bar')
+       If 'group' (a JobGroup) is given, a failure of the command cancels the
+       other jobs in the group instead of terminating the program; the caller
+       is then expected to check the results, e.g. with wait_for_jobs().
+
+       This function returns a BackgroundJob, just in case you want to wait
+       for that specific command to finish.  For example, you could do:
+             job = background_command('foo | bar')
              # do something else while waiting for it to finish
-             thread.join()
+             job.join()
 
        See also:
          - wait_for_background_commands(), which can be used
@@ -214,31 +692,9 @@ def background_command(command, require_zero_status = False):
            execute commands in the foreground.
 
     """
-
-    p = subprocess.Popen(command, shell=True)
-    thread = threading.Thread(target=background_command_waiter,
-                              args=(command, p, require_zero_status))
-    thread.daemon=True  # make sure it exits if main thread is terminated
-                        # abnormally.
-    thread.start()
-    return thread
-
-
-def background_command_waiter(command, popen_object, require_zero_status):
-    """ This is the function that is called from background_command, in
-        a separate thread."""
-
-    popen_object.communicate()
-    if popen_object.returncode is not 0:
-        str = "Command exited with status {0}: {1}".format(
-            popen_object.returncode, command)
-        if require_zero_status:
-            logger.error(str)
-            # thread.interrupt_main() sends a KeyboardInterrupt to the main
-            # thread, which will generally terminate the program.
-            thread_module.interrupt_main()
-        else:
-            logger.warning(str)
+    return get_background_executor().submit(
+        command, require_zero_status=require_zero_status, group=group,
+        on_failure=(_interrupt_main_on_failure if group is None else None))
 
 
 def get_number_of_leaves_from_tree(alidir):
@@ -0,0 +1,913 @@
+# Copyright 2020  Johns Hopkins University
+# Apache 2.0
+
+""" This module contains functions and classes to read and write Kaldi
+objects in binary format (and, for matrices and vectors, text format) from
+python, without going through Kaldi binaries like copy-feats.
+
+The supported objects are:
+  - float and double matrices (tokens FM and DM),
+  - compressed matrices, in all three storage formats (tokens CM, CM2 and
+    CM3; see src/matrix/compressed-matrix.h),
+  - float and double vectors (tokens FV and DV),
+  - integer vectors as written by Int32VectorHolder, e.g. alignments,
+  - WAV files and archives of them, as read and written by WaveHolder
+    (e.g. wav-copy); samples are floats with the integer scale of the file
+    (e.g. -32768..32767 for 16-bit), as in Kaldi's WaveData.
+
+Matrices and vectors are returned as numpy arrays.  When reading
+uncompressed objects from a file through ScpReader, which memory-maps the
+archives, the returned arrays are read-only views of the mapped buffer, so
+no copy of the data is made until you modify it.
+
+rxfilenames may be plain files, '-' for standard input, "command |" pipes,
+or 'file:offset' as found in scp files, optionally followed by a range
+specifier like '[10:20]' or '[10:20,0:2]'.  Table specifiers with an
+'ark:' or 'scp:' prefix (and options like 'ark,t:') are also accepted where
+it makes sense.
+
+e.g.:
+    for key, mat in read_mat_ark('ark:feats.1.ark'):
+        ...
+    reader = ScpReader('data/train/feats.scp')
+    mat = reader['utt1']
+    with ArkScpWriter('targets.1.ark', 'targets.1.scp') as writer:
+        writer.write_mat('utt1', mat)
+"""
+
+from __future__ import print_function
+from __future__ import division
+import logging
+import mmap
+import re
+import struct
+import subprocess
+import sys
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# The compression methods from enum CompressionMethod in
+# src/matrix/compressed-matrix.h.
+kAutomaticMethod = 1
+kSpeechFeature = 2
+kTwoByteAuto = 3
+kTwoByteSignedInteger = 4
+kOneByteAuto = 5
+kOneByteUnsignedInteger = 6
+kOneByteZeroOne = 7
+
+_BINARY_HEADER = b'\0B'
+_INT32_SIZE_BYTE = b'\x04'
+
+# dtype of the (size-byte, value) pairs written by WriteBasicType for each
+# element of an integer vector in binary mode.
+_INT32_PAIR_DTYPE = np.dtype([('size', 'i1'), ('value', '<i4')])
+
+# The compressed-matrix global header, without the leading 'format' field,
+# which is encoded in the token instead.
+_CM_HEADER = struct.Struct('<ffii')
+_CM_PER_COL_HEADER_DTYPE = np.dtype('<u2')
+
+_TABLE_PREFIX_RE = re.compile(r'^(ark|scp)(,[a-z]+)*:(.*)$')
+_RANGE_RE = re.compile(r'^(.*)\[(\d+):(\d+)(?:,(\d+):(\d+))?\]$')
+_OFFSET_RE = re.compile(r'^(.*):(\d+)$')
+
+
+class KaldiIOError(Exception):
+    """ Raised when a Kaldi object or archive has an unexpected format. """
+    pass
+
+
+def _strip_table_prefix(specifier):
+    m = _TABLE_PREFIX_RE.match(specifier)
+    if m is not None:
+        return m.group(3)
+    return specifier
+
+
+def parse_rxfilename(rxfilename):
+    """ Splits an rxfilename like '/path/feats.1.ark:1234[0:9,2:3]' into a
+    tuple (filename, offset, row_range, col_range).  offset is None if there
+    is no offset; row_range and col_range are None or (first, last) tuples,
+    with 'last' inclusive as in Kaldi.
+    """
+    rxfilename = rxfilename.strip()
+    row_range = col_range = None
+    m = _RANGE_RE.match(rxfilename)
+    if m is not None:
+        rxfilename = m.group(1)
+        row_range = (int(m.group(2)), int(m.group(3)))
+        if m.group(4) is not None:
+            col_range = (int(m.group(4)), int(m.group(5)))
+    offset = None
+    if not rxfilename.endswith('|'):
+        m = _OFFSET_RE.match(rxfilename)
+        if m is not None:
+            rxfilename = m.group(1)
+            offset = int(m.group(2))
+    return rxfilename, offset, row_range, col_range
+
+
+class _PipeHandle(object):
+    """ Wraps the pipe of a subprocess so that closing it also waits for the
+    process and checks its exit status. """
+    def __init__(self, command, proc, fh):
+        self.command = command
+        self.proc = proc
+        self.fh = fh
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+    def __iter__(self):
+        return iter(self.fh)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.fh.close()
+        self.proc.wait()
+        if self.proc.returncode != 0:
+            raise KaldiIOError("Command exited with status {0}: {1}".format(
+                self.proc.returncode, self.command))
+
+
+def open_or_fd(file_or_fd, mode='rb'):
+    """ Returns a binary file object for 'file_or_fd'.  If it is already a
+    file object it is returned unchanged; otherwise it is interpreted as an
+    rxfilename/wxfilename: '-' is standard input/output, 'command |' and
+    '| command' are pipes, and 'file:offset' opens 'file' and seeks to
+    'offset'.  Table prefixes like 'ark:' are ignored.
+    """
+    if not isinstance(file_or_fd, str):
+        return file_or_fd
+    filename = _strip_table_prefix(file_or_fd.strip())
+    if filename == '-':
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        return stream.buffer if hasattr(stream, 'buffer') else stream
+    if filename.endswith('|'):
+        command = filename[:-1]
+        proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+        return _PipeHandle(command, proc, proc.stdout)
+    if filename.startswith('|'):
+        command = filename[1:]
+        proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+        return _PipeHandle(command, proc, proc.stdin)
+    filename, offset, _, _ = parse_rxfilename(filename)
+    fd = open(filename, mode)
+    if offset is not None:
+        fd.seek(offset)
+    return fd
+
+
+def _close_if_opened(fd, file_or_fd):
+    """ Closes 'fd' if it was opened by open_or_fd(file_or_fd), unless it is
+    standard input or output. """
+    if fd is file_or_fd:
+        return
+    if fd is getattr(sys.stdout, 'buffer', sys.stdout):
+        fd.flush()
+        return
+    if fd is getattr(sys.stdin, 'buffer', sys.stdin):
+        return
+    fd.close()
+
+
+def read_key(fd):
+    """ Reads the key of the next archive entry from the binary file object
+    'fd', including the single space after it.  Returns None at end of
+    file.
+    """
+    chars = []
+    while True:
+        c = fd.read(1)
+        if c == b'' or c == b' ':
+            break
+        if c == b'\n' and len(chars) == 0:
+            continue
+        chars.append(c)
+    key = b''.join(chars).decode().strip()
+    if key == '':
+        return None
+    return key
+
+
+def _read_int32(fd):
+    data = fd.read(5)
+    if len(data) != 5 or data[0:1] != _INT32_SIZE_BYTE:
+        raise KaldiIOError("Expected int32, got {0!r}".format(data))
+    return struct.unpack('<i', data[1:])[0]
+
+
+def _read_token(fd):
+    chars = []
+    while True:
+        c = fd.read(1)
+        if c == b'' or c == b' ':
+            break
+        chars.append(c)
+    return b''.join(chars).decode()
+
+
+def _read_exactly(fd, num_bytes):
+    data = fd.read(num_bytes)
+    if len(data) != num_bytes:
+        raise KaldiIOError("Unexpected end of file: expected {0} bytes, "
+                           "got {1}".format(num_bytes, len(data)))
+    return data
+
+
+def _read_ascii_rows(fd, first):
+    """ Reads a text-format matrix or vector whose opening '[' has already
+    been consumed ('first' is whatever followed it on the same line).
+    Returns a list of rows, each a list of strings. """
+    rows = []
+    line = first
+    while True:
+        fields = line.split()
+        if len(fields) > 0 and fields[-1] == b']':
+            if len(fields) > 1:
+                rows.append(fields[:-1])
+            return rows
+        if len(fields) > 0:
+            rows.append(fields)
+        line = fd.readline()
+        if line == b'':
+            raise KaldiIOError("Got EOF before end of text-format object")
+
+
+def _compressed_size(token, num_rows, num_cols):
+    if token == 'CM':
+        return num_cols * (8 + num_rows)
+    elif token == 'CM2':
+        return 2 * num_rows * num_cols
+    else:
+        assert token == 'CM3'
+        return num_rows * num_cols
+
+
+def _uncompress(token, header, data):
+    """ Uncompresses the data of a compressed matrix into a float32 matrix,
+    following CompressedMatrix::CopyToMat(). 'data' is a buffer with the
+    data that follows the global header. """
+    min_value, range_, num_rows, num_cols = header
+    min_value = np.float32(min_value)
+    range_ = np.float32(range_)
+    if num_rows == 0 or num_cols == 0:
+        return np.zeros((num_rows, num_cols), dtype=np.float32)
+
+    if token == 'CM':
+        headers = np.frombuffer(data, dtype=_CM_PER_COL_HEADER_DTYPE,
+                                count=4 * num_cols).reshape(num_cols, 4)
+        percentiles = (min_value + range_ * np.float32(1.52590218966964e-05)
+                       * headers.astype(np.float32))
+        p0, p25, p75, p100 = (percentiles[:, i:i+1] for i in range(4))
+        # byte data is stored column by column.
+        bytes_ = np.frombuffer(data, dtype=np.uint8, count=num_rows * num_cols,
+                               offset=8 * num_cols).reshape(num_cols, num_rows)
+        values = bytes_.astype(np.float32)
+
+        # This follows the float/double promotions of CharToFloat().
+        def interpolate(lower, upper, offset, scale):
+            return (lower.astype(np.float64)
+                    + ((upper - lower) * (values - np.float32(offset)))
+                    .astype(np.float64) * scale)
+
+        mat = np.where(
+            bytes_ <= 64, interpolate(p0, p25, 0, 1 / 64.0),
+            np.where(bytes_ <= 192, interpolate(p25, p75, 64, 1 / 128.0),
+                     interpolate(p75, p100, 192, 1 / 63.0)))
+        return mat.astype(np.float32).T
+    elif token == 'CM2':
+        increment = np.float32(float(range_) * (1.0 / 65535.0))
+        values = np.frombuffer(data, dtype='<u2', count=num_rows * num_cols)
+    else:
+        increment = np.float32(float(range_) * (1.0 / 255.0))
+        values = np.frombuffer(data, dtype=np.uint8,
+                               count=num_rows * num_cols)
+    mat = min_value + values.astype(np.float32) * increment
+    return mat.reshape(num_rows, num_cols)
+
+
+def _read_binary_object(fd, expected):
+    """ Reads a binary Kaldi object (after the '\\0B' header) from 'fd'.
+    'expected' is 'mat', 'vec' or 'ivec'. """
+    if expected == 'ivec':
+        dim = _read_int32(fd)
+        data = _read_exactly(fd, dim * _INT32_PAIR_DTYPE.itemsize)
+        return np.frombuffer(data, dtype=_INT32_PAIR_DTYPE)['value']
+    token = _read_token(fd)
+    if token in ('FM', 'DM'):
+        if expected != 'mat':
+            raise KaldiIOError("Expected vector, got token " + token)
+        dtype = np.dtype('<f4' if token == 'FM' else '<f8')
+        num_rows = _read_int32(fd)
+        num_cols = _read_int32(fd)
+        data = _read_exactly(fd, num_rows * num_cols * dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype).reshape(num_rows, num_cols)
+    elif token in ('FV', 'DV'):
+        if expected != 'vec':
+            raise KaldiIOError("Expected matrix, got token " + token)
+        dtype = np.dtype('<f4' if token == 'FV' else '<f8')
+        dim = _read_int32(fd)
+        return np.frombuffer(_read_exactly(fd, dim * dtype.itemsize),
+                             dtype=dtype)
+    elif token in ('CM', 'CM2', 'CM3'):
+        if expected != 'mat':
+            raise KaldiIOError("Expected vector, got token " + token)
+        header = _CM_HEADER.unpack(_read_exactly(fd, _CM_HEADER.size))
+        data = _read_exactly(fd, _compressed_size(token, header[2],
+                                                  header[3]))
+        return _uncompress(token, header, data)
+    raise KaldiIOError("Unexpected token {0!r}".format(token))
+
+
+def _read_object(fd, expected, text_dtype=np.float32):
+    header = fd.read(2)
+    if header == _BINARY_HEADER:
+        return _read_binary_object(fd, expected)
+    # Text mode.  Kaldi text-format objects are preceded by whitespace.
+    rest = (header + fd.readline())
+    if expected == 'ivec':
+        return np.array(rest.split(), dtype=np.int32)
+    fields = rest.split(None, 1)
+    if len(fields) == 0 or fields[0] != b'[':
+        raise KaldiIOError("Expected '[' at start of text-format object, "
+                           "got {0!r}".format(rest))
+    rows = _read_ascii_rows(fd, fields[1] if len(fields) > 1 else b'')
+    if expected == 'vec':
+        return np.array(rows[0] if len(rows) > 0 else [], dtype=text_dtype)
+    return np.array(rows, dtype=text_dtype).reshape(len(rows), -1)
+
+
+def _apply_ranges(mat, row_range, col_range):
+    if row_range is not None:
+        mat = mat[row_range[0]:row_range[1] + 1]
+    if col_range is not None:
+        mat = mat[:, col_range[0]:col_range[1] + 1]
+    return mat
+
+
+def _read_single(rxfilename, expected):
+    filename, offset, row_range, col_range = parse_rxfilename(
+        _strip_table_prefix(rxfilename))
+    if offset is not None:
+        filename = '{0}:{1}'.format(filename, offset)
+    fd = open_or_fd(filename)
+    try:
+        obj = _read_object(fd, expected)
+    finally:
+        _close_if_opened(fd, filename)
+    return _apply_ranges(obj, row_range, col_range)
+
+
+def read_mat(file_or_fd):
+    """ Reads a single matrix (possibly compressed) in binary or text format
+    and returns it as a numpy array.  The input can be an rxfilename, e.g.
+    the second field of a line of feats.scp, or an opened binary file
+    object positioned at the start of the matrix. """
+    if isinstance(file_or_fd, str):
+        return _read_single(file_or_fd, 'mat')
+    return _read_object(file_or_fd, 'mat')
+
+
+def read_vec_flt(file_or_fd):
+    """ Like read_mat(), but reads a float or double vector. """
+    if isinstance(file_or_fd, str):
+        return _read_single(file_or_fd, 'vec')
+    return _read_object(file_or_fd, 'vec')
+
+
+def read_vec_int(file_or_fd):
+    """ Like read_mat(), but reads an integer vector (e.g. an alignment). """
+    if isinstance(file_or_fd, str):
+        return _read_single(file_or_fd, 'ivec')
+    return _read_object(file_or_fd, 'ivec')
+
+
+def _read_wav(fd):
+    """ Reads a WAV file from the binary file object 'fd', following
+    WaveInfo::Read() and WaveData::Read() in src/feat/wave-reader.cc, and
+    returns (samp_freq, data) with 'data' a (num_channels, num_samples)
+    float32 array.  A data chunk size of 0 or 0xffffffff, as written by
+    programs that stream to a pipe, means the data extends to end of file.
+    """
+    riff = _read_exactly(fd, 12)
+    if riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise KaldiIOError("Expected a RIFF/WAVE header, got {0!r}".format(
+            riff))
+    fmt = None
+    while True:
+        chunk_header = _read_exactly(fd, 8)
+        chunk_id = chunk_header[0:4]
+        chunk_size = struct.unpack('<I', chunk_header[4:8])[0]
+        if chunk_id == b'data':
+            break
+        chunk = _read_exactly(fd, chunk_size + (chunk_size % 2))
+        if chunk_id == b'fmt ':
+            fmt = chunk
+    if fmt is None:
+        raise KaldiIOError("WAV file has no 'fmt ' chunk before its data")
+    audio_format, num_channels, samp_freq, _, block_align, bits = \
+        struct.unpack('<HHIIHH', fmt[0:16])
+    if audio_format == 0xFFFE and len(fmt) >= 26:  # WAVE_FORMAT_EXTENSIBLE
+        audio_format = struct.unpack('<H', fmt[24:26])[0]
+    if audio_format != 1 or bits not in (8, 16, 32) or \
+            block_align != num_channels * bits // 8:
+        raise KaldiIOError("Unsupported WAV format: format {0}, {1} bits, "
+                           "block align {2}".format(audio_format, bits,
+                                                    block_align))
+    if chunk_size == 0 or chunk_size == 0xffffffff:
+        data = fd.read()
+        data = data[0:len(data) - len(data) % block_align]
+    else:
+        data = _read_exactly(fd, chunk_size)
+        if chunk_size % block_align != 0:
+            data = data[0:chunk_size - chunk_size % block_align]
+    dtype = {8: 'u1', 16: '<i2', 32: '<i4'}[bits]
+    samples = np.frombuffer(data, dtype=dtype).astype(np.float32)
+    if bits == 8:
+        samples -= 128
+    return float(samp_freq), samples.reshape(-1, num_channels).T.copy()
+
+
+def read_wav(file_or_fd):
+    """ Reads a WAV file and returns (samp_freq, data), where 'data' is a
+    (num_channels, num_samples) float32 array.  The input can be an
+    rxfilename, e.g. the second field of a line of wav.scp ('a.wav',
+    'sox a.flac -t wav - |' or 'wav.1.ark:1234'), or an opened binary file
+    object positioned at the start of the WAV data. """
+    if not isinstance(file_or_fd, str):
+        return _read_wav(file_or_fd)
+    fd = open_or_fd(file_or_fd)
+    try:
+        wav = _read_wav(fd)
+        if isinstance(fd, _PipeHandle):
+            fd.read()  # so the command doesn't get SIGPIPE.
+    finally:
+        _close_if_opened(fd, file_or_fd)
+    return wav
+
+
+def _read_ark(file_or_fd, expected, text_dtype=np.float32):
+    fd = open_or_fd(file_or_fd)
+    try:
+        key = read_key(fd)
+        while key is not None:
+            yield key, _read_object(fd, expected, text_dtype)
+            key = read_key(fd)
+    finally:
+        _close_if_opened(fd, file_or_fd)
+
+
+def read_mat_ark(file_or_fd, text_dtype=np.float32):
+    """ Reads a matrix archive in binary or text format and yields tuples
+    (key, matrix).  The input can be an rxfilename or an opened binary file
+    object.  The matrices in text format are read as 'text_dtype'; the
+    default, float32, is what Kaldi programs would read them as, but
+    np.float64 keeps all the digits.
+
+    e.g. mat_dict = { key: mat for key, mat in read_mat_ark(file) }
+    """
+    return _read_ark(file_or_fd, 'mat', text_dtype)
+
+
+def read_vec_flt_ark(file_or_fd):
+    """ Like read_mat_ark(), but for float vectors. """
+    return _read_ark(file_or_fd, 'vec')
+
+
+def read_vec_int_ark(file_or_fd):
+    """ Like read_mat_ark(), but for integer vectors. """
+    return _read_ark(file_or_fd, 'ivec')
+
+
+def read_scp(file_or_fd):
+    """ Reads an scp file and yields tuples (key, rxfilename). """
+    fd = open_or_fd(file_or_fd, 'rb')
+    try:
+        for line in fd:
+            parts = line.decode().strip().split(None, 1)
+            if len(parts) == 0:
+                continue
+            if len(parts) != 2:
+                raise KaldiIOError("Bad line in scp file: " + line.decode())
+            yield parts[0], parts[1]
+    finally:
+        _close_if_opened(fd, file_or_fd)
+
+
+class ScpReader(object):
+    """ Random-access reader for the objects in an scp file, similar to a
+    RandomAccessTableReader in Kaldi.  Archives referred to with offsets are
+    memory-mapped (each archive once), and uncompressed matrices and
+    vectors are returned as read-only numpy views of the mapped memory;
+    compressed matrices are uncompressed into new arrays.  Entries that are
+    pipes or plain files without an offset are read with read_mat() etc.
+
+    'expected' is 'mat' (the default), 'vec' or 'ivec'.
+
+    e.g.:
+        reader = ScpReader('data/train/feats.scp')
+        for key in reader.keys():
+            mat = reader[key]
+        reader.close()
+    """
+    def __init__(self, scp, expected='mat'):
+        assert expected in ('mat', 'vec', 'ivec')
+        self.expected = expected
+        self.entries = dict()
+        self.order = []
+        for key, rxfilename in read_scp(_strip_table_prefix(scp)):
+            self.entries[key] = rxfilename
+            self.order.append(key)
+        self.mmaps = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.order)
+
+    def keys(self):
+        return list(self.order)
+
+    def __iter__(self):
+        for key in self.order:
+            yield key, self[key]
+
+    def _get_mmap(self, filename):
+        mm = self.mmaps.get(filename)
+        if mm is None:
+            with open(filename, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mmaps[filename] = mm
+        return mm
+
+    def location(self, key):
+        """ Returns (filename, offset) for the entry 'key', where offset is
+        None if the entry has no offset (e.g. a pipe). """
+        filename, offset, _, _ = parse_rxfilename(self.entries[key])
+        return filename, offset
+
+    def __getitem__(self, key):
+        rxfilename = self.entries[key]
+        filename, offset, row_range, col_range = parse_rxfilename(rxfilename)
+        if offset is None or filename.endswith('|'):
+            return _read_single(rxfilename, self.expected)
+        mm = self._get_mmap(filename)
+        obj = _read_mmap_object(mm, offset, self.expected)
+        return _apply_ranges(obj, row_range, col_range)
+
+    def close(self):
+        for mm in self.mmaps.values():
+            mm.close()
+        self.mmaps = dict()
+
+
+def _read_mmap_object(mm, offset, expected):
+    """ Reads the object starting at 'offset' in the memory map 'mm',
+    returning a view of 'mm' where the object is stored uncompressed. """
+    if mm[offset:offset + 2] != _BINARY_HEADER:
+        # Text-format object; fall back to the stream reader.
+        fd = _MmapFile(mm, offset)
+        return _read_object(fd, expected)
+    pos = offset + 2
+
+    def int32_at(pos):
+        if mm[pos:pos + 1] != _INT32_SIZE_BYTE:
+            raise KaldiIOError("Expected int32 at offset {0}".format(pos))
+        return struct.unpack_from('<i', mm, pos + 1)[0]
+
+    if expected == 'ivec':
+        dim = int32_at(pos)
+        return np.frombuffer(mm, dtype=_INT32_PAIR_DTYPE, count=dim,
+                             offset=pos + 5)['value']
+    end = mm.find(b' ', pos, pos + 8)
+    if end < 0:
+        raise KaldiIOError("Could not read token at offset {0}".format(pos))
+    token = mm[pos:end].decode()
+    pos = end + 1
+    if token in ('FM', 'DM') and expected == 'mat':
+        dtype = np.dtype('<f4' if token == 'FM' else '<f8')
+        num_rows, num_cols = int32_at(pos), int32_at(pos + 5)
+        return np.frombuffer(mm, dtype=dtype, count=num_rows * num_cols,
+                             offset=pos + 10).reshape(num_rows, num_cols)
+    elif token in ('FV', 'DV') and expected == 'vec':
+        dtype = np.dtype('<f4' if token == 'FV' else '<f8')
+        dim = int32_at(pos)
+        return np.frombuffer(mm, dtype=dtype, count=dim, offset=pos + 5)
+    elif token in ('CM', 'CM2', 'CM3') and expected == 'mat':
+        header = _CM_HEADER.unpack_from(mm, pos)
+        pos += _CM_HEADER.size
+        size = _compressed_size(token, header[2], header[3])
+        return _uncompress(token, header, memoryview(mm)[pos:pos + size])
+    raise KaldiIOError("Unexpected token {0!r} at offset {1}".format(
+        token, offset))
+
+
+class _MmapFile(object):
+    """ Minimal read-only file object over a memory map, used to re-use the
+    stream readers for text-format objects. """
+    def __init__(self, mm, offset):
+        self.mm = mm
+        self.pos = offset
+
+    def read(self, n):
+        data = self.mm[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        end = self.mm.find(b'\n', self.pos)
+        end = len(self.mm) if end < 0 else end + 1
+        return self.read(end - self.pos)
+
+
+def _write_int32(fd, value):
+    fd.write(_INT32_SIZE_BYTE + struct.pack('<i', value))
+
+
+def _float_to_uint(min_value, range_, mat, max_int):
+    """ Vectorized FloatToUint16() / FloatToUint8() from
+    compressed-matrix.cc. """
+    f = ((mat.astype(np.float32) - np.float32(min_value))
+         / np.float32(range_))
+    f = np.clip(f, np.float32(0.0), np.float32(1.0))
+    return np.floor((f * np.float32(max_int)).astype(np.float64)
+                    + 0.499).astype(np.int64)
+
+
+def _compute_col_headers(min_value, range_, mat):
+    """ Vectorized CompressedMatrix::ComputeColHeader() applied to all
+    columns of 'mat'; returns a (num_cols, 4) uint16 array. """
+    num_rows = mat.shape[0]
+    sdata = np.sort(mat.astype(np.float32), axis=0)
+    if num_rows >= 5:
+        quarter_nr = num_rows // 4
+        rows = [0, quarter_nr, 3 * quarter_nr, num_rows - 1]
+    else:
+        rows = [0, min(1, num_rows - 1), min(2, num_rows - 1),
+                min(3, num_rows - 1)]
+    q = _float_to_uint(min_value, range_, sdata[rows, :], 65535)
+    # For num_rows < 5 this is the 'pathological case' of ComputeColHeader().
+    p0 = np.minimum(q[0], 65532)
+    p25 = (np.minimum(np.maximum(q[1], p0 + 1), 65533) if num_rows > 1
+           else p0 + 1)
+    p75 = (np.minimum(np.maximum(q[2], p25 + 1), 65534) if num_rows > 2
+           else p25 + 1)
+    p100 = np.maximum(q[3], p75 + 1) if num_rows > 3 else p75 + 1
+    return np.stack([p0, p25, p75, p100], axis=1).astype('<u2')
+
+
+def _compress_columns(min_value, range_, mat, col_headers):
+    """ Vectorized FloatToChar() over all columns; returns uint8 data of
+    shape (num_cols, num_rows). """
+    p = (np.float32(min_value) + np.float32(range_)
+         * np.float32(1.52590218966964e-05)
+         * col_headers.astype(np.float32))
+    p0, p25, p75, p100 = (p[:, i:i+1] for i in range(4))
+    value = mat.astype(np.float32).T
+
+    def quantize(lower, upper, num_steps):
+        # static_cast<int>(f * num_steps + 0.5) truncates towards zero.
+        f = (value - lower) / (upper - lower) * np.float32(num_steps)
+        return np.trunc(f.astype(np.float64) + 0.5)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        low = np.clip(quantize(p0, p25, 64), 0, 64)
+        mid = np.clip(64 + quantize(p25, p75, 128), 64, 192)
+        high = np.clip(192 + quantize(p75, p100, 63), 192, 255)
+    ans = np.where(value < p25, low, np.where(value < p75, mid, high))
+    return ans.astype(np.uint8)
+
+
+def _write_compressed(fd, mat, method):
+    """ Writes 'mat' as a CompressedMatrix, as CompressedMatrix::CopyFromMat()
+    followed by CompressedMatrix::Write() would. """
+    num_rows, num_cols = mat.shape
+    if num_rows == 0:
+        fd.write(b'CM ' + _CM_HEADER.pack(0.0, 0.0, 0, 0))
+        return
+    if method == kAutomaticMethod:
+        method = kSpeechFeature if num_rows > 8 else kTwoByteAuto
+    if method in (kSpeechFeature, kTwoByteAuto, kOneByteAuto):
+        min_value = float(np.float32(mat.min()))
+        max_value = float(np.float32(mat.max()))
+        if max_value == min_value:
+            max_value = min_value + (1.0 + abs(min_value))
+        if not (np.isfinite(min_value) and np.isfinite(max_value)):
+            raise KaldiIOError("Cannot compress a matrix with Nan's or Inf's")
+        range_ = float(np.float32(max_value) - np.float32(min_value))
+    elif method == kTwoByteSignedInteger:
+        min_value, range_ = -32768.0, 65535.0
+    elif method == kOneByteUnsignedInteger:
+        min_value, range_ = 0.0, 255.0
+    elif method == kOneByteZeroOne:
+        min_value, range_ = 0.0, 1.0
+    else:
+        raise KaldiIOError("Invalid compression method {0}".format(method))
+
+    header = _CM_HEADER.pack(min_value, range_, num_rows, num_cols)
+    if method == kSpeechFeature:
+        col_headers = _compute_col_headers(min_value, range_, mat)
+        fd.write(b'CM ' + header)
+        fd.write(col_headers.tobytes())
+        fd.write(_compress_columns(min_value, range_, mat,
+                                   col_headers).tobytes())
+    elif method in (kTwoByteAuto, kTwoByteSignedInteger):
+        fd.write(b'CM2 ' + header)
+        fd.write(_float_to_uint(min_value, range_, mat, 65535)
+                 .astype('<u2').tobytes())
+    else:
+        fd.write(b'CM3 ' + header)
+        fd.write(_float_to_uint(min_value, range_, mat, 255)
+                 .astype(np.uint8).tobytes())
+
+
+def _write_key(fd, key):
+    if key is not None:
+        if ' ' in key or key == '':
+            raise KaldiIOError("Invalid key {0!r}".format(key))
+        fd.write((key + ' ').encode())
+
+
+def write_mat(file_or_fd, mat, key=None, compression_method=None):
+    """ Writes the 2-dimensional numpy array 'mat' in binary format, as a
+    float matrix (FM) if its dtype is float32 or smaller and a double
+    matrix (DM) if it is float64.  If 'key' is given, the matrix is written
+    as an archive entry.  If 'compression_method' is given (one of the
+    k* constants in this module, e.g. kAutomaticMethod), the matrix is
+    written as a compressed matrix, like copy-feats --compress=true.
+    The destination can be a wxfilename or an opened binary file object.
+    """
+    mat = np.asarray(mat)
+    if mat.ndim != 2:
+        raise KaldiIOError("Expected 2-dimensional array, got shape "
+                           "{0}".format(mat.shape))
+    fd = open_or_fd(file_or_fd, 'wb')
+    try:
+        _write_key(fd, key)
+        fd.write(_BINARY_HEADER)
+        if compression_method is not None:
+            _write_compressed(fd, mat, compression_method)
+            return
+        if mat.dtype == np.float64:
+            fd.write(b'DM ')
+            dtype = '<f8'
+        else:
+            fd.write(b'FM ')
+            dtype = '<f4'
+        _write_int32(fd, mat.shape[0])
+        _write_int32(fd, mat.shape[1])
+        fd.write(np.ascontiguousarray(mat, dtype=dtype).tobytes())
+    finally:
+        _close_if_opened(fd, file_or_fd)
+
+
+def write_vec_flt(file_or_fd, vec, key=None):
+    """ Like write_mat(), but writes a float (FV) or double (DV) vector. """
+    vec = np.asarray(vec)
+    if vec.ndim != 1:
+        raise KaldiIOError("Expected 1-dimensional array, got shape "
+                           "{0}".format(vec.shape))
+    fd = open_or_fd(file_or_fd, 'wb')
+    try:
+        _write_key(fd, key)
+        fd.write(_BINARY_HEADER)
+        if vec.dtype == np.float64:
+            fd.write(b'DV ')
+            dtype = '<f8'
+        else:
+            fd.write(b'FV ')
+            dtype = '<f4'
+        _write_int32(fd, vec.shape[0])
+        fd.write(np.ascontiguousarray(vec, dtype=dtype).tobytes())
+    finally:
+        _close_if_opened(fd, file_or_fd)
+
+
+def write_vec_int(file_or_fd, vec, key=None):
+    """ Like write_mat(), but writes an integer vector the way
+    Int32VectorHolder does. """
+    vec = np.asarray(vec)
+    if vec.ndim != 1:
+        raise KaldiIOError("Expected 1-dimensional array, got shape "
+                           "{0}".format(vec.shape))
+    fd = open_or_fd(file_or_fd, 'wb')
+    try:
+        _write_key(fd, key)
+        fd.write(_BINARY_HEADER)
+        _write_int32(fd, vec.shape[0])
+        pairs = np.empty(vec.shape[0], dtype=_INT32_PAIR_DTYPE)
+        pairs['size'] = 4
+        pairs['value'] = vec
+        fd.write(pairs.tobytes())
+    finally:
+        _close_if_opened(fd, file_or_fd)
+
+
+def write_wav(file_or_fd, data, samp_freq, key=None):
+    """ Writes 'data', a (num_channels, num_samples) or (num_samples,) array
+    with samples in the 16-bit integer scale, as a 16-bit PCM WAV file, the
+    way WaveData::Write() does: samples are truncated towards zero and
+    clipped to the int16 range.  If 'key' is given, it is written as an
+    archive entry, like wav-copy does.
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[np.newaxis, :]
+    if data.ndim != 2:
+        raise KaldiIOError("Expected 1 or 2-dimensional array, got shape "
+                           "{0}".format(data.shape))
+    num_channels, num_samples = data.shape
+    samples = np.clip(np.trunc(data.T), -32768, 32767).astype('<i2')
+    data_size = num_samples * num_channels * 2
+    samp_freq = int(samp_freq)
+    fd = open_or_fd(file_or_fd, 'wb')
+    try:
+        _write_key(fd, key)
+        fd.write(b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVEfmt ' +
+                 struct.pack('<IHHIIHH', 16, 1, num_channels, samp_freq,
+                             samp_freq * num_channels * 2, num_channels * 2,
+                             16) +
+                 b'data' + struct.pack('<I', data_size))
+        fd.write(samples.tobytes())
+    finally:
+        _close_if_opened(fd, file_or_fd)
+
+
+class ArkScpWriter(object):
+    """ Writes objects to a binary archive and, optionally, an scp file
+    with offsets into it, like the wspecifier 'ark,scp:foo.ark,foo.scp'.
+    If 'ark' is '-', the archive is written to standard output (there can't
+    be an scp file then).
+
+    e.g.:
+        with ArkScpWriter('foo.ark', 'foo.scp') as writer:
+            writer.write_mat('utt1', mat)
+    """
+    def __init__(self, ark, scp=None, compression_method=None):
+        self.ark_filename = ark
+        self.scp_filename = scp
+        self.compression_method = compression_method
+        if ark == '-':
+            if scp is not None:
+                raise KaldiIOError("Can't write an scp file for an archive "
+                                   "written to standard output")
+            self.ark = sys.stdout.buffer
+        else:
+            self.ark = open(ark, 'wb')
+        self.scp = None if scp is None else open(scp, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _add_scp_entry(self, key):
+        if self.scp is not None:
+            # The offset points just after the key and its space.
+            print("{0} {1}:{2}".format(
+                key, self.ark_filename, self.ark.tell() + len(key.encode()) + 1),
+                file=self.scp)
+
+    def write_mat(self, key, mat):
+        self._add_scp_entry(key)
+        write_mat(self.ark, mat, key=key,
+                  compression_method=self.compression_method)
+
+    def write_vec_flt(self, key, vec):
+        self._add_scp_entry(key)
+        write_vec_flt(self.ark, vec, key=key)
+
+    def write_vec_int(self, key, vec):
+        self._add_scp_entry(key)
+        write_vec_int(self.ark, vec, key=key)
+
+    def write_wav(self, key, data, samp_freq):
+        self._add_scp_entry(key)
+        write_wav(self.ark, data, samp_freq, key=key)
+
+    def close(self):
+        if self.ark_filename == '-':
+            self.ark.flush()
+        else:
+            self.ark.close()
+        if self.scp is not None:
+            self.scp.close()
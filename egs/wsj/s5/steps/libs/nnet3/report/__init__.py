@@ -3,6 +3,8 @@
 # Copyright 2016    Vimal Manohar
 # Apache 2.0.
 
+from . import log_cache
 from . import log_parse
+from . import param_drift
 
-__all__ = ["log_parse"]
+__all__ = ["log_cache", "log_parse", "param_drift"]
@@ -0,0 +1,198 @@
+
+
+# Copyright 2020    Johns Hopkins University
+# Apache 2.0.
+
+""" This module contains LogCache, an incremental index of the stats that the
+functions in log_parse.py parse from the training logs (progress.*.log,
+compute_prob_*.log, train.*.log ...), so that generating a report does not
+mean parsing all the logs of an experiment again.
+
+The functions in log_parse.py parse each log file separately, into a
+"record" (e.g. the list of (iteration, component, clipped-proportion) in a
+progress log), and LogCache stores the records of each file with the file's
+size and modification time.  A file is only parsed again when its size or
+modification time changes, e.g. while training is still writing it, so
+reports can be refreshed cheaply during training.  The cache is kept in
+memory (one per experiment directory) and on disk, in
+<exp-dir>/log/log_parse_cache.json.gz:
+    {"version": 1,
+     "files": {<log-file-name>: [<size>, <mtime-ns>,
+                                 {<parser-key>: <record>, ...}], ...}}
+(the file names are relative to <exp-dir>/log), which is rewritten (atomically) by write_log_caches(), which is called when
+the program exits.  If it can't be written, e.g. because the experiment
+directory belongs to someone else, only the in-memory cache is used.
+
+The records are stored as JSON, so they must be made of lists, dicts with
+string keys, strings and numbers (tuples come back as lists), and they must
+not be modified by the callers.  If a parser changes the format of its
+records, its parser key must be changed too.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import fnmatch
+import gzip
+import io
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+g_cache_version = 1
+
+# dict from experiment directory to its LogCache.
+g_log_caches = {}
+
+
+class LogCache(object):
+    """ The cache of the records parsed from the logs in <exp_dir>/log (see
+    the module docstring). """
+
+    def __init__(self, exp_dir):
+        self.log_dir = os.path.join(exp_dir, 'log')
+        self.filename = os.path.join(self.log_dir, 'log_parse_cache.json.gz')
+        self.files = {}
+        self.changed = False
+        self.can_write = True
+        if os.path.exists(self.filename):
+            try:
+                with gzip.open(self.filename, 'rb') as f:
+                    cache = json.loads(f.read().decode())
+                if cache.get('version') == g_cache_version:
+                    self.files = cache['files']
+            except (IOError, OSError, EOFError, ValueError) as e:
+                logger.warning("Ignoring the log cache {0}, which could not "
+                               "be read: {1}".format(self.filename, e))
+
+    def get_records(self, file_pattern, parser_key, parse_file,
+                    recursive=False):
+        """ Returns a list of (path, record) for the log files whose names
+        match the wildcard pattern 'file_pattern' (e.g. "progress.*.log"),
+        sorted by name, where 'record' is parse_file(path).  The records of
+        the files that are new or have changed since they were cached under
+        'parser_key' are computed again.  If 'recursive' is True, the
+        subdirectories of the log directory are searched too (like
+        "find <exp-dir>/log -name <file-pattern>"). """
+        if recursive:
+            names = []
+            for dirpath, dirnames, filenames in os.walk(self.log_dir):
+                dirnames.sort()
+                for filename in sorted(fnmatch.filter(filenames,
+                                                      file_pattern)):
+                    names.append(os.path.relpath(
+                        os.path.join(dirpath, filename), self.log_dir))
+            names.sort()
+        else:
+            try:
+                names = sorted(fnmatch.filter(os.listdir(self.log_dir),
+                                              file_pattern))
+            except OSError:
+                names = []
+        records = []
+        for name in names:
+            path = os.path.join(self.log_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # e.g. it was removed.
+            mtime_ns = get_mtime_ns(stat)
+            entry = self.files.get(name)
+            if (entry is None or entry[0] != stat.st_size
+                    or entry[1] != mtime_ns):
+                entry = [stat.st_size, mtime_ns, {}]
+                self.files[name] = entry
+            if parser_key not in entry[2]:
+                entry[2][parser_key] = parse_file(path)
+                self.changed = True
+            records.append((path, entry[2][parser_key]))
+        return records
+
+    def write(self):
+        """ Writes the cache to disk if it has changed. """
+        if not self.changed or not self.can_write:
+            return
+        # the entries of the logs that have been removed are not written.
+        try:
+            names = set(os.listdir(self.log_dir))
+        except OSError:
+            return
+        files = dict((name, entry) for name, entry in self.files.items()
+                     if name in names or (os.sep in name and os.path.exists(
+                         os.path.join(self.log_dir, name))))
+        data = json.dumps({'version': g_cache_version, 'files': files},
+                          separators=(',', ':'))
+        tmp_filename = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+        try:
+            with gzip.open(tmp_filename, 'wb', 1) as f:
+                f.write(data.encode())
+            os.rename(tmp_filename, self.filename)
+            self.changed = False
+        except (IOError, OSError) as e:
+            logger.warning("Could not write the log cache {0}, so the logs "
+                           "will be parsed again next time: {1}".format(
+                               self.filename, e))
+            self.can_write = False
+
+
+def get_mtime_ns(stat):
+    """ Returns the modification time in nanoseconds of the file whose
+    os.stat() result is 'stat'.  python2 doesn't have st_mtime_ns, so there
+    it is computed from the float st_mtime. """
+    try:
+        return stat.st_mtime_ns
+    except AttributeError:
+        return int(stat.st_mtime * 1e9)
+
+
+def get_records(exp_dir, file_pattern, parser_key, parse_file,
+                recursive=False):
+    """ Returns the records of the logs <exp_dir>/log/<file_pattern>, as
+    LogCache.get_records(), using the cache of 'exp_dir'. """
+    if exp_dir not in g_log_caches:
+        g_log_caches[exp_dir] = LogCache(exp_dir)
+    return g_log_caches[exp_dir].get_records(file_pattern, parser_key,
+                                             parse_file, recursive)
+
+
+@atexit.register
+def write_log_caches():
+    """ Writes the caches that have changed to disk.  This is called
+    automatically when the program exits, but long-running programs (e.g. the
+    training scripts) may call it to save the cache earlier. """
+    for cache in g_log_caches.values():
+        cache.write()
+
+
+def grep_file(path, line_regex):
+    """ Returns the lines of the file 'path' that match the regex
+    'line_regex' (as grep -e would), without newlines, each prefixed with
+    'path' and ':' like the output of grep with several files. """
+    # Most lines of a log don't match, so rather than trying the regex on
+    # each line we search the whole file for it (undecoded; the patterns are
+    # ASCII) and only look at the lines where it matched; each of them is
+    # checked on its own if the match went across lines.
+    regex = re.compile(line_regex.encode(), re.MULTILINE)
+    with open(path, 'rb') as f:
+        text = f.read()
+    lines = []
+    pos = 0
+    while True:
+        match = regex.search(text, pos)
+        if match is None:
+            break
+        start = text.rfind(b'\n', 0, match.start()) + 1
+        end = text.find(b'\n', match.start())
+        if end < 0:
+            end = len(text)
+        line = text[start:end]
+        if match.end() <= end or regex.search(line):
+            lines.append(u"{0}:{1}".format(
+                path, line.decode('utf-8', 'replace')))
+        pos = end + 1
+    return lines
@@ -11,7 +11,7 @@ import datetime
 import logging
 import re
 
-import libs.common as common_lib
+from libs.nnet3.report import log_cache
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -57,10 +57,10 @@ class KaldiLogParseException(Exception):
                            "There was an error while trying to parse the logs."
                            " Details : \n{0}\n".format(message))
 
-# This function is used to fill stats_per_component_per_iter table with the
-# results of regular expression.
-
-def fill_nonlin_stats_table_with_regex_result(groups, gate_index, stats_table):
+def get_nonlin_stats_from_regex_result(groups, gate_index):
+    """ Returns [iteration, component_name, component_type, stats] for the
+    result 'groups' of one of the nonlinearity regexes above, where stats is
+    the list of the stats of the gate 'gate_index'. """
     iteration = int(groups[0])
     component_name = groups[1]
     component_type = groups[2]
@@ -84,28 +84,10 @@ def fill_nonlin_stats_table_with_regex_result(groups, gate_index, stats_table):
     deriv_95th = float(deriv_percentiles_split[9])
 
     if len(groups) <= 9:
-        try:
-            if iteration in stats_table[component_name]['stats']:
-                stats_table[component_name]['stats'][iteration].extend(
-                        [value_mean,  value_stddev,
-                         deriv_mean,  deriv_stddev,
-                         value_5th,  value_50th,  value_95th,
-                         deriv_5th,  deriv_50th,  deriv_95th])
-            else:
-                stats_table[component_name]['stats'][iteration] = [
-                        value_mean,  value_stddev,
-                        deriv_mean,  deriv_stddev,
-                        value_5th,  value_50th,  value_95th,
-                        deriv_5th,  deriv_50th,  deriv_95th]
-        except KeyError:
-            stats_table[component_name] = {}
-            stats_table[component_name]['type'] = component_type
-            stats_table[component_name]['stats'] = {}
-            stats_table[component_name][
-                    'stats'][iteration] = [value_mean,  value_stddev,
-                                           deriv_mean,  deriv_stddev,
-                                           value_5th,  value_50th,  value_95th,
-                                           deriv_5th,  deriv_50th,  deriv_95th]
+        stats = [value_mean,  value_stddev,
+                 deriv_mean,  deriv_stddev,
+                 value_5th,  value_50th,  value_95th,
+                 deriv_5th,  deriv_50th,  deriv_95th]
     else:
         #for oderiv-rms
         oderiv_percentiles = groups[9+gate_index*6]
@@ -116,68 +98,68 @@ def fill_nonlin_stats_table_with_regex_result(groups, gate_index, stats_table):
         oderiv_5th = float(oderiv_percentiles_split[4])
         oderiv_50th = float(oderiv_percentiles_split[6])
         oderiv_95th = float(oderiv_percentiles_split[9])
-        try:
-            if iteration in stats_table[component_name]['stats']:
-                stats_table[component_name]['stats'][iteration].extend(
-                        [value_mean,  value_stddev,
-                         deriv_mean,  deriv_stddev,
-                         oderiv_mean, oderiv_stddev,
-                         value_5th,  value_50th,  value_95th,
-                         deriv_5th,  deriv_50th,  deriv_95th,
-                         oderiv_5th, oderiv_50th, oderiv_95th])
-            else:
-                stats_table[component_name]['stats'][iteration] = [
-                        value_mean,  value_stddev,
-                        deriv_mean,  deriv_stddev,
-                        oderiv_mean, oderiv_stddev,
-                        value_5th,  value_50th,  value_95th,
-                        deriv_5th,  deriv_50th,  deriv_95th,
-                        oderiv_5th, oderiv_50th, oderiv_95th]
-        except KeyError:
-            stats_table[component_name] = {}
-            stats_table[component_name]['type'] = component_type
-            stats_table[component_name]['stats'] = {}
-            stats_table[component_name][
-                    'stats'][iteration] = [value_mean,  value_stddev,
-                                           deriv_mean,  deriv_stddev,
-                                           oderiv_mean, oderiv_stddev,
-                                           value_5th,  value_50th,  value_95th,
-                                           deriv_5th,  deriv_50th,  deriv_95th,
-                                           oderiv_5th, oderiv_50th, oderiv_95th]
-
-def parse_progress_logs_for_nonlinearity_stats(exp_dir):
-
-    """ Parse progress logs for mean and std stats for non-linearities.
-    e.g. for a line that is parsed from progress.*.log:
-    exp/nnet3/lstm_self_repair_ld5_sp/log/progress.9.log:component name=Lstm3_i
-    type=SigmoidComponent, dim=1280, self-repair-scale=1e-05, count=1.96e+05,
-    value-avg=[percentiles(0,1,2,5 10,20,50,80,90
-    95,98,99,100)=(0.05,0.09,0.11,0.15 0.19,0.27,0.50,0.72,0.83
-    0.88,0.92,0.94,0.99), mean=0.502, stddev=0.23],
-    deriv-avg=[percentiles(0,1,2,5 10,20,50,80,90
-    95,98,99,100)=(0.009,0.04,0.05,0.06 0.08,0.10,0.14,0.17,0.18
-    0.19,0.20,0.20,0.21), mean=0.134, stddev=0.0397]
-    """
+        stats = [value_mean,  value_stddev,
+                 deriv_mean,  deriv_stddev,
+                 oderiv_mean, oderiv_stddev,
+                 value_5th,  value_50th,  value_95th,
+                 deriv_5th,  deriv_50th,  deriv_95th,
+                 oderiv_5th, oderiv_50th, oderiv_95th]
+    return [iteration, component_name, component_type, stats]
+
+
+def add_nonlin_stats_to_table(iteration, component_name, component_type,
+                              stats, stats_table):
+    """ Adds the stats of a gate of a component (see
+    get_nonlin_stats_from_regex_result()) to the stats_per_component_per_iter
+    table 'stats_table'; the stats of the gates of a component are
+    concatenated. """
+    if component_name not in stats_table:
+        stats_table[component_name] = {}
+        stats_table[component_name]['type'] = component_type
+        stats_table[component_name]['stats'] = {}
+    if iteration in stats_table[component_name]['stats']:
+        stats_table[component_name]['stats'][iteration].extend(stats)
+    else:
+        stats_table[component_name]['stats'][iteration] = list(stats)
 
-    progress_log_files = "%s/log/progress.*.log" % (exp_dir)
-    stats_per_component_per_iter = {}
 
-    progress_log_lines = common_lib.get_command_stdout(
-        'grep -e "value-avg.*deriv-avg.*oderiv" {0}'.format(progress_log_files),
-        require_zero_status = False)
+# This function is used to fill stats_per_component_per_iter table with the
+# results of regular expression.
 
-    if progress_log_lines:
+def fill_nonlin_stats_table_with_regex_result(groups, gate_index, stats_table):
+    add_nonlin_stats_to_table(
+        *(get_nonlin_stats_from_regex_result(groups, gate_index)
+          + [stats_table]))
+
+
+def parse_progress_log_for_nonlinearity_stats(progress_log_file):
+    """ Parses the nonlinearity stats of one progress log (see
+    parse_progress_logs_for_nonlinearity_stats()).  Returns
+    [has_oderiv, stats_list], where has_oderiv is True if the log has
+    oderiv-rms stats, in which case only the lines with oderiv-rms stats are
+    parsed, and stats_list is a list of
+    [iteration, component_name, component_type, stats]. """
+    progress_log_lines = log_cache.grep_file(
+        progress_log_file, "value-avg.*deriv-avg")
+    oderiv_regex = re.compile("value-avg.*deriv-avg.*oderiv")
+    oderiv_lines = [line for line in progress_log_lines
+                    if oderiv_regex.search(line)]
+    has_oderiv = len(oderiv_lines) > 0
+
+    if has_oderiv:
         # cases with oderiv-rms
+        progress_log_lines = oderiv_lines
         parse_regex = re.compile(g_normal_nonlin_regex_pattern_with_oderiv)
     else:
         # cases with only value-avg and deriv-avg
-        progress_log_lines = common_lib.get_command_stdout(
-        'grep -e "value-avg.*deriv-avg" {0}'.format(progress_log_files),
-        require_zero_status = False)
         parse_regex = re.compile(g_normal_nonlin_regex_pattern)
 
-    for line in progress_log_lines.split("\n"):
-        mat_obj = parse_regex.search(line)
+    # The parse regexes start with ".*" and the lines have no newlines, so
+    # match() is the same as search(), which would try every position of the
+    # line in turn.
+    stats_list = []
+    for line in progress_log_lines:
+        mat_obj = parse_regex.match(line)
         if mat_obj is None:
             continue
         # groups = ('9', 'Lstm3_i', 'Sigmoid', '0.05...0.99', '0.502', '0.23',
@@ -186,15 +168,47 @@ def parse_progress_logs_for_nonlinearity_stats(exp_dir):
         component_type = groups[2]
         if component_type == 'LstmNonlinearity':
             parse_regex_lstmp = re.compile(g_lstmp_nonlin_regex_pattern)
-            mat_obj = parse_regex_lstmp.search(line)
+            mat_obj = parse_regex_lstmp.match(line)
             groups = mat_obj.groups()
             assert len(groups) == 33
             for i in list(range(0,5)):
-                fill_nonlin_stats_table_with_regex_result(groups, i,
-                        stats_per_component_per_iter)
+                stats_list.append(
+                    get_nonlin_stats_from_regex_result(groups, i))
         else:
-            fill_nonlin_stats_table_with_regex_result(groups, 0,
-                    stats_per_component_per_iter)
+            stats_list.append(get_nonlin_stats_from_regex_result(groups, 0))
+    return [has_oderiv, stats_list]
+
+
+def parse_progress_logs_for_nonlinearity_stats(exp_dir):
+
+    """ Parse progress logs for mean and std stats for non-linearities.
+    e.g. for a line that is parsed from progress.*.log:
+    exp/nnet3/lstm_self_repair_ld5_sp/log/progress.9.log:component name=Lstm3_i
+    type=SigmoidComponent, dim=1280, self-repair-scale=1e-05, count=1.96e+05,
+    value-avg=[percentiles(0,1,2,5 10,20,50,80,90
+    95,98,99,100)=(0.05,0.09,0.11,0.15 0.19,0.27,0.50,0.72,0.83
+    0.88,0.92,0.94,0.99), mean=0.502, stddev=0.23],
+    deriv-avg=[percentiles(0,1,2,5 10,20,50,80,90
+    95,98,99,100)=(0.009,0.04,0.05,0.06 0.08,0.10,0.14,0.17,0.18
+    0.19,0.20,0.20,0.21), mean=0.134, stddev=0.0397]
+
+    If any of the logs has oderiv-rms stats, only the lines with oderiv-rms
+    stats are used.
+    """
+
+    stats_per_component_per_iter = {}
+    records = log_cache.get_records(
+        exp_dir, "progress.*.log", "nonlinearity_stats",
+        parse_progress_log_for_nonlinearity_stats)
+
+    has_oderiv = any(has_oderiv for path, (has_oderiv, stats_list) in records)
+    for path, (file_has_oderiv, stats_list) in records:
+        if file_has_oderiv != has_oderiv:
+            continue
+        for iteration, component_name, component_type, stats in stats_list:
+            add_nonlin_stats_to_table(iteration, component_name,
+                                      component_type, stats,
+                                      stats_per_component_per_iter)
     return stats_per_component_per_iter
 
 
@@ -213,6 +227,31 @@ class MalformedClippedProportionLineException(Exception):
                            "extract clipped-proportions.\n{0}".format(line))
 
 
+def parse_progress_log_for_clipped_proportion(progress_log_file):
+    """ Parses the clipped proportions in one progress log (see
+    parse_progress_logs_for_clipped_proportion()), and returns a list of
+    [iteration, component_name, clipped_proportion]. """
+    progress_log_lines = log_cache.grep_file(progress_log_file,
+                                             "clipped-proportion")
+    parse_regex = re.compile(".*progress\.([0-9]+)\.log:component "
+                             "name=(.*) type=.* "
+                             "clipped-proportion=([0-9\.e\-]+)")
+
+    cp_list = []
+    for line in progress_log_lines:
+        mat_obj = parse_regex.match(line)
+        if mat_obj is None:
+            if line.strip() == "":
+                continue
+            raise MalformedClippedProportionLineException(line)
+        groups = mat_obj.groups()
+        clipped_proportion = float(groups[2])
+        if clipped_proportion > 1:
+            raise MalformedClippedProportionLineException(line)
+        cp_list.append([int(groups[0]), groups[1], clipped_proportion])
+    return cp_list
+
+
 def parse_progress_logs_for_clipped_proportion(exp_dir):
     """ Parse progress logs for clipped proportion stats.
 
@@ -225,37 +264,21 @@ def parse_progress_logs_for_clipped_proportion(exp_dir):
     self-repair-scale=1
     """
 
-    progress_log_files = "%s/log/progress.*.log" % (exp_dir)
-    component_names = set([])
-    progress_log_lines = common_lib.get_command_stdout(
-        'grep -e "{0}" {1}'.format(
-            "clipped-proportion", progress_log_files),
-        require_zero_status=False)
-    parse_regex = re.compile(".*progress\.([0-9]+)\.log:component "
-                             "name=(.*) type=.* "
-                             "clipped-proportion=([0-9\.e\-]+)")
+    records = log_cache.get_records(
+        exp_dir, "progress.*.log", "clipped_proportion",
+        parse_progress_log_for_clipped_proportion)
 
     cp_per_component_per_iter = {}
 
     max_iteration = 0
     component_names = set([])
-    for line in progress_log_lines.split("\n"):
-        mat_obj = parse_regex.search(line)
-        if mat_obj is None:
-            if line.strip() == "":
-                continue
-            raise MalformedClippedProportionLineException(line)
-        groups = mat_obj.groups()
-        iteration = int(groups[0])
-        max_iteration = max(max_iteration, iteration)
-        name = groups[1]
-        clipped_proportion = float(groups[2])
-        if clipped_proportion > 1:
-            raise MalformedClippedProportionLineException(line)
-        if iteration not in cp_per_component_per_iter:
-            cp_per_component_per_iter[iteration] = {}
-        cp_per_component_per_iter[iteration][name] = clipped_proportion
-        component_names.add(name)
+    for path, cp_list in records:
+        for iteration, name, clipped_proportion in cp_list:
+            max_iteration = max(max_iteration, iteration)
+            if iteration not in cp_per_component_per_iter:
+                cp_per_component_per_iter[iteration] = {}
+            cp_per_component_per_iter[iteration][name] = clipped_proportion
+            component_names.add(name)
     component_names = list(component_names)
     component_names.sort()
 
@@ -289,6 +312,24 @@ def parse_progress_logs_for_clipped_proportion(exp_dir):
             'cp_per_iter_per_component': cp_per_iter_per_component}
 
 
+def parse_progress_log_for_param_diff(progress_log_file, pattern):
+    """ Parses the parameter differences in one progress log (see
+    parse_progress_logs_for_param_diff()), and returns a list of
+    [iteration, differences], where differences is a dict from component
+    name to difference. """
+    progress_log_lines = log_cache.grep_file(progress_log_file, pattern)
+    parse_regex = re.compile(".*progress\.([0-9]+)\.log:"
+                             "LOG.*{0}.*\[(.*)\]".format(pattern))
+    diff_list = []
+    for line in progress_log_lines:
+        mat_obj = parse_regex.match(line)
+        if mat_obj is None:
+            continue
+        groups = mat_obj.groups()
+        diff_list.append([int(groups[0]), parse_difference_string(groups[1])])
+    return diff_list
+
+
 def parse_progress_logs_for_param_diff(exp_dir, pattern):
     """ Parse progress logs for per-component parameter differences.
 
@@ -308,22 +349,19 @@ def parse_progress_logs_for_param_diff(exp_dir, pattern):
                            "Parameter differences"]):
         raise Exception("Unknown value for pattern : {0}".format(pattern))
 
-    progress_log_files = "%s/log/progress.*.log" % (exp_dir)
     progress_per_iter = {}
     component_names = set([])
-    progress_log_lines = common_lib.get_command_stdout(
-        'grep -e "{0}" {1}'.format(pattern, progress_log_files))
-    parse_regex = re.compile(".*progress\.([0-9]+)\.log:"
-                             "LOG.*{0}.*\[(.*)\]".format(pattern))
-    for line in progress_log_lines.split("\n"):
-        mat_obj = parse_regex.search(line)
-        if mat_obj is None:
-            continue
-        groups = mat_obj.groups()
-        iteration = groups[0]
-        differences = parse_difference_string(groups[1])
-        component_names = component_names.union(list(differences.keys()))
-        progress_per_iter[int(iteration)] = differences
+    records = log_cache.get_records(
+        exp_dir, "progress.*.log", "param_diff:" + pattern,
+        lambda progress_log_file: parse_progress_log_for_param_diff(
+            progress_log_file, pattern))
+    if not any(diff_list for path, diff_list in records):
+        raise KaldiLogParseException("Could not find any lines with {k} in "
+                " {l}/log/progress.*.log".format(k=pattern, l=exp_dir))
+    for path, diff_list in records:
+        for iteration, differences in diff_list:
+            component_names = component_names.union(list(differences.keys()))
+            progress_per_iter[iteration] = differences
 
     component_names = list(component_names)
     component_names.sort()
@@ -363,37 +401,56 @@ def parse_progress_logs_for_param_diff(exp_dir, pattern):
             'max_iter': max_iter}
 
 
-def get_train_times(exp_dir):
-    train_log_files = "%s/log/" % (exp_dir)
-    train_log_names = "train.*.log"
-    train_log_lines = common_lib.get_command_stdout(
-        'find {0} -name "{1}" | xargs grep -H -e Accounting'.format(train_log_files,train_log_names))
+def parse_train_log_for_train_time(train_log_file):
+    """ Returns a list of [iteration, job, time] for the "Accounting" line
+    in one train.*.*.log. """
+    train_log_lines = log_cache.grep_file(train_log_file, "Accounting")
     parse_regex = re.compile(".*train\.([0-9]+)\.([0-9]+)\.log:# "
                              "Accounting: time=([0-9]+) thread.*")
 
-    train_times = {}
-    for line in train_log_lines.split('\n'):
-        mat_obj = parse_regex.search(line)
+    time_list = []
+    for line in train_log_lines:
+        mat_obj = parse_regex.match(line)
         if mat_obj is not None:
             groups = mat_obj.groups()
-            try:
-                train_times[int(groups[0])][int(groups[1])] = float(groups[2])
-            except KeyError:
-                train_times[int(groups[0])] = {}
-                train_times[int(groups[0])][int(groups[1])] = float(groups[2])
+            time_list.append([int(groups[0]), int(groups[1]),
+                              float(groups[2])])
+    return time_list
+
+
+def get_train_times(exp_dir):
+    records = log_cache.get_records(exp_dir, "train.*.log", "train_time",
+                                    parse_train_log_for_train_time,
+                                    recursive=True)
+    train_times = {}
+    for path, time_list in records:
+        for iteration, job, time in time_list:
+            if iteration not in train_times:
+                train_times[iteration] = {}
+            train_times[iteration][job] = time
     iters = train_times.keys()
     for iter in iters:
         values = train_times[iter].values()
         train_times[iter] = max(values)
     return train_times
 
+def parse_prob_log(prob_log_file, key, parse_regex):
+    """ Returns a list of [iteration, objf] for the lines of the log
+    'prob_log_file' that match 'parse_regex' and have the objective 'key';
+    the objf is a string. """
+    objf_list = []
+    for line in log_cache.grep_file(prob_log_file, key):
+        mat_obj = parse_regex.match(line)
+        if mat_obj is not None:
+            groups = mat_obj.groups()
+            if groups[1] == key:
+                objf_list.append([int(groups[0]), groups[2]])
+    return objf_list
+
+
 def parse_prob_logs(exp_dir, key='accuracy', output="output"):
     train_prob_files = "%s/log/compute_prob_train.*.log" % (exp_dir)
     valid_prob_files = "%s/log/compute_prob_valid.*.log" % (exp_dir)
-    train_prob_strings = common_lib.get_command_stdout(
-        'grep -e {0} {1}'.format(key, train_prob_files))
-    valid_prob_strings = common_lib.get_command_stdout(
-        'grep -e {0} {1}'.format(key, valid_prob_files))
 
     # LOG
     # (nnet3-chain-compute-prob:PrintTotalStats():nnet-chain-diagnostics.cc:149)
@@ -410,26 +467,23 @@ def parse_prob_logs(exp_dir, key='accuracy', output="output"):
         ".nnet3.*compute-prob.*:PrintTotalStats..:"
         "nnet.*diagnostics.cc:[0-9]+. Overall ([a-zA-Z\-]+) for "
         "'{output}'.*is ([0-9.\-e]+) .*per frame".format(output=output))
+    parser_key = "prob:{0}:{1}".format(key, output)
+    parse_file = lambda prob_file: parse_prob_log(prob_file, key,
+                                                  parse_regex)
 
     train_objf = {}
     valid_objf = {}
 
-    for line in train_prob_strings.split('\n'):
-        mat_obj = parse_regex.search(line)
-        if mat_obj is not None:
-            groups = mat_obj.groups()
-            if groups[1] == key:
-                train_objf[int(groups[0])] = groups[2]
+    for path, objf_list in log_cache.get_records(
+            exp_dir, "compute_prob_train.*.log", parser_key, parse_file):
+        train_objf.update(objf_list)
     if not train_objf:
         raise KaldiLogParseException("Could not find any lines with {k} in "
                 " {l}".format(k=key, l=train_prob_files))
 
-    for line in valid_prob_strings.split('\n'):
-        mat_obj = parse_regex.search(line)
-        if mat_obj is not None:
-            groups = mat_obj.groups()
-            if groups[1] == key:
-                valid_objf[int(groups[0])] = groups[2]
+    for path, objf_list in log_cache.get_records(
+            exp_dir, "compute_prob_valid.*.log", parser_key, parse_file):
+        valid_objf.update(objf_list)
 
     if not valid_objf:
         raise KaldiLogParseException("Could not find any lines with {k} in "
@@ -447,10 +501,6 @@ def parse_prob_logs(exp_dir, key='accuracy', output="output"):
 def parse_rnnlm_prob_logs(exp_dir, key='objf'):
     train_prob_files = "%s/log/train.*.*.log" % (exp_dir)
     valid_prob_files = "%s/log/compute_prob.*.log" % (exp_dir)
-    train_prob_strings = common_lib.get_command_stdout(
-        'grep -e {0} {1}'.format(key, train_prob_files))
-    valid_prob_strings = common_lib.get_command_stdout(
-        'grep -e {0} {1}'.format(key, valid_prob_files))
 
     # LOG
     # (rnnlm-train[5.3.36~8-2ec51]:PrintStatsOverall():rnnlm-core-training.cc:118)
@@ -477,22 +527,20 @@ def parse_rnnlm_prob_logs(exp_dir, key='objf'):
     train_objf = {}
     valid_objf = {}
 
-    for line in train_prob_strings.split('\n'):
-        mat_obj = parse_regex_train.search(line)
-        if mat_obj is not None:
-            groups = mat_obj.groups()
-            if groups[1] == key:
-                train_objf[int(groups[0])] = groups[2]
+    for path, objf_list in log_cache.get_records(
+            exp_dir, "train.*.*.log", "rnnlm_train_prob:" + key,
+            lambda prob_file: parse_prob_log(prob_file, key,
+                                             parse_regex_train)):
+        train_objf.update(objf_list)
     if not train_objf:
         raise KaldiLogParseException("Could not find any lines with {k} in "
                 " {l}".format(k=key, l=train_prob_files))
 
-    for line in valid_prob_strings.split('\n'):
-        mat_obj = parse_regex_valid.search(line)
-        if mat_obj is not None:
-            groups = mat_obj.groups()
-            if groups[1] == key:
-                valid_objf[int(groups[0])] = groups[2]
+    for path, objf_list in log_cache.get_records(
+            exp_dir, "compute_prob.*.log", "rnnlm_valid_prob:" + key,
+            lambda prob_file: parse_prob_log(prob_file, key,
+                                             parse_regex_valid)):
+        valid_objf.update(objf_list)
 
     if not valid_objf:
         raise KaldiLogParseException("Could not find any lines with {k} in "
@@ -0,0 +1,238 @@
+
+
+# Copyright 2020    Johns Hopkins University
+# Apache 2.0.
+
+""" This module contains ParamDriftStore, a compact columnar store of
+per-component statistics of the parameters of the models of a training run,
+which are computed from the models themselves by
+steps/nnet3/report/compute_param_drift.py, and which
+steps/nnet3/report/generate_plots.py plots in preference to the parameter
+differences parsed from the progress logs, for the components and iterations
+that it has.
+
+For each model that was processed (identified by its iteration) and for each
+component with a parameter matrix, the store has:
+    norm:        the 2-norm of the parameters (matrix and bias),
+    change:      the 2-norm of the difference between the parameters and those
+                 of the previous model that was processed,
+    rel-change:  'change' divided by the norm of the previous model,
+    row-norms:   the 2-norms of the rows of the parameter matrix,
+    col-norms:   the 2-norms of its columns.
+If the models of consecutive iterations are processed, 'change' and
+'rel-change' are the "Parameter differences" and "Relative parameter
+differences" printed by nnet3-show-progress.
+
+The store is a directory (<exp-dir>/param_drift by default) which contains
+index.json:
+    {"version": 1,
+     "iters": [<iteration>, ...],
+     "components": {<component-name>: {"num-rows": <R>, "num-cols": <C>,
+                                       "iters": [...], "prev-iters": [...],
+                                       "norm": [...], "change": [...],
+                                       "rel-change": [...]}, ...}}
+where "change" and "rel-change" are null if there was no previous model, and,
+for each component, <component-name>.row-norms and <component-name>.col-norms,
+which contain the row and column norms of the iterations of the component as
+float16 arrays of R and C elements, one after the other.  Models are added
+incrementally: the new norms are appended to these files and index.json is
+rewritten (atomically) after them, so an interrupted update doesn't leave the
+store inconsistent.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+g_store_version = 1
+g_norm_dtype = np.dtype('<f2')
+g_history_keys = ['row-norms', 'col-norms']
+
+
+def get_store_dir(exp_dir):
+    """ Returns the default store directory of the experiment 'exp_dir'. """
+    return os.path.join(exp_dir, 'param_drift')
+
+
+def store_exists(store_dir):
+    return os.path.exists(os.path.join(store_dir, 'index.json'))
+
+
+def compute_param_stats(params, bias=None, prev_params=None, prev_bias=None):
+    """ Returns a dict with the statistics of a component (see the module
+    docstring) given its parameter matrix 'params' and bias vector 'bias'
+    (which may be None) and those of the previous model, 'prev_params' and
+    'prev_bias' (or None if there is no previous model, or if the parameters
+    had a different shape, in which case 'change' and 'rel-change' are None).
+    """
+    params = params.astype(np.float64)
+    sumsq_per_row = np.sum(params * params, axis=1)
+    sumsq = np.sum(sumsq_per_row)
+    if bias is not None:
+        sumsq += np.sum(np.square(bias, dtype=np.float64))
+    stats = {'norm': float(np.sqrt(sumsq)),
+             'change': None,
+             'rel-change': None,
+             'row-norms': np.sqrt(sumsq_per_row),
+             'col-norms': np.sqrt(np.sum(params * params, axis=0))}
+    if prev_params is not None and prev_params.shape == params.shape:
+        prev_params = prev_params.astype(np.float64)
+        diff_sumsq = np.sum(np.square(params - prev_params))
+        prev_sumsq = np.sum(np.square(prev_params))
+        if bias is not None and prev_bias is not None:
+            diff_sumsq += np.sum(np.square(bias - prev_bias, dtype=np.float64))
+            prev_sumsq += np.sum(np.square(prev_bias, dtype=np.float64))
+        stats['change'] = float(np.sqrt(diff_sumsq))
+        stats['rel-change'] = (float(np.sqrt(diff_sumsq / prev_sumsq))
+                               if prev_sumsq > 0 else None)
+    return stats
+
+
+class ParamDriftStore(object):
+    """ The store described in the module docstring, in the directory
+    'store_dir', which is created by write() if it doesn't exist. """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.iters = []
+        self.components = {}
+        # the norms of the iterations that were added but not written yet, as
+        # a dict from (component-name, key) to a list of arrays.
+        self.pending = {}
+        filename = os.path.join(store_dir, 'index.json')
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                index = json.load(f)
+            if index.get('version') != g_store_version:
+                raise Exception("{0} has an unknown version; remove {1} to "
+                                "recompute it.".format(filename, store_dir))
+            self.iters = index['iters']
+            self.components = index['components']
+
+    @property
+    def last_iter(self):
+        """ The last iteration that was processed, or None. """
+        return self.iters[-1] if len(self.iters) > 0 else None
+
+    def component_names(self):
+        return sorted(self.components.keys())
+
+    def add(self, iter, prev_iter, component_stats):
+        """ Adds the statistics of the model of iteration 'iter', which must
+        be after the iterations already in the store; 'prev_iter' is the
+        iteration of the previous model (the one the 'change' statistics are
+        relative to), or None.  'component_stats' is a dict from component
+        name to the stats returned by compute_param_stats(). """
+        if self.last_iter is not None and iter <= self.last_iter:
+            raise ValueError("Iteration {0} is not after the last iteration "
+                             "in {1}".format(iter, self.store_dir))
+        for name, stats in component_stats.items():
+            shape = [len(stats['row-norms']), len(stats['col-norms'])]
+            if name not in self.components:
+                self.components[name] = {
+                    'num-rows': shape[0], 'num-cols': shape[1], 'iters': [],
+                    'prev-iters': [], 'norm': [], 'change': [],
+                    'rel-change': []}
+            c = self.components[name]
+            if shape != [c['num-rows'], c['num-cols']]:
+                logger.warning("The parameters of {0} have changed shape at "
+                               "iteration {1}; not adding them to {2}".format(
+                                   name, iter, self.store_dir))
+                continue
+            c['iters'].append(iter)
+            c['prev-iters'].append(prev_iter)
+            for key in ['norm', 'change', 'rel-change']:
+                c[key].append(stats[key])
+            for key in g_history_keys:
+                self.pending.setdefault((name, key), []).append(
+                    np.asarray(stats[key], dtype=g_norm_dtype))
+        self.iters.append(iter)
+
+    def _history_filename(self, component_name, key):
+        return os.path.join(self.store_dir,
+                            '{0}.{1}'.format(component_name, key))
+
+    def write(self):
+        """ Appends the norms of the iterations added since the last write to
+        their files and rewrites the index. """
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        for (name, key), arrays in self.pending.items():
+            c = self.components[name]
+            dim = c['num-rows'] if key == 'row-norms' else c['num-cols']
+            num_written = len(c['iters']) - len(arrays)
+            filename = self._history_filename(name, key)
+            with open(filename, 'r+b' if os.path.exists(filename) else 'wb') as f:
+                # drop whatever an interrupted update may have left.
+                f.truncate(num_written * dim * g_norm_dtype.itemsize)
+                f.seek(0, os.SEEK_END)
+                for a in arrays:
+                    f.write(a.tobytes())
+        self.pending = {}
+        filename = os.path.join(self.store_dir, 'index.json')
+        tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump({'version': g_store_version, 'iters': self.iters,
+                       'components': self.components}, f)
+        os.rename(tmp_filename, filename)
+
+    def get_stats(self, component_name, key):
+        """ Returns a pair (iters, values) of numpy arrays with the statistic
+        'key' ('norm', 'change' or 'rel-change') of the component
+        'component_name' for each of its iterations; missing values are nan.
+        """
+        c = self.components[component_name]
+        return (np.array(c['iters'], dtype=np.int64),
+                np.array(c[key], dtype=np.float64))
+
+    def get_norm_history(self, component_name, key):
+        """ Returns a pair (iters, norms) where 'norms' is a matrix with, for
+        each of the iterations of the component 'component_name', the row
+        norms (key='row-norms') or the column norms (key='col-norms') of its
+        parameter matrix. """
+        assert key in g_history_keys
+        c = self.components[component_name]
+        dim = c['num-rows'] if key == 'row-norms' else c['num-cols']
+        num_iters = len(c['iters'])
+        pending = self.pending.get((component_name, key), [])
+        num_written = num_iters - len(pending)
+        norms = np.fromfile(self._history_filename(component_name, key),
+                            dtype=g_norm_dtype, count=num_written * dim)
+        norms = np.concatenate([norms] + pending).reshape(num_iters, dim)
+        return (np.array(c['iters'], dtype=np.int64),
+                norms.astype(np.float32))
+
+    def get_param_diff_stats(self, pattern):
+        """ Returns the parameter differences in the same format as
+        log_parse.parse_progress_logs_for_param_diff() ('pattern' is
+        "Parameter differences" or "Relative parameter differences").  Only
+        the differences between the models of consecutive iterations are
+        returned, since the others (e.g. with --iter-interval) are not
+        comparable with the per-iteration differences in the progress logs;
+        so the result may have no differences at all, in which case
+        'max_iter' is -1. """
+        key = {"Parameter differences": 'change',
+               "Relative parameter differences": 'rel-change'}[pattern]
+        progress_per_component = {}
+        max_iter = -1
+        for name, c in self.components.items():
+            progress_per_component[name] = dict(
+                (iter, value) for iter, prev_iter, value
+                in zip(c['iters'], c['prev-iters'], c[key])
+                if value is not None and prev_iter == iter - 1)
+            if len(progress_per_component[name]) > 0:
+                max_iter = max(max_iter,
+                               max(progress_per_component[name].keys()))
+            else:
+                del progress_per_component[name]
+        return {'progress_per_component': progress_per_component,
+                'component_names': sorted(progress_per_component.keys()),
+                'max_iter': max_iter}
@@ -133,6 +133,8 @@ def train_new_models(dir, iter, srand, num_jobs,
     Called from train_one_iteration(), this method trains new models
     with 'num_jobs' jobs, and
     writes files like exp/tdnn_a/24.{1,2,3,..<num_jobs>}.raw
+    It returns the list of background jobs (see common_lib.BackgroundJob)
+    without waiting for them; if one of them fails, the others are cancelled.
 
     We cannot easily use a single parallel SGE job to do the main training,
     because the computation of which archive and which --frame option
@@ -155,7 +157,10 @@ def train_new_models(dir, iter, srand, num_jobs,
         deriv_time_opts.append("--optimization.max-deriv-time-relative={0}".format(
                                     int(max_deriv_time_relative)))
 
-    threads = []
+    # the jobs are in a group so that if one of them fails, the others are
+    # killed rather than left to run to completion.
+    group = common_lib.JobGroup()
+    jobs = []
     # the GPU timing info is only printed if we use the --verbose=1 flag; this
     # slows down the computation slightly, so don't accumulate it on every
     # iteration.  Don't do it on iteration 0 either, because we use a smaller
@@ -184,7 +189,7 @@ def train_new_models(dir, iter, srand, num_jobs,
                          (" --write-cache={0}/cache.{1}".format(dir, iter + 1)
                           if job == 1 else ""))
 
-        thread = common_lib.background_command(
+        train_job = common_lib.background_command(
             """{command} {train_queue_opt} {dir}/log/train.{iter}.{job}.log \
                     nnet3-chain-train {parallel_train_opts} {verbose_opt} \
                     --apply-deriv-weights={app_deriv_wts} \
@@ -227,12 +232,11 @@ def train_new_models(dir, iter, srand, num_jobs,
                         num_chunk_per_mb=num_chunk_per_minibatch_str,
                         multitask_egs_opts=multitask_egs_opts,
                         scp_or_ark=scp_or_ark),
-            require_zero_status=True)
+            require_zero_status=True, group=group)
 
-        threads.append(thread)
+        jobs.append(train_job)
 
-    for thread in threads:
-        thread.join()
+    return jobs
 
 
 def train_one_iteration(dir, iter, srand, egs_dir,
@@ -247,10 +251,14 @@ def train_one_iteration(dir, iter, srand, egs_dir,
                         frame_subsampling_factor,
                         run_opts, dropout_edit_string="", train_opts="",
                         backstitch_training_scale=0.0, backstitch_training_interval=1,
-                        use_multitask_egs=False):
+                        use_multitask_egs=False, diagnostics_pipeline=None):
     """ Called from steps/nnet3/chain/train.py for one iteration for
     neural network training with LF-MMI objective
 
+    diagnostics_pipeline : If not None, a DiagnosticsPipeline (see
+                           libs/nnet3/train/pipeline.py); the diagnostic jobs
+                           are then started after the training jobs, and are
+                           waited for at the end of the next iteration.
     """
 
     # Set off jobs doing some diagnostics, in the background.
@@ -272,17 +280,22 @@ def train_one_iteration(dir, iter, srand, egs_dir,
         with open('{0}/srand'.format(dir), 'w') as f:
             f.write(str(srand))
 
-    # Sets off some background jobs to compute train and
-    # validation set objectives
-    compute_train_cv_probabilities(
-        dir=dir, iter=iter, egs_dir=egs_dir,
-        l2_regularize=l2_regularize, xent_regularize=xent_regularize,
-        leaky_hmm_coefficient=leaky_hmm_coefficient, run_opts=run_opts,
-        use_multitask_egs=use_multitask_egs)
+    def start_diagnostics():
+        # Sets off some background jobs to compute train and
+        # validation set objectives
+        diagnostic_jobs = compute_train_cv_probabilities(
+            dir=dir, iter=iter, egs_dir=egs_dir,
+            l2_regularize=l2_regularize, xent_regularize=xent_regularize,
+            leaky_hmm_coefficient=leaky_hmm_coefficient, run_opts=run_opts,
+            use_multitask_egs=use_multitask_egs)
+
+        if iter > 0:
+            # Runs in the background
+            diagnostic_jobs += compute_progress(dir, iter, run_opts)
+        return diagnostic_jobs
 
-    if iter > 0:
-        # Runs in the background
-        compute_progress(dir, iter, run_opts)
+    if diagnostics_pipeline is None:
+        start_diagnostics()
 
     do_average = (iter > 0)
 
@@ -304,29 +317,40 @@ def train_one_iteration(dir, iter, srand, egs_dir,
         cur_max_param_change = float(max_param_change) / math.sqrt(2)
 
     raw_model_string = raw_model_string + dropout_edit_string
-    train_new_models(dir=dir, iter=iter, srand=srand, num_jobs=num_jobs,
-                     num_archives_processed=num_archives_processed,
-                     num_archives=num_archives,
-                     raw_model_string=raw_model_string,
-                     egs_dir=egs_dir,
-                     apply_deriv_weights=apply_deriv_weights,
-                     min_deriv_time=min_deriv_time,
-                     max_deriv_time_relative=max_deriv_time_relative,
-                     l2_regularize=l2_regularize,
-                     xent_regularize=xent_regularize,
-                     leaky_hmm_coefficient=leaky_hmm_coefficient,
-                     momentum=momentum,
-                     max_param_change=cur_max_param_change,
-                     shuffle_buffer_size=shuffle_buffer_size,
-                     num_chunk_per_minibatch_str=cur_num_chunk_per_minibatch_str,
-                     frame_subsampling_factor=frame_subsampling_factor,
-                     run_opts=run_opts, train_opts=train_opts,
-                     # linearly increase backstitch_training_scale during the
-                     # first few iterations (hard-coded as 15)
-                     backstitch_training_scale=(backstitch_training_scale *
-                         iter / 15 if iter < 15 else backstitch_training_scale),
-                     backstitch_training_interval=backstitch_training_interval,
-                     use_multitask_egs=use_multitask_egs)
+    jobs = train_new_models(dir=dir, iter=iter, srand=srand, num_jobs=num_jobs,
+                            num_archives_processed=num_archives_processed,
+                            num_archives=num_archives,
+                            raw_model_string=raw_model_string,
+                            egs_dir=egs_dir,
+                            apply_deriv_weights=apply_deriv_weights,
+                            min_deriv_time=min_deriv_time,
+                            max_deriv_time_relative=max_deriv_time_relative,
+                            l2_regularize=l2_regularize,
+                            xent_regularize=xent_regularize,
+                            leaky_hmm_coefficient=leaky_hmm_coefficient,
+                            momentum=momentum,
+                            max_param_change=cur_max_param_change,
+                            shuffle_buffer_size=shuffle_buffer_size,
+                            num_chunk_per_minibatch_str=cur_num_chunk_per_minibatch_str,
+                            frame_subsampling_factor=frame_subsampling_factor,
+                            run_opts=run_opts, train_opts=train_opts,
+                            # linearly increase backstitch_training_scale during the
+                            # first few iterations (hard-coded as 15)
+                            backstitch_training_scale=(backstitch_training_scale *
+                                iter / 15 if iter < 15 else backstitch_training_scale),
+                            backstitch_training_interval=backstitch_training_interval,
+                            use_multitask_egs=use_multitask_egs)
+    if diagnostics_pipeline is not None:
+        # the training jobs were submitted first, so if the number of
+        # background jobs is limited they get priority.
+        diagnostics_pipeline.add(iter, start_diagnostics())
+
+    # raises an exception if any of the jobs failed.
+    common_lib.wait_for_jobs(jobs)
+
+    if diagnostics_pipeline is not None:
+        # waits for the diagnostics of the previous iteration.
+        diagnostics_pipeline.reconcile(iter)
 
     [models_to_average, best_model] = common_train_lib.get_successful_models(
          num_jobs, '{0}/log/train.{1}.%.log'.format(dir, iter))
@@ -483,7 +507,8 @@ def compute_train_cv_probabilities(dir, iter, egs_dir, l2_regularize,
                              use_multitask_egs=use_multitask_egs)
 
 
-    common_lib.background_command(
+    jobs = []
+    jobs.append(common_lib.background_command(
         """{command} {dir}/log/compute_prob_valid.{iter}.log \
                 nnet3-chain-compute-prob --l2-regularize={l2} \
                 --leaky-hmm-coefficient={leaky} --xent-regularize={xent_reg} \
@@ -495,14 +520,14 @@ def compute_train_cv_probabilities(dir, iter, egs_dir, l2_regularize,
                    xent_reg=xent_regularize,
                    egs_dir=egs_dir,
                    multitask_egs_opts=multitask_egs_opts,
-                   scp_or_ark=scp_or_ark, egs_suffix=egs_suffix))
+                   scp_or_ark=scp_or_ark, egs_suffix=egs_suffix)))
 
     multitask_egs_opts = common_train_lib.get_multitask_egs_opts(
                              egs_dir,
                              egs_prefix="train_diagnostic.",
                              use_multitask_egs=use_multitask_egs)
 
-    common_lib.background_command(
+    jobs.append(common_lib.background_command(
         """{command} {dir}/log/compute_prob_train.{iter}.log \
                 nnet3-chain-compute-prob --l2-regularize={l2} \
                 --leaky-hmm-coefficient={leaky} --xent-regularize={xent_reg} \
@@ -514,7 +539,8 @@ def compute_train_cv_probabilities(dir, iter, egs_dir, l2_regularize,
                    xent_reg=xent_regularize,
                    egs_dir=egs_dir,
                    multitask_egs_opts=multitask_egs_opts,
-                   scp_or_ark=scp_or_ark, egs_suffix=egs_suffix))
+                   scp_or_ark=scp_or_ark, egs_suffix=egs_suffix)))
+    return jobs
 
 
 def compute_progress(dir, iter, run_opts):
@@ -522,7 +548,8 @@ def compute_progress(dir, iter, run_opts):
     prev_model = '{0}/{1}.mdl'.format(dir, iter - 1)
     model = '{0}/{1}.mdl'.format(dir, iter)
 
-    common_lib.background_command(
+    jobs = []
+    jobs.append(common_lib.background_command(
         """{command} {dir}/log/progress.{iter}.log \
                 nnet3-am-info {model} '&&' \
                 nnet3-show-progress --use-gpu=no {prev_model} {model}
@@ -530,28 +557,29 @@ def compute_progress(dir, iter, run_opts):
                    dir=dir,
                    iter=iter,
                    model=model,
-                   prev_model=prev_model))
+                   prev_model=prev_model)))
     if iter % 10 == 0 and iter > 0:
         # Every 10 iters, print some more detailed information.
         # full_progress.X.log contains some diagnostics of the difference in
         # parameters, printed in the same format as from nnet3-info.
-        common_lib.background_command(
+        jobs.append(common_lib.background_command(
             """{command} {dir}/log/full_progress.{iter}.log \
             nnet3-show-progress --use-gpu=no --verbose=2 {prev_model} {model}
         """.format(command=run_opts.command,
                    dir=dir,
                    iter=iter,
                    model=model,
-                   prev_model=prev_model))
+                   prev_model=prev_model)))
         # full_info.X.log is just the nnet3-info of the model, with the --verbose=2
         # option which includes stats on the singular values of the parameter matrices.
-        common_lib.background_command(
+        jobs.append(common_lib.background_command(
             """{command} {dir}/log/full_info.{iter}.log \
             nnet3-info --verbose=2 {model}
         """.format(command=run_opts.command,
                    dir=dir,
                    iter=iter,
-                   model=model))
+                   model=model)))
+    return jobs
 
 
 
@@ -953,6 +953,14 @@ class CommonParser(object):
         self.parser.add_argument("--egs.cmd", type=str, dest="egs_command",
                                  action=common_lib.NullstrToNoneAction,
                                  help="Script to launch egs jobs")
+        self.parser.add_argument("--max-background-jobs", type=int,
+                                 dest="max_background_jobs", default=0,
+                                 help="""Maximum number of jobs (training,
+                                 diagnostic, combination jobs, launched with
+                                 --cmd) that run at the same time; the others
+                                 wait until one finishes.  0 means no limit.
+                                 This can be useful with run.pl on a single
+                                 machine.""")
         self.parser.add_argument("--use-gpu", type=str,
                                  choices=["true", "false", "yes", "no", "wait"],
                                  help="Use GPU for training. "
@@ -38,6 +38,8 @@ def train_new_models(dir, iter, srand, num_jobs,
     """ Called from train_one_iteration(), this model does one iteration of
     training with 'num_jobs' jobs, and writes files like
     exp/tdnn_a/24.{1,2,3,..<num_jobs>}.raw
+    It returns the list of background jobs (see common_lib.BackgroundJob)
+    without waiting for them; if one of them fails, the others are cancelled.
 
     We cannot easily use a single parallel SGE job to do the main training,
     because the computation of which archive and which --frame option
@@ -76,7 +78,10 @@ def train_new_models(dir, iter, srand, num_jobs,
         deriv_time_opts.append("--optimization.max-deriv-time-relative={0}".format(
                            max_deriv_time_relative))
 
-    threads = []
+    # the jobs are in a group so that if one of them fails, the others are
+    # killed rather than left to run to completion.
+    group = common_lib.JobGroup()
+    jobs = []
 
     # the GPU timing info is only printed if we use the --verbose=1 flag; this
     # slows down the computation slightly, so don't accumulate it on every
@@ -134,8 +139,7 @@ def train_new_models(dir, iter, srand, num_jobs,
                 scp_or_ark=scp_or_ark,
                 multitask_egs_opts=multitask_egs_opts))
 
-        # note: the thread waits on that process's completion.
-        thread = common_lib.background_command(
+        train_job = common_lib.background_command(
             """{command} {train_queue_opt} {dir}/log/train.{iter}.{job}.log \
                     nnet3-train {parallel_train_opts} {cache_io_opts} \
                      {verbose_opt} --print-interval=10 \
@@ -163,12 +167,11 @@ def train_new_models(dir, iter, srand, num_jobs,
                 deriv_time_opts=" ".join(deriv_time_opts),
                 raw_model=raw_model_string,
                 egs_rspecifier=egs_rspecifier),
-            require_zero_status=True)
+            require_zero_status=True, group=group)
 
-        threads.append(thread)
+        jobs.append(train_job)
 
-    for thread in threads:
-        thread.join()
+    return jobs
 
 
 def train_one_iteration(dir, iter, srand, egs_dir,
@@ -256,22 +259,24 @@ def train_one_iteration(dir, iter, srand, egs_dir,
         cur_minibatch_size_str = common_train_lib.halve_minibatch_size_str(minibatch_size_str)
         cur_max_param_change = float(max_param_change) / math.sqrt(2)
 
-    train_new_models(dir=dir, iter=iter, srand=srand, num_jobs=num_jobs,
-                     num_archives_processed=num_archives_processed,
-                     num_archives=num_archives,
-                     raw_model_string=raw_model_string, egs_dir=egs_dir,
-                     momentum=momentum, max_param_change=cur_max_param_change,
-                     shuffle_buffer_size=shuffle_buffer_size,
-                     minibatch_size_str=cur_minibatch_size_str,
-                     run_opts=run_opts,
-                     frames_per_eg=frames_per_eg,
-                     min_deriv_time=min_deriv_time,
-                     max_deriv_time_relative=max_deriv_time_relative,
-                     image_augmentation_opts=image_augmentation_opts,
-                     use_multitask_egs=use_multitask_egs,
-                     train_opts=train_opts,
-                     backstitch_training_scale=backstitch_training_scale,
-                     backstitch_training_interval=backstitch_training_interval)
+    jobs = train_new_models(dir=dir, iter=iter, srand=srand, num_jobs=num_jobs,
+                            num_archives_processed=num_archives_processed,
+                            num_archives=num_archives,
+                            raw_model_string=raw_model_string, egs_dir=egs_dir,
+                            momentum=momentum, max_param_change=cur_max_param_change,
+                            shuffle_buffer_size=shuffle_buffer_size,
+                            minibatch_size_str=cur_minibatch_size_str,
+                            run_opts=run_opts,
+                            frames_per_eg=frames_per_eg,
+                            min_deriv_time=min_deriv_time,
+                            max_deriv_time_relative=max_deriv_time_relative,
+                            image_augmentation_opts=image_augmentation_opts,
+                            use_multitask_egs=use_multitask_egs,
+                            train_opts=train_opts,
+                            backstitch_training_scale=backstitch_training_scale,
+                            backstitch_training_interval=backstitch_training_interval)
+    # raises an exception if any of the jobs failed.
+    common_lib.wait_for_jobs(jobs)
 
     [models_to_average, best_model] = common_train_lib.get_successful_models(
          num_jobs, '{0}/log/train.{1}.%.log'.format(dir, iter))
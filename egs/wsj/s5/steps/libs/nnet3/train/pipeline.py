@@ -0,0 +1,106 @@
+
+
+# Copyright 2020    Johns Hopkins University
+# Apache 2.0.
+
+""" This module contains DiagnosticsPipeline, which lets the training scripts
+run the diagnostic jobs of an iteration (compute_prob_train,
+compute_prob_valid and progress logs) alongside the training jobs of the next
+iteration, and checks their results afterwards.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class DiagnosticsPipeline(object):
+    """ Keeps track of the diagnostic jobs (common_lib.BackgroundJob objects)
+    of each training iteration.  The diagnostic jobs of iteration N are allowed
+    to run until the training jobs of iteration N+1 have finished; then
+    reconcile(N+1) waits for them, warns about any that failed, and logs how
+    long training had to wait for them (normally nothing, since they are much
+    quicker than the training jobs).
+
+    Waiting at that point matters because the progress diagnostics of
+    iteration N read the model of iteration N-1, which the training scripts
+    may delete at the end of iteration N+1 (see remove_model()).
+
+    e.g.:
+        pipeline = DiagnosticsPipeline()
+        try:
+            for iter in range(num_iters):
+                train_jobs = ...     # submit the training jobs first
+                pipeline.add(iter, diagnostic_jobs)
+                common_lib.wait_for_jobs(train_jobs)
+                pipeline.reconcile(iter)
+        except:
+            pipeline.cancel()
+            raise
+        pipeline.finish()
+    """
+
+    def __init__(self):
+        # list of (iter, jobs) in the order they were added.
+        self.pending = []
+        self.num_iters_reconciled = 0
+        self.total_waited_time = 0.0
+
+    def add(self, iter, jobs):
+        """ Registers the diagnostic jobs of iteration 'iter'. """
+        if jobs:
+            self.pending.append((iter, list(jobs)))
+
+    def reconcile(self, iter):
+        """ Waits for the diagnostic jobs of the iterations before 'iter'.
+        This is to be called once the training jobs of iteration 'iter' have
+        finished. """
+        while self.pending and self.pending[0][0] < iter:
+            self._reconcile_one(*self.pending.pop(0))
+
+    def finish(self):
+        """ Waits for all the remaining diagnostic jobs, and logs the total
+        time spent waiting for diagnostics. """
+        while self.pending:
+            self._reconcile_one(*self.pending.pop(0))
+        if self.num_iters_reconciled > 0:
+            logger.info("Pipelined diagnostics: waited {0:.1f} seconds for "
+                        "the diagnostics of {1} iterations.".format(
+                            self.total_waited_time,
+                            self.num_iters_reconciled))
+
+    def cancel(self):
+        """ Cancels all the pending diagnostic jobs, e.g. when training has
+        failed. """
+        for iter, jobs in self.pending:
+            for job in jobs:
+                job.cancel()
+        self.pending = []
+
+    def _reconcile_one(self, iter, jobs):
+        wait_start_time = time.time()
+        for job in jobs:
+            job.wait()
+        waited_time = time.time() - wait_start_time
+
+        results = [job.result() for job in jobs if not job.cancelled()]
+        for job in jobs:
+            if job.cancelled():
+                logger.warning("Diagnostic job for iteration {0} was "
+                               "cancelled: {1}".format(iter, job.command))
+        for result in results:
+            if not result.succeeded():
+                logger.warning("Diagnostic job for iteration {0} failed with "
+                               "status {1}; its output will be missing from "
+                               "the reports: {2}".format(
+                                   iter, result.status, result.command))
+        self.num_iters_reconciled += 1
+        self.total_waited_time += waited_time
+        if waited_time >= 1.0:
+            logger.info("Waited {0:.1f} seconds for the diagnostics of "
+                        "iteration {1}.".format(waited_time, iter))
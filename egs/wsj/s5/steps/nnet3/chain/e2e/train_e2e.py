@@ -253,6 +253,9 @@ def train(args, run_opts):
     arg_string = pprint.pformat(vars(args))
     logger.info("Arguments for the experiment\n{0}".format(arg_string))
 
+    if args.max_background_jobs > 0:
+        common_lib.set_max_background_jobs(args.max_background_jobs)
+
     # Check files
     files = ['{0}/feats.scp'.format(args.feat_dir), '{0}/fst.1.scp'.format(args.tree_dir),
              '{0}/final.mdl'.format(args.tree_dir), '{0}/tree'.format(args.tree_dir),
@@ -21,6 +21,7 @@ sys.path.insert(0, 'steps')
 import libs.nnet3.train.common as common_train_lib
 import libs.common as common_lib
 import libs.nnet3.train.chain_objf.acoustic_model as chain_lib
+import libs.nnet3.train.pipeline as pipeline_lib
 import libs.nnet3.report.log_parse as nnet3_log_parse
 
 
@@ -95,6 +96,15 @@ def get_args():
                         action=common_lib.StrToBoolAction,
                         choices=["true", "false"],
                         help="")
+    parser.add_argument("--trainer.pipeline-diagnostics", type=str,
+                        dest='pipeline_diagnostics', default=False,
+                        action=common_lib.StrToBoolAction,
+                        choices=["true", "false"],
+                        help="If true, the diagnostic jobs of each iteration "
+                        "(compute_prob_*.log, progress.*.log) are started "
+                        "after its training jobs and are only waited for once "
+                        "the training jobs of the next iteration have "
+                        "finished, and any failures are reported in the log.")
     parser.add_argument("--chain.frame-subsampling-factor", type=int,
                         dest='frame_subsampling_factor', default=3,
                         help="ratio of frames-per-second of features we "
@@ -280,6 +290,9 @@ def train(args, run_opts):
     arg_string = pprint.pformat(vars(args))
     logger.info("Arguments for the experiment\n{0}".format(arg_string))
 
+    if args.max_background_jobs > 0:
+        common_lib.set_max_background_jobs(args.max_background_jobs)
+
     # Check files
     chain_lib.check_for_required_files(args.feat_dir, args.tree_dir,
                                        args.lat_dir if args.egs_dir is None
@@ -484,101 +497,116 @@ def train(args, run_opts):
     logger.info("Training will run for {0} epochs = "
                 "{1} iterations".format(args.num_epochs, num_iters))
 
-    for iter in range(num_iters):
-        if (args.exit_stage is not None) and (iter == args.exit_stage):
-            logger.info("Exiting early due to --exit-stage {0}".format(iter))
-            return
-
-        current_num_jobs = common_train_lib.get_current_num_jobs(
-            iter, num_iters,
-            args.num_jobs_initial, args.num_jobs_step, args.num_jobs_final)
-
-        if args.stage <= iter:
-            model_file = "{dir}/{iter}.mdl".format(dir=args.dir, iter=iter)
-
-            lrate = common_train_lib.get_learning_rate(iter, current_num_jobs,
-                                                       num_iters,
-                                                       num_archives_processed,
-                                                       num_archives_to_process,
-                                                       args.initial_effective_lrate,
-                                                       args.final_effective_lrate)
-            shrinkage_value = 1.0 - (args.proportional_shrink * lrate)
-            if shrinkage_value <= 0.5:
-                raise Exception("proportional-shrink={0} is too large, it gives "
-                                "shrink-value={1}".format(args.proportional_shrink,
-                                                          shrinkage_value))
-            if args.shrink_value < shrinkage_value:
-                shrinkage_value = (args.shrink_value
-                                   if common_train_lib.should_do_shrinkage(
-                                       iter, model_file,
-                                       args.shrink_saturation_threshold)
-                                   else shrinkage_value)
-
-            percent = num_archives_processed * 100.0 / num_archives_to_process
-            epoch = (num_archives_processed * args.num_epochs
-                     / num_archives_to_process)
-            shrink_info_str = ''
-            if shrinkage_value != 1.0:
-                shrink_info_str = 'shrink: {0:0.5f}'.format(shrinkage_value)
-            logger.info("Iter: {0}/{1}   Jobs: {2}   "
-                        "Epoch: {3:0.2f}/{4:0.1f} ({5:0.1f}% complete)   "
-                        "lr: {6:0.6f}   {7}".format(iter, num_iters - 1,
-                                                    current_num_jobs,
-                                                    epoch, args.num_epochs,
-                                                    percent,
-                                                    lrate, shrink_info_str))
-
-            chain_lib.train_one_iteration(
-                dir=args.dir,
-                iter=iter,
-                srand=args.srand,
-                egs_dir=egs_dir,
-                num_jobs=current_num_jobs,
-                num_archives_processed=num_archives_processed,
-                num_archives=num_archives,
-                learning_rate=lrate,
-                dropout_edit_string=common_train_lib.get_dropout_edit_string(
-                    args.dropout_schedule,
-                    float(num_archives_processed) / num_archives_to_process,
-                    iter),
-                train_opts=' '.join(args.train_opts),
-                shrinkage_value=shrinkage_value,
-                num_chunk_per_minibatch_str=args.num_chunk_per_minibatch,
-                apply_deriv_weights=args.apply_deriv_weights,
-                min_deriv_time=min_deriv_time,
-                max_deriv_time_relative=max_deriv_time_relative,
-                l2_regularize=args.l2_regularize,
-                xent_regularize=args.xent_regularize,
-                leaky_hmm_coefficient=args.leaky_hmm_coefficient,
-                momentum=args.momentum,
-                max_param_change=args.max_param_change,
-                shuffle_buffer_size=args.shuffle_buffer_size,
-                frame_subsampling_factor=args.frame_subsampling_factor,
-                run_opts=run_opts,
-                backstitch_training_scale=args.backstitch_training_scale,
-                backstitch_training_interval=args.backstitch_training_interval,
-                use_multitask_egs=use_multitask_egs)
+    diagnostics_pipeline = (pipeline_lib.DiagnosticsPipeline()
+                            if args.pipeline_diagnostics else None)
 
-            if args.cleanup:
-                # do a clean up everything but the last 2 models, under certain
-                # conditions
-                common_train_lib.remove_model(
-                    args.dir, iter-2, num_iters, models_to_combine,
-                    args.preserve_model_interval)
-
-            if args.email is not None:
-                reporting_iter_interval = num_iters * args.reporting_interval
-                if iter % reporting_iter_interval == 0:
-                    # lets do some reporting
-                    [report, times, data] = (
-                        nnet3_log_parse.generate_acc_logprob_report(
-                            args.dir, "log-probability"))
-                    message = report
-                    subject = ("Update : Expt {dir} : "
-                               "Iter {iter}".format(dir=args.dir, iter=iter))
-                    common_lib.send_mail(message, subject, args.email)
-
-        num_archives_processed = num_archives_processed + current_num_jobs
+    try:
+        for iter in range(num_iters):
+            if (args.exit_stage is not None) and (iter == args.exit_stage):
+                logger.info("Exiting early due to --exit-stage {0}".format(iter))
+                if diagnostics_pipeline is not None:
+                    diagnostics_pipeline.finish()
+                return
+
+            current_num_jobs = common_train_lib.get_current_num_jobs(
+                iter, num_iters,
+                args.num_jobs_initial, args.num_jobs_step, args.num_jobs_final)
+
+            if args.stage <= iter:
+                model_file = "{dir}/{iter}.mdl".format(dir=args.dir, iter=iter)
+
+                lrate = common_train_lib.get_learning_rate(iter, current_num_jobs,
+                                                           num_iters,
+                                                           num_archives_processed,
+                                                           num_archives_to_process,
+                                                           args.initial_effective_lrate,
+                                                           args.final_effective_lrate)
+                shrinkage_value = 1.0 - (args.proportional_shrink * lrate)
+                if shrinkage_value <= 0.5:
+                    raise Exception("proportional-shrink={0} is too large, it gives "
+                                    "shrink-value={1}".format(args.proportional_shrink,
+                                                              shrinkage_value))
+                if args.shrink_value < shrinkage_value:
+                    shrinkage_value = (args.shrink_value
+                                       if common_train_lib.should_do_shrinkage(
+                                           iter, model_file,
+                                           args.shrink_saturation_threshold)
+                                       else shrinkage_value)
+
+                percent = num_archives_processed * 100.0 / num_archives_to_process
+                epoch = (num_archives_processed * args.num_epochs
+                         / num_archives_to_process)
+                shrink_info_str = ''
+                if shrinkage_value != 1.0:
+                    shrink_info_str = 'shrink: {0:0.5f}'.format(shrinkage_value)
+                logger.info("Iter: {0}/{1}   Jobs: {2}   "
+                            "Epoch: {3:0.2f}/{4:0.1f} ({5:0.1f}% complete)   "
+                            "lr: {6:0.6f}   {7}".format(iter, num_iters - 1,
+                                                        current_num_jobs,
+                                                        epoch, args.num_epochs,
+                                                        percent,
+                                                        lrate, shrink_info_str))
+
+                chain_lib.train_one_iteration(
+                    dir=args.dir,
+                    iter=iter,
+                    srand=args.srand,
+                    egs_dir=egs_dir,
+                    num_jobs=current_num_jobs,
+                    num_archives_processed=num_archives_processed,
+                    num_archives=num_archives,
+                    learning_rate=lrate,
+                    dropout_edit_string=common_train_lib.get_dropout_edit_string(
+                        args.dropout_schedule,
+                        float(num_archives_processed) / num_archives_to_process,
+                        iter),
+                    train_opts=' '.join(args.train_opts),
+                    shrinkage_value=shrinkage_value,
+                    num_chunk_per_minibatch_str=args.num_chunk_per_minibatch,
+                    apply_deriv_weights=args.apply_deriv_weights,
+                    min_deriv_time=min_deriv_time,
+                    max_deriv_time_relative=max_deriv_time_relative,
+                    l2_regularize=args.l2_regularize,
+                    xent_regularize=args.xent_regularize,
+                    leaky_hmm_coefficient=args.leaky_hmm_coefficient,
+                    momentum=args.momentum,
+                    max_param_change=args.max_param_change,
+                    shuffle_buffer_size=args.shuffle_buffer_size,
+                    frame_subsampling_factor=args.frame_subsampling_factor,
+                    run_opts=run_opts,
+                    backstitch_training_scale=args.backstitch_training_scale,
+                    backstitch_training_interval=args.backstitch_training_interval,
+                    use_multitask_egs=use_multitask_egs,
+                    diagnostics_pipeline=diagnostics_pipeline)
+
+                if args.cleanup:
+                    # do a clean up everything but the last 2 models, under certain
+                    # conditions
+                    common_train_lib.remove_model(
+                        args.dir, iter-2, num_iters, models_to_combine,
+                        args.preserve_model_interval)
+
+                if args.email is not None:
+                    reporting_iter_interval = num_iters * args.reporting_interval
+                    if iter % reporting_iter_interval == 0:
+                        # lets do some reporting
+                        [report, times, data] = (
+                            nnet3_log_parse.generate_acc_logprob_report(
+                                args.dir, "log-probability"))
+                        message = report
+                        subject = ("Update : Expt {dir} : "
+                                   "Iter {iter}".format(dir=args.dir, iter=iter))
+                        common_lib.send_mail(message, subject, args.email)
+
+            num_archives_processed = num_archives_processed + current_num_jobs
+
+        if diagnostics_pipeline is not None:
+            diagnostics_pipeline.finish()
+    finally:
+        # cancels the diagnostic jobs that are still pending if training
+        # failed; after finish() there are none.
+        if diagnostics_pipeline is not None:
+            diagnostics_pipeline.cancel()
 
     if args.stage <= num_iters:
         if args.do_final_combination:
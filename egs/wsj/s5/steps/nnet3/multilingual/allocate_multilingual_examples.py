@@ -29,6 +29,11 @@
 
     For chain training egs, the --egs-prefix option should be "cegs."
 
+    The script also writes info/<egs-prefix>lang_histogram, which has one
+    line per output archive with its number of examples from each language:
+    <archive-index> <num-egs-lang0> <num-egs-lang1> ...
+    so the balance of the languages in the archives can be checked.
+
     You can call this script as (e.g.):
 
     allocate_multilingual_examples.py [opts] example-scp-lists
@@ -41,6 +46,8 @@
 """
 
 import os, argparse, sys, random
+import heapq
+import itertools
 import logging
 import traceback
 
@@ -104,28 +111,75 @@ def get_args():
     return args
 
 
-def read_lines(file_handle, num_lines):
-    n_read = 0
-    lines = []
-    while n_read < num_lines:
-        line = file_handle.readline()
-        if not line:
-            break
-        lines.append(line.strip())
-        n_read += 1
-    return lines
+def count_lines(filename):
+    """ Returns the number of lines in 'filename' (including a last line
+    without a newline), reading it in large binary chunks. """
+    num_lines = 0
+    last_byte = b'\n'
+    with open(filename, 'rb') as fh:
+        while True:
+            buf = fh.read(1 << 20)
+            if not buf:
+                break
+            num_lines += buf.count(b'\n')
+            last_byte = buf[-1:]
+    if last_byte != b'\n':
+        num_lines += 1
+    return num_lines
+
+
+def read_blocks(filename, block_size):
+    """ Lazily reads the lines of 'filename' (stripped) and yields them in
+    lists of 'block_size' lines; the last list may be shorter. """
+    with open(filename, 'r') as fh:
+        lines = (line.strip() for line in fh)
+        while True:
+            block = list(itertools.islice(lines, block_size))
+            if not block:
+                return
+            yield block
+
+
+class LangScheduler(object):
+    """ Chooses the language of each block of examples: the language with
+    the highest proportion of its examples remaining (the lowest-numbered
+    one among equals).  This is a smooth weighted round-robin over the
+    languages, weighted by their numbers of examples, so that each language
+    is spread evenly over the output.  The languages with examples remaining
+    are kept in a heap, so choosing a block takes O(log num_langs) time. """
+
+    def __init__(self, lang_to_num_examples):
+        self.lang_to_num_examples = list(lang_to_num_examples)
+        self.lang_to_num_remaining_egs = list(lang_to_num_examples)
+        self.heap = [(-1.0, lang) for lang, num_egs
+                     in enumerate(self.lang_to_num_examples) if num_egs > 0]
+        heapq.heapify(self.heap)
+
+    def next_lang(self):
+        """ Returns the language of the next block, or None if no examples
+        remain. """
+        return self.heap[0][1] if self.heap else None
+
+    def consume(self, lang, num_egs):
+        """ Records that 'num_egs' examples of 'lang' (which must be the
+        language returned by next_lang()) were written. """
+        self.lang_to_num_remaining_egs[lang] -= num_egs
+        remaining = self.lang_to_num_remaining_egs[lang]
+        if remaining > 0 and num_egs > 0:
+            heapq.heapreplace(self.heap, (-float(remaining) / self.lang_to_num_examples[lang], lang))
+        else:
+            # the language is finished (or its scp file was shorter than
+            # counted).
+            heapq.heappop(self.heap)
 
 
 def process_multilingual_egs(args):
-    args = get_args()
-
     scp_lists = args.egs_scp_lists
     num_langs = len(scp_lists)
 
     lang_to_num_examples = [0] * num_langs
     for lang in range(num_langs):
-        with open(scp_lists[lang]) as fh:
-            lang_to_num_examples[lang] = sum([1 for line in fh])
+        lang_to_num_examples[lang] = count_lines(scp_lists[lang])
         logger.info("Number of examples for language {0} "
                     "is {1}.".format(lang, lang_to_num_examples[lang]))
 
@@ -166,59 +220,80 @@ def process_multilingual_egs(args):
                                 blocks_per_archive_this_lang,
                                 warning))
 
-    in_scp_file_handles = [open(scp_lists[lang], 'r') for lang in range(num_langs)]
+    # The input scp files are read lazily, a block at a time, so only one
+    # block per language is in memory.
+    lang_to_blocks = [read_blocks(scp_lists[lang], args.block_size) for lang in range(num_langs)]
+    scheduler = LangScheduler(lang_to_num_examples)
+    # archive_lang_counts[archive_index][lang] is the number of examples of
+    # 'lang' written to the archive.
+    archive_lang_counts = []
 
     num_remaining_egs = tot_num_egs
-    lang_to_num_remaining_egs = [n for n in lang_to_num_examples]
-    for archive_index in range(num_archives + 1):  #  +1 is because we write to the last archive in two rounds
+    for archive_index in range(num_archives):
         num_remaining_archives = num_archives - archive_index
         num_remaining_blocks = float(num_remaining_egs) / args.block_size
-
-        last_round = (archive_index == num_archives)
-        if not last_round:
-            num_blocks_this_archive = int(round(float(num_remaining_blocks) / num_remaining_archives))
-            logger.info("Generating archive {} containing {} blocks...".format(archive_index, num_blocks_this_archive))
-        else:  # This is the second round for the last archive. Flush all the remaining egs...
-            archive_index = num_archives - 1
-            num_blocks_this_archive = num_langs
-            logger.info("Writing all the {} remaining egs to the last archive...".format(num_remaining_egs))
-
-        out_scp_file_handle = open('{0}/{1}{2}.scp'.format(args.egs_dir, args.egs_prefix, archive_index + 1),
-                                   'a' if last_round else 'w')
-        eg_to_output_file_handle = open("{0}/{1}output.{2}.ark".format(args.egs_dir, args.egs_prefix, archive_index + 1),
-                                        'a' if last_round else 'w')
-        eg_to_weight_file_handle = open("{0}/{1}weight.{2}.ark".format(args.egs_dir, args.egs_prefix, archive_index + 1),
-                                        'a' if last_round else 'w')
-
-
-        for block_index in range(num_blocks_this_archive):
-            # Find the lang with the highest proportion of remaining examples
-            remaining_proportions = [float(remain) / tot for remain, tot in zip(lang_to_num_remaining_egs, lang_to_num_examples)]
-            lang_index, max_proportion = max(enumerate(remaining_proportions), key=lambda a: a[1])
-
-            # Read 'block_size' examples from the selected lang and write them to the current output scp file:
-            example_lines  = read_lines(in_scp_file_handles[lang_index], args.block_size)
+        num_blocks_this_archive = int(round(float(num_remaining_blocks) / num_remaining_archives))
+        logger.info("Generating archive {} containing {} blocks...".format(archive_index, num_blocks_this_archive))
+
+        out_scp_file_handle = open('{0}/{1}{2}.scp'.format(args.egs_dir, args.egs_prefix, archive_index + 1), 'w')
+        eg_to_output_file_handle = open("{0}/{1}output.{2}.ark".format(args.egs_dir, args.egs_prefix, archive_index + 1), 'w')
+        eg_to_weight_file_handle = open("{0}/{1}weight.{2}.ark".format(args.egs_dir, args.egs_prefix, archive_index + 1), 'w')
+        lang_counts = [0] * num_langs
+
+        for block_index in itertools.count():
+            if block_index == num_blocks_this_archive:
+                if archive_index < num_archives - 1 or num_remaining_egs == 0:
+                    break
+                # The egs left over because of rounding all go to the last
+                # archive.
+                logger.info("Writing the {} remaining egs to the last archive...".format(num_remaining_egs))
+            lang_index = scheduler.next_lang()
+            if lang_index is None:
+                break
+
+            # Read a block of examples from the selected lang and write them to the current output scp file:
+            example_lines = next(lang_to_blocks[lang_index], [])
             for eg_line in example_lines:
                 eg_id = eg_line.split()[0]
-                print(eg_line, file=out_scp_file_handle)
-                print("{0} output-{1}".format(eg_id, lang_index), file=eg_to_output_file_handle)
-                print("{0} {1}".format(eg_id, lang2weight[lang_index]), file=eg_to_weight_file_handle)
+                out_scp_file_handle.write(eg_line + "\n")
+                eg_to_output_file_handle.write("{0} output-{1}\n".format(eg_id, lang_index))
+                eg_to_weight_file_handle.write("{0} {1}\n".format(eg_id, lang2weight[lang_index]))
 
             num_remaining_egs -= len(example_lines)
-            lang_to_num_remaining_egs[lang_index] -= len(example_lines)
+            lang_counts[lang_index] += len(example_lines)
+            scheduler.consume(lang_index, len(example_lines))
 
         out_scp_file_handle.close()
         eg_to_output_file_handle.close()
         eg_to_weight_file_handle.close()
+        archive_lang_counts.append(lang_counts)
 
-    for handle in in_scp_file_handles:
-        handle.close()
+    write_lang_histogram(args, archive_lang_counts, lang_to_num_examples)
     logger.info("Finished generating {0}*.scp, {0}output.*.ark "
                 "and {0}weight.*.ark files. Wrote a total of {1} examples "
                 "to {2} archives.".format(args.egs_prefix,
                                           tot_num_egs - num_remaining_egs, num_archives))
 
 
+def write_lang_histogram(args, archive_lang_counts, lang_to_num_examples):
+    """ Writes info/<egs-prefix>lang_histogram (see the top of this file) and
+    logs, for each language, how far its proportion in the archives is from
+    its proportion overall. """
+    with open("{0}/info/{1}lang_histogram".format(args.egs_dir, args.egs_prefix), "w") as fh:
+        for archive_index, lang_counts in enumerate(archive_lang_counts):
+            print("{0} {1}".format(archive_index + 1, " ".join(map(str, lang_counts))), file=fh)
+
+    tot_num_egs = sum(lang_to_num_examples)
+    for lang in range(len(lang_to_num_examples)):
+        proportions = [float(lang_counts[lang]) / sum(lang_counts)
+                       for lang_counts in archive_lang_counts if sum(lang_counts) > 0]
+        if tot_num_egs == 0 or not proportions:
+            continue
+        logger.info("The proportion of egs from lang {} in the archives ranges from {:.3f} to "
+                    "{:.3f} (overall: {:.3f}).".format(lang, min(proportions), max(proportions),
+                                                     float(lang_to_num_examples[lang]) / tot_num_egs))
+
+
 def main():
     try:
         args = get_args()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Copyright 2020    Johns Hopkins University
+# Apache 2.0.
+
+""" This script reads the models saved during training (<exp-dir>/<iter>.mdl
+or <exp-dir>/<iter>.raw) and adds per-component statistics of their
+parameters (norms, change from the previous model, row and column norms) to
+a store which steps/nnet3/report/generate_plots.py uses to plot how the
+parameters drift during training; see
+steps/libs/nnet3/report/param_drift.py for details.
+
+The store is updated incrementally: only the models of the iterations after
+the last one in the store are read, each of them once.  As the training
+scripts remove most models as training goes on (see --cleanup and
+--cleanup.preserve-model-interval), you can run this script periodically
+while training is running to catch all of them, e.g.
+  while sleep 600; do steps/nnet3/report/compute_param_drift.py exp/chain/tdnn1a_sp; done
+or run it after training to process the models that were kept.
+"""
+
+from __future__ import print_function
+import argparse
+import logging
+import os
+import re
+import sys
+
+sys.path.insert(0, 'steps')
+import libs.nnet3.report.param_drift as param_drift
+import libs.common as common_lib
+import convert_model
+
+logging.basicConfig(format="%(filename)s:%(lineno)s:%(levelname)s:%(message)s",
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0],
+        formatter_class=type('', (argparse.RawDescriptionHelpFormatter,
+                                  argparse.ArgumentDefaultsHelpFormatter), {}),
+        description=__doc__)
+
+    parser.add_argument("--iter-interval", type=int, metavar='N', default=1,
+                        help="Only process the models of the iterations that "
+                        "are multiples of N (e.g. 100 to use the models kept "
+                        "by the training scripts).")
+    parser.add_argument("--components", type=str, metavar='NAMES',
+                        action=common_lib.NullstrToNoneAction,
+                        help="Space separated list of the components to "
+                        "process; by default, all those with a parameter "
+                        "matrix.")
+    parser.add_argument("--store-dir", type=str, metavar='DIR',
+                        action=common_lib.NullstrToNoneAction,
+                        help="Directory of the store; default is "
+                        "<exp-dir>/param_drift, which is where "
+                        "generate_plots.py looks for it.")
+    parser.add_argument("exp_dir", help="Experiment directory, e.g. "
+                        "exp/chain/tdnn1a_sp")
+
+    args = parser.parse_args()
+    if args.iter_interval < 1:
+        raise Exception("--iter-interval must be positive")
+    return args
+
+
+def find_models(exp_dir):
+    """ Returns a dict from iteration to the model of that iteration in
+    'exp_dir' (<iter>.mdl, or <iter>.raw if there is no <iter>.mdl). """
+    models = {}
+    for name in os.listdir(exp_dir):
+        m = re.match(r'^([0-9]+)\.(mdl|raw)$', name)
+        if m is not None:
+            iter = int(m.group(1))
+            if iter not in models or m.group(2) == 'mdl':
+                models[iter] = os.path.join(exp_dir, name)
+    return models
+
+
+def compute_param_drift(exp_dir, store_dir, iter_interval=1,
+                        component_names=None):
+    store = param_drift.ParamDriftStore(store_dir)
+    models = find_models(exp_dir)
+    last_iter = store.last_iter
+    new_iters = sorted(iter for iter in models if iter % iter_interval == 0
+                       and (last_iter is None or iter > last_iter))
+    if len(new_iters) == 0:
+        logger.info("No new models in {0} (last iteration in {1} is "
+                    "{2})".format(exp_dir, store_dir, last_iter))
+        return
+
+    prev_iter = None
+    prev_model = {}
+    if last_iter is not None:
+        if last_iter in models:
+            prev_iter = last_iter
+            prev_model = convert_model.read_model(models[last_iter],
+                                                  component_names)
+        else:
+            logger.warning("The model of iteration {0} has been removed, so "
+                           "the change at iteration {1} can't be "
+                           "computed".format(last_iter, new_iters[0]))
+
+    logger.info("Processing the models of {0} iterations from {1} to "
+                "{2}".format(len(new_iters), new_iters[0], new_iters[-1]))
+    for iter in new_iters:
+        try:
+            model = convert_model.read_model(models[iter], component_names)
+        except (ValueError, IndexError) as e:
+            # The last model may still be being written.
+            logger.warning("Could not read {0}, stopping there: {1}".format(
+                models[iter], e))
+            break
+        component_stats = {}
+        for name, c in model.items():
+            if 'params' not in c:
+                continue
+            prev = prev_model.get(name, {})
+            component_stats[name] = param_drift.compute_param_stats(
+                c['params'], c.get('bias'), prev.get('params'),
+                prev.get('bias'))
+        store.add(iter, prev_iter, component_stats)
+        prev_iter = iter
+        prev_model = model
+    store.write()
+
+
+def main():
+    args = get_args()
+    store_dir = (args.store_dir if args.store_dir is not None
+                 else param_drift.get_store_dir(args.exp_dir))
+    component_names = (args.components.split()
+                       if args.components is not None else None)
+    compute_param_drift(args.exp_dir, store_dir, args.iter_interval,
+                        component_names)
+
+
+if __name__ == "__main__":
+    main()
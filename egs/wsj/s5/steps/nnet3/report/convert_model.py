@@ -2,10 +2,16 @@
 
 # This script dumps the parameters of (most components of) an nnet3 model as a
 # pickled python dict.  (see documentation for the function 'read_model' below
-# for more details).
+# for more details).  Binary models are read directly (see BinaryModelReader);
+# other models are converted to text with nnet3-copy first.
 #
 # It also contains some utility function that you can get access by importing this
-# file.
+# file.  For instance, to look at the progress of training over a number of
+# iterations:
+#  for filename, model in convert_model.iterate_model_progress(
+#        ['exp/chain/tdnn1g_sp/{0}.mdl'.format(i) for i in range(20, 30)],
+#        component_names=['tdnn3.affine', 'tdnn4.affine']):
+#     print(filename, model['tdnn3.affine'].get('rel-row-change'))
 #
 # In egs/mini_librispeech/s5/local/chain/diagnostic/report_example.py, you can
 # find an example of the use of this script.
@@ -16,6 +22,10 @@
 
 # This requires python 3.
 
+import mmap
+import os
+import re
+import struct
 import sys
 import subprocess
 import numpy as np
@@ -272,7 +282,7 @@ def get_action_dict(component_type):
                '<Count>': (read_float, 'count'),
                '<OderivCount>': (read_float, 'oderiv-count') }
    if raw_component_type in {'Affine',
-                             'NaturalGradientAffine'}:
+                             'NaturalGradientAffine', 'Tdnn'}:
       # We call  '<LinearParams>' to just 'params' for compatibility with
       # LinearComponent.
       return { '<LinearParams>': (read_matrix, 'params'),
@@ -300,7 +310,7 @@ def get_stdout_from_command(command):
                         stdout=subprocess.PIPE)
 
    stdout = p.communicate()[0]
-   if p.returncode is not 0:
+   if p.returncode != 0:
       raise Exception("Command exited with status {0}: {1}".format(
          p.returncode, command))
    return stdout.decode()
@@ -336,10 +346,10 @@ def read_component(s, pos):
    return (d, pos)
 
 
-def read_model(filename):
-   """Reads an nnet3 model from the provided filename, and returns a dict
-      from the component-name to a dict containing things we have read
-      in for that component."""
+def read_text_model(filename):
+   """Reads an nnet3 model from the provided filename (or rxfilename, e.g. a
+      pipe), by converting it to text with nnet3-copy and parsing the text.
+      Returns a dict from component-name to component, as read_model()."""
    command = "nnet3-copy --binary=false {0} -".format(filename)
    s = get_stdout_from_command(command)
    # The model starts with some structural stuff (component-nodes, etc.) that we
@@ -387,6 +397,300 @@ def read_model(filename):
 
    return d
 
+
+def read_binary_token(s, pos):
+   """This function, given a binary nnet3 model s (a bytes-like object, e.g. an
+      mmap) and a position 'pos', reads the token (e.g. '<Dim>') at that
+      position, as written by Kaldi's WriteToken() in binary mode, i.e.
+      followed by a single space.  Returns the pair (token, new_pos), where
+      'token' is a str, or (None, pos) if there is no token at 'pos'.
+   """
+   end = s.find(b' ', pos, pos + 1024)
+   if end <= pos:
+      return (None, pos)
+   return (s[pos:end].decode(), end + 1)
+
+
+def read_binary_int(s, pos):
+   """Reads an integer written by WriteBasicType() in binary mode (a byte
+      with the size of the type, followed by the value), and returns the pair
+      (int, new_pos).  Raises ValueError if there is no integer at 'pos'."""
+   size = s[pos]
+   if size not in (1, 2, 4, 8):
+      raise ValueError("at file position {0}, expected int".format(pos))
+   value = int.from_bytes(s[pos + 1:pos + 1 + size], 'little', signed=True)
+   return (value, pos + 1 + size)
+
+
+def read_binary_float(s, pos):
+   """Reads a float or double written by WriteBasicType() in binary mode, and
+      returns the pair (float, new_pos).  Raises ValueError if there is no
+      float at 'pos'."""
+   size = s[pos]
+   if size == 4:
+      return (struct.unpack_from('<f', s, pos + 1)[0], pos + 5)
+   if size == 8:
+      return (struct.unpack_from('<d', s, pos + 1)[0], pos + 9)
+   raise ValueError("at file position {0}, expected float".format(pos))
+
+
+def read_binary_array(s, pos, num_dims):
+   """Reads a binary-format vector (num_dims == 1; tokens FV or DV) or matrix
+      (num_dims == 2; tokens FM or DM) starting at position 'pos', and returns
+      the pair (array, new_pos), where 'array' is a float32 numpy array that
+      does not share memory with 's'.  Raises ValueError if there is no such
+      object at 'pos' (compressed matrices are not supported, as they don't
+      appear in models)."""
+   (tok, new_pos) = read_binary_token(s, pos)
+   expected = ('FV', 'DV') if num_dims == 1 else ('FM', 'DM')
+   if tok not in expected:
+      raise ValueError("at file position {0}, expected {1} but got {2}".format(
+         pos, ' or '.join(expected), tok))
+   shape = []
+   for _ in range(num_dims):
+      (dim, new_pos) = read_binary_int(s, new_pos)
+      shape.append(dim)
+   dtype = np.dtype('<f4' if tok[0] == 'F' else '<f8')
+   count = int(np.prod(shape))
+   if new_pos + count * dtype.itemsize > len(s):
+      raise ValueError("at file position {0}, {1} of size {2} goes past the "
+                       "end of the file".format(pos, tok, shape))
+   a = np.frombuffer(s, dtype=dtype, count=count, offset=new_pos)
+   return (a.astype(np.float32).reshape(shape),
+           new_pos + count * dtype.itemsize)
+
+
+def read_binary_vector(s, pos):
+   """Binary counterpart of read_vector()."""
+   return read_binary_array(s, pos, 1)
+
+
+def read_binary_matrix(s, pos):
+   """Binary counterpart of read_matrix()."""
+   return read_binary_array(s, pos, 2)
+
+
+# Maps the text-format readers used in the 'action_dict's returned by
+# get_action_dict() to the corresponding binary-format readers.
+binary_readers = { read_int: read_binary_int,
+                   read_float: read_binary_float,
+                   read_vector: read_binary_vector,
+                   read_matrix: read_binary_matrix }
+
+
+# Matches a token like '<Dim> ' or '</BatchNormComponent> ' in a binary file.
+binary_token_regex = re.compile(b'</?[A-Za-z][A-Za-z0-9_-]*> ')
+
+
+def skip_binary_values(s, pos, end):
+   """Skips the values following a token that we don't know how to read (the
+      binary format doesn't say what they are), up to the next token or
+      position 'end', guessing their type from their first bytes: vectors and
+      matrices start with FV, DV, FM or DM, booleans are T or F and the basic
+      types and integer vectors start with the size of their elements.
+      Returns the new position, or None if something unexpected was found."""
+   while pos < end and s[pos:pos + 1] != b'<':
+      head = s[pos:pos + 3]
+      try:
+         if head in (b'FV ', b'DV '):
+            (_, pos) = read_binary_vector(s, pos)
+         elif head in (b'FM ', b'DM '):
+            (_, pos) = read_binary_matrix(s, pos)
+         elif head[:1] in (b'T', b'F'):
+            pos += 1
+         elif s[pos] in (1, 2, 4, 8):
+            # This is either a basic type or an integer vector as written
+            # by WriteIntegerVector() (e.g. the <TimeOffsets> of a
+            # TdnnComponent), which has the number of elements as a raw int32
+            # after their size.  We assume it's an integer vector if a token
+            # follows it and wouldn't follow a basic type.
+            size = s[pos]
+            basic_end = pos + 1 + size
+            count = int.from_bytes(s[pos + 1:pos + 5], 'little', signed=True)
+            vector_end = pos + 5 + count * size
+            if (basic_end < end and not binary_token_regex.match(s, basic_end)
+                and count >= 0 and vector_end <= end and
+                (vector_end == end or binary_token_regex.match(s, vector_end))):
+               pos = vector_end
+            else:
+               pos = basic_end
+         else:
+            return None
+      except ValueError:
+         return None
+   return pos if pos <= end else None
+
+
+def read_binary_component(s, pos, end, component_type):
+   """Reads the contents of a binary-format component of type
+      'component_type' (e.g. '<RectifiedLinearComponent>') which start at
+      'pos', just after the component type, and end at 'end', where the
+      terminating token (e.g. '</RectifiedLinearComponent>') is.  Returns a
+      dict like the one returned by read_component() for the text format;
+      if we fail to parse something, a warning is printed and the dict
+      contains what was read until then."""
+   action_dict = get_action_dict(component_type)
+   d = dict()
+   orig_pos = pos
+   # We don't need to go through the components whose type we don't know.
+   while pos < end and len(action_dict) > 0:
+      (tok, pos) = read_binary_token(s, pos)
+      if tok is None or tok[0] != '<':
+         print("{0}: error reading {1} starting at file position {2}: expected "
+               "token at position {3}".format(sys.argv[0], component_type,
+                                              orig_pos, pos), file=sys.stderr)
+         break
+      if tok in action_dict:
+         (func, name) = action_dict[tok]
+         try:
+            (d[name], pos) = binary_readers[func](s, pos)
+            continue
+         except ValueError as e:
+            print("{0}: error reading {1} starting at file position {2}: "
+                  "{3}".format(sys.argv[0], component_type, orig_pos, e),
+                  file=sys.stderr)
+            break
+      pos = skip_binary_values(s, pos, end)
+      if pos is None:
+         print("{0}: could not parse the value of {1} in {2} starting at "
+               "file position {3}".format(sys.argv[0], tok, component_type,
+                                          orig_pos), file=sys.stderr)
+         break
+   d['type'] = component_type             # e.g. '<LinearComponent>'
+   d['raw-type'] = component_type[1:-10]  # e.g. 'Linear'
+   return d
+
+
+class BinaryModelReader(object):
+   """This class reads an nnet3 model in binary format (a raw nnet, or an
+      acoustic model like final.mdl, which has a transition model before the
+      nnet) directly from the file, without converting it to text.  The file
+      is memory-mapped and the constructor only locates the components, so
+      the parameters of a component are only read if they are asked for.
+
+      It will raise an exception if the file is not a binary nnet3 model.
+
+      e.g.
+        with BinaryModelReader('exp/chain/tdnn1g_sp/final.mdl') as reader:
+           affine = reader.read_component('tdnn3.affine')
+           model = reader.read_model()   # all components, like read_model()
+   """
+   def __init__(self, filename):
+      self.filename = filename
+      with open(filename, 'rb') as f:
+         self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+         self._locate_components()
+      except:
+         self.mm.close()
+         raise
+
+   def _locate_components(self):
+      s = self.mm
+      if s[:2] != b'\0B':
+         raise ValueError("{0} is not a binary Kaldi file".format(self.filename))
+      # The model starts with some structural stuff (component-nodes, etc.)
+      # that we skip, and the components start after <NumComponents>.
+      pos = s.find(b'<Nnet3> ')
+      if pos >= 0:
+         pos = s.find(b'<NumComponents> ', pos)
+      if pos < 0:
+         raise ValueError("{0} does not look like a binary nnet3 model".format(
+            self.filename))
+      (num_components, pos) = read_binary_int(s, pos + len(b'<NumComponents> '))
+      # a list of (component-name, component-type, start-pos, end-pos), where
+      # start-pos is after the component type and end-pos is the position of
+      # the terminating token.
+      self.components = []
+      self.component_index = dict()
+      for c in range(num_components):
+         (tok, pos) = read_binary_token(s, pos)
+         if tok != '<ComponentName>':
+            raise ValueError("{0}: at file position {1}, expected "
+                             "<ComponentName> but got {2}".format(
+                                self.filename, pos, tok))
+         (component_name, pos) = read_binary_token(s, pos)
+         (component_type, pos) = read_binary_token(s, pos)
+         if not is_component_type(component_type):
+            raise ValueError("{0}: expected <xxxxComponent> for component {1} "
+                             "but got {2}".format(self.filename, component_name,
+                                                  component_type))
+         # We don't try to parse the components to find where they end, as we
+         # don't know the format of all of them; instead we look for the
+         # terminating token, e.g. </RectifiedLinearComponent>.
+         terminating_token = ("</" + component_type[1:] + " ").encode()
+         end = s.find(terminating_token, pos)
+         if end < 0:
+            raise ValueError("{0}: could not find {1} for component {2}".format(
+               self.filename, terminating_token.decode().strip(),
+               component_name))
+         self.component_index[component_name] = len(self.components)
+         self.components.append((component_name, component_type, pos, end))
+         pos = end + len(terminating_token)
+
+   def component_names(self):
+      """Returns the names of the components, in the order of the model."""
+      return [c[0] for c in self.components]
+
+   def __contains__(self, component_name):
+      return component_name in self.component_index
+
+   def read_component(self, component_name):
+      """Returns a dict from element-name to object for the component
+         'component_name' (see read_component()).  Raises KeyError if there
+         is no such component."""
+      (_, component_type, start, end) = \
+         self.components[self.component_index[component_name]]
+      return read_binary_component(self.mm, start, end, component_type)
+
+   def read_model(self, component_names=None):
+      """Returns a dict from component-name to component, for all the
+         components, or for those in 'component_names' that exist if it is
+         not None."""
+      if component_names is None:
+         component_names = self.component_names()
+      return dict((name, self.read_component(name))
+                  for name in component_names if name in self)
+
+   def close(self):
+      self.mm.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+
+def is_binary_file(filename):
+   """Returns True if 'filename' is a file (and not e.g. a pipe) in Kaldi's
+      binary format."""
+   if not os.path.isfile(filename):
+      return False
+   with open(filename, 'rb') as f:
+      return f.read(2) == b'\0B'
+
+
+def read_model(filename, component_names=None):
+   """Reads an nnet3 model from the provided filename, and returns a dict
+      from the component-name to a dict containing things we have read
+      in for that component.  If 'component_names' is not None, only the
+      components in that list are returned (for binary models, the others are
+      not even parsed).
+
+      Binary models are read directly by BinaryModelReader, which is a lot
+      faster than parsing the text form, and gives the exact values of the
+      parameters; other models (e.g. text-format models or pipes) are read by
+      read_text_model().
+   """
+   if is_binary_file(filename):
+      with BinaryModelReader(filename) as reader:
+         return reader.read_model(component_names)
+   d = read_text_model(filename)
+   if d is not None and component_names is not None:
+      d = dict((name, d[name]) for name in component_names if name in d)
+   return d
+
 def compute_derived_quantities(model):
    """This function, given a model as returned by 'read_model', computes certain
        potentially-useful derived quantities inside components: things like row
@@ -397,7 +701,8 @@ def compute_derived_quantities(model):
    for c in model.values():
       # 'c' represents the component; it's a dict.
       raw_component_type = c['raw-type']
-      if raw_component_type in {'Linear', 'Affine', 'NaturalGradientAffine'}:
+      if raw_component_type in {'Linear', 'Affine', 'NaturalGradientAffine',
+                                'Tdnn'}:
          params = c['params'] # this is the parameter matrix.
          # compute the row and column norms of the parameter matrix.
          c['row-norms'] = np.sqrt(np.sum(params * params, axis=1))
@@ -407,8 +712,8 @@ def compute_derived_quantities(model):
             # if the input-dim of this layer is divisible by 3, then compute the
             # column-norms after reshaping... this is a kind of pooled column-norm
             # that makes sense for TDNNs or wherever we have used Append().
-            c['col-norms-3'] = np.sqrt(np.sum(np.power(c['col-norms'], 2).reshape(3, size/3), axis=0))
-            assert c['col-norms-3'].shape == (size/3,)
+            c['col-norms-3'] = np.sqrt(np.sum(np.power(c['col-norms'], 2).reshape(3, size // 3), axis=0))
+            assert c['col-norms-3'].shape == (size // 3,)
 
       if raw_component_type == 'BatchNorm':
          stats_var = c['stats-var']
@@ -426,7 +731,8 @@ def compute_progress(model1, model2):
       c1 = model1[component_name]
       c2 = model2[component_name]
       raw_component_type = c1['raw-type']
-      if raw_component_type in {'Linear', 'Affine', 'NaturalGradientAffine'}:
+      if raw_component_type in {'Linear', 'Affine', 'NaturalGradientAffine',
+                                'Tdnn'}:
          params1 = c1['params']
          params2 = c2['params']
          if params1.size != params2.size:
@@ -447,10 +753,35 @@ def compute_progress(model1, model2):
             # if the input-dim of this layer is divisible by 3, then average the
             # column changes over 3 blocks... this makes sense for TDNNs or
             # wherever we have used Append().
-            c1['col-change-3'] = np.sum(c1['col-change'].reshape(3, size/3), axis=0)
+            c1['col-change-3'] = np.sum(c1['col-change'].reshape(3, size // 3), axis=0)
             c1['rel-col-change-3'] = c1['col-change-3'] / (c1['col-norms-3'] + epsilon)
 
 
+def iterate_model_progress(filenames, component_names=None):
+   """This function, given the filenames of models from successive iterations
+      of training, reads them one by one (see read_model()) and yields pairs
+      (filename, model) where the derived quantities of
+      compute_derived_quantities() have been computed for 'model', and, except
+      for the last model, the quantities of compute_progress() relative to the
+      model that follows it.  This way many checkpoints can be compared in
+      one process while only two models are held in memory at a time (unless
+      the caller keeps them).  If 'component_names' is not None, only those
+      components are read.
+   """
+   prev = None
+   for filename in filenames:
+      model = read_model(filename, component_names)
+      if model is None:
+         raise Exception("Could not read model {0}".format(filename))
+      compute_derived_quantities(model)
+      if prev is not None:
+         compute_progress(prev[1], model)
+         yield prev
+      prev = (filename, model)
+   if prev is not None:
+      yield prev
+
+
 def test():
    assert sys.version_info.major >= 3
    assert read_next_token("", 0) == (None, 0)
@@ -472,12 +803,100 @@ def test():
    assert pos == len(s)
    assert np.array_equal(obj['some_vec'], np.array([1, 2, 3], dtype=np.float32))
 
-   m = read_model('exp/chain_cleaned/tdnn1c_sp_bi/final.mdl')
-   compute_derived_quantities(m)
-   print("model is: {0}".format(m))
+   test_binary_model()
    print("tested")
 
 
+def write_test_binary_model(filename):
+   """Writes a small hand-built nnet3 model in binary format to 'filename',
+      for test_binary_model().  It is a raw nnet with only the parts of the
+      format that BinaryModelReader looks at, but the components are written
+      as Kaldi writes them, including fields that we have to skip, like the
+      integer vector <TimeOffsets> of the TdnnComponent."""
+   def token(t):
+      return t.encode() + b' '
+   def int32(i):
+      return b'\x04' + struct.pack('<i', i)
+   def float32(f):
+      return b'\x04' + struct.pack('<f', f)
+   def int_vector(v):
+      return b'\x04' + struct.pack('<i', len(v)) + struct.pack(
+         '<{0}i'.format(len(v)), *v)
+   def vector(v):
+      return b'FV ' + int32(len(v)) + np.asarray(v, dtype='<f4').tobytes()
+   def matrix(m):
+      m = np.asarray(m, dtype='<f4')
+      return (b'FM ' + int32(m.shape[0]) + int32(m.shape[1]) +
+              m.tobytes())
+
+   tdnn = (token('<TdnnComponent>') + token('<MaxChange>') + float32(0.75) +
+           token('<LearningRate>') + float32(0.001) +
+           token('<TimeOffsets>') + int_vector([-3, 0, 3]) +
+           token('<LinearParams>') + matrix([[1, 2, 3], [4, 5, 6]]) +
+           token('<BiasParams>') + vector([0.5, -0.5]) +
+           token('<OrthonormalConstraint>') + float32(0.0) +
+           token('<UseNaturalGradient>') + b'T' +
+           token('</TdnnComponent>'))
+   relu = (token('<RectifiedLinearComponent>') + token('<Dim>') + int32(2) +
+           token('<BlockDim>') + int32(2) +
+           token('<ValueAvg>') + vector([0.25, 0.75]) +
+           token('<DerivAvg>') + vector([0.5, 1.0]) +
+           token('<Count>') + float32(100.0) +
+           token('<OderivRms>') + vector([0.125, 0.25]) +
+           token('<OderivCount>') + float32(50.0) +
+           token('</RectifiedLinearComponent>'))
+   # a component type that get_action_dict() knows nothing about.
+   other = (token('<GeneralDropoutComponent>') + token('<Dim>') + int32(2) +
+            token('<BlockDim>') + int32(2) +
+            token('<TimePeriod>') + int32(0) +
+            token('<DropoutProportion>') + float32(0.5) +
+            token('</GeneralDropoutComponent>'))
+   with open(filename, 'wb') as f:
+      f.write(b'\0B' + token('<Nnet3>') +
+              b'\ninput-node name=input dim=3\n\n' +
+              token('<NumComponents>') + int32(3) +
+              token('<ComponentName>') + token('tdnn1.affine') + tdnn +
+              token('<ComponentName>') + token('tdnn1.relu') + relu +
+              token('<ComponentName>') + token('tdnn1.dropout') + other +
+              token('</Nnet3>'))
+
+
+def test_binary_model():
+   import shutil
+   import tempfile
+   dirname = tempfile.mkdtemp()
+   try:
+      filename = os.path.join(dirname, 'test.raw')
+      write_test_binary_model(filename)
+      assert is_binary_file(filename)
+      with BinaryModelReader(filename) as reader:
+         assert reader.component_names() == ['tdnn1.affine', 'tdnn1.relu',
+                                             'tdnn1.dropout']
+         assert 'tdnn1.relu' in reader and 'tdnn2.relu' not in reader
+         tdnn = reader.read_component('tdnn1.affine')
+         assert tdnn['raw-type'] == 'Tdnn'
+         assert np.array_equal(tdnn['params'], np.array([[1, 2, 3], [4, 5, 6]],
+                                                        dtype=np.float32))
+         assert np.array_equal(tdnn['bias'],
+                               np.array([0.5, -0.5], dtype=np.float32))
+         relu = reader.read_component('tdnn1.relu')
+         assert relu['dim'] == 2 and relu['block-dim'] == 2
+         assert relu['count'] == 100.0 and relu['oderiv-count'] == 50.0
+         assert np.array_equal(relu['oderiv-rms'],
+                               np.array([0.125, 0.25], dtype=np.float32))
+         assert reader.read_component('tdnn1.dropout') == {
+            'type': '<GeneralDropoutComponent>', 'raw-type': 'GeneralDropout' }
+
+      m = read_model(filename, ['tdnn1.affine', 'tdnn2.affine'])
+      assert list(m.keys()) == ['tdnn1.affine']
+      compute_derived_quantities(m)
+      assert np.allclose(m['tdnn1.affine']['row-norms'],
+                         [np.sqrt(14), np.sqrt(77)])
+      assert m['tdnn1.affine']['col-norms-3'].shape == (1,)
+   finally:
+      shutil.rmtree(dirname)
+
+
 
 if __name__ == '__main__':
    if len(sys.argv) == 1:
@@ -15,6 +15,7 @@ import warnings
 
 sys.path.insert(0, 'steps')
 import libs.nnet3.report.log_parse as log_parse
+import libs.nnet3.report.param_drift as param_drift
 import libs.common as common_lib
 
 try:
@@ -576,6 +577,23 @@ def generate_clipped_proportion_plots(exp_dir, output_dir, plot,
                     "Clipped proportion at {0}".format(component_name))
 
 
+def merge_param_diff_stats(log_stats, store_stats):
+    """ Returns the parameter differences parsed from the progress logs
+    ('log_stats', which may be None) with those of the store ('store_stats')
+    taking precedence where both have the difference of a component at an
+    iteration.  Both are as returned by
+    log_parse.parse_progress_logs_for_param_diff(). """
+    if log_stats is None:
+        return store_stats
+    progress_per_component = {}
+    for stats in [log_stats, store_stats]:
+        for name, diffs in stats['progress_per_component'].items():
+            progress_per_component.setdefault(name, {}).update(diffs)
+    return {'progress_per_component': progress_per_component,
+            'component_names': sorted(progress_per_component.keys()),
+            'max_iter': max(log_stats['max_iter'], store_stats['max_iter'])}
+
+
 def generate_parameter_diff_plots(exp_dir, output_dir, plot,
                                   comparison_dir=None, start_iter=1,
                                   latex_report=None):
@@ -591,9 +609,30 @@ def generate_parameter_diff_plots(exp_dir, output_dir, plot,
     stats_per_dir = {}
     for dir in dirs:
         stats_per_dir[dir] = {}
+        # The parameter differences computed from the models by
+        # compute_param_drift.py are used if they are available; the progress
+        # logs are used for the components and iterations they don't cover.
+        store_dir = param_drift.get_store_dir(dir)
+        store = None
+        if param_drift.store_exists(store_dir):
+            logger.info("Using the parameter differences in %s", store_dir)
+            store = param_drift.ParamDriftStore(store_dir)
         for key in key_file:
-            stats_per_dir[dir][key] = (
-                log_parse.parse_progress_logs_for_param_diff(dir, key))
+            try:
+                stats = log_parse.parse_progress_logs_for_param_diff(dir, key)
+            except log_parse.KaldiLogParseException:
+                if store is None:
+                    raise
+                stats = None
+            if store is not None:
+                stats = merge_param_diff_stats(
+                    stats, store.get_param_diff_stats(key))
+                if stats['max_iter'] < 0:
+                    raise log_parse.KaldiLogParseException(
+                        "There are no parameter differences of consecutive "
+                        "iterations in {0} or in {1}/log/progress.*.log".format(
+                            store_dir, dir))
+            stats_per_dir[dir][key] = stats
 
     # write down the stats for the main experiment directory
     for diff_type in key_file:
@@ -707,6 +746,79 @@ def generate_parameter_diff_plots(exp_dir, output_dir, plot,
                     "Parameter differences at {0}".format(component_name))
 
 
+def generate_param_norm_plots(exp_dir, output_dir, plot, start_iter=1,
+                              latex_report=None):
+    """ Plots the history of the parameter norms, and of the distribution of
+    the row and column norms of the parameter matrices, of the components of
+    the main experiment directory, from the store written by
+    compute_param_drift.py; nothing is done if there is no store. """
+    assert start_iter >= 1
+
+    store_dir = param_drift.get_store_dir(exp_dir)
+    if not param_drift.store_exists(store_dir):
+        logger.info("There is no parameter drift store in %s (see "
+                    "steps/nnet3/report/compute_param_drift.py), not "
+                    "generating parameter norm plots.", store_dir)
+        return
+    store = param_drift.ParamDriftStore(store_dir)
+    component_names = store.component_names()
+
+    with open("{0}/parameter.norm".format(output_dir), "w") as f:
+        norm_per_component = dict(
+            (c, dict(zip(*store.get_stats(c, 'norm'))))
+            for c in component_names)
+        f.write(" ".join(["Iteration"] + component_names) + "\n")
+        for iter in store.iters:
+            f.write(" ".join([str(iter)] + [
+                str(norm_per_component[c].get(iter, "NA"))
+                for c in component_names]) + "\n")
+
+    if plot:
+        logger.info("Plotting parameter norms for components: " +
+                    ", ".join(component_names))
+        percentiles = [0, 10, 50, 90, 100]
+        fig = plt.figure()
+        for component_name in component_names:
+            fig.clf()
+            iters, norms = store.get_stats(component_name, 'norm')
+            if not np.any(iters >= start_iter):
+                continue
+            ax = plt.subplot(311)
+            ax.plot(iters[iters >= start_iter], norms[iters >= start_iter],
+                    color='red')
+            ax.set_ylabel('Parameter norm')
+            ax.grid(True)
+            for (subplot, key, name) in [(312, 'row-norms', 'Row norms'),
+                                         (313, 'col-norms', 'Column norms')]:
+                iters, norms = store.get_norm_history(component_name, key)
+                norms = norms[iters >= start_iter, :]
+                iters = iters[iters >= start_iter]
+                # a line for each percentile of the row (or column) norms,
+                # shading between the 10th and 90th percentiles.
+                data = np.percentile(norms, percentiles, axis=1)
+                ax = plt.subplot(subplot)
+                ax.fill_between(iters, data[1], data[3], color='blue',
+                                alpha=0.2)
+                for i, percentile in enumerate(percentiles):
+                    ax.plot(iters, data[i], color='blue',
+                            linestyle='-' if percentile == 50 else ':')
+                ax.set_ylabel(name)
+                ax.grid(True)
+            ax.set_xlabel('Iteration')
+            fig.suptitle("Parameter norms at {comp_name} (row/column norm "
+                         "percentiles: {p})".format(
+                             comp_name=component_name,
+                             p=", ".join(str(p) for p in percentiles)))
+            comp_name = latex_compliant_name(component_name)
+            figfile_name = '{dir}/param_norm_{comp_name}.pdf'.format(
+                dir=output_dir, comp_name=comp_name)
+            fig.savefig(figfile_name, bbox_inches='tight')
+            if latex_report is not None:
+                latex_report.add_figure(
+                    figfile_name,
+                    "Parameter norms at {0}".format(component_name))
+
+
 def generate_plots(exp_dir, output_dir, output_names, comparison_dir=None,
                    start_iter=1):
     try:
@@ -773,6 +885,11 @@ def generate_plots(exp_dir, output_dir, output_names, comparison_dir=None,
         exp_dir, output_dir, g_plot, comparison_dir=comparison_dir,
         start_iter=start_iter, latex_report=latex_report)
 
+    logger.info("Generating parameter norm plots")
+    generate_param_norm_plots(
+        exp_dir, output_dir, g_plot, start_iter=start_iter,
+        latex_report=latex_report)
+
     if g_plot and latex_report is not None:
         has_compiled = latex_report.close()
         if has_compiled:
@@ -177,6 +177,9 @@ def train(args, run_opts):
     arg_string = pprint.pformat(vars(args))
     logger.info("Arguments for the experiment\n{0}".format(arg_string))
 
+    if args.max_background_jobs > 0:
+        common_lib.set_max_background_jobs(args.max_background_jobs)
+
     # Copy phones.txt from ali-dir to dir. Later, steps/nnet3/decode.sh will
     # use it to check compatibility between training and decoding phone-sets.
     shutil.copy('{0}/phones.txt'.format(args.ali_dir), args.dir)
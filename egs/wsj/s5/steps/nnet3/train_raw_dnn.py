@@ -195,6 +195,9 @@ def train(args, run_opts):
     arg_string = pprint.pformat(vars(args))
     logger.info("Arguments for the experiment\n{0}".format(arg_string))
 
+    if args.max_background_jobs > 0:
+        common_lib.set_max_background_jobs(args.max_background_jobs)
+
     # Set some variables.
 
     # note, feat_dim gets set to 0 if args.feat_dir is unset (None).
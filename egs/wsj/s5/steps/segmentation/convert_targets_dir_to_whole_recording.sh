@@ -111,7 +111,7 @@ $cmd JOB=1:$nj $dir/log/merge_targets_to_reco.JOB.log \
     --default-targets="$default_targets" \
     $dir/split${nj}reco/reco2utt.JOB $dir/split${nj}reco/segments.JOB \
     $dir/split${nj}reco/targets.JOB.scp - \| \
-  copy-feats ark,t:- ark,scp:$dir/targets.JOB.ark,$dir/targets.JOB.scp || exit 1
+  copy-feats ark:- ark,scp:$dir/targets.JOB.ark,$dir/targets.JOB.scp || exit 1
 
 for n in $(seq $nj); do
   cat $dir/targets.$n.scp
@@ -8,17 +8,30 @@ This script merges targets matrices corresponding to
 segments into targets matrix for whole recording. The frames that are not
 in any of the segments are assigned the default targets vector, specified by
 the option --default-targets or [ 0 0 0 ] if unspecified.
+
+With --benchmark <dir>, it instead creates a synthetic data directory in
+<dir>, merges its targets and reports the speed, e.g.
+  steps/segmentation/internal/merge_segment_targets_to_recording.py \
+    --benchmark exp/merge_targets_benchmark
 """
 from __future__ import division
 
 import argparse
 import logging
 import numpy as np
+import os
 import subprocess
 import sys
+import time
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
 
 sys.path.insert(0, 'steps')
 import libs.common as common_lib
+import libs.kaldi_io as kaldi_io
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -43,29 +56,55 @@ def get_args():
                         "region")
     parser.add_argument("--length-tolerance", type=int, default=4,
                         help="Tolerate length mismatches of this many frames")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Number of recordings whose targets are read "
+                        "together; the reads of a batch are sorted by their "
+                        "position in the archives")
     parser.add_argument("--verbose", type=int, default=0, choices=[0, 1, 2],
                         help="Verbose level")
-
-    parser.add_argument("--reco2num-frames", type=str, required=True,
+    parser.add_argument("--benchmark", type=str, default=None,
+                        action=common_lib.NullstrToNoneAction,
+                        help="""If supplied, a directory in which a synthetic
+                        data directory is created (see
+                        --benchmark-num-recordings); its targets are merged,
+                        the speed is reported and the script exits.  The
+                        other arguments are not needed in this case.""")
+    parser.add_argument("--benchmark-num-recordings", type=int, default=200,
+                        help="""Number of recordings of the synthetic data
+                        directory of --benchmark; each one has 10 segments
+                        of 1 to 5 seconds, some of them overlapping, with
+                        3-dimensional targets.""")
+
+    parser.add_argument("--reco2num-frames", type=str,
                         action=common_lib.NullstrToNoneAction,
                         help="""The number of frames per reco
                         is used to determine the num-rows of the output matrix
                         """)
-    parser.add_argument("reco2utt", type=str,
+    parser.add_argument("reco2utt", type=str, nargs='?',
                         help="""reco2utt file.
                         The format is <reco> <utt-1> <utt-2> ... <utt-N>""")
-    parser.add_argument("segments", type=str,
+    parser.add_argument("segments", type=str, nargs='?',
                         help="Input kaldi segments file")
-    parser.add_argument("targets_scp", type=str,
+    parser.add_argument("targets_scp", type=str, nargs='?',
                         help="""SCP of input targets matrices.
                         The matrices are indexed by the utterance-id.""")
-    parser.add_argument("out_targets_ark", type=str,
+    parser.add_argument("out_targets_ark", type=str, nargs='?',
                         help="""Output archive to which the
-                        recording-level matrix will be written in text
+                        recording-level matrix will be written in binary
                         format""")
 
     args = parser.parse_args()
 
+    if args.benchmark is None and (
+            args.reco2num_frames is None or args.out_targets_ark is None):
+        parser.error("--reco2num-frames and the arguments <reco2utt> "
+                     "<segments> <targets-scp> <out-targets-ark> are "
+                     "required (unless --benchmark is given)")
+
+    if args.batch_size < 1:
+        raise ValueError("--batch-size should be positive; got {0}"
+                         "".format(args.batch_size))
+
     if args.frame_shift < 0.0001 or args.frame_shift > 1:
         raise ValueError("--frame-shift should be in [0.0001, 1]; got {0}"
                          "".format(args.frame_shift))
@@ -123,19 +162,26 @@ def read_segments_file(segments_file, reco2utt):
     return segments
 
 
-def read_targets_scp(targets_scp, segments):
-    # Read the SCP file containing targets
+def read_targets_in_archive_order(targets_reader, utts):
+    """Reads the targets matrices of 'utts' from targets_reader (a
+    kaldi_io.ScpReader) in the order in which they are stored in the
+    archives, so that the archives are read sequentially.
+    Returns a dict from utterance-id to matrix."""
+    locations = []
+    for utt in utts:
+        filename, offset = targets_reader.location(utt)
+        locations.append((filename, -1 if offset is None else offset, utt))
+    locations.sort()
+
     targets = {}
-    with common_lib.smart_open(targets_scp) as fh:
-        for line in fh:
-            parts = line.strip().split()
-            if len(parts) != 2:
-                raise ValueError("Could not parse line {0} in "
-                                 "targets scp file".format(line, targets_scp))
-            utt = parts[0]
-            if utt not in segments:
-                continue
-            targets[utt] = parts[1]
+    for filename, offset, utt in locations:
+        try:
+            targets[utt] = targets_reader[utt]
+        except Exception:
+            logger.error("Failed to read targets for utterance {utt} from "
+                         "{rxfilename}".format(
+                             utt=utt, rxfilename=targets_reader.entries[utt]))
+            raise
     return targets
 
 
@@ -143,11 +189,11 @@ def run(args):
     reco2utt = read_reco2utt_file(args.reco2utt)
     reco2num_frames = read_reco2num_frames_file(args.reco2num_frames)
     segments = read_segments_file(args.segments, reco2utt)
-    targets = read_targets_scp(args.targets_scp, segments)
+    targets_reader = kaldi_io.ScpReader(args.targets_scp)
 
     if args.default_targets is not None:
         # Read the vector of default targets for out-of-segment regions
-        default_targets = np.matrix(
+        default_targets = np.array(
             common_lib.read_matrix_ascii(args.default_targets))
     else:
         default_targets = np.zeros([1, 3])
@@ -158,8 +204,19 @@ def run(args):
     num_utt = 0
     num_reco = 0
 
-    with common_lib.smart_open(args.out_targets_ark, 'w') as fh:
-        for reco, utts in reco2utt.items():
+    recos = list(reco2utt.keys())
+    targets_writer = kaldi_io.open_or_fd(args.out_targets_ark, 'wb')
+    for batch_start in range(0, len(recos), args.batch_size):
+        batch_recos = recos[batch_start:(batch_start + args.batch_size)]
+        # Read the targets of all the utterances of this batch of recordings
+        # at once, grouped by archive.
+        targets = read_targets_in_archive_order(
+            targets_reader, [utt for reco in batch_recos
+                             for utt in reco2utt[reco]
+                             if utt in segments and utt in targets_reader])
+
+        for reco in batch_recos:
+            utts = reco2utt[reco]
             # Read a recording and the list of its utterances from the
             # reco2utt dictionary
             reco_mat = np.repeat(default_targets, reco2num_frames[reco],
@@ -173,27 +230,7 @@ def run(args):
                     num_utt_err += 1
                     continue
                 segment = segments[utt]
-
-                # Read the targets corresponding to the segments
-                cmd = ("copy-feats --binary=false {mat_fn} -"
-                       "".format(mat_fn=targets[utt]))
-                p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-
-                try:
-                    mat = np.matrix(common_lib.read_matrix_ascii(p.stdout),
-                                    dtype='float32')
-                except Exception:
-                    logger.error("Command '{cmd}' failed".format(cmd=cmd))
-                    raise
-                finally:
-                    [stdout, stderr] = p.communicate()
-                    if p.returncode is not None and p.returncode != 0:
-                        raise RuntimeError(
-                            'Command "{cmd}" failed with status {status}; '
-                            'stderr = {stderr}'.format(cmd=cmd, status=-p.returncode,
-                                                       stderr=stderr))
-
+                mat = targets[utt]
                 start_frame = int(segment[1] / args.frame_shift + 0.5)
                 end_frame = int(segment[2] / args.frame_shift + 0.5)
                 num_frames = end_frame - start_frame
@@ -243,11 +280,12 @@ def run(args):
                     # Combine targets using a weighted interpolation using a
                     # triangular window with a weight of 1 at the start/end of
                     # overlap and 0 at the end/start of the segment
-                    for n in range(0, end_frame_accounted - start_frame):
-                        w = float(n) / float(end_frame_accounted - start_frame)
-                        reco_mat[n + start_frame, :] = (
-                            reco_mat[n + start_frame, :] * (1.0 - w)
-                            + mat[n, :] * w)
+                    overlap = end_frame_accounted - start_frame
+                    w = (np.arange(overlap, dtype=np.float64)
+                         / float(overlap))[:, np.newaxis]
+                    reco_mat[start_frame:end_frame_accounted, :] = (
+                        reco_mat[start_frame:end_frame_accounted, :]
+                        * (1.0 - w) + mat[0:overlap, :] * w)
 
                     if end_frame > end_frame_accounted:
                         reco_mat[end_frame_accounted:end_frame, :] = (
@@ -266,9 +304,14 @@ def run(args):
                 num_utt += 1
 
             if reco_mat.shape[0] > 0:
-                common_lib.write_matrix_ascii(fh, reco_mat,
-                                              key=reco)
+                kaldi_io.write_mat(targets_writer,
+                                   reco_mat.astype(np.float32), key=reco)
                 num_reco += 1
+    targets_writer.flush()
+    # the matrices are views of the memory-mapped archives, which can only be
+    # closed once they are released.
+    targets = mat = None
+    targets_reader.close()
 
     logger.info("Merged {num_utt} segment targets from {num_reco} recordings; "
                 "failed with {num_utt_err} utterances"
@@ -279,10 +322,93 @@ def run(args):
         raise RuntimeError
 
 
+def make_synthetic_data_dir(dir, num_recos, frame_shift):
+    """Creates the files reco2utt, segments, reco2num_frames and
+    targets.{ark,scp} of a synthetic data directory in 'dir' for
+    run_benchmark().  Each recording has 10 segments of 1 to 5 seconds, about
+    a quarter of which overlap with the previous one."""
+    rng = np.random.RandomState(0)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    targets_writer = kaldi_io.ArkScpWriter(
+        os.path.join(dir, 'targets.ark'), os.path.join(dir, 'targets.scp'))
+    with open(os.path.join(dir, 'reco2utt'), 'w') as reco2utt_fh, \
+            open(os.path.join(dir, 'segments'), 'w') as segments_fh, \
+            open(os.path.join(dir, 'reco2num_frames'), 'w') as num_frames_fh:
+        for r in range(num_recos):
+            reco = 'reco{0:05d}'.format(r)
+            utts = []
+            end_time = 0.0
+            for i in range(10):
+                start_time = round(max(0.0, end_time
+                                       + rng.uniform(-0.3, 1.0)), 2)
+                end_time = round(start_time + rng.uniform(1.0, 5.0), 2)
+                utt = '{0}-{1:03d}'.format(reco, i)
+                num_frames = (int(end_time / frame_shift + 0.5)
+                              - int(start_time / frame_shift + 0.5))
+                targets_writer.write_mat(
+                    utt, rng.rand(num_frames, 3).astype(np.float32))
+                print("{0} {1} {2:.2f} {3:.2f}".format(
+                    utt, reco, start_time, end_time), file=segments_fh)
+                utts.append(utt)
+            print("{0} {1}".format(reco, ' '.join(utts)), file=reco2utt_fh)
+            print("{0} {1}".format(
+                reco, int(end_time / frame_shift + 0.5) + 100),
+                  file=num_frames_fh)
+    targets_writer.close()
+
+
+def run_benchmark(args):
+    """Merges the targets of a synthetic data directory created in
+    args.benchmark and logs the speed.  If copy-feats is on the PATH, it also
+    times reading the targets with one 'copy-feats --binary=false' process
+    per utterance, as this script used to do, on the first 100
+    utterances."""
+    dir = args.benchmark
+    make_synthetic_data_dir(dir, args.benchmark_num_recordings,
+                            args.frame_shift)
+    args.reco2utt = os.path.join(dir, 'reco2utt')
+    args.segments = os.path.join(dir, 'segments')
+    args.reco2num_frames = os.path.join(dir, 'reco2num_frames')
+    args.targets_scp = os.path.join(dir, 'targets.scp')
+    args.out_targets_ark = os.path.join(dir, 'merged_targets.ark')
+    num_utts = 10 * args.benchmark_num_recordings
+
+    start_time = time.time()
+    run(args)
+    elapsed = time.time() - start_time
+    logger.info("Merged the targets of {num_utts} utterances in {t:.2f} s "
+                "({speed:.0f} utts/sec)".format(num_utts=num_utts, t=elapsed,
+                                                speed=num_utts / elapsed))
+
+    if which('copy-feats') is None:
+        logger.info("copy-feats is not on the PATH, so reading the targets "
+                    "with one copy-feats process per utterance was not timed")
+        return
+    with open(args.targets_scp) as fh:
+        rxfilenames = [line.split(None, 1)[1].strip()
+                       for line in fh][:100]
+    start_time = time.time()
+    for rxfilename in rxfilenames:
+        p = subprocess.Popen("copy-feats --binary=false {0} -".format(
+            rxfilename), shell=True, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+        common_lib.read_matrix_ascii(p.stdout)
+        p.communicate()
+    elapsed = time.time() - start_time
+    logger.info("Reading the targets with one copy-feats process per "
+                "utterance took {t:.2f} s for {n} utterances ({speed:.0f} "
+                "utts/sec)".format(t=elapsed, n=len(rxfilenames),
+                                   speed=len(rxfilenames) / elapsed))
+
+
 def main():
     args = get_args()
     try:
-        run(args)
+        if args.benchmark is not None:
+            run_benchmark(args)
+        else:
+            run(args)
     except Exception:
         raise
 
@@ -8,12 +8,13 @@ This script merges targets created from multiple sources (systems) into
 single targets matrices.
 
 Usage: merge_targets.py [options] <pasted-targets> <out-targets>
- e.g.: paste-feats scp:targets1.scp scp:targets2.scp ark,t:- | merge_targets.py --dim=3 - - | copy-feats ark,t:- ark:-
+ e.g.: paste-feats scp:targets1.scp scp:targets2.scp ark:- | merge_targets.py --dim=3 - - | copy-feats ark:- ark:-
 
 <pasted-targets> is matrix archive with matrices corresponding to
 targets from multiple sources appended together using paste-feats.
 The column dimension is num-sources * dim, which dim is specified by --dim
-option.
+option.  It may be in binary or text format; <out-targets> is written in
+binary format.
 """
 
 import argparse
@@ -23,6 +24,7 @@ import sys
 
 sys.path.insert(0, 'steps')
 import libs.common as common_lib
+import libs.kaldi_io as kaldi_io
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -40,7 +42,7 @@ def get_args():
     This script merges targets created from multiple sources (systems) into
     single targets matrices.
     Usage: merge_targets.py [options] <pasted-targets> <out-targets>
-     e.g.: paste-feats scp:targets1.scp scp:targets2.scp ark,t:- | merge_targets.py --dim=3 - - | copy-feats ark,t:- ark:-
+     e.g.: paste-feats scp:targets1.scp scp:targets2.scp ark:- | merge_targets.py --dim=3 - - | copy-feats ark:- ark:-
     """,
         formatter_class=argparse.RawTextHelpFormatter)
 
@@ -157,43 +159,93 @@ def should_remove_frame(row, dim):
     return False
 
 
+def get_frames_to_remove(mat, dim):
+    """Returns a boolean array with one element per row of 'mat', which is
+    True for the frames that need to be removed.  This is a vectorized
+    version of should_remove_frame(), which it gives the same results as;
+    see that function for the rules.
+
+    Input:
+        mat -- a numpy array of shape (num-frames, num-sources x dim)
+        dim -- Usually 3.
+    """
+    assert mat.shape[1] % dim == 0
+    num_frames = mat.shape[0]
+    num_sources = mat.shape[1] // dim
+    frames = np.arange(num_frames)
+
+    max_idx = np.argmax(mat, axis=1)
+    max_val = mat[frames, max_idx]
+    best_source = max_idx // dim
+    best_class = max_idx % dim
+
+    # Shape (num-frames, num-sources): the argmax over the scores of each
+    # source, the corresponding score and whether it is > 0.5.
+    per_source = mat.reshape(num_frames, num_sources, dim)
+    source_class = np.argmax(per_source, axis=2)
+    source_val = np.take_along_axis(
+        per_source, source_class[:, :, np.newaxis], axis=2)[:, :, 0]
+    confident_in_source = source_val > 0.5
+
+    # A source other than the 'best_source' that we are confident in, but
+    # whose best class is not the 'best_class', is a mismatch.
+    mismatch = confident_in_source & (source_class
+                                      != best_class[:, np.newaxis])
+    mismatch[frames, best_source] = False
+
+    return ((max_val < 0.5)
+            | ((np.sum(confident_in_source, axis=1) != 1)
+               & np.any(mismatch, axis=1)))
+
+
+def round_like_text(mat):
+    """Returns 'mat' rounded to 6 decimals the same way as "{0:f}".format()
+    does, i.e. as the targets were when they were written in text format
+    with common_lib.write_matrix_ascii().  np.round() can round the
+    other way when the value is within rounding error of a tie, so those
+    elements are formatted and parsed.
+    """
+    scaled = mat * 1e6
+    out = np.round(scaled) / 1e6
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-3
+    out[near_tie] = [float("{0:f}".format(x)) for x in mat[near_tie]]
+    return out
+
+
 def run(args):
     num_done = 0
 
-    with common_lib.smart_open(args.pasted_targets) as targets_reader, \
-            common_lib.smart_open(args.out_targets, 'w') as targets_writer:
-        for key, mat in common_lib.read_mat_ark(targets_reader):
-            mat = np.matrix(mat)
-            if mat.shape[1] % args.dim != 0:
-                raise RuntimeError(
-                    "For utterance {utt} in {f}, num-columns {nc} "
-                    "is not a multiple of dim {dim}"
-                    "".format(utt=key, f=args.pasted_targets.name,
-                              nc=mat.shape[1], dim=args.dim))
-            num_sources = mat.shape[1] // args.dim
-
-            out_mat = np.matrix(np.zeros([mat.shape[0], args.dim]))
-
-            if args.remove_mismatch_frames:
-                for n in range(mat.shape[0]):
-                    if should_remove_frame(mat[n, :].getA()[0], args.dim):
-                        out_mat[n, :] = np.zeros([1, args.dim])
-                    else:
-                        for i in range(num_sources):
-                            out_mat[n, :] += (
-                                mat[n, (i * args.dim) : ((i+1) * args.dim)]
-                                * (1.0 if args.weights is None
-                                   else args.weights[i]))
-            else:
-                # Just interpolate the targets
-                for i in range(num_sources):
-                    out_mat += (
-                        mat[:, (i * args.dim) : ((i+1) * args.dim)]
-                        * (1.0 if args.weights is None else args.weights[i]))
-
-            common_lib.write_matrix_ascii(targets_writer, out_mat.tolist(),
-                                          key=key)
-            num_done += 1
+    targets_writer = kaldi_io.open_or_fd(args.out_targets, 'wb')
+    for key, mat in kaldi_io.read_mat_ark(args.pasted_targets,
+                                          text_dtype=np.float64):
+        # The computation is done in double precision, as it was when the
+        # targets were read with common_lib.read_mat_ark(); text-format
+        # targets are read with all their digits, for the same reason.
+        mat = np.asarray(mat, dtype=np.float64)
+        if mat.shape[1] % args.dim != 0:
+            raise RuntimeError(
+                "For utterance {utt} in {f}, num-columns {nc} "
+                "is not a multiple of dim {dim}"
+                "".format(utt=key, f=args.pasted_targets,
+                          nc=mat.shape[1], dim=args.dim))
+        num_sources = mat.shape[1] // args.dim
+
+        # Interpolate the targets; the sources are added one at a time so that
+        # the result is the same as adding the rows one by one.
+        out_mat = np.zeros([mat.shape[0], args.dim])
+        for i in range(num_sources):
+            out_mat += (
+                mat[:, (i * args.dim) : ((i+1) * args.dim)]
+                * (1.0 if args.weights is None else args.weights[i]))
+
+        if args.remove_mismatch_frames:
+            out_mat[get_frames_to_remove(mat, args.dim), :] = 0.0
+
+        kaldi_io.write_mat(targets_writer,
+                           round_like_text(out_mat).astype(np.float32),
+                           key=key)
+        num_done += 1
+    targets_writer.flush()
 
     logger.info("Merged {num_done} target matrices"
                 "".format(num_done=num_done))
@@ -4,9 +4,9 @@
 # Apache 2.0
 
 """
-This script reads a Kaldi text archive of matrices from 'targets_in_ark' (e.g.
+This script reads a Kaldi archive of matrices from 'targets_in_ark' (e.g.
 '-' for standard input), modifies them by subsampling them, and writes the
-modified archive to 'targets_out_ark'.
+modified archive to 'targets_out_ark' in binary format.
 This form of 'subsampling' is similar to taking every n'th frame (specifically:
 every n'th row), except that we average over blocks of size 'n' instead of
 taking every n'th element.
@@ -20,7 +20,7 @@ import numpy as np
 import sys
 
 sys.path.insert(0, 'steps')
-import libs.common as common_lib
+import libs.kaldi_io as kaldi_io
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -35,9 +35,9 @@ logger.addHandler(handler)
 def get_args():
     parser = argparse.ArgumentParser(
         description="""
-This script reads a Kaldi text archive of matrices from 'targets_in_ark' (e.g.
+This script reads a Kaldi archive of matrices from 'targets_in_ark' (e.g.
 '-' for standard input), modifies them by subsampling them, and writes the
-modified archive to 'targets_out_ark'.
+modified archive to 'targets_out_ark' in binary format.
 This form of 'subsampling' is similar to taking every n'th frame (specifically:
 every n'th row), except that we average over blocks of size 'n' instead of
 taking every n'th element.
@@ -49,9 +49,9 @@ it subsamples by averaging.""")
     parser.add_argument("--verbose", type=int, default=0, choices=[0,1,2],
                         help="Verbose level")
 
-    parser.add_argument("targets_in_ark", type=argparse.FileType('r'),
+    parser.add_argument("targets_in_ark", type=str,
                         help="Input targets archive")
-    parser.add_argument("targets_out_ark", type=argparse.FileType('w'),
+    parser.add_argument("targets_out_ark", type=str,
                         help="Output targets archive")
 
     args = parser.parse_args()
@@ -69,11 +69,11 @@ it subsamples by averaging.""")
 
 def run(args):
     num_utts = 0
-    for key, mat in common_lib.read_mat_ark(args.targets_in_ark):
-        mat = np.matrix(mat)
+    targets_writer = kaldi_io.open_or_fd(args.targets_out_ark, 'wb')
+    for key, mat in kaldi_io.read_mat_ark(args.targets_in_ark):
         if args.subsampling_factor > 0:
             num_indexes = ((mat.shape[0] + args.subsampling_factor - 1)
-                            / args.subsampling_factor)
+                            // args.subsampling_factor)
 
         out_mat = np.zeros([num_indexes, mat.shape[1]])
         i = 0
@@ -93,13 +93,13 @@ def run(args):
                 logger.error("mat.shape = {0}, st = {1}, end = {2}"
                              "".format(mat.shape, st, end))
                 raise
-            assert i == k / args.subsampling_factor
+            assert i == k // args.subsampling_factor
             i += 1
 
-        common_lib.write_matrix_ascii(args.targets_out_ark, out_mat, key=key)
+        kaldi_io.write_mat(targets_writer, out_mat.astype(np.float32),
+                           key=key)
         num_utts += 1
-    args.targets_in_ark.close()
-    args.targets_out_ark.close()
+    targets_writer.flush()
 
     logger.info("Sub-sampled {num_utts} target matrices"
                 "".format(num_utts=num_utts))
@@ -112,10 +112,6 @@ def main():
     except Exception as e:
         logger.error("Script failed; traceback = ", exc_info=True)
         raise SystemExit(1)
-    finally:
-        for f in [args.targets_in_ark, args.targets_out_ark]:
-            if f is not None:
-                f.close()
 
 
 if __name__ == "__main__":
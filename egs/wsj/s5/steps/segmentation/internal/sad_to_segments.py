@@ -6,7 +6,7 @@
 
 """
 This script converts frame-level speech activity detection marks (in kaldi
-integer vector text archive format) into kaldi segments and utt2spk.
+integer vector archive format, binary or text) into kaldi segments and utt2spk.
 The input integer vectors are expected to contain '1' for silence frames
 and '2' for speech frames.
 """
@@ -14,10 +14,19 @@ and '2' for speech frames.
 from __future__ import print_function
 import argparse
 import logging
+import multiprocessing
 import sys
+from collections import deque
+import numpy as np
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 sys.path.insert(0, 'steps')
 import libs.common as common_lib
+import libs.kaldi_io as kaldi_io
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -35,7 +44,7 @@ def get_args():
     parser = argparse.ArgumentParser(
         description="""
 This script converts frame-level speech activity detection marks (in kaldi
-integer vector text archive format) into kaldi segments and utt2spk.
+integer vector archive format, binary or text) into kaldi segments and utt2spk.
 The input integer vectors are expected to contain 1 for silence frames
 and 2 for speech frames.
 """,
@@ -67,9 +76,15 @@ and 2 for speech frames.
                              "This is after padding by --segment-padding seconds."
                              "0 means do not merge. Use 'inf' to not limit the duration.")
 
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="Number of processes used to segment the "
+                             "recordings. The output is in the same order "
+                             "as the input.")
+
     parser.add_argument("in_sad", type=str,
                         help="Input file containing alignments in "
-                             "text archive format")
+                             "binary or text archive format, e.g. "
+                             "'ark:gunzip -c ali.1.gz |'")
 
     parser.add_argument("out_segments", type=str,
                         help="Output kaldi segments file")
@@ -81,6 +96,10 @@ and 2 for speech frames.
 
     logger.info("Setting verbosity to {0}".format(global_verbose))
 
+    if args.num_workers < 1:
+        raise ValueError("--num-workers must be positive; got {0}".format(
+            args.num_workers))
+
     if args.verbose >= 3:
         logger.setLevel(logging.DEBUG)
         handler.setLevel(logging.DEBUG)
@@ -136,60 +155,61 @@ class SegmenterStats(object):
             final_duration=self.final_duration))
 
 
-def process_label(text_label):
-    """Processes an input integer label and returns a 1 or 2,
-    where 1 is for silence and 2 is for speech.
-
-    Arguments:
-        text_label -- input label (must be integer)
-    """
-    prev_label = int(text_label)
-    if prev_label not in [1, 2]:
-        raise ValueError("Expecting label to 1 (non-speech) or 2 (speech); "
-                         "got {}".format(prev_label))
-
-    return prev_label
-
-
 class Segmentation(object):
-    """Stores segmentation for an utterances"""
+    """Stores segmentation for an utterances, as a run-length representation:
+    numpy arrays 'starts' and 'ends' (in seconds) and 'labels' of the
+    segments, in order of time.  All the post-processing stages are done on
+    whole arrays."""
 
     def __init__(self):
-        self.segments = None
+        self.starts = None
+        self.ends = None
+        self.labels = None
         self.stats = SegmenterStats()
 
+    @property
+    def segments(self):
+        """The segments as a list of [start, end, label] triples."""
+        return [list(x) for x in zip(self.starts.tolist(), self.ends.tolist(),
+                                     self.labels.tolist())]
+
+    def _keep(self, mask):
+        self.starts = self.starts[mask]
+        self.ends = self.ends[mask]
+        self.labels = self.labels[mask]
+
     def initialize_segments(self, alignment, frame_shift=0.01):
         """Initializes segments from input alignment.
         The alignment is frame-level speech-activity detection marks,
         each of which must be 1 or 2."""
-        self.segments = []
+        alignment = np.asarray(alignment)
+        if alignment.dtype.kind not in 'iu':
+            alignment = alignment.astype(np.int64)
 
         assert len(alignment) > 0
 
-        prev_label = None
-        prev_length = 0
-        for i, text_label in enumerate(alignment):
-            if prev_label is not None and int(text_label) != prev_label:
-                if prev_label == 2:
-                    self.segments.append(
-                        [float(i - prev_length) * frame_shift,
-                         float(i) * frame_shift, prev_label])
-                    self.stats.initial_duration += (prev_length * frame_shift)
-                prev_label = process_label(text_label)
-                prev_length = 0
-            elif prev_label is None:
-                prev_label = process_label(text_label)
-
-            prev_length += 1
-
-        if prev_length > 0 and prev_label == 2:
-            self.segments.append(
-                [float(len(alignment) - prev_length) * frame_shift,
-                 float(len(alignment)) * frame_shift, prev_label])
-            self.stats.initial_duration += (prev_length * frame_shift)
-
-        self.stats.num_segments_initial = len(self.segments)
-        self.stats.num_segments_final = len(self.segments)
+        if not np.all((alignment == 1) | (alignment == 2)):
+            bad_labels = np.unique(alignment[(alignment != 1)
+                                             & (alignment != 2)])
+            raise ValueError("Expecting label to 1 (non-speech) or 2 (speech); "
+                             "got {}".format(bad_labels[0]))
+
+        # The frame indexes where each run of identical labels starts and ends.
+        run_starts = np.concatenate(
+            [[0], np.flatnonzero(alignment[1:] != alignment[:-1]) + 1])
+        run_ends = np.append(run_starts[1:], len(alignment))
+        speech = alignment[run_starts] == 2
+        run_starts = run_starts[speech]
+        run_ends = run_ends[speech]
+
+        self.starts = run_starts.astype(np.float64) * frame_shift
+        self.ends = run_ends.astype(np.float64) * frame_shift
+        self.labels = np.full(len(run_starts), 2, dtype=np.int32)
+        self.stats.initial_duration += _sequential_sum(
+            (run_ends - run_starts) * frame_shift)
+
+        self.stats.num_segments_initial = len(self.starts)
+        self.stats.num_segments_final = len(self.starts)
         self.stats.final_duration = self.stats.initial_duration
 
     def filter_short_segments(self, min_dur):
@@ -197,17 +217,13 @@ class Segmentation(object):
         if min_dur <= 0:
             return
 
-        segments_kept = []
-        for segment in self.segments:
-            assert segment[2] == 2, segment
-            dur = segment[1] - segment[0]
-            if dur < min_dur:
-                self.stats.filter_short_duration += dur
-                self.stats.num_short_segments_filtered += 1
-            else:
-                segments_kept.append(segment)
-        self.segments = segments_kept
-        self.stats.num_segments_final = len(self.segments)
+        assert np.all(self.labels == 2)
+        durs = self.ends - self.starts
+        short = durs < min_dur
+        self.stats.filter_short_duration += _sequential_sum(durs[short])
+        self.stats.num_short_segments_filtered += int(np.sum(short))
+        self._keep(~short)
+        self.stats.num_segments_final = len(self.starts)
         self.stats.final_duration -= self.stats.filter_short_duration
 
     def pad_speech_segments(self, segment_padding, max_duration=float("inf")):
@@ -216,73 +232,146 @@ class Segmentation(object):
         or the duration of the utterance 'max_duration'."""
         if max_duration == None:
             max_duration = float("inf")
-        for i, segment in enumerate(self.segments):
-            assert segment[2] == 2, segment
-            segment[0] -= segment_padding  # try adding padding on the left side
-            self.stats.padding_duration += segment_padding
-            if segment[0] < 0.0:
-                # Padding takes the segment start to before the beginning of the utterance.
-                # Reduce padding.
-                self.stats.padding_duration += segment[0]
-                segment[0] = 0.0
-            if i >= 1 and self.segments[i - 1][1] > segment[0]:
-                # Padding takes the segment start to before the end the previous segment.
-                # Reduce padding.
-                self.stats.padding_duration -= (
-                        self.segments[i - 1][1] - segment[0])
-                segment[0] = self.segments[i - 1][1]
-
-            segment[1] += segment_padding
-            self.stats.padding_duration += segment_padding
-            if segment[1] >= max_duration:
-                # Padding takes the segment end beyond the max duration of the utterance.
-                # Reduce padding.
-                self.stats.padding_duration -= (segment[1] - max_duration)
-                segment[1] = max_duration
-            if (i + 1 < len(self.segments)
-                    and segment[1] > self.segments[i + 1][0]):
-                # Padding takes the segment end beyond the start of the next segment.
-                # Reduce padding.
-                self.stats.padding_duration -= (
-                        segment[1] - self.segments[i + 1][0])
-                segment[1] = self.segments[i + 1][0]
+        if len(self.starts) == 0:
+            return
+        assert np.all(self.labels == 2)
+
+        # The end of a segment is limited by the original start of the next
+        # segment, and the start by the padded end of the previous one.
+        ends = self.ends + segment_padding
+        ends = np.where(ends >= max_duration, max_duration, ends)
+        next_starts = self.starts[1:]
+        ends[:-1] = np.where(ends[:-1] > next_starts, next_starts, ends[:-1])
+
+        starts = self.starts - segment_padding
+        starts = np.where(starts < 0.0, 0.0, starts)
+        prev_ends = ends[:-1]
+        starts[1:] = np.where(prev_ends > starts[1:], prev_ends, starts[1:])
+
+        self.stats.padding_duration += _sequential_sum(
+            (self.starts - starts) + (ends - self.ends))
+        self.starts = starts
+        self.ends = ends
         self.stats.final_duration += self.stats.padding_duration
 
     def merge_consecutive_segments(self, max_dur):
         """Merge consecutive segments (happens after padding), provided that
         the merged segment is no longer than 'max_dur'."""
-        if max_dur <= 0 or not self.segments:
+        if max_dur <= 0 or len(self.starts) == 0:
             return
-
-        merged_segments = [self.segments[0]]
-        for segment in self.segments[1:]:
-            assert segment[2] == 2, segment
-            if segment[0] == merged_segments[-1][1] and \
-                    segment[1] - merged_segments[-1][0] <= max_dur:
-                # The segment starts at the same time the last segment ends,
-                # and the merged segment is shorter than 'max_dur'.
-                # Extend the previous segment.
-                merged_segments[-1][1] = segment[1]
-                self.stats.num_merges += 1
-            else:
-                merged_segments.append(segment)
-
-        self.segments = merged_segments
-        self.stats.num_segments_final = len(self.segments)
+        assert np.all(self.labels == 2)
+
+        # touching[i] is True if segment i starts where segment i-1 ends;
+        # only such segments can be merged into the previous one.
+        touching = np.zeros(len(self.starts), dtype=bool)
+        touching[1:] = self.starts[1:] == self.ends[:-1]
+
+        if max_dur == float("inf"):
+            # Every run of touching segments becomes one segment.
+            group_starts = np.flatnonzero(~touching)
+        else:
+            # Within a run of touching segments, segments are added to the
+            # current merged segment while it is no longer than 'max_dur';
+            # ends[i] - starts[first] increases with i, so we can search
+            # for the first segment that does not fit.
+            run_ends = np.append(np.flatnonzero(~touching)[1:],
+                                 len(self.starts))
+            group_starts = []
+            for run_start, run_end in zip(np.flatnonzero(~touching).tolist(),
+                                          run_ends.tolist()):
+                first = run_start
+                while first < run_end:
+                    group_starts.append(first)
+                    first = _first_exceeding(self.ends, self.starts[first],
+                                             max_dur, first + 1, run_end)
+            group_starts = np.array(group_starts, dtype=np.int64)
+
+        group_ends = np.append(group_starts[1:], len(self.starts)) - 1
+        self.stats.num_merges += len(self.starts) - len(group_starts)
+        self.starts = self.starts[group_starts]
+        self.ends = self.ends[group_ends]
+        self.labels = self.labels[group_starts]
+        self.stats.num_segments_final = len(self.starts)
 
     def write(self, key, file_handle):
         """Write segments to file"""
         if global_verbose >= 2:
             logger.info("For key {key}, got stats {stats}".format(
                 key=key, stats=self.stats))
-        for segment in self.segments:
+        for start, end in zip(self.starts.tolist(), self.ends.tolist()):
             seg_id = "{key}-{st:07d}-{end:07d}".format(
-                key=key, st=int(segment[0] * 100), end=int(segment[1] * 100))
+                key=key, st=int(start * 100), end=int(end * 100))
             print("{seg_id} {key} {st:.2f} {end:.2f}".format(
-                seg_id=seg_id, key=key, st=segment[0], end=segment[1]),
+                seg_id=seg_id, key=key, st=start, end=end),
                 file=file_handle)
 
 
+def _sequential_sum(values):
+    """Returns the sum of 'values' added from left to right, like a python
+    loop would (np.sum() adds pairwise, which can differ in the last bits)."""
+    if len(values) == 0:
+        return 0.0
+    return float(np.cumsum(values)[-1])
+
+
+def _first_exceeding(ends, start, max_dur, begin, end):
+    """Returns the first index i in [begin, end) for which
+    ends[i] - start > max_dur, or 'end' if there is none.  ends[i] - start
+    must be non-decreasing in i."""
+    while begin < end:
+        middle = (begin + end) // 2
+        if ends[middle] - start <= max_dur:
+            begin = middle + 1
+        else:
+            end = middle
+    return begin
+
+
+def segment_utterance(utt_id, alignment, args, utt2dur):
+    """Does all the post-processing for one utterance; returns its segments
+    in the format of the output file, and the Segmentation's stats."""
+    segmentation = Segmentation()
+    segmentation.initialize_segments(alignment, args.frame_shift)
+    segmentation.filter_short_segments(args.min_segment_dur)
+    segmentation.pad_speech_segments(args.segment_padding,
+                                     None if args.utt2dur is None
+                                     else utt2dur[utt_id])
+    segmentation.merge_consecutive_segments(args.merge_consecutive_max_dur)
+    out = StringIO()
+    segmentation.write(utt_id, out)
+    return out.getvalue(), segmentation.stats
+
+
+# These are set in the worker processes by init_worker().
+_worker_args = None
+_worker_utt2dur = None
+
+
+def init_worker(args, utt2dur):
+    global _worker_args, _worker_utt2dur, global_verbose
+    _worker_args = args
+    _worker_utt2dur = utt2dur
+    global_verbose = args.verbose
+
+
+def segment_utterance_in_worker(utt_and_alignment):
+    return segment_utterance(utt_and_alignment[0], utt_and_alignment[1],
+                             _worker_args, _worker_utt2dur)
+
+
+def _bounded_imap(pool, func, iterable, max_in_flight):
+    """Like pool.imap(func, iterable), but with at most 'max_in_flight' items
+    sent to the workers at a time, so that a long input (e.g. the alignments
+    of many long recordings) is not all read into memory at once."""
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
 def run(args):
     """The main function that does everything."""
     utt2dur = {}
@@ -296,27 +385,25 @@ def run(args):
                 utt2dur[parts[0]] = float(parts[1])
 
     global_stats = SegmenterStats()
-    with common_lib.smart_open(args.in_sad) as in_sad_fh, \
-            common_lib.smart_open(args.out_segments, 'w') as out_segments_fh:
-        for line in in_sad_fh:
-            parts = line.strip().split()
-            utt_id = parts[0]
-
-            if len(parts) < 2:
-                raise RuntimeError("Unable to parse line '{0}' in {1}"
-                                   "".format(line.strip(),
-                                             in_sad_fh))
-
-            segmentation = Segmentation()
-            segmentation.initialize_segments(
-                parts[1:], args.frame_shift)
-            segmentation.filter_short_segments(args.min_segment_dur)
-            segmentation.pad_speech_segments(args.segment_padding,
-                                             None if args.utt2dur is None
-                                             else utt2dur[utt_id])
-            segmentation.merge_consecutive_segments(args.merge_consecutive_max_dur)
-            segmentation.write(utt_id, out_segments_fh)
-            global_stats.add(segmentation.stats)
+    alignments = kaldi_io.read_vec_int_ark(args.in_sad)
+    pool = None
+    if args.num_workers > 1:
+        pool = multiprocessing.Pool(args.num_workers, initializer=init_worker,
+                                    initargs=(args, utt2dur))
+        results = _bounded_imap(pool, segment_utterance_in_worker, alignments,
+                                4 * args.num_workers)
+    else:
+        results = (segment_utterance(utt_id, alignment, args, utt2dur)
+                   for utt_id, alignment in alignments)
+    try:
+        with common_lib.smart_open(args.out_segments, 'w') as out_segments_fh:
+            for segments_str, stats in results:
+                out_segments_fh.write(segments_str)
+                global_stats.add(stats)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
     logger.info(global_stats)
 
 
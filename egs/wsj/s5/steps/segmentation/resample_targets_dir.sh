@@ -73,11 +73,11 @@ if [ $subsampling_factor -eq 1 ]; then
   cp $targets_dir/frame_subsampling_factor $dir || true
 elif [ $subsampling_factor -gt 1 ]; then
   $cmd JOB=1:$nj $dir/log/resample_targets.JOB.log \
-    copy-feats scp:$targets_dir/split${nj}/targets.JOB.scp ark,t:- \| \
+    copy-feats scp:$targets_dir/split${nj}/targets.JOB.scp ark:- \| \
     steps/segmentation/internal/resample_targets.py \
       --subsampling-factor=$subsampling_factor \
       - - \| \
-    copy-feats ark,t:- ark,scp:$dir/targets.JOB.ark,$dir/targets.JOB.scp || exit 1
+    copy-feats ark:- ark,scp:$dir/targets.JOB.ark,$dir/targets.JOB.scp || exit 1
 
   perl -e "print $frame_subsampling_factor * $subsampling_factor" > \
     $dir/frame_subsampling_factor || exit 1
@@ -17,8 +17,15 @@ from __future__ import unicode_literals, division
 import sys
 import codecs
 import io
+import os
 import argparse
 import re
+import json
+import heapq
+import hashlib
+import itertools
+import multiprocessing
+from collections import deque, OrderedDict
 
 # hack for python2/3 compatibility
 from io import open
@@ -26,7 +33,8 @@ argparse.open = open
 
 class BPE(object):
 
-    def __init__(self, codes, merges=-1, separator='@@', vocab=None, glossaries=None):
+    def __init__(self, codes, merges=-1, separator='@@', vocab=None, glossaries=None,
+                 cache_size=-1):
 
         codes.seek(0)
 
@@ -57,7 +65,23 @@ class BPE(object):
 
         self.glossaries = glossaries if glossaries else []
 
-        self.cache = {}
+        # maps whitespace-separated words to their segmented form, i.e. the
+        # subword units joined by spaces, with the separator attached.
+        self.cache = WordCache(cache_size)
+
+        # if not None, words that were not found in the cache are appended
+        # to this list as (word, segmented_word) pairs; in multi-process
+        # mode this is how the workers return them to the main process.
+        self.new_entries = None
+
+    def fingerprint(self):
+        """Return a string identifying everything that the segmentation of a
+        word depends on; a saved cache is only reused if this matches."""
+        codes = sorted(self.bpe_codes.items(), key=lambda x: x[1])
+        vocab = sorted(self.vocab) if self.vocab is not None else None
+        description = json.dumps([self.version, codes, self.separator,
+                                  vocab, self.glossaries])
+        return hashlib.md5(description.encode('utf-8')).hexdigest()
 
     def process_line(self, line):
         """segment line, dealing with leading and trailing whitespace"""
@@ -83,20 +107,29 @@ class BPE(object):
             # eliminate double spaces
             if not word:
                 continue
-            new_word = [out for segment in self._isolate_glossaries(word)
-                        for out in encode(segment,
-                                          self.bpe_codes,
-                                          self.bpe_codes_reverse,
-                                          self.vocab,
-                                          self.separator,
-                                          self.version,
-                                          self.cache,
-                                          self.glossaries)]
-
-            for item in new_word[:-1]:
-                output.append(item + self.separator)
-            output.append(new_word[-1])
+            segmented_word = self.cache.get(word)
+            if segmented_word is None:
+                segmented_word = self.segment_word(word)
+                self.cache.add(word, segmented_word)
+                if self.new_entries is not None:
+                    self.new_entries.append((word, segmented_word))
+            output.append(segmented_word)
+
+        return ' '.join(output)
 
+    def segment_word(self, word):
+        """segment a single word, returning the subword units joined by spaces"""
+        new_word = [out for segment in self._isolate_glossaries(word)
+                    for out in encode_with_heap(segment,
+                                                self.bpe_codes,
+                                                self.bpe_codes_reverse,
+                                                self.vocab,
+                                                self.separator,
+                                                self.version,
+                                                self.glossaries)]
+
+        output = [item + self.separator for item in new_word[:-1]]
+        output.append(new_word[-1])
         return ' '.join(output)
 
     def _isolate_glossaries(self, word):
@@ -106,6 +139,60 @@ class BPE(object):
                                  for out_segments in isolate_glossary(segment, gloss)]
         return word_segments
 
+
+class WordCache(object):
+    """A least-recently-used cache of segmented words, which can be saved to
+    and reloaded from disk so that repeated runs with the same codes do not
+    re-encode the same words.  max_size <= 0 means the cache is unbounded.
+    """
+
+    def __init__(self, max_size=-1):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        # python2's OrderedDict has no move_to_end().
+        self._touch = getattr(self.entries, 'move_to_end', self._reinsert)
+
+    def _reinsert(self, word):
+        self.entries[word] = self.entries.pop(word)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, word):
+        value = self.entries.get(word)
+        if value is not None and self.max_size > 0:
+            self._touch(word)
+        return value
+
+    def add(self, word, value):
+        self.entries[word] = value
+        if self.max_size > 0 and len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def load(self, path, fingerprint):
+        """Load entries saved by save(); returns the number of entries loaded,
+        which is zero if the file was written for a different fingerprint."""
+        with io.open(path, encoding='utf-8') as f:
+            if f.readline().rstrip('\n') != '#bpe-cache ' + fingerprint:
+                return 0
+            num_loaded = 0
+            for line in f:
+                word, value = json.loads(line)
+                self.add(word, value)
+                num_loaded += 1
+        return num_loaded
+
+    def save(self, path, fingerprint):
+        """Write the entries, least recently used first, to 'path' (via a
+        temporary file, so an interrupted run leaves the old cache intact)."""
+        tmp_path = path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('#bpe-cache ' + fingerprint + '\n')
+            for item in self.entries.items():
+                f.write(json.dumps(item) + '\n')
+        os.rename(tmp_path, path)
+
+
 def create_parser():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -144,6 +231,23 @@ def create_parser():
         metavar="STR",
         help="Glossaries. The strings provided in glossaries will not be affected"+
              "by the BPE (i.e. they will neither be broken into subwords, nor concatenated with other subwords")
+    parser.add_argument(
+        '--cache', type=str, default=None, metavar="PATH",
+        help="File in which segmented words are cached across runs. It is read "
+             "at startup if it exists and was written with the same codes, "
+             "merges, separator, vocabulary and glossaries, and rewritten at the end.")
+    parser.add_argument(
+        '--cache-size', type=int, default=1000000, metavar="INT",
+        help="Maximum number of words kept in the cache, least recently used "
+             "words are dropped first; <= 0 means unlimited (default: %(default)s)")
+    parser.add_argument(
+        '--num-workers', type=int, default=1, metavar="INT",
+        help="Number of processes used to segment the input; the output lines "
+             "are written in input order (default: %(default)s)")
+    parser.add_argument(
+        '--lines-per-block', type=int, default=10000, metavar="INT",
+        help="Number of input lines sent to a worker at a time if "
+             "--num-workers > 1 (default: %(default)s)")
 
     return parser
 
@@ -223,6 +327,89 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
     cache[orig] = word
     return word
 
+def encode_with_heap(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, glossaries=None):
+    """Encode word based on list of BPE merge operations; the output is
+    identical to that of encode(), but rather than searching all pairs for
+    the lowest-ranked one after every merge, the adjacent pairs are kept in a
+    heap ordered by (rank, position) and the symbols in a linked list, so
+    each merge only updates the pairs that overlap with it.
+    """
+
+    if glossaries and orig in glossaries:
+        return (orig,)
+
+    if version == (0, 1):
+        symbols = list(orig) + ['</w>']
+    elif version == (0, 2): # more consistent handling of word-final segments
+        symbols = list(orig[:-1]) + [orig[-1] + '</w>']
+    else:
+        raise NotImplementedError
+
+    num_symbols = len(symbols)
+    if num_symbols < 2:
+        # encode() returns the word itself in this case, without removing
+        # '</w>' or checking the vocabulary.
+        return tuple(orig)
+
+    # next_pos[i] and prev_pos[i] link the symbols that have not been merged
+    # into their left neighbour (those have symbols[i] = None); -1 marks
+    # the ends of the list.
+    next_pos = list(range(1, num_symbols)) + [-1]
+    prev_pos = list(range(-1, num_symbols - 1))
+    heap = []
+    for i in range(num_symbols - 1):
+        rank = bpe_codes.get((symbols[i], symbols[i + 1]))
+        if rank is not None:
+            heap.append((rank, i))
+    heapq.heapify(heap)
+
+    while heap:
+        # encode() merges all (non-overlapping, leftmost-first) occurrences
+        # of the lowest-ranked pair before looking at the pairs this
+        # creates, so we pop all entries for that rank, which come out in
+        # order of position, before pushing the new ones.  A rank
+        # identifies a pair, and a merged symbol can never form that same
+        # pair with a neighbour, so no entries for it are pushed meanwhile.
+        rank, pos = heapq.heappop(heap)
+        positions = [pos]
+        while heap and heap[0][0] == rank:
+            positions.append(heapq.heappop(heap)[1])
+
+        for pos in positions:
+            right = next_pos[pos]
+            # skip entries that are out of date, i.e. the symbol at 'pos' or
+            # its right neighbour has been merged since they were pushed.
+            if (right == -1 or symbols[pos] is None or
+                    bpe_codes.get((symbols[pos], symbols[right])) != rank):
+                continue
+            symbols[pos] += symbols[right]
+            symbols[right] = None
+            right = next_pos[right]
+            next_pos[pos] = right
+            if right != -1:
+                prev_pos[right] = pos
+                new_rank = bpe_codes.get((symbols[pos], symbols[right]))
+                if new_rank is not None:
+                    heapq.heappush(heap, (new_rank, pos))
+            left = prev_pos[pos]
+            if left != -1:
+                new_rank = bpe_codes.get((symbols[left], symbols[pos]))
+                if new_rank is not None:
+                    heapq.heappush(heap, (new_rank, left))
+
+    word = tuple(symbol for symbol in symbols if symbol is not None)
+
+    # don't print end-of-word symbols
+    if word[-1] == '</w>':
+        word = word[:-1]
+    elif word[-1].endswith('</w>'):
+        word = word[:-1] + (word[-1].replace('</w>',''),)
+
+    if vocab:
+        word = check_vocab_and_split(word, bpe_codes_reverse, vocab, separator)
+
+    return word
+
 def recursive_split(segment, bpe_codes, vocab, separator, final=False):
     """Recursively split segment into smaller units (by reversing BPE merges)
     until all units are either in-vocabulary, or cannot be split futher."""
@@ -305,6 +492,54 @@ def isolate_glossary(word, glossary):
         segments = [segment.strip() for split in splits[:-1] for segment in [split, glossary] if segment != '']
         return segments + [splits[-1].strip()] if splits[-1] != '' else segments
 
+
+# the BPE object used by worker processes in process_in_parallel().
+g_bpe = None
+
+def init_worker(bpe, collect_new_entries):
+    global g_bpe
+    g_bpe = bpe
+    if collect_new_entries:
+        g_bpe.new_entries = []
+
+def process_block(lines):
+    """Segment a block of lines in a worker process; returns the output text
+    and the words that were added to the worker's cache."""
+    output = ''.join([g_bpe.process_line(line) for line in lines])
+    new_entries = g_bpe.new_entries
+    if new_entries is not None:
+        g_bpe.new_entries = []
+    return output, new_entries
+
+def process_in_parallel(bpe, fin, fout, num_workers, lines_per_block,
+                        collect_new_entries=False):
+    """Segment the lines of 'fin' using 'num_workers' processes, writing the
+    output to 'fout' in input order.  At most 2 * num_workers blocks are in
+    flight at a time, so memory use does not grow with the input size.  If
+    collect_new_entries is true, the words segmented by the workers are
+    added to bpe.cache, so that they can be saved."""
+    pool = multiprocessing.Pool(num_workers, initializer=init_worker,
+                                initargs=(bpe, collect_new_entries))
+    pending = deque()
+    blocks = iter(lambda: list(itertools.islice(fin, lines_per_block)), [])
+    try:
+        for block in blocks:
+            pending.append(pool.apply_async(process_block, (block,)))
+            while len(pending) >= 2 * num_workers or (pending and pending[0].ready()):
+                write_block(pending.popleft().get(), bpe, fout)
+        while pending:
+            write_block(pending.popleft().get(), bpe, fout)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def write_block(result, bpe, fout):
+    output, new_entries = result
+    fout.write(output)
+    if new_entries:
+        for word, segmented_word in new_entries:
+            bpe.cache.add(word, segmented_word)
+
 if __name__ == '__main__':
 
     # python 2/3 compatibility
@@ -334,7 +569,21 @@ if __name__ == '__main__':
     else:
         vocabulary = None
 
-    bpe = BPE(args.codes, args.merges, args.separator, vocabulary, args.glossaries)
+    bpe = BPE(args.codes, args.merges, args.separator, vocabulary, args.glossaries,
+              args.cache_size)
+
+    if args.cache and os.path.exists(args.cache):
+        num_loaded = bpe.cache.load(args.cache, bpe.fingerprint())
+        if num_loaded == 0:
+            sys.stderr.write('{0}: not using cache {1}, it is empty or was written with '
+                             'different settings\n'.format(sys.argv[0], args.cache))
+
+    if args.num_workers > 1:
+        process_in_parallel(bpe, args.input, args.output, args.num_workers,
+                            args.lines_per_block, args.cache is not None)
+    else:
+        for line in args.input:
+            args.output.write(bpe.process_line(line))
 
-    for line in args.input:
-        args.output.write(bpe.process_line(line))
+    if args.cache:
+        bpe.cache.save(args.cache, bpe.fingerprint())
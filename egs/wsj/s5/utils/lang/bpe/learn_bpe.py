@@ -16,12 +16,20 @@ from __future__ import unicode_literals
 from __future__ import division
 from __future__ import print_function
 
+import os
 import sys
+import time
 import codecs
 import re
 import copy
+import heapq
+import bisect
+import random
 import argparse
-from collections import defaultdict, Counter
+import itertools
+import multiprocessing
+from array import array
+from collections import defaultdict, deque, Counter
 
 # hack for python2/3 compatibility
 from io import open
@@ -52,6 +60,19 @@ def create_parser():
     parser.add_argument(
         '--verbose', '-v', action="store_true",
         help="verbose mode.")
+    parser.add_argument(
+        '--num-workers', type=int, default=1,
+        help="Number of processes used to count the words of the input "
+             "(default: %(default)s)")
+    parser.add_argument(
+        '--benchmark-num-types', type=int, default=0, metavar='INT',
+        help="If > 0, instead of learning from the input, learn --symbols "
+             "merges from a synthetic vocabulary with this many word types, "
+             "and print timing information to stderr")
+    parser.add_argument(
+        '--benchmark-reference', action="store_true",
+        help="With --benchmark-num-types, also time the original "
+             "dictionary-based learner and check that the merges are the same.")
 
     return parser
 
@@ -73,6 +94,67 @@ def get_vocabulary(fobj, is_dict=False):
                     vocab[word] += 1
     return vocab
 
+def count_vocabulary_block(task):
+    """Count the words in a block of lines, or in the byte range
+    [begin, end) of a file; this runs in a worker process of
+    get_vocabulary_in_parallel().  Returns None on a parse error, for which
+    get_vocabulary() will already have printed a message."""
+    lines, path, begin, end, is_dict = task
+    if lines is None:
+        with open(path, 'rb') as f:
+            # the range owns the lines that start in it.
+            if begin > 0:
+                f.seek(begin - 1)
+                f.readline()
+            start = f.tell()
+            if start >= end:
+                return Counter()
+            data = f.read(end - start)
+            if not data.endswith(b'\n'):
+                data += f.readline()
+        # splitting like the codecs reader in __main__ does.
+        lines = data.decode('utf-8').splitlines()
+    try:
+        return get_vocabulary(lines, is_dict)
+    except SystemExit:
+        return None
+
+def get_vocabulary_in_parallel(fobj, is_dict=False, num_workers=2,
+                               bytes_per_shard=64 << 20, lines_per_block=100000):
+    """Like get_vocabulary(), but the words are counted by 'num_workers'
+    processes.  If fobj is a regular file, each worker reads its own byte
+    ranges of it; otherwise the main process reads blocks of lines and
+    passes them to the workers."""
+    path = getattr(fobj, 'name', None)
+    if path is not None and os.path.isfile(path):
+        size = os.path.getsize(path)
+        num_shards = max(num_workers, (size + bytes_per_shard - 1) // bytes_per_shard)
+        bounds = [size * n // num_shards for n in range(num_shards + 1)]
+        tasks = ((None, path, bounds[n], bounds[n + 1], is_dict)
+                 for n in range(num_shards))
+    else:
+        tasks = ((lines, None, 0, 0, is_dict) for lines in
+                 iter(lambda: list(itertools.islice(fobj, lines_per_block)), []))
+
+    vocab = Counter()
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        # a bounded number of tasks in flight, so that the blocks of lines
+        # are not all read into memory at once.
+        pending = deque()
+        for task in itertools.chain(tasks, [None]):
+            if task is not None:
+                pending.append(pool.apply_async(count_vocabulary_block, (task,)))
+            while pending and (task is None or len(pending) >= 2 * num_workers):
+                counts = pending.popleft().get()
+                if counts is None:
+                    sys.exit(1)
+                vocab.update(counts)
+    finally:
+        pool.terminate()
+        pool.join()
+    return vocab
+
 def update_pair_statistics(pair, changed, stats, indices):
     """Minimally update the indices and frequency of symbol pairs
 
@@ -191,17 +273,158 @@ def prune_stats(stats, big_stats, threshold):
                 big_stats[item] = freq
 
 
-def main(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=False):
-    """Learn num_symbols BPE operations from vocabulary, and write to outfile.
+class LinkedVocabulary(object):
+    """The words of the vocabulary as doubly-linked lists of symbol ids, stored
+    in flat arrays, together with the count of each pair of adjacent symbols
+    and, for each pair, the words it occurs in.  Merging a pair walks only
+    the words that contain it, and updates the counts of the pairs next to
+    each occurrence; a heap of pair counts, whose entries are checked against
+    the current counts when they are popped, gives the most frequent pair.
+
+    The merges are the same as those of the dictionary-based learner in
+    learn_with_pair_statistics(): the most frequent pair is chosen, with ties
+    going to the pair (first, second) that is greatest as a tuple of strings.
     """
 
-    # version 0.2 changes the handling of the end-of-word token ('</w>');
-    # version numbering allows bckward compatibility
-    outfile.write('#version: 0.2\n')
+    # pairs of symbol ids (a, b) are represented by the int (a << SHIFT) | b.
+    SHIFT = 32
+    MASK = (1 << SHIFT) - 1
+
+    def __init__(self, vocab):
+        """vocab is a dict from tuples of symbols to counts."""
+        self.symbols = []      # symbol id -> string
+        self.symbol_ids = {}   # string -> symbol id
+        self.sort_keys = []    # symbol id -> key used to break ties in the heap
+
+        self.word_start = array('l')   # word index -> position of first symbol
+        self.word_count = array('l')   # word index -> count
+        self.symbol = array('i')       # position -> symbol id
+        self.next_pos = array('i')     # position -> next position in word, or -1
+        self.prev_pos = array('i')     # position -> previous position, or -1
+
+        self.pair_count = defaultdict(int)
+        # pair -> indexes of the words it occurs in, possibly repeated or no
+        # longer containing the pair (these are skipped when merging).
+        self.pair_words = defaultdict(lambda: array('i'))
+
+        shift = self.SHIFT
+        for w, (word, count) in enumerate(vocab.items()):
+            begin = len(self.symbol)
+            self.word_start.append(begin)
+            self.word_count.append(count)
+            ids = [self.get_symbol_id(s) for s in word]
+            self.symbol.extend(ids)
+            self.next_pos.extend(range(begin + 1, begin + len(ids)))
+            self.next_pos.append(-1)
+            self.prev_pos.append(-1)
+            self.prev_pos.extend(range(begin, begin + len(ids) - 1))
+            for a, b in zip(ids[:-1], ids[1:]):
+                pair = (a << shift) | b
+                self.pair_count[pair] += count
+                self.pair_words[pair].append(w)
+
+    def get_symbol_id(self, s):
+        symbol_id = self.symbol_ids.get(s)
+        if symbol_id is None:
+            symbol_id = len(self.symbols)
+            self.symbols.append(s)
+            self.symbol_ids[s] = symbol_id
+            # heapq pops the smallest entry, so the key reverses the order
+            # of strings; the trailing 1 makes a string sort after the
+            # strings it is a prefix of.
+            self.sort_keys.append(tuple([-ord(c) for c in s]) + (1,))
+        return symbol_id
+
+    def pair_strings(self, pair):
+        return (self.symbols[pair >> self.SHIFT], self.symbols[pair & self.MASK])
+
+    def heap_entry(self, pair):
+        return (-self.pair_count[pair],
+                self.sort_keys[pair >> self.SHIFT] + self.sort_keys[pair & self.MASK],
+                pair)
+
+    def merge(self, pair):
+        """Replace all occurrences of 'pair' with a new symbol, leftmost first,
+        and return the set of pairs whose counts changed."""
+        shift = self.SHIFT
+        a, b = pair >> shift, pair & self.MASK
+        c = self.get_symbol_id(self.symbols[a] + self.symbols[b])
+        symbol, next_pos, prev_pos = self.symbol, self.next_pos, self.prev_pos
+        word_start, word_count = self.word_start, self.word_count
+        pair_count, pair_words = self.pair_count, self.pair_words
+        changed = set()
+
+        for w in set(pair_words.pop(pair, ())):
+            count = word_count[w]
+            pos = word_start[w]
+            while pos != -1:
+                right = next_pos[pos]
+                if right == -1 or symbol[pos] != a or symbol[right] != b:
+                    pos = right
+                    continue
+                left = prev_pos[pos]
+                if left != -1:
+                    s = symbol[left] << shift
+                    pair_count[s | a] -= count
+                    pair_count[s | c] += count
+                    pair_words[s | c].append(w)
+                    changed.add(s | a)
+                    changed.add(s | c)
+                right = next_pos[right]
+                if right != -1:
+                    s = symbol[right]
+                    pair_count[(b << shift) | s] -= count
+                    pair_count[(c << shift) | s] += count
+                    pair_words[(c << shift) | s].append(w)
+                    changed.add((b << shift) | s)
+                    changed.add((c << shift) | s)
+                    prev_pos[right] = pos
+                symbol[pos] = c
+                next_pos[pos] = right
+                pos = right
+
+        pair_count.pop(pair, None)
+        changed.discard(pair)
+        for p in changed:
+            if pair_count[p] <= 0:
+                del pair_count[p]
+                pair_words.pop(p, None)
+        return changed
+
+    def learn(self, outfile, num_symbols, min_frequency=2, verbose=False):
+        """Learn up to num_symbols merges, writing them to outfile."""
+        heap = [self.heap_entry(pair) for pair, count in self.pair_count.items()
+                if count >= min_frequency]
+        heapq.heapify(heap)
+        for i in range(num_symbols):
+            # discard entries for pairs whose count has changed since they
+            # were pushed (the pair has a newer entry if still frequent).
+            while heap and -heap[0][0] != self.pair_count.get(heap[0][2], 0):
+                heapq.heappop(heap)
+            if not heap:
+                sys.stderr.write('no pair has frequency >= {0}. Stopping\n'.format(min_frequency))
+                break
+            neg_count, _, pair = heapq.heappop(heap)
+            first, second = self.pair_strings(pair)
 
-    vocab = get_vocabulary(infile, is_dict)
-    vocab = dict([(tuple(x[:-1])+(x[-1]+'</w>',) ,y) for (x,y) in vocab.items()])
-    sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
+            if verbose:
+                sys.stderr.write('pair {0}: {1} {2} -> {1}{2} (frequency {3})\n'.format(i, first, second, -neg_count))
+            outfile.write('{0} {1}\n'.format(first, second))
+
+            for p in self.merge(pair):
+                if self.pair_count.get(p, 0) >= min_frequency:
+                    heapq.heappush(heap, self.heap_entry(p))
+            if len(heap) > 2 * len(self.pair_count) + 100000:
+                heap = [self.heap_entry(p) for p, count in self.pair_count.items()
+                        if count >= min_frequency]
+                heapq.heapify(heap)
+
+
+def learn_with_pair_statistics(sorted_vocab, outfile, num_symbols, min_frequency=2, verbose=False):
+    """Learn num_symbols BPE operations from sorted_vocab, a list of (word,
+    count) pairs sorted by decreasing count, using dictionaries of pair
+    statistics that are pruned for efficiency; this is the original
+    learner, which LinkedVocabulary replaces."""
 
     stats, indices = get_pair_statistics(sorted_vocab)
     big_stats = copy.deepcopy(stats)
@@ -234,6 +457,79 @@ def main(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=F
             prune_stats(stats, big_stats, threshold)
 
 
+def main(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=False,
+         num_workers=1):
+    """Learn num_symbols BPE operations from vocabulary, and write to outfile.
+    """
+
+    # version 0.2 changes the handling of the end-of-word token ('</w>');
+    # version numbering allows bckward compatibility
+    outfile.write('#version: 0.2\n')
+
+    if num_workers > 1:
+        vocab = get_vocabulary_in_parallel(infile, is_dict, num_workers)
+    else:
+        vocab = get_vocabulary(infile, is_dict)
+    vocab = dict([(tuple(x[:-1])+(x[-1]+'</w>',) ,y) for (x,y) in vocab.items()])
+
+    LinkedVocabulary(vocab).learn(outfile, num_symbols, min_frequency, verbose)
+
+
+def make_synthetic_vocabulary(num_types, seed=0):
+    """Return a dict from words to counts with num_types word types, made of
+    letters with a skewed distribution and with Zipfian counts, to benchmark
+    the learners on."""
+    rand = random.Random(seed)
+    letters = 'etaoinshrdlcumwfgypbvkjxqz'
+    cum_weights = []
+    for n in range(len(letters)):
+        cum_weights.append((cum_weights[-1] if cum_weights else 0.0) + 1.0 / (n + 2))
+    vocab = {}
+    while len(vocab) < num_types:
+        length = min(20, 2 + int(rand.expovariate(0.25)))
+        word = ''.join([letters[bisect.bisect(cum_weights, rand.random() * cum_weights[-1])]
+                        for _ in range(length)])
+        vocab[word] = max(1, int(1e6 / (len(vocab) + 1)))
+    return vocab
+
+
+def benchmark(num_types, num_symbols, min_frequency=2, compare_reference=False):
+    """Time learning num_symbols merges from a synthetic vocabulary with
+    num_types types, optionally also with the original learner."""
+    class CodesCollector(object):
+        def __init__(self):
+            self.lines = []
+        def write(self, line):
+            self.lines.append(line)
+
+    start_time = time.time()
+    vocab = make_synthetic_vocabulary(num_types)
+    vocab = dict([(tuple(x[:-1])+(x[-1]+'</w>',) ,y) for (x,y) in vocab.items()])
+    sys.stderr.write('benchmark: made {0} word types in {1:.1f} seconds\n'.format(
+        len(vocab), time.time() - start_time))
+
+    start_time = time.time()
+    linked_vocab = LinkedVocabulary(vocab)
+    index_time = time.time() - start_time
+    codes = CodesCollector()
+    linked_vocab.learn(codes, num_symbols, min_frequency)
+    sys.stderr.write('benchmark: linked-list learner: {0:.1f} seconds to index, '
+                     '{1:.1f} seconds for {2} merges\n'.format(
+                         index_time, time.time() - start_time - index_time,
+                         len(codes.lines)))
+    del linked_vocab
+
+    if compare_reference:
+        start_time = time.time()
+        sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
+        reference_codes = CodesCollector()
+        learn_with_pair_statistics(sorted_vocab, reference_codes, num_symbols, min_frequency)
+        sys.stderr.write('benchmark: original learner: {0:.1f} seconds; the merges '
+                         'are {1}\n'.format(time.time() - start_time,
+                                             'the same' if reference_codes.lines == codes.lines
+                                             else 'DIFFERENT'))
+
+
 if __name__ == '__main__':
 
     # python 2/3 compatibility
@@ -255,4 +551,10 @@ if __name__ == '__main__':
     if args.output.name != '<stdout>':
         args.output = codecs.open(args.output.name, 'w', encoding='utf-8')
 
-    main(args.input, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=args.dict_input)
+    if args.benchmark_num_types > 0:
+        benchmark(args.benchmark_num_types, args.symbols, args.min_frequency,
+                  args.benchmark_reference)
+        sys.exit(0)
+
+    main(args.input, args.output, args.symbols, args.min_frequency, args.verbose,
+         is_dict=args.dict_input, num_workers=args.num_workers)
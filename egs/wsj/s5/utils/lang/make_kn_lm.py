@@ -21,7 +21,16 @@ import re
 import io
 import math
 import argparse
-from collections import Counter, defaultdict
+import tempfile
+import time
+import multiprocessing
+from collections import Counter, defaultdict, deque
+
+try:
+    import numpy as np
+    g_have_numpy = True
+except ImportError:
+    g_have_numpy = False
 
 
 parser = argparse.ArgumentParser(description="""
@@ -32,6 +41,24 @@ parser.add_argument("-ngram-order", type=int, default=4, choices=[2, 3, 4, 5, 6,
 parser.add_argument("-text", type=str, default=None, help="Path to the corpus file")
 parser.add_argument("-lm", type=str, default=None, help="Path to output arpa file for language models")
 parser.add_argument("-verbose", type=int, default=0, choices=[0, 1, 2, 3, 4, 5], help="Verbose level")
+parser.add_argument("-lines-per-shard", type=int, default=1000000,
+                    help="Number of lines of text counted at a time into one shard of "
+                    "n-gram counts (requires numpy)")
+parser.add_argument("-temp-dir", type=str, default=None,
+                    help="If supplied, count shards are written to this directory and "
+                    "merged from disk one n-gram order at a time, which bounds the memory "
+                    "used during counting (external-memory mode; requires numpy)")
+parser.add_argument("-num-workers", type=int, default=1,
+                    help="If >1, the text is split into blocks of about -bytes-per-shard "
+                    "bytes which are counted in parallel by this many processes "
+                    "(requires numpy).  The result does not depend on the number of workers.")
+parser.add_argument("-bytes-per-shard", type=int, default=16 * 1024 * 1024,
+                    help="Size of the blocks of text counted by each worker when "
+                    "-num-workers > 1")
+parser.add_argument("-benchmark-num-workers", type=str, default=None,
+                    help="If supplied, e.g. '1,2,4,8,16,32', time the counting of -text with "
+                    "each of these numbers of workers, check that the counts are identical, "
+                    "and exit without writing a language model.")
 args = parser.parse_args()
 
 default_encoding = "latin-1"  # For encoding-agnostic scripts, we assume byte stream as input.
@@ -358,9 +385,579 @@ class NgramCounts:
         print('\\end\\', file=fout)
 
 
+def merge_count_tables(tables):
+    # Merges a list of count tables for the same n-gram order into one.  A
+    # count table is a tuple (words, counts, first_pos): 'words' is an int32
+    # matrix with one row per unique n-gram, sorted lexicographically, 'counts'
+    # holds the raw counts and 'first_pos' the position of the first token of
+    # the earliest occurrence of each n-gram in the corpus.
+    if len(tables) == 1:
+        return tables[0]
+    words = np.concatenate([t[0] for t in tables])
+    counts = np.concatenate([t[1] for t in tables])
+    first_pos = np.concatenate([t[2] for t in tables])
+    order = np.lexsort((first_pos,) + tuple(words[:, j] for j in reversed(range(words.shape[1]))))
+    words = words[order]
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = np.any(words[1:] != words[:-1], axis=1)
+    starts = np.flatnonzero(is_new)
+    return (words[starts],
+            np.add.reduceat(counts[order], starts),
+            first_pos[order][starts])
+
+
+def sequential_segment_sums(values, segment_ids, num_segments):
+    # Returns, for each segment, the sum of the elements of 'values' belonging
+    # to it.  Elements of the same segment must be contiguous, and they are
+    # added one by one from left to right, so the result is bit-identical to
+    # a python loop 'total = 0; for v in values: total += v'.
+    sums = np.zeros(num_segments)
+    if len(values) == 0:
+        return sums
+    is_new = np.ones(len(values), dtype=bool)
+    is_new[1:] = segment_ids[1:] != segment_ids[:-1]
+    starts = np.flatnonzero(is_new)
+    lengths = np.diff(np.append(starts, len(values)))
+    rank = np.arange(len(values)) - np.repeat(starts, lengths)
+    # process the elements in layers: the j'th element of every segment at once.
+    order = np.argsort(rank, kind='stable')
+    bounds = np.searchsorted(rank[order], np.arange(lengths.max() + 1))
+    for j in range(lengths.max()):
+        idx = order[bounds[j]:bounds[j + 1]]
+        sums[segment_ids[idx]] += values[idx]
+    return sums
+
+
+def sort_count_table(table):
+    # sorts the rows of a count table (see merge_count_tables()) lexicographically.
+    words, counts, first_pos = table
+    order = np.lexsort(tuple(words[:, j] for j in reversed(range(words.shape[1]))))
+    return (words[order], counts[order], first_pos[order])
+
+
+def count_ngrams_in_lines(lines, ngram_order, word_to_id, vocab, bos_id, eos_id):
+    # Counts the n-grams of orders 1 to ngram_order in 'lines', a list of
+    # strings each containing a sequence of words.  New words are added to
+    # 'word_to_id' and 'vocab'.  Returns (tables, num_tokens), where tables[n]
+    # is a tuple (words, counts, first_pos, hist_index) for the n-grams of
+    # order n + 1: the first three are as for merge_count_tables(), with
+    # positions counted from the start of 'lines', and hist_index is the row
+    # of the history of each n-gram in tables[n - 1].  num_tokens is the
+    # number of tokens including the <s> and </s> of each line.
+    tokens = []
+    line_lengths = []
+    for line in lines:
+        words = whitespace.split(line)
+        tokens.append(bos_id)
+        for word in words:
+            word_id = word_to_id.get(word)
+            if word_id is None:
+                word_id = len(vocab)
+                word_to_id[word] = word_id
+                vocab.append(word)
+            tokens.append(word_id)
+        tokens.append(eos_id)
+        line_lengths.append(len(words) + 2)
+    tokens = np.array(tokens, dtype=np.int32)
+    line_lengths = np.array(line_lengths, dtype=np.int64)
+    num_tokens = len(tokens)
+    vocab_size = len(vocab)
+    # room[i] is the number of tokens from position i to the end of its line.
+    room = np.repeat(np.cumsum(line_lengths), line_lengths) - np.arange(num_tokens)
+
+    # ids[i] is the index of the n-gram starting at position i among the
+    # sorted unique n-grams of the current order; ids of the order n+1 are
+    # computed from those of order n plus the next word.
+    tables = []
+    ids = None
+    for hist_len in range(ngram_order):
+        positions = np.flatnonzero(room > hist_len)
+        if hist_len == 0:
+            keys = tokens.astype(np.int64)
+        else:
+            keys = ids[positions] * vocab_size + tokens[positions + hist_len]
+        unique_keys, first_index, inverse, counts = np.unique(
+            keys, return_index=True, return_inverse=True, return_counts=True)
+        ids = np.zeros(num_tokens, dtype=np.int64)
+        ids[positions] = inverse.reshape(-1)
+        first = positions[first_index]
+        tables.append((tokens[first[:, None] + np.arange(hist_len + 1)],
+                       counts.astype(np.int64),
+                       first,
+                       unique_keys // vocab_size if hist_len > 0 else None))
+    return tables, num_tokens
+
+
+def read_blocks(fp, block_size):
+    # yields blocks of about 'block_size' bytes from the binary file 'fp',
+    # each ending at a line boundary.
+    while True:
+        block = fp.read(block_size)
+        if len(block) == 0:
+            return
+        if not block.endswith(b'\n'):
+            block += fp.readline()
+        yield block
+
+
+def count_block(task):
+    # This is run by the worker processes when -num-workers > 1.  It counts
+    # the n-grams in a block of text the same way as
+    # CompactNgramCounts.add_raw_counts_from_stream(), stopping at the first
+    # empty line.  The word-ids in the returned count tables index the
+    # returned 'vocab', which is local to this block.
+    block, ngram_order, bos_symbol, eos_symbol = task
+    # decode with universal newlines, as a file opened in text mode would.
+    text = block.decode(default_encoding).replace('\r\n', '\n').replace('\r', '\n')
+    if text.endswith('\n'):
+        text = text[:-1]
+    lines = []
+    reached_empty_line = False
+    for line in text.split('\n'):
+        line = line.strip(strip_chars)
+        if line == '':
+            reached_empty_line = True
+            break
+        lines.append(line)
+    vocab = [bos_symbol, eos_symbol]
+    word_to_id = {bos_symbol: 0, eos_symbol: 1}
+    tables, num_tokens = count_ngrams_in_lines(lines, ngram_order, word_to_id, vocab, 0, 1)
+    return len(lines), reached_empty_line, vocab, tables, num_tokens
+
+
+class CompactNgramCounts:
+    # This is an array-backed version of class NgramCounts, which produces
+    # exactly the same ARPA output while using a small fraction of the memory.
+    # Words are interned as integer ids, and the n-grams of each order are
+    # stored as a lexicographically sorted matrix of word-ids, with parallel
+    # numpy arrays for the raw counts, the discounted probabilities, etc.
+    # Everything is indexed by hist_len (== n-gram order minus one), as in
+    # class NgramCounts.
+    #
+    # Text is counted in shards of 'lines_per_shard' lines; if 'temp_dir' is
+    # given, the count tables of each shard are written there and merged from
+    # disk (external-memory mode).  If num_workers > 1, shards are blocks of
+    # about 'bytes_per_shard' bytes, counted in parallel by a pool of
+    # processes; their results are added in the order of the blocks, so they
+    # are the same as for a single process.
+    #
+    # To reproduce the order in which NgramCounts prints n-grams (which is the
+    # order in which dict keys were first inserted), we remember the corpus
+    # position of the first occurrence of each n-gram: within an order, a
+    # history is printed in the order in which it first appeared, and the words
+    # of a history in the order in which they first appeared after it.
+    def __init__(self, ngram_order, bos_symbol='<s>', eos_symbol='</s>',
+                 lines_per_shard=1000000, temp_dir=None,
+                 num_workers=1, bytes_per_shard=16 * 1024 * 1024):
+        assert ngram_order >= 2
+        assert lines_per_shard > 0 and num_workers > 0 and bytes_per_shard > 0
+
+        self.ngram_order = ngram_order
+        self.bos_symbol = bos_symbol
+        self.eos_symbol = eos_symbol
+        self.lines_per_shard = lines_per_shard
+        self.temp_dir = temp_dir
+        self.num_workers = num_workers
+        self.bytes_per_shard = bytes_per_shard
+
+        self.vocab = []
+        self.word_to_id = dict()
+        self.bos_id = self.intern(bos_symbol)
+        self.eos_id = self.intern(eos_symbol)
+
+        self.num_tokens = 0
+        self.num_shards = 0
+        # self.shards[hist_len] is a list of count tables (or, in
+        # external-memory mode, of filenames of count tables).
+        self.shards = [[] for n in range(ngram_order)]
+
+        self.words = []  # words[hist_len] is a matrix of word-ids, one row per n-gram
+        self.counts = []  # raw counts
+        self.first_pos = []  # corpus position of the first occurrence
+        self.keys = []  # keys[hist_len] = hist_ids * vocab-size + last word, sorted.
+        self.hist_ids = []  # index of the history of each n-gram in the table of hist_len - 1
+        self.suffix_ids = []  # index of the n-gram minus its first word in the table of hist_len - 1
+        self.d = []  # list of discounting factor for each order of ngram
+        self.f = []  # discounted probabilities
+        self.bow = []  # back-off weights, NaN where there is none.
+
+    def intern(self, word):
+        word_id = self.word_to_id.get(word)
+        if word_id is None:
+            word_id = len(self.vocab)
+            self.word_to_id[word] = word_id
+            self.vocab.append(word)
+        return word_id
+
+    # 'lines' is a list of strings, each containing a sequence of words.  This
+    # function adds one shard with the un-smoothed counts from these lines.
+    def add_raw_counts_from_lines(self, lines):
+        tables, num_tokens = count_ngrams_in_lines(
+            lines, self.ngram_order, self.word_to_id, self.vocab, self.bos_id, self.eos_id)
+        self.add_count_tables(tables, num_tokens)
+
+    # Adds one shard of counts, as returned by count_ngrams_in_lines().  If
+    # 'vocab' is supplied, the word-ids in 'tables' index 'vocab' rather than
+    # self.vocab; the positions in 'tables' are relative to the start of the
+    # shard.
+    def add_count_tables(self, tables, num_tokens, vocab=None):
+        if num_tokens == 0:
+            return
+        if vocab is not None:
+            id_map = np.array([self.intern(word) for word in vocab], dtype=np.int32)
+
+        for hist_len, (words, counts, first_pos, hist_index) in enumerate(tables):
+            first_pos = first_pos + self.num_tokens
+            if self.temp_dir is None:
+                # in memory we only need the last word; the history is
+                # identified through hist_index when merging.
+                last_words = words[:, -1]
+                if vocab is not None:
+                    last_words = id_map[last_words]
+                self.shards[hist_len].append((last_words, counts, first_pos, hist_index))
+            else:
+                table = (words, counts, first_pos)
+                if vocab is not None:
+                    table = sort_count_table((id_map[words], counts, first_pos))
+                filename = os.path.join(self.temp_dir, 'counts.{0}.{1}.npz'.format(
+                    hist_len + 1, self.num_shards))
+                np.savez(filename, words=table[0], counts=table[1], first_pos=table[2])
+                self.shards[hist_len].append(filename)
+
+        self.num_tokens += num_tokens
+        self.num_shards += 1
+
+    def add_raw_counts_from_stream(self, infile):
+        lines_processed = 0
+        lines = []
+        for line in infile:
+            line = line.strip(strip_chars)
+            if line == '':
+                break
+            lines.append(line)
+            lines_processed += 1
+            if len(lines) == self.lines_per_shard:
+                self.add_raw_counts_from_lines(lines)
+                lines = []
+        self.add_raw_counts_from_lines(lines)
+        if lines_processed == 0 or args.verbose > 0:
+            print("make_phone_lm.py: processed {0} lines of input".format(lines_processed), file=sys.stderr)
+        self.merge_shards()
+
+    def add_raw_counts_in_parallel(self, fp):
+        # Counts the text in the binary file 'fp' with a pool of
+        # self.num_workers processes.  At most 2 * self.num_workers blocks are
+        # in flight at any time, which bounds the memory used.
+        lines_processed = 0
+        reached_empty_line = False
+        pool = multiprocessing.Pool(self.num_workers)
+        try:
+            pending = deque()
+            blocks = read_blocks(fp, self.bytes_per_shard)
+            while True:
+                # once a block has reached the empty line we stop submitting
+                # blocks, and the results of the blocks after it are
+                # collected and discarded, so that the pool can be closed and
+                # joined normally (terminating it while the workers are
+                # sending back count tables can deadlock).
+                if not reached_empty_line:
+                    for block in blocks:
+                        pending.append(pool.apply_async(
+                            count_block, [(block, self.ngram_order, self.bos_symbol, self.eos_symbol)]))
+                        if len(pending) >= 2 * self.num_workers:
+                            break
+                if len(pending) == 0:
+                    break
+                result = pending.popleft().get()
+                if reached_empty_line:
+                    continue
+                num_lines, reached_empty_line, vocab, tables, num_tokens = result
+                self.add_count_tables(tables, num_tokens, vocab=vocab)
+                lines_processed += num_lines
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if lines_processed == 0 or args.verbose > 0:
+            print("make_phone_lm.py: processed {0} lines of input".format(lines_processed), file=sys.stderr)
+        self.merge_shards()
+
+    def add_raw_counts_from_standard_input(self):
+        if self.num_workers > 1:
+            self.add_raw_counts_in_parallel(sys.stdin.buffer)
+            return
+        infile = io.TextIOWrapper(sys.stdin.buffer, encoding=default_encoding)  # byte stream as input
+        self.add_raw_counts_from_stream(infile)
+
+    def add_raw_counts_from_file(self, filename):
+        if self.num_workers > 1:
+            with open(filename, 'rb') as fp:
+                self.add_raw_counts_in_parallel(fp)
+            return
+        with open(filename, encoding=default_encoding) as fp:
+            self.add_raw_counts_from_stream(fp)
+
+    def load_count_table(self, filename):
+        with np.load(filename) as data:
+            return (data['words'], data['counts'], data['first_pos'])
+
+    def merge_shard_files(self, filenames):
+        # merges the count tables on disk two at a time, so that at most two of
+        # them (plus their union) are in memory at any time.
+        filenames = list(filenames)
+        num_merged = 0
+        while len(filenames) > 1:
+            a = filenames.pop(0)
+            b = filenames.pop(0)
+            words, counts, first_pos = merge_count_tables(
+                [self.load_count_table(a), self.load_count_table(b)])
+            os.remove(a)
+            os.remove(b)
+            filename = '{0}.merged{1}.npz'.format(a[:-len('.npz')], num_merged)
+            num_merged += 1
+            np.savez(filename, words=words, counts=counts, first_pos=first_pos)
+            filenames.append(filename)
+        table = self.load_count_table(filenames[0])
+        os.remove(filenames[0])
+        return table
+
+    def lookup(self, words):
+        # returns the indexes of the n-grams whose words are the rows of 'words'.
+        vocab_size = len(self.vocab)
+        ids = np.searchsorted(self.keys[0], words[:, 0])
+        for j in range(1, words.shape[1]):
+            ids = np.searchsorted(self.keys[j], ids * vocab_size + words[:, j])
+        return ids
+
+    def merge_shards_in_memory(self, hist_len, shard_ids):
+        # Merges the in-memory shards of hist_len 'hist_len'.  shard_ids[s]
+        # maps the rows of shard s of the previous order to their index in the
+        # merged table, so each n-gram can be given the sortable key
+        # hist_id * vocab-size + last-word; it is updated for this order.
+        # Returns (keys, counts, first_pos), sorted on the keys.
+        vocab_size = len(self.vocab)
+        shards = self.shards[hist_len]
+        if hist_len == 0:
+            keys = np.concatenate([last_words.astype(np.int64) for last_words, _, _, _ in shards])
+        else:
+            keys = np.concatenate([ids[hist_index] * vocab_size + last_words
+                                   for ids, (last_words, _, _, hist_index) in zip(shard_ids, shards)])
+        counts = np.concatenate([shard[1] for shard in shards])
+        first_pos = np.concatenate([shard[2] for shard in shards])
+
+        order = np.lexsort((first_pos, keys))
+        keys = keys[order]
+        is_new = np.ones(len(keys), dtype=bool)
+        is_new[1:] = keys[1:] != keys[:-1]
+        starts = np.flatnonzero(is_new)
+        inverse = np.empty(len(keys), dtype=np.int64)
+        inverse[order] = np.cumsum(is_new) - 1
+        shard_ids[:] = np.split(inverse, np.cumsum([len(shard[1]) for shard in shards])[:-1])
+        return (keys[starts],
+                np.add.reduceat(counts[order], starts),
+                first_pos[order][starts])
+
+    def merge_shards(self):
+        # Combines the shards into one count table per order, and works out
+        # how the n-grams of consecutive orders are linked to each other.
+        vocab_size = len(self.vocab)
+        shard_ids = []
+        for hist_len in range(self.ngram_order):
+            if len(self.shards[hist_len]) == 0:
+                words = np.zeros((0, hist_len + 1), dtype=np.int32)
+                counts = np.zeros(0, dtype=np.int64)
+                first_pos = np.zeros(0, dtype=np.int64)
+                hist_ids = None
+            elif self.temp_dir is None:
+                keys, counts, first_pos = self.merge_shards_in_memory(hist_len, shard_ids)
+                hist_ids = keys // vocab_size
+                last_words = (keys % vocab_size).astype(np.int32)[:, None]
+                if hist_len == 0:
+                    words = last_words
+                else:
+                    words = np.concatenate([self.words[hist_len - 1][hist_ids], last_words], axis=1)
+            else:
+                words, counts, first_pos = self.merge_shard_files(self.shards[hist_len])
+                hist_ids = None
+            self.shards[hist_len] = []
+
+            if hist_len == 0:
+                hist_ids = np.zeros(len(words), dtype=np.int64)
+                suffix_ids = hist_ids
+                keys = words[:, 0].astype(np.int64)
+            else:
+                if hist_ids is None:
+                    hist_ids = self.lookup(words[:, :-1])
+                suffix_ids = self.lookup(words[:, 1:])
+                keys = hist_ids * vocab_size + words[:, -1]
+            self.words.append(words)
+            self.counts.append(counts)
+            self.first_pos.append(first_pos)
+            self.keys.append(keys)
+            self.hist_ids.append(hist_ids)
+            self.suffix_ids.append(suffix_ids)
+
+    def num_histories(self, hist_len):
+        return 1 if hist_len == 0 else len(self.words[hist_len - 1])
+
+    def cal_discounting_constants(self):
+        # See NgramCounts.cal_discounting_constants().
+        self.d = [0]
+        for n in range(1, self.ngram_order):
+            n1 = int(np.count_nonzero(self.counts[n] == 1))
+            n2 = int(np.count_nonzero(self.counts[n] == 2))
+            assert n1 + 2 * n2 > 0
+            self.d.append(n1 * 1.0 / (n1 + 2 * n2))
+
+    def cal_f(self):
+        # See NgramCounts.cal_f().  The number of unique contexts n(*_z) of an
+        # n-gram _z is the number of distinct (n+1)-grams ending in _z.
+        self.f = []
+        for n in range(self.ngram_order):
+            num_hists = self.num_histories(n)
+            hist_ids = self.hist_ids[n]
+            counts = self.counts[n]
+            total_count = np.bincount(hist_ids, weights=counts, minlength=num_hists)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                f = np.maximum(counts - self.d[n], 0) * 1.0 / total_count[hist_ids]
+                if n < self.ngram_order - 1:
+                    n_star_z = np.bincount(self.suffix_ids[n + 1], minlength=len(counts))
+                    n_star_star = np.bincount(hist_ids, weights=n_star_z, minlength=num_hists)[hist_ids]
+                    # patterns begin with <s>, they do not have "modified
+                    # count", so they keep using the raw count.
+                    f = np.where(n_star_star != 0,
+                                 np.maximum(n_star_z - self.d[n], 0) * 1.0 / n_star_star,
+                                 f)
+            self.f.append(f)
+
+    def cal_bow(self):
+        # See NgramCounts.cal_bow().  The sums over Z1 are accumulated in the
+        # same order as NgramCounts does, so that the results are identical.
+        self.bow = []
+        for n in range(self.ngram_order):
+            num_ngrams = len(self.words[n])
+            if n == self.ngram_order - 1:
+                self.bow.append(np.full(num_ngrams, np.nan))
+                continue
+            hist_ids = self.hist_ids[n + 1]
+            order = np.lexsort((self.first_pos[n + 1], hist_ids))
+            sum_z1_f_a_z = sequential_segment_sums(
+                self.f[n + 1][order], hist_ids[order], num_ngrams)
+            sum_z1_f_z = sequential_segment_sums(
+                self.f[n][self.suffix_ids[n + 1][order]], hist_ids[order], num_ngrams)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bow = (1.0 - sum_z1_f_a_z) / (1.0 - sum_z1_f_z)
+            bow[self.words[n][:, -1] == self.eos_id] = np.nan
+            self.bow.append(bow)
+
+    def print_order(self, n):
+        # returns the indexes of the n-grams of hist_len n in the order in
+        # which NgramCounts would print them.
+        hist_ids = self.hist_ids[n]
+        first_pos = self.first_pos[n]
+        if len(hist_ids) == 0:
+            return hist_ids
+        is_new = np.ones(len(hist_ids), dtype=bool)
+        is_new[1:] = hist_ids[1:] != hist_ids[:-1]
+        starts = np.flatnonzero(is_new)
+        lengths = np.diff(np.append(starts, len(hist_ids)))
+        hist_first_pos = np.repeat(np.minimum.reduceat(first_pos, starts), lengths)
+        return np.lexsort((first_pos, hist_first_pos))
+
+    def print_as_arpa(self, fout=io.TextIOWrapper(sys.stdout.buffer, encoding='latin-1')):
+        # print as ARPA format.
+
+        print('\\data\\', file=fout)
+        for hist_len in range(self.ngram_order):
+            # print the number of n-grams.
+            print('ngram {0}={1}'.format(hist_len + 1, len(self.words[hist_len])), file=fout)
+
+        print('', file=fout)
+
+        ngrams = None
+        for hist_len in range(self.ngram_order):
+            print('\\{0}-grams:'.format(hist_len + 1), file=fout)
+
+            last_words = [self.vocab[w] for w in self.words[hist_len][:, -1].tolist()]
+            if hist_len == 0:
+                ngrams = last_words
+            else:
+                ngrams = [ngrams[h] + ' ' + w
+                          for h, w in zip(self.hist_ids[hist_len].tolist(), last_words)]
+            probs = self.f[hist_len].tolist()
+            bows = self.bow[hist_len].tolist()
+
+            lines = []
+            for i in self.print_order(hist_len).tolist():
+                prob = probs[i]
+                bow = bows[i]
+                if prob == 0:  # f(<s>) is always 0
+                    prob = 1e-99
+
+                line = '{0}\t{1}'.format('%.7f' % math.log10(prob), ngrams[i])
+                if bow == bow:  # i.e. not NaN
+                    line += '\t{0}'.format('%.7f' % math.log10(bow))
+                lines.append(line)
+            if len(lines) > 0:
+                print('\n'.join(lines), file=fout)
+            print('', file=fout)
+        print('\\end\\', file=fout)
+        fout.flush()
+
+
+def benchmark_counting(filename, ngram_order, worker_counts):
+    # Times the counting of 'filename' for each number of workers in
+    # 'worker_counts', and checks that the merged counts are identical.
+    reference = None
+    base_time = None
+    for num_workers in worker_counts:
+        start_time = time.time()
+        ngram_counts = CompactNgramCounts(ngram_order, num_workers=num_workers,
+                                          bytes_per_shard=args.bytes_per_shard)
+        ngram_counts.add_raw_counts_from_file(filename)
+        elapsed = time.time() - start_time
+        if reference is None:
+            reference = ngram_counts
+            base_time = elapsed
+        else:
+            assert ngram_counts.vocab == reference.vocab
+            for n in range(ngram_order):
+                assert np.array_equal(ngram_counts.words[n], reference.words[n])
+                assert np.array_equal(ngram_counts.counts[n], reference.counts[n])
+                assert np.array_equal(ngram_counts.first_pos[n], reference.first_pos[n])
+        print("make_kn_lm.py: counting with {0} worker(s) took {1:.2f} seconds "
+              "(speed-up {2:.2f}x vs. {3} worker(s))".format(
+                  num_workers, elapsed, base_time / elapsed, worker_counts[0]),
+              file=sys.stderr)
+
+
 if __name__ == "__main__":
 
-    ngram_counts = NgramCounts(args.ngram_order)
+    if (args.temp_dir is not None or args.num_workers > 1 or
+            args.benchmark_num_workers is not None) and not g_have_numpy:
+        sys.exit("make_kn_lm.py: -temp-dir, -num-workers and -benchmark-num-workers "
+                 "require numpy")
+
+    if args.benchmark_num_workers is not None:
+        if args.text is None:
+            sys.exit("make_kn_lm.py: -benchmark-num-workers requires -text")
+        benchmark_counting(args.text, args.ngram_order,
+                           [int(x) for x in args.benchmark_num_workers.split(',')])
+        sys.exit(0)
+
+    if g_have_numpy:
+        temp_dir = None
+        if args.temp_dir is not None:
+            temp_dir = tempfile.mkdtemp(dir=args.temp_dir)
+        ngram_counts = CompactNgramCounts(args.ngram_order,
+                                          lines_per_shard=args.lines_per_shard,
+                                          temp_dir=temp_dir,
+                                          num_workers=args.num_workers,
+                                          bytes_per_shard=args.bytes_per_shard)
+    else:
+        ngram_counts = NgramCounts(args.ngram_order)
 
     if args.text is None:
         ngram_counts.add_raw_counts_from_standard_input()
@@ -368,6 +965,9 @@ if __name__ == "__main__":
         assert os.path.isfile(args.text)
         ngram_counts.add_raw_counts_from_file(args.text)
 
+    if args.temp_dir is not None:
+        os.rmdir(temp_dir)
+
     ngram_counts.cal_discounting_constants()
     ngram_counts.cal_f()
     ngram_counts.cal_bow()
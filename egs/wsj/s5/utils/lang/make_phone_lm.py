@@ -8,7 +8,10 @@ from __future__ import division
 import sys
 import argparse
 import math
-from collections import defaultdict
+import time
+import heapq
+import multiprocessing
+from collections import defaultdict, deque
 
 # note, this was originally based
 
@@ -58,6 +61,40 @@ parser.add_argument("--print-as-arpa", type = str, default = "false",
                     "this is not allowed.")
 parser.add_argument("--verbose", type = int, default = 0,
                     choices=[0,1,2,3,4,5], help = "Verbose level")
+parser.add_argument("--pruning-method", type = str, default = "batch",
+                    choices = ["batch", "incremental"],
+                    help = "With 'batch', pruning is done in a sequence of rounds, "
+                    "each of which computes the likelihood change of all candidate "
+                    "n-grams and prunes the best ones.  With 'incremental', the "
+                    "candidates are kept in a priority queue and pruned one at a "
+                    "time; after each prune, only the likelihood changes of the "
+                    "n-grams whose history-states were affected are recomputed.  "
+                    "This does less work than 'batch' (somewhat faster on large "
+                    "LMs, and it usually gives a slightly lower K-L divergence), "
+                    "but it does not give exactly the same LM.")
+parser.add_argument("--sweep-num-extra-ngrams", type = str, default = "",
+                    help = "Comma-separated list of extra targets for the number of "
+                    "n-grams, larger than --num-extra-ngrams, e.g. '80000,40000'.  "
+                    "While pruning down to --num-extra-ngrams, the LM is written to "
+                    "the filename given by --sweep-output with {0} replaced by the "
+                    "target when the number of n-grams reaches each of these targets.  "
+                    "This does not change the final LM.")
+parser.add_argument("--sweep-output", type = str, default = None,
+                    help = "Filename template for the LMs written for "
+                    "--sweep-num-extra-ngrams, e.g. exp/phone_lm/lm.{0}.fst")
+parser.add_argument("--num-workers", type = int, default = 1,
+                    help = "If >1, the input is split into blocks of about "
+                    "--bytes-per-shard bytes which are counted in parallel by "
+                    "this many processes.  The result does not depend on the "
+                    "number of workers.")
+parser.add_argument("--bytes-per-shard", type = int, default = 16 * 1024 * 1024,
+                    help = "Size of the blocks of input counted by each worker "
+                    "when --num-workers > 1")
+parser.add_argument("--benchmark-num-workers", type = str, default = None,
+                    help = "If supplied, e.g. '1,2,4,8,16,32', time the counting of "
+                    "the standard input with each of these numbers of workers, check "
+                    "that the counts are identical, and exit without writing a "
+                    "language model.")
 
 args = parser.parse_args()
 
@@ -138,6 +175,19 @@ class NgramCounts(object):
         for n in range(ngram_order):
             self.counts.append(defaultdict(lambda: CountsForHistory()))
 
+    # Returns a copy of the counts in this object (with the same insertion
+    # order).
+    def Copy(self):
+        ans = NgramCounts(len(self.counts))
+        ans.total_num_words = self.total_num_words
+        for n in range(len(self.counts)):
+            for hist, counts_for_hist in self.counts[n].items():
+                new_counts_for_hist = ans.counts[n][hist]
+                new_counts_for_hist.word_to_count = defaultdict(
+                    int, counts_for_hist.word_to_count)
+                new_counts_for_hist.total_count = counts_for_hist.total_count
+        return ans
+
     # adds a raw count (called while processing input data).
     # Suppose we see the sequence '6 7 8 9' and ngram_order=4, 'history'
     # would be (6,7,8) and 'predicted_word' would be 9; 'count' would be
@@ -174,6 +224,63 @@ class NgramCounts(object):
             print("make_phone_lm.py: processed {0} lines of input".format(
                     lines_processed), file = sys.stderr)
 
+    # Adds the counts returned by CountBlock() (except for the number of
+    # lines).  Because blocks are added in order, the dicts end up with the
+    # same insertion order as when the lines are counted one by one, which
+    # matters because it determines the numbering of the FST states.
+    def AddBlockCounts(self, block_counts):
+        (lines_processed, total_num_words, counts) = block_counts
+        self.total_num_words += total_num_words
+        for n in range(args.ngram_order):
+            this_order_counts = self.counts[n]
+            for hist, word_to_count in counts[n]:
+                counts_for_hist = this_order_counts[hist]
+                for word, count in word_to_count:
+                    counts_for_hist.AddCount(word, count)
+
+    # This is like AddRawCountsFromStandardInput(), but it reads blocks of
+    # bytes from the binary file 'fp' and counts them in a pool of
+    # 'num_workers' processes.  At most 2 * num_workers blocks are in flight
+    # at any time.
+    def AddRawCountsInParallel(self, fp, num_workers):
+        lines_processed = 0
+        error_message = None
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            pending = deque()
+            blocks = ReadBlocks(fp, args.bytes_per_shard)
+            while True:
+                # after an error we stop submitting blocks but still collect
+                # the pending results, so that the pool can be closed and
+                # joined normally (terminating it while the workers are
+                # sending results back can deadlock).
+                if error_message is None:
+                    for block in blocks:
+                        pending.append(pool.apply_async(CountBlock, [block]))
+                        if len(pending) >= 2 * num_workers:
+                            break
+                if len(pending) == 0:
+                    break
+                block_counts = pending.popleft().get()
+                if error_message is not None:
+                    continue
+                if block_counts[0] is None:
+                    error_message = block_counts[1]
+                    continue
+                self.AddBlockCounts(block_counts)
+                lines_processed += block_counts[0]
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if error_message is not None:
+            sys.exit(error_message)
+        if lines_processed == 0 or args.verbose > 0:
+            print("make_phone_lm.py: processed {0} lines of input".format(
+                    lines_processed), file = sys.stderr)
+
 
     # This backs off the counts by subtracting 1 and assigning the subtracted
     # count to the backoff state.  It's like a special case of Kneser-Ney with D
@@ -280,7 +387,7 @@ class NgramCounts(object):
         for n in reversed(list(range(args.no_backoff_ngram_order,
                                 args.ngram_order))):
             num_states_removed = 0
-            for hist, counts_for_hist in self.counts[n].items():
+            for hist, counts_for_hist in list(self.counts[n].items()):
                 l = len(counts_for_hist.word_to_count)
                 assert l > 0 and self.backoff_symbol in counts_for_hist.word_to_count
                 if l == 1 and not hist in protected_histories:  # only the backoff symbol has a count.
@@ -336,7 +443,7 @@ class NgramCounts(object):
 
 
     # This function prints the estimated language model as an FST.
-    def PrintAsFst(self, word_disambig_symbol):
+    def PrintAsFst(self, word_disambig_symbol, fout = sys.stdout):
         # n is the history-length (== order + 1).  We iterate over the
         # history-length in the order 1, 0, 2, 3, and then iterate over the
         # histories of each order in sorted order.  Putting order 1 first
@@ -365,15 +472,15 @@ class NgramCounts(object):
                             next_hist = next_hist[1:]
                         next_fst_state = hist_to_state[next_hist]
                         print(this_fst_state, next_fst_state, word, word,
-                              this_cost)
+                              this_cost, file = fout)
                     elif word == self.eos_symbol:
                         # print final-prob for this state.
-                        print(this_fst_state, this_cost)
+                        print(this_fst_state, this_cost, file = fout)
                     else:
                         assert word == self.backoff_symbol
                         backoff_fst_state = hist_to_state[hist[1:len(hist)]]
                         print(this_fst_state, backoff_fst_state,
-                              word_disambig_symbol, 0, this_cost)
+                              word_disambig_symbol, 0, this_cost, file = fout)
 
     # This function returns a set of n-grams that cannot currently be pruned
     # away, either because a higher-order form of the same n-gram already exists,
@@ -406,6 +513,11 @@ class NgramCounts(object):
                                                       # history
         return ans
 
+    # Prunes the n-gram (hist, word), backing off its count to the
+    # lower-order state.  Returns the number of n-grams by which this reduces
+    # GetNumExtraNgrams(): normally 1, but it may be 2 if the count is zero and
+    # the n-gram for 'word' in the backoff state also had a zero count, since
+    # AddCount() removes zero counts.
     def PruneNgram(self, hist, word):
         counts_for_hist = self.counts[len(hist)][hist]
         assert word != self.backoff_symbol and word in counts_for_hist.word_to_count
@@ -414,7 +526,12 @@ class NgramCounts(object):
         counts_for_hist.word_to_count[self.backoff_symbol] += count
         # the next call adds the count to the symbol 'word' in the backoff
         # history-state, and also updates its 'total_count'.
-        self.counts[len(hist) - 1][hist[1:]].AddCount(word, count)
+        counts_for_backoff_hist = self.counts[len(hist) - 1][hist[1:]]
+        had_backoff_ngram = word in counts_for_backoff_hist.word_to_count
+        counts_for_backoff_hist.AddCount(word, count)
+        if len(hist) - 1 < args.no_backoff_ngram_order:
+            return 1
+        return 1 + int(had_backoff_ngram) - int(word in counts_for_backoff_hist.word_to_count)
 
     # The function PruningLogprobChange is the same as the same-named
     # function in float-counts-prune.cc in pocolm.  Note, it doesn't access
@@ -565,7 +682,13 @@ class NgramCounts(object):
                                          backoff_count, float(backoff_total))
 
     # note: returns loglike change per word.
-    def PruneToIntermediateTarget(self, num_extra_ngrams):
+    # 'sweep_targets' is an optional list of targets for sweep LMs, sorted
+    # from largest to smallest; the LM is written out (see WriteSweepLm()) as
+    # soon as the number of extra n-grams is at or below the first of them,
+    # which is then removed from the list.
+    def PruneToIntermediateTarget(self, num_extra_ngrams, sweep_targets = None):
+        if sweep_targets is None:
+            sweep_targets = []
         protected_ngrams = self.GetProtectedNgrams()
         initial_num_extra_ngrams = self.GetNumExtraNgrams()
         num_ngrams_to_prune = initial_num_extra_ngrams - num_extra_ngrams
@@ -602,13 +725,16 @@ class NgramCounts(object):
             num_ngrams_to_prune = len(like_change_and_ngrams)
 
         total_loglike_change = 0.0
+        current_num_extra_ngrams = initial_num_extra_ngrams
 
         for i in range(num_ngrams_to_prune):
             total_loglike_change += like_change_and_ngrams[i][0]
             hist = like_change_and_ngrams[i][1:-1]  # all but 1st and last elements
             word = like_change_and_ngrams[i][-1]  # last element
             num_pruned_per_order[len(hist)] += 1
-            self.PruneNgram(hist, word)
+            current_num_extra_ngrams -= self.PruneNgram(hist, word)
+            while len(sweep_targets) > 0 and current_num_extra_ngrams <= sweep_targets[0]:
+                self.WriteSweepLm(sweep_targets.pop(0))
 
         like_change_per_word = total_loglike_change / self.total_num_words
 
@@ -640,7 +766,7 @@ class NgramCounts(object):
 
 
 
-    def PruneToFinalTarget(self, num_extra_ngrams):
+    def PruneToFinalTarget(self, num_extra_ngrams, sweep_targets = None):
         # prunes to a specified num_extra_ngrams.  The 'extra_ngrams' refers to
         # the count of n-grams of order higher than args.no_backoff_ngram_order.
         # We construct a sequence of targets that gradually approaches
@@ -649,9 +775,18 @@ class NgramCounts(object):
         # n-gram before certain other n-grams are pruned (because
         # they lead to a state that must be kept, or an n-gram exists
         # that backs off to this n-gram).
-
+        # 'sweep_targets' is an optional list of larger targets; the LM is
+        # written out (see WriteSweepLm()) in the middle of the pruning round
+        # in which the number of extra n-grams reaches each of them.  They
+        # don't affect the schedule, so the final LM is the same with or
+        # without them.
         current_num_extra_ngrams = self.GetNumExtraNgrams()
 
+        sweep_targets = sorted(sweep_targets if sweep_targets is not None else [],
+                               reverse = True)
+        while len(sweep_targets) > 0 and current_num_extra_ngrams <= sweep_targets[0]:
+            self.WriteSweepLm(sweep_targets.pop(0))
+
         if num_extra_ngrams >= current_num_extra_ngrams:
             print('make_phone_lm.py: not pruning since target num-extra-ngrams={0} is >= '
                   'current num-extra-ngrams={1}'.format(num_extra_ngrams, current_num_extra_ngrams),
@@ -682,13 +817,255 @@ class NgramCounts(object):
               file = sys.stderr)
         total_like_change_per_word = 0.0
         for target in target_sequence:
-            total_like_change_per_word += self.PruneToIntermediateTarget(target)
+            total_like_change_per_word += self.PruneToIntermediateTarget(
+                target, sweep_targets)
 
         if args.verbose >= 1:
             print('make_phone_lm.py: K-L divergence from pruning (upper bound) is '
                   '%.4f' % total_like_change_per_word, file = sys.stderr)
 
 
+    # The following functions implement the "incremental" pruning method
+    # (--pruning-method=incremental), which PruneIncrementally() uses instead
+    # of PruneToFinalTarget().  Rather than doing rounds of pruning in which
+    # the likelihood change of every candidate n-gram is computed and the
+    # GetProtectedNgrams() and PruneEmptyStates() are recomputed from
+    # scratch, it keeps everything up to date as n-grams are pruned one at a
+    # time:
+    #
+    #  - self.pruning_heap is a min-heap of items (-like_change, ngram,
+    #    computed_at) for the candidate n-grams, where 'ngram' is hist +
+    #    (word,) and 'computed_at' is the value of self.num_modifications when
+    #    like_change was computed.  self.candidate_items maps each candidate
+    #    n-gram to its current item; items that are not there are out of
+    #    date and are skipped when they are popped.
+    #  - self.protection_count maps each n-gram that can't be pruned to the
+    #    number of reasons why (as in GetProtectedNgrams()); when this goes
+    #    to zero the n-gram becomes a candidate.
+    #  - self.num_child_states maps each history-state to the number of
+    #    history-states that back off to it; a state can only be removed (as
+    #    in PruneEmptyStates()) if this is zero.
+    #  - self.hist_modified_at maps each history-state to the value of
+    #    self.num_modifications when pruning an n-gram last changed its counts.
+    #    The likelihood change of pruning an n-gram (hist, word) only depends
+    #    on the counts in 'hist' and in the states it backs off to, so it
+    #    needs to be recomputed if any of these was modified since it was
+    #    computed.  This is done when the n-gram reaches the top of the queue:
+    #    so the n-gram we prune always has an up-to-date likelihood change,
+    #    and the n-grams in histories unaffected by the pruning so far are
+    #    never recomputed.  (The likelihood changes further down the queue may
+    #    be out of date, like those computed at the start of each round in the
+    #    batch method).
+
+    def InitIncrementalPruning(self):
+        self.num_modifications = 0
+        self.hist_modified_at = dict()
+        self.num_child_states = defaultdict(int)
+        self.protection_count = defaultdict(int)
+        self.pruning_heap = []
+        self.candidate_items = dict()
+        for n in range(1, args.ngram_order):
+            for hist in self.counts[n].keys():
+                self.num_child_states[hist[1:]] += 1
+        # This is like ChangePrefixProtection() and ChangeSuffixProtection()
+        # with delta = 1, but faster.
+        protection_count = self.protection_count
+        for n in range(args.no_backoff_ngram_order + 1, args.ngram_order):
+            for hist, counts_for_hist in self.counts[n].items():
+                for m in range(n - args.no_backoff_ngram_order):
+                    protection_count[hist[:n - m]] += 1
+                for m in range(1, n - args.no_backoff_ngram_order + 1):
+                    reduced_hist = hist[m:]
+                    for word in counts_for_hist.word_to_count.keys():
+                        if word != self.backoff_symbol:
+                            protection_count[reduced_hist + (word,)] += 1
+        for n in range(args.no_backoff_ngram_order, args.ngram_order):
+            for hist, counts_for_hist in self.counts[n].items():
+                for word in counts_for_hist.word_to_count.keys():
+                    if word != self.backoff_symbol and \
+                       not hist + (word,) in self.protection_count:
+                        self.AddPruningCandidate(hist, word, push = False)
+        self.pruning_heap = list(self.candidate_items.values())
+        heapq.heapify(self.pruning_heap)
+
+    # Computes the likelihood change of pruning the n-gram (hist, word) and
+    # (re-)adds it to the queue; if 'push' is false it is only added to
+    # self.candidate_items.  Returns the item.
+    def AddPruningCandidate(self, hist, word, push = True):
+        ngram = hist + (word,)
+        item = (-self.GetLikeChangeFromPruningNgram(hist, word), ngram,
+                self.num_modifications)
+        self.candidate_items[ngram] = item
+        if push:
+            heapq.heappush(self.pruning_heap, item)
+        return item
+
+    # Adds 'delta' to the protection count of 'ngram'; if it becomes zero and
+    # the n-gram exists, it becomes a pruning candidate.
+    def ChangeProtection(self, ngram, delta):
+        count = self.protection_count[ngram] + delta
+        assert count >= 0
+        if count > 0:
+            self.protection_count[ngram] = count
+            return
+        del self.protection_count[ngram]
+        hist = ngram[:-1]
+        word = ngram[-1]
+        counts_for_hist = self.counts[len(hist)].get(hist)
+        if counts_for_hist is not None and word in counts_for_hist.word_to_count:
+            self.AddPruningCandidate(hist, word)
+
+    # Changes the protection counts of the n-grams that the n-gram (hist, word)
+    # protects because they are backed-off versions of it: if it is (6, 7, 8)
+    # -> 9, these are (7, 8) -> 9 and (8) -> 9 (see GetProtectedNgrams()).
+    def ChangeSuffixProtection(self, hist, word, delta):
+        for m in range(1, len(hist) - args.no_backoff_ngram_order + 1):
+            self.ChangeProtection(hist[m:] + (word,), delta)
+
+    # Changes the protection counts of the n-grams that the history-state
+    # 'hist' protects so that it is accessible: if it is (6, 7, 8), these are
+    # (6, 7) -> 8 and (6) -> 7 (see GetProtectedNgrams()).
+    def ChangePrefixProtection(self, hist, delta):
+        for m in range(len(hist) - args.no_backoff_ngram_order):
+            self.ChangeProtection(hist[:len(hist) - m], delta)
+
+    # Returns true if any of the states that the likelihood change of pruning
+    # an n-gram in history-state 'hist' depends on was modified after it was
+    # computed (when self.num_modifications was 'computed_at').
+    def LikeChangeIsStale(self, hist, computed_at):
+        hist_modified_at = self.hist_modified_at
+        # (states shorter than args.no_backoff_ngram_order - 1 are never
+        # modified).
+        for i in range(len(hist) - args.no_backoff_ngram_order + 2):
+            if hist_modified_at.get(hist[i:], 0) > computed_at:
+                return True
+        return False
+
+    # Removes history-state 'hist' if it only has the backoff count and no
+    # other state backs off to it (as PruneEmptyStates() would), and then
+    # does the same for the state it backs off to.
+    def RemoveStateIfUnused(self, hist):
+        while len(hist) >= args.no_backoff_ngram_order:
+            counts_for_hist = self.counts[len(hist)].get(hist)
+            if counts_for_hist is None or len(counts_for_hist.word_to_count) != 1 or \
+               self.num_child_states.get(hist, 0) != 0:
+                return
+            del self.counts[len(hist)][hist]
+            if len(hist) > args.no_backoff_ngram_order:
+                self.ChangePrefixProtection(hist, -1)
+            self.num_child_states[hist[1:]] -= 1
+            hist = hist[1:]
+
+    # Prunes the n-gram (hist, word) and updates the pruning state.  Returns
+    # the number of n-grams removed, as PruneNgram().
+    def PruneNgramIncrementally(self, hist, word):
+        backoff_hist = hist[1:]
+        counts_for_backoff_hist = self.counts[len(backoff_hist)][backoff_hist]
+        had_backoff_ngram = word in counts_for_backoff_hist.word_to_count
+        counts_for_hist = self.counts[len(hist)][hist]
+        count = counts_for_hist.word_to_count[word]
+        num_removed = self.PruneNgram(hist, word)
+        if count != 0 or num_removed != 1:
+            # (pruning an n-gram with zero count doesn't change any
+            # probabilities, unless it removed the backed-off n-gram).
+            self.num_modifications += 1
+            self.hist_modified_at[hist] = self.num_modifications
+            self.hist_modified_at[backoff_hist] = self.num_modifications
+        if len(hist) > args.no_backoff_ngram_order:
+            self.ChangeSuffixProtection(hist, word, -1)
+        if len(backoff_hist) >= args.no_backoff_ngram_order and \
+           had_backoff_ngram != (word in counts_for_backoff_hist.word_to_count):
+            # The n-gram (backoff_hist, word) was added, or removed because
+            # it had a zero count (see PruneNgram()).
+            backoff_ngram = backoff_hist + (word,)
+            if had_backoff_ngram:
+                self.candidate_items.pop(backoff_ngram, None)
+            elif not backoff_ngram in self.protection_count:
+                self.AddPruningCandidate(backoff_hist, word)
+            if len(backoff_hist) > args.no_backoff_ngram_order:
+                self.ChangeSuffixProtection(backoff_hist, word,
+                                            -1 if had_backoff_ngram else 1)
+        if len(counts_for_hist.word_to_count) == 1:
+            self.RemoveStateIfUnused(hist)
+        return num_removed
+
+    # This is the counterpart of PruneToFinalTarget() for the "incremental"
+    # pruning method: it prunes the n-grams with the smallest likelihood
+    # change one at a time until there are only 'num_extra_ngrams' extra
+    # n-grams left.  'sweep_targets' is as for PruneToFinalTarget(), but
+    # since we prune one n-gram at a time the sweep LMs have exactly the
+    # requested number of n-grams.
+    def PruneIncrementally(self, num_extra_ngrams, sweep_targets = None):
+        sweep_targets = sorted(sweep_targets if sweep_targets is not None else [],
+                               reverse = True)
+        initial_num_extra_ngrams = self.GetNumExtraNgrams()
+        current_num_extra_ngrams = initial_num_extra_ngrams
+        self.InitIncrementalPruning()
+        print('make_phone_lm.py: current num-extra-ngrams={0}, pruning incrementally '
+              'to {1}; there are {2} candidates for pruning'.format(
+                  current_num_extra_ngrams, num_extra_ngrams, len(self.candidate_items)),
+              file = sys.stderr)
+
+        num_pruned_per_order = [ 0 ] * args.ngram_order
+        num_recomputed = 0
+        total_loglike_change = 0.0
+        candidate_items = self.candidate_items
+        while len(sweep_targets) > 0 and current_num_extra_ngrams <= sweep_targets[0]:
+            self.WriteSweepLm(sweep_targets.pop(0))
+        while current_num_extra_ngrams > num_extra_ngrams:
+            if len(self.pruning_heap) == 0:
+                print('make_phone_lm.py: aimed to prune to {0} n-grams but could only '
+                      'prune to {1}'.format(num_extra_ngrams, current_num_extra_ngrams),
+                      file = sys.stderr)
+                break
+            item = heapq.heappop(self.pruning_heap)
+            ngram = item[1]
+            if candidate_items.get(ngram) is not item:
+                continue  # an out-of-date item.
+            hist = ngram[:-1]
+            if self.LikeChangeIsStale(hist, item[2]):
+                num_recomputed += 1
+                # If it would be at the top of the queue again we prune it
+                # right away.
+                item = self.AddPruningCandidate(hist, ngram[-1], push = False)
+                if len(self.pruning_heap) > 0 and item > self.pruning_heap[0]:
+                    heapq.heappush(self.pruning_heap, item)
+                    continue
+            del candidate_items[ngram]
+            total_loglike_change -= item[0]
+            num_pruned_per_order[len(hist)] += 1
+            current_num_extra_ngrams -= self.PruneNgramIncrementally(hist, ngram[-1])
+            while len(sweep_targets) > 0 and current_num_extra_ngrams <= sweep_targets[0]:
+                self.WriteSweepLm(sweep_targets.pop(0))
+            # Drop the out-of-date items if they make up most of the heap.
+            if len(self.pruning_heap) > 2 * len(candidate_items) + 1000:
+                self.pruning_heap = list(candidate_items.values())
+                heapq.heapify(self.pruning_heap)
+
+        like_change_per_word = total_loglike_change / self.total_num_words
+        if args.verbose >= 1:
+            print("Pruned from {0} ngrams to {1}, recomputing {2} likelihood changes.  "
+                  "num-ngrams pruned per order were {3}.  Like-change per word was {4}".format(
+                      initial_num_extra_ngrams, current_num_extra_ngrams, num_recomputed,
+                      num_pruned_per_order, like_change_per_word), file = sys.stderr)
+            print('make_phone_lm.py: K-L divergence from pruning (upper bound) is '
+                  '%.4f' % like_change_per_word, file = sys.stderr)
+        if args.verbose >= 3:
+            self.Print("Counts after pruning to num-extra-ngrams={0}".format(
+                    current_num_extra_ngrams))
+
+    # Writes the LM as it would be if we stopped pruning now to the file
+    # given by the --sweep-output template, without changing the counts.
+    def WriteSweepLm(self, target):
+        counts = self.Copy()
+        counts.PruneEmptyStates()
+        counts.EnsureStructurallyNeededNgramsExist()
+        filename = args.sweep_output.format(target)
+        print('make_phone_lm.py: writing LM with num-extra-ngrams={0} to {1}'.format(
+                counts.GetNumExtraNgrams(), filename), file = sys.stderr)
+        with open(filename, 'w') as f:
+            counts.PrintLm(f)
+
     # returns the number of n-grams on top of those that can't be pruned away
     # because their order is <= args.no_backoff_ngram_order.
     def GetNumExtraNgrams(self):
@@ -729,30 +1106,31 @@ class NgramCounts(object):
 
 
 
-    def PrintAsArpa(self):
+    def PrintAsArpa(self, fout = sys.stdout):
         # Prints out the FST in ARPA format.
         assert args.no_backoff_ngram_order == 1  # without unigrams we couldn't
                                                  # print as ARPA format.
 
-        print('\\data\\');
+        print('\\data\\', file = fout)
         for hist_len in range(args.ngram_order):
             # print the number of n-grams.  Add 1 for the 1-gram
             # section because of <s>, we print -99 as the prob so we
             # have a place to put the backoff prob.
             print('ngram {0}={1}'.format(
                     hist_len + 1,
-                    self.GetNumNgrams(hist_len) + (1 if hist_len == 0 else 0)))
+                    self.GetNumNgrams(hist_len) + (1 if hist_len == 0 else 0)),
+                  file = fout)
 
-        print('')
+        print('', file = fout)
 
         for hist_len in range(args.ngram_order):
-            print('\\{0}-grams:'.format(hist_len + 1))
+            print('\\{0}-grams:'.format(hist_len + 1), file = fout)
 
             # print fake n-gram for <s>, for its backoff prob.
             if hist_len == 0:
                 backoff_prob = self.GetProb((self.bos_symbol,), self.backoff_symbol)
                 if backoff_prob != None:
-                    print('-99\t<s>\t{0}'.format('%.5f' % math.log10(backoff_prob)))
+                    print('-99\t<s>\t{0}'.format('%.5f' % math.log10(backoff_prob)), file = fout)
 
             for hist in self.counts[hist_len].keys():
                 for word in self.counts[hist_len][hist].word_to_count.keys():
@@ -764,42 +1142,130 @@ class NgramCounts(object):
                                                  ' '.join(self.IntToString(x) for x in hist + (word,)))
                         if backoff_prob != None:
                             line += '\t{0}'.format('%.5f' % math.log10(backoff_prob))
-                        print(line)
-            print('')
-        print('\\end\\')
+                        print(line, file = fout)
+            print('', file = fout)
+        print('\\end\\', file = fout)
 
 
 
-ngram_counts = NgramCounts(args.ngram_order)
-ngram_counts.AddRawCountsFromStandardInput()
+    # Prints the LM in the format selected by --print-as-arpa.
+    def PrintLm(self, fout = sys.stdout):
+        if args.print_as_arpa == "true":
+            self.PrintAsArpa(fout)
+        else:
+            self.PrintAsFst(args.phone_disambig_symbol, fout)
 
-if args.verbose >= 3:
-    ngram_counts.Print("Raw counts:")
-ngram_counts.ApplyBackoff()
-if args.verbose >= 3:
-    ngram_counts.Print("Counts after applying Kneser-Ney discounting:")
-ngram_counts.EnsureStructurallyNeededNgramsExist()
-if args.verbose >= 3:
-    ngram_counts.Print("Counts after adding structurally-needed n-grams (1st time):")
-ngram_counts.PruneEmptyStates()
-if args.verbose >= 3:
-    ngram_counts.Print("Counts after removing empty states:")
-ngram_counts.PruneToFinalTarget(args.num_extra_ngrams)
 
-ngram_counts.EnsureStructurallyNeededNgramsExist()
-if args.verbose >= 3:
-    ngram_counts.Print("Counts after adding structurally-needed n-grams (2nd time):")
 
+# yields blocks of about 'block_size' bytes from the binary file 'fp', each
+# ending at a line boundary.
+def ReadBlocks(fp, block_size):
+    while True:
+        block = fp.read(block_size)
+        if len(block) == 0:
+            return
+        if not block.endswith(b'\n'):
+            block += fp.readline()
+        yield block
+
+
+# This is run by the worker processes when --num-workers > 1.  It counts the
+# lines in 'block' (a bytes object) and returns a tuple (lines_processed,
+# total_num_words, counts), where counts[n] is a list of pairs (hist,
+# word_to_count) in insertion order, word_to_count being a list of (word,
+# count) pairs.  On a bad input line it returns (None, error_message).
+def CountBlock(block):
+    counts = NgramCounts(args.ngram_order)
+    lines = block.decode(sys.stdin.encoding).split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    try:
+        for line in lines:
+            counts.AddRawCountsFromLine(line)
+    except SystemExit as e:
+        return (None, e.code)
+    return (len(lines), counts.total_num_words,
+            [[(hist, list(counts_for_hist.word_to_count.items()))
+              for hist, counts_for_hist in this_order_counts.items()]
+             for this_order_counts in counts.counts])
+
+
+# Times the counting of 'data' (the input, as bytes) for each number of
+# workers in 'worker_counts', and checks that the counts are identical.
+def BenchmarkCounting(data, worker_counts):
+    import io
+    reference = None
+    base_time = None
+    for num_workers in worker_counts:
+        start_time = time.time()
+        ngram_counts = NgramCounts(args.ngram_order)
+        if num_workers > 1:
+            ngram_counts.AddRawCountsInParallel(io.BytesIO(data), num_workers)
+        else:
+            ngram_counts.AddBlockCounts(CountBlock(data))
+        elapsed = time.time() - start_time
+        these_counts = [[(hist, list(counts_for_hist.word_to_count.items()))
+                         for hist, counts_for_hist in this_order_counts.items()]
+                        for this_order_counts in ngram_counts.counts]
+        if reference is None:
+            reference = these_counts
+            base_time = elapsed
+        else:
+            assert these_counts == reference
+        print("make_phone_lm.py: counting with {0} worker(s) took {1:.2f} seconds "
+              "(speed-up {2:.2f}x vs. {3} worker(s))".format(
+                  num_workers, elapsed, base_time / elapsed, worker_counts[0]),
+              file = sys.stderr)
 
 
+if __name__ == "__main__":
+    if args.benchmark_num_workers is not None:
+        BenchmarkCounting(sys.stdin.buffer.read(),
+                          [ int(x) for x in args.benchmark_num_workers.split(',') ])
+        sys.exit(0)
 
-if args.print_as_arpa == "true":
-    ngram_counts.PrintAsArpa()
-else:
-    if args.phone_disambig_symbol == None:
+    if args.print_as_arpa != "true" and args.phone_disambig_symbol == None:
         sys.exit("make_phone_lm.py: --phone-disambig-symbol must be provided (unless "
                  "you are writing as ARPA")
-    ngram_counts.PrintAsFst(args.phone_disambig_symbol)
+    sweep_targets = [ int(x) for x in args.sweep_num_extra_ngrams.split(',') if x != '' ]
+    if len(sweep_targets) > 0:
+        if args.sweep_output == None or not '{0}' in args.sweep_output:
+            sys.exit("make_phone_lm.py: --sweep-num-extra-ngrams requires "
+                     "--sweep-output containing '{0}'")
+        if min(sweep_targets) <= args.num_extra_ngrams:
+            sys.exit("make_phone_lm.py: the values of --sweep-num-extra-ngrams must be "
+                     "larger than --num-extra-ngrams")
+
+    ngram_counts = NgramCounts(args.ngram_order)
+    if args.num_workers > 1:
+        ngram_counts.AddRawCountsInParallel(sys.stdin.buffer, args.num_workers)
+    else:
+        ngram_counts.AddRawCountsFromStandardInput()
+
+    if args.verbose >= 3:
+        ngram_counts.Print("Raw counts:")
+    ngram_counts.ApplyBackoff()
+    if args.verbose >= 3:
+        ngram_counts.Print("Counts after applying Kneser-Ney discounting:")
+    ngram_counts.EnsureStructurallyNeededNgramsExist()
+    if args.verbose >= 3:
+        ngram_counts.Print("Counts after adding structurally-needed n-grams (1st time):")
+    ngram_counts.PruneEmptyStates()
+    if args.verbose >= 3:
+        ngram_counts.Print("Counts after removing empty states:")
+    if args.pruning_method == "incremental":
+        ngram_counts.PruneIncrementally(args.num_extra_ngrams, sweep_targets)
+    else:
+        ngram_counts.PruneToFinalTarget(args.num_extra_ngrams, sweep_targets)
+
+    ngram_counts.EnsureStructurallyNeededNgramsExist()
+    if args.verbose >= 3:
+        ngram_counts.Print("Counts after adding structurally-needed n-grams (2nd time):")
+
+
+
+
+    ngram_counts.PrintLm()
 
 
 ## Below are some little test commands that can be used to look at the detailed stats
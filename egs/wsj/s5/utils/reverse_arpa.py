@@ -1,10 +1,12 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Copyright 2012 Mirko Hannemann BUT, mirko.hannemann@gmail.com
 
 from __future__ import print_function
 import sys
-import codecs # for UTF-8/unicode
+
+sys.path.insert(0, 'steps')
+import libs.arpa_lm as arpa_lm
 
 if len(sys.argv) != 2:
     print('usage: reverse_arpa arpa.in')
@@ -33,93 +35,54 @@ arpaname = sys.argv[1]
 
 # read language model in ARPA format
 try:
-  file = codecs.open(arpaname, "r", "utf-8")
+  reader = arpa_lm.ArpaReader(arpaname)
 except IOError:
   print('file not found: ' + arpaname)
   sys.exit()
-
-text=file.readline()
-while (text and text[:6] != "\\data\\"): text=file.readline()
-if not text:
-  print("invalid ARPA file")
+except ValueError as e:
+  print("invalid ARPA file: {}".format(e))
   sys.exit()
-#print text,
-while (text and text[:5] != "ngram"): text=file.readline()
-
-# get ngram counts
-cngrams=[]
-n=0
-while (text and text[:5] == "ngram"):
-  ind = text.split("=")
-  counts = int(ind[1].strip())
-  r = ind[0].split()
-  read_n = int(r[1].strip())
-  if read_n != n+1:
-    print("invalid ARPA file: {}".format(text))
-    sys.exit()
-  n = read_n
-  cngrams.append(counts)
-  #print text,
-  text=file.readline()
+cngrams = reader.counts
 
 # read all n-grams order by order
 sentprob = 0.0 # sentence begin unigram
 ngrams=[]
 inf=float("inf")
-for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
-  while (text and "-grams:" not in text): text=file.readline()
-  if n != int(text[1]):
-    print("invalid ARPA file:{}".format(text))
-    sys.exit()
-  #print text,cngrams[n-1]
-  this_ngrams={} # stores all read ngrams
-  for ng in range(cngrams[n-1]):
-    while (text and len(text.split())<2):
-      text=file.readline()
-      if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))): break
-    if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))):
-      break # to deal with incorrect ARPA files
-    entry = text.split()
-    prob = float(entry[0])
-    if len(entry)>n+1:
-      back = float(entry[-1])
-      words = entry[1:n+1]
-    else:
-      back = 0.0
-      words = entry[1:]
-    ngram = " ".join(words)
-    if (n==1) and words[0]=="<s>":
-      sentprob = prob
-      prob = 0.0
-    this_ngrams[ngram] = (prob,back)
-    #print prob,ngram.encode("utf-8"),back
-
-    for x in range(n-1,0,-1):
-      # add all missing backoff ngrams for reversed lm
-      l_ngram = " ".join(words[:x]) # shortened ngram
-      r_ngram = " ".join(words[1:1+x]) # shortened ngram with offset one
-      if l_ngram not in ngrams[x-1]: # create missing ngram
-        ngrams[x-1][l_ngram] = (0.0,inf)
-        #print ngram, "create 0.0", l_ngram, "inf"
-      if r_ngram not in ngrams[x-1]: # create missing ngram
-        ngrams[x-1][r_ngram] = (0.0,inf)
-        #print ngram, "create 0.0", r_ngram, "inf",x,n,h_ngram
-
-      # add all missing backoff ngrams for forward lm
-      h_ngram = " ".join(words[n-x:]) # shortened history
-      if h_ngram not in ngrams[x-1]: # create missing ngram
-        ngrams[x-1][h_ngram] = (0.0,inf)
-        #print "create inf", h_ngram, "0.0"
-    text=file.readline()
-    if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))): break
-  ngrams.append(this_ngrams)
-
-while (text and text[:5] != "\\end\\"): text=file.readline()
-if not text:
-  print("invalid ARPA file")
+try:
+  for n, lines in reader.sections(): # unigrams, bigrams, trigrams
+    this_ngrams={} # stores all read ngrams
+    ngrams.append(this_ngrams)
+    for text in lines:
+      prob, words, back = arpa_lm.parse_ngram_line(text, n)
+      if back is None:
+        back = 0.0
+      ngram = " ".join(words)
+      if (n==1) and words[0]=="<s>":
+        sentprob = prob
+        prob = 0.0
+      this_ngrams[ngram] = (prob,back)
+      #print prob,ngram.encode("utf-8"),back
+
+      for x in range(n-1,0,-1):
+        # add all missing backoff ngrams for reversed lm
+        l_ngram = " ".join(words[:x]) # shortened ngram
+        r_ngram = " ".join(words[1:1+x]) # shortened ngram with offset one
+        if l_ngram not in ngrams[x-1]: # create missing ngram
+          ngrams[x-1][l_ngram] = (0.0,inf)
+          #print ngram, "create 0.0", l_ngram, "inf"
+        if r_ngram not in ngrams[x-1]: # create missing ngram
+          ngrams[x-1][r_ngram] = (0.0,inf)
+          #print ngram, "create 0.0", r_ngram, "inf",x,n,h_ngram
+
+        # add all missing backoff ngrams for forward lm
+        h_ngram = " ".join(words[n-x:]) # shortened history
+        if h_ngram not in ngrams[x-1]: # create missing ngram
+          ngrams[x-1][h_ngram] = (0.0,inf)
+          #print "create inf", h_ngram, "0.0"
+except ValueError as e:
+  print("invalid ARPA file: {}".format(e))
   sys.exit()
-file.close()
-#print text,
+reader.close()
 
 #fourgram "maxent" model (b(ABCD)=0):
 #p(A)+b(A) A 0
@@ -134,12 +97,9 @@ file.close()
 #p(ABCD)+b(ABCD)-p(BCD)+p(ABC)-p(BC)+p(AB)-p(B)+p(A) DCBA 0
 
 # compute new reversed ARPA model
-print("\\data\\")
-for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
-  print("ngram {0} = {1}".format(n, len(ngrams[n-1].keys())))
+writer = arpa_lm.ArpaWriter(sys.stdout, [len(ngrams[n-1]) for n in range(1,len(cngrams)+1)])
 offset = 0.0
 for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
-  print("\\{}-grams:".format(n))
   keys = sorted(ngrams[n-1].keys())
   for ngram in keys:
     prob = ngrams[n-1][ngram]
@@ -179,10 +139,10 @@ for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
         elif n == 2:
           revprob = revprob + offset # add <s> weight to bigrams starting with <s>
       if (prob[1] != inf): # only backoff weights from not newly created ngrams
-        print(revprob,rev_ngram.encode("utf-8"),back)
+        writer.write_ngram_line(n, "{} {} {}".format(revprob,rev_ngram,back))
       else:
-        print(revprob,rev_ngram.encode("utf-8"),"-100000.0")
+        writer.write_ngram_line(n, "{} {} {}".format(revprob,rev_ngram,"-100000.0"))
     else: # highest order - no backoff weights
       if (n==2) and (rev_ngram[:3] == "<s>"): revprob = revprob + offset
-      print(revprob,rev_ngram.encode("utf-8"))
-print("\\end\\")
+      writer.write_ngram_line(n, "{} {}".format(revprob,rev_ngram))
+writer.close()